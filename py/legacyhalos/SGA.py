@@ -149,6 +149,7 @@ def mpi_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--nproc', default=1, type=int, help='number of multiprocessing processes per MPI rank.')
     parser.add_argument('--mpi', action='store_true', help='Use MPI parallelism')
+    parser.add_argument('--static-schedule', action='store_true', help='Divide the galaxies across MPI ranks ahead of time rather than dynamically.')
 
     parser.add_argument('--first', type=int, help='Index of first object to process.')
     parser.add_argument('--last', type=int, help='Index of last object to process.')
@@ -183,6 +184,15 @@ def mpi_args():
 
     parser.add_argument('--force', action='store_true', help='Use with --coadds; ignore previous pickle files.')
     parser.add_argument('--count', action='store_true', help='Count how many objects are left to analyze and then return.')
+    parser.add_argument('--prefetch', action='store_true', help='Use with --ellipse; stage the inputs of the next galaxy in node-local scratch in the background.')
+    parser.add_argument('--prefetch-maxgb', default=4.0, type=float, help='Maximum node-local scratch space used by --prefetch (GB).')
+    parser.add_argument('--concurrent-bands', action='store_true', help='Use with --ellipse; fit the isophotes and aperture photometry of all the bands together on the worker pool.')
+    parser.add_argument('--multires', action='store_true', help='Use with --ellipse; sample the outer isophotes from block-averaged images.')
+    parser.add_argument('--stats-engine', default='astropy', type=str, choices=['astropy', 'histogram', 'subsample'],
+                        help='Use with --ellipse; engine for the sigma-clipped image statistics (see legacyhalos.robust).')
+    parser.add_argument('--adaptive-sma', action='store_true', help='Use with --ellipse; integrate on an adaptive sma grid and stop each band at the noise.')
+    parser.add_argument('--sma-snrmin', default=1.0, type=float, help='Use with --adaptive-sma; minimum signal-to-noise ratio of an isophote.')
+    parser.add_argument('--sma-nlow', default=3, type=int, help='Use with --adaptive-sma; stop a band after this many consecutive isophotes below --sma-snrmin.')
     parser.add_argument('--debug', action='store_true', help='Log to STDOUT and build debugging plots.')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose output.')
     parser.add_argument('--clobber', action='store_true', help='Overwrite existing files.')                                
@@ -193,8 +203,9 @@ def mpi_args():
     return args
 
 def missing_files(args, sample, size=1, clobber_overwrite=None):
-    import multiprocessing
     from legacyhalos.io import _missing_files_one
+    from legacyhalos.pool import get_pool
+    from legacyhalos.statedb import missing_files as statedb_missing_files
 
     dependson = None
     if args.htmlplots is False and args.htmlindex is False:
@@ -264,7 +275,7 @@ def missing_files(args, sample, size=1, clobber_overwrite=None):
         ngal = len(sample)
     indices = np.arange(ngal)
 
-    pool = multiprocessing.Pool(args.nproc)
+    pool = get_pool(args.nproc)
     missargs = []
     #if args.htmlplots:
     #    for gal, gdir, ddir in zip(np.atleast_1d(galaxy), np.atleast_1d(galaxydir), np.atleast_1d(dependsondir)):
@@ -282,7 +293,9 @@ def missing_files(args, sample, size=1, clobber_overwrite=None):
     if args.verbose:
         t0 = time.time()
         print('Finding missing files...', end='')
-    todo = np.array(pool.map(_missing_files_one, missargs))
+    todo = statedb_missing_files(np.atleast_1d(galaxy), filesuffix, dependson=dependson, clobber=clobber)
+    if todo is None:
+        todo = np.array(pool.map(_missing_files_one, missargs))
     if args.verbose:
         print('...took {:.3f} min'.format((time.time() - t0)/60))
 
@@ -667,6 +680,18 @@ def _init_ellipse_SGA(clobber=False):
 
     return outfile, dropfile, refcat
 
+def _index_ellipse_SGA():
+    """Index the ellipse store (if configured; see legacyhalos.ellipsestore) once,
+    before the processes which gather the results of each galaxy are started,
+    so they inherit the index rather than each rebuilding it.
+
+    """
+    from legacyhalos.ellipsestore import ellipse_store_dir, get_store_index
+    storedir = ellipse_store_dir()
+    if storedir is not None:
+        index = get_store_index(storedir, refresh=True)
+        print('Indexed {} ellipse-fitting results in {}'.format(len(index), storedir))
+
 def _write_ellipse_SGA(cat, dropcat, outfile, dropfile, refcat,
                        exclude_full_sga=False, writekd=True):
     import shutil
@@ -817,7 +842,7 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', verbose=False):
     from astropy.table import Table, vstack, hstack, Column
     from astrometry.util.util import Tan
     from tractor.ellipses import EllipseE # EllipseESoft
-    from legacyhalos.io import read_ellipsefit, get_run
+    from legacyhalos.io import read_ellipsefit, ellipsefit_exists, get_run
     from legacyhalos.misc import is_in_ellipse
     #from legacyhalos.ellipse import SBTHRESH as sbcuts
 
@@ -1021,7 +1046,10 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', verbose=False):
 
     dropcat = []
     for igal, sga_id in enumerate(np.atleast_1d(fullsample['SGA_ID'])):
-        ellipsefile = os.path.join(galaxydir, '{}-largegalaxy-{}-ellipse.fits'.format(galaxy, sga_id))
+        # The ellipse-fitting results are in the ellipse store (see
+        # legacyhalos.ellipsestore), if configured, or in a file.
+        ellipsefit_done = ellipsefit_exists(galaxy, galaxydir, filesuffix='largegalaxy',
+                                            galaxy_id=str(sga_id))
 
         # Find this object in the Tractor catalog. 
         match = np.where((tractor['REF_CAT'] == refcat) * (tractor['REF_ID'] == sga_id))[0]
@@ -1040,7 +1068,7 @@ def build_ellipse_SGA_one(onegal, fullsample, refcat='L3', verbose=False):
             continue
 
         # An object can be missing an ellipsefit file for two reasons:
-        if not os.path.isfile(ellipsefile):
+        if not ellipsefit_done:
              # If the galaxy does not appear in the Tractor catalog, it was
              # dropped during fitting, which means that it's either spurious (or
              # there's a fitting bug) (or we're missing grz coverage, e.g.,
@@ -1257,16 +1285,21 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
     """
     import numpy.ma as ma
     from legacyhalos.mge import find_galaxy
-    from legacyhalos.misc import srcs2image, ellipse_mask
+    from legacyhalos.misc import (SourceModelCache, ellipse_mask_bbox, paint_ellipse,
+                                  ellipse_shrink_factor)
 
     bands, refband = data['bands'], data['refband']
     residual_mask = data['residual_mask']
 
+    # Render each Tractor source once per band and build the model images of
+    # every object except the central from the cache.
+    modelcache = SourceModelCache(tractor)
+
     nbox = 5
     box = np.arange(nbox)-nbox // 2
     #box = np.meshgrid(np.arange(nbox), np.arange(nbox))[0]-nbox//2
 
-    xobj, yobj = np.ogrid[0:data['refband_height'], 0:data['refband_width']]
+    shape = (data['refband_height'], data['refband_width'])
 
     # If the row-index of the central galaxy is not provided, use the source
     # nearest to the center of the field.
@@ -1288,35 +1321,30 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         # on-the-fly. Need to be smarter about Tractor sources of resolved
         # structure (i.e., sources that "belong" to the central).
         nocentral = np.delete(np.arange(len(tractor)), central)
-        srcs = tractor.copy()
-        srcs.cut(nocentral)
-        model_nocentral = srcs2image(srcs, data['{}_wcs'.format(refband)], band=refband.lower(),
-                                     pixelized_psf=data['{}_psf'.format(refband)])
+        model_nocentral = modelcache.model(data['{}_wcs'.format(refband)], band=refband.lower(),
+                                           pixelized_psf=data['{}_psf'.format(refband)],
+                                           indx=nocentral)
 
         # Mask all previous (brighter) central galaxies, if any.
         img, newmask = ma.getdata(data[refband]) - model_nocentral, ma.getmask(data[refband])
+        if ii > 0:
+            newmask = np.logical_or(newmask, np.zeros(shape, bool)) # writeable copy
         for jj in np.arange(ii):
             geo = data['mge'][jj] # the previous galaxy
 
-            # Do this step iteratively to capture the possibility where the
-            # previous galaxy has masked the central pixels of the *current*
-            # galaxy, in each iteration reducing the size of the mask.
-            for shrink in np.arange(0.1, 1.05, 0.05)[::-1]:
-                maxis = shrink * geo['majoraxis']
-                _mask = ellipse_mask(geo['xmed'], geo['ymed'], maxis, maxis * (1-geo['eps']),
-                                     np.radians(geo['theta']-90), xobj, yobj)
-                notok = False
-                for xb in box:
-                    for yb in box:
-                        if _mask[int(yb+tractor.by[central]), int(xb+tractor.bx[central])]:
-                            notok = True
-                            break
-                if notok:
-                #if _mask[int(tractor.by[central]), int(tractor.bx[central])]:
-                    print('The previous central has masked the current central with shrink factor {:.2f}'.format(shrink))
-                else:
-                    break
-            newmask = ma.mask_or(_mask, newmask)
+            # Shrink the mask of the previous galaxy in case it has masked the
+            # central pixels of the *current* galaxy, choosing the largest
+            # factor for which none of those pixels are masked.
+            xbox = np.array([int(yb+tractor.by[central]) for xb in box for yb in box])
+            ybox = np.array([int(xb+tractor.bx[central]) for xb in box for yb in box])
+            shrink, rejected = ellipse_shrink_factor(
+                geo['xmed'], geo['ymed'], geo['majoraxis'], geo['majoraxis'] * (1-geo['eps']),
+                np.radians(geo['theta']-90), xbox, ybox, np.arange(0.1, 1.05, 0.05))
+            for _shrink in rejected:
+                print('The previous central has masked the current central with shrink factor {:.2f}'.format(_shrink))
+            maxis = shrink * geo['majoraxis']
+            paint_ellipse(newmask, geo['xmed'], geo['ymed'], maxis, maxis * (1-geo['eps']),
+                          np.radians(geo['theta']-90))
 
         # Next, get the basic galaxy geometry and pack it into a dictionary. If
         # the object of interest has been masked by, e.g., an adjacent star
@@ -1356,7 +1384,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             maxis = 1.5 * tractor.shape_r[central] / filt2pixscale[refband] # [pixels]
             theta = (270 - pa) % 180
                 
-            fixmask = ellipse_mask(xmed, ymed, maxis, maxis*ba, np.radians(theta-90), xobj, yobj)
+            fixmask = ellipse_mask_bbox(xmed, ymed, maxis, maxis*ba, np.radians(theta-90), shape)
             newmask[fixmask] = ma.nomask
         
         #import matplotlib.pyplot as plt ; plt.clf()
@@ -1385,9 +1413,9 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             while (maxis > prevmaxis) and (iiter < maxiter):
                 #print(prevmaxis, maxis, iiter, maxiter)
                 print('  r={:.2f} pixels'.format(maxis))
-                fixmask = ellipse_mask(mgegalaxy.xmed, mgegalaxy.ymed,
-                                       maxis, maxis * (1-mgegalaxy.eps), 
-                                       np.radians(mgegalaxy.theta-90), xobj, yobj)
+                fixmask = ellipse_mask_bbox(mgegalaxy.xmed, mgegalaxy.ymed,
+                                            maxis, maxis * (1-mgegalaxy.eps), 
+                                            np.radians(mgegalaxy.theta-90), shape)
                 newmask[fixmask] = ma.nomask
                 mgegalaxy = find_galaxy(ma.masked_array(img/filt2pixscale[refband]**2, newmask), 
                                         nblob=1, binning=3, quiet=True, plot=False, level=minsb)
@@ -1419,9 +1447,9 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             mgegalaxy.theta = (270 - pa) % 180
             mgegalaxy.majoraxis = 2 * tractor.shape_r[central] / filt2pixscale[refband] # [pixels]
             print('  r={:.2f} pixels'.format(mgegalaxy.majoraxis))
-            fixmask = ellipse_mask(mgegalaxy.xmed, mgegalaxy.ymed,
-                                   mgegalaxy.majoraxis, mgegalaxy.majoraxis * (1-mgegalaxy.eps), 
-                                   np.radians(mgegalaxy.theta-90), xobj, yobj)
+            fixmask = ellipse_mask_bbox(mgegalaxy.xmed, mgegalaxy.ymed,
+                                        mgegalaxy.majoraxis, mgegalaxy.majoraxis * (1-mgegalaxy.eps), 
+                                        np.radians(mgegalaxy.theta-90), shape)
             newmask[fixmask] = ma.nomask
         else:
             largeshift = False
@@ -1467,9 +1495,9 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             majoraxis = 1.5 * factor * mgegalaxy.majoraxis # [pixels]
 
             # Grab the pixels belonging to this galaxy so we can unmask them below.
-            central_mask = ellipse_mask(mge['xmed'] * factor, mge['ymed'] * factor, 
-                                        majoraxis, majoraxis * (1-mgegalaxy.eps), 
-                                        np.radians(mgegalaxy.theta-90), xobj, yobj)
+            central_mask = ellipse_mask_bbox(mge['xmed'] * factor, mge['ymed'] * factor, 
+                                             majoraxis, majoraxis * (1-mgegalaxy.eps), 
+                                             np.radians(mgegalaxy.theta-90), shape)
             if np.sum(central_mask) == 0:
                 print('No pixels belong to the central galaxy---this is bad!')
                 data['failed'] = True
@@ -1487,10 +1515,9 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             #pdb.set_trace()
 
             # Need to be smarter about the srcs list...
-            srcs = tractor.copy()
-            srcs.cut(nocentral)
-            model_nocentral = srcs2image(srcs, data['{}_wcs'.format(refband)], band=filt.lower(),
-                                         pixelized_psf=data['{}_psf'.format(refband)])
+            model_nocentral = modelcache.model(data['{}_wcs'.format(refband)], band=filt.lower(),
+                                               pixelized_psf=data['{}_psf'.format(refband)],
+                                               indx=nocentral)
 
             # Convert to surface brightness and 32-bit precision.
             img = (ma.getdata(data[filt]) - model_nocentral) / thispixscale**2 # [nanomaggies/arcsec**2]
@@ -1517,7 +1544,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
 
 def read_multiband(galaxy, galaxydir, filesuffix='largegalaxy', refband='r', 
                    bands=['g', 'r', 'z'], pixscale=0.262, fill_value=0.0,
-                   verbose=False):
+                   stats_engine='astropy', verbose=False):
     """Read the multi-band images (converted to surface brightness) and create a
     masked array suitable for ellipse-fitting.
 
@@ -1609,7 +1636,8 @@ def read_multiband(galaxy, galaxydir, filesuffix='largegalaxy', refband='r',
 
     # Read the basic imaging data and masks.
     data = _read_image_data(data, filt2imfile, starmask=starmask,
-                            fill_value=fill_value, verbose=verbose)
+                            fill_value=fill_value, stats_engine=stats_engine,
+                            verbose=verbose)
 
     # Figure out which galaxies we are going to ellipse-fit by iterating on all
     # the SGA sources in the field and gather the data we need.
@@ -1737,17 +1765,34 @@ def read_multiband(galaxy, galaxydir, filesuffix='largegalaxy', refband='r',
 
 def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                  filesuffix='largegalaxy', bands=['g', 'r', 'z'], refband='r',
-                 unwise=False, verbose=False, debug=False, logfile=None):
+                 unwise=False, verbose=False, debug=False, logfile=None,
+                 inputdir=None,
+                 concurrent_bands=False, multires=False, adaptive_sma=False,
+                 sma_snrmin=1.0, sma_nlow=3, stats_engine='astropy'):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the SGA project.
 
+    inputdir - read the input files from this directory (e.g., staged by
+      legacyhalos.prefetch) instead of galaxydir
+    concurrent_bands - fit all the bands together on the worker pool (see
+      legacyhalos.mpi.call_ellipse)
+    multires - sample the outer isophotes from block-averaged images (see
+      legacyhalos.mpi.call_ellipse)
+    adaptive_sma, sma_snrmin, sma_nlow - integrate on an adaptive sma grid and
+      stop each band at the noise (see legacyhalos.mpi.call_ellipse)
+    stats_engine - engine for the sigma-clipped statistics of the images (see
+      legacyhalos.robust.clipped_stats)
+
     """
     from legacyhalos.mpi import call_ellipse as mpi_call_ellipse
 
-    data, galaxyinfo = read_multiband(galaxy, galaxydir, bands=bands,
+    if inputdir is None:
+        inputdir = galaxydir
+
+    data, galaxyinfo = read_multiband(galaxy, inputdir, bands=bands,
                                       filesuffix=filesuffix,
                                       refband=refband, pixscale=pixscale,
-                                      verbose=verbose)
+                                      stats_engine=stats_engine, verbose=verbose)
 
     maxis = data['mge'][igal]['majoraxis'] # [pixels]        
 
@@ -1767,7 +1812,9 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                      pixscale=pixscale, nproc=nproc,
                      logsma=False, delta_sma=delta_sma, maxsma=maxsma,
                      bands=bands, refband=refband, sbthresh=SBTHRESH,
-                     verbose=verbose, debug=debug, logfile=logfile)
+                     concurrent_bands=concurrent_bands, multires=multires,
+                     adaptive_sma=adaptive_sma, sma_snrmin=sma_snrmin,
+                     sma_nlow=sma_nlow, verbose=verbose, debug=debug, logfile=logfile)
 
 def _get_mags(cat, rad='10', kpc=False, pipeline=False, cog=False, R24=False, R25=False, R26=False):
     res = []
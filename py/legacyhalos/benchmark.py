@@ -0,0 +1,253 @@
+"""
+legacyhalos.benchmark
+=====================
+
+Offline benchmarks of the main pipeline stages on synthetic galaxies (see
+legacyhalos.mock), so changes to the performance of the code can be measured
+without any survey data.
+
+For each image size, run_benchmarks times (wall-clock and CPU time, best and
+median of nrepeat calls)--
+
+  find_galaxy - mge.find_galaxy on the reference-band image
+  build_mask - SGA._build_multiband_mask (requires tractor / astrometry.net)
+  ellipsefit - ellipse.ellipsefit_multiband (isophotes plus curve of growth)
+  ellipse_cog - ellipse.ellipse_cog alone
+  write_ellipsefit, read_ellipsefit - io.write_ellipsefit / io.read_ellipsefit
+  integrate - integrate.integrate_one
+  stats_{astropy,histogram,subsample} - robust.clipped_stats of the smoothed
+    reference-band image with each engine, plus the error of the median and
+    standard deviation relative to the astropy engine [in units of the standard
+    deviation]
+
+and returns (or writes) a JSON-serializable dictionary, which compare_benchmarks
+can diff against a previous run. Benchmarks whose dependencies are not
+installed are recorded with status='skipped' rather than failing the run.
+
+"""
+import os, sys, time, json, platform, pdb
+import numpy as np
+
+BENCHMARKS = ('find_galaxy', 'build_mask', 'ellipsefit', 'ellipse_cog',
+              'write_ellipsefit', 'read_ellipsefit', 'integrate',
+              'stats_astropy', 'stats_histogram', 'stats_subsample')
+DEFAULT_SIZES = (128, 256, 512)
+
+def _quiet(func, quiet=True):
+    """Silence the (many) print statements in the pipeline while timing."""
+    if not quiet:
+        return func()
+    from contextlib import redirect_stdout
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        return func()
+
+def timeit(func, nrepeat=3, quiet=True):
+    """Call func() nrepeat times and return the timing statistics and the output
+    of the last call.
+
+    """
+    wall, cpu = [], []
+    for _ in range(nrepeat):
+        t0, c0 = time.perf_counter(), time.process_time()
+        out = _quiet(func, quiet=quiet)
+        wall.append(time.perf_counter() - t0)
+        cpu.append(time.process_time() - c0)
+    timing = {'wall_min': float(np.min(wall)), 'wall_median': float(np.median(wall)),
+              'cpu_min': float(np.min(cpu)), 'cpu_median': float(np.median(cpu)),
+              'wall': wall, 'cpu': cpu}
+    return timing, out
+
+def _metadata(nproc):
+    import socket
+    import scipy, astropy
+    meta = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': socket.gethostname(),
+            'platform': platform.platform(), 'python': platform.python_version(),
+            'ncpu': os.cpu_count(), 'nproc': nproc,
+            'numpy': np.__version__, 'scipy': scipy.__version__,
+            'astropy': astropy.__version__}
+    try:
+        import photutils
+        meta['photutils'] = photutils.__version__
+    except ImportError:
+        pass
+    return meta
+
+def benchmark_size(size, nrepeat=3, nproc=1, seed=1, benchmarks=BENCHMARKS,
+                   quiet=True, verbose=False):
+    """Run the benchmarks on one synthetic galaxy of a given size [pixels].
+
+    Returns a list of dictionaries, one per benchmark.
+
+    """
+    import tempfile
+    import legacyhalos.io
+    from legacyhalos.mock import simulate_galaxy, mock_tractor_catalog
+    from legacyhalos.mge import find_galaxy
+    from legacyhalos.ellipse import ellipsefit_multiband, ellipse_cog
+    from legacyhalos.integrate import integrate_one
+
+    galaxy = 'MOCK-{}'.format(size)
+    data, src, truth = simulate_galaxy(size=size, seed=seed)
+    bands, refband = data['bands'], data['refband']
+    galaxyinfo = {'redshift': (truth['redshift'], '')}
+
+    tmpdir = tempfile.TemporaryDirectory(prefix='legacyhalos-benchmark-')
+    galaxydir = tmpdir.name
+
+    results, state = [], {}
+
+    def _find_galaxy():
+        return find_galaxy(truth['{}_image'.format(refband)], nblob=1, binning=1, quiet=True)
+
+    def _build_mask():
+        from legacyhalos.SGA import _build_multiband_mask
+        maskdata, tractor, filt2pixscale = mock_tractor_catalog(src, truth, bands=bands, refband=refband)
+        return _build_multiband_mask(maskdata, tractor, filt2pixscale)
+
+    def _ellipsefit():
+        return ellipsefit_multiband(galaxy, galaxydir, data, nproc=nproc, nowrite=True)
+
+    def _ellipse_cog():
+        from legacyhalos.pool import get_pool
+        return ellipse_cog(bands, data, state['ellipsefit'], 1.0, data['refpixscale'],
+                           pool=get_pool(nproc))
+
+    def _write_ellipsefit():
+        ellipsefit = state['ellipsefit'].copy()
+        ellipsefit.setdefault('input_ellipse', False)
+        legacyhalos.io.write_ellipsefit(galaxy, galaxydir, ellipsefit, galaxyinfo=galaxyinfo,
+                                        refband=refband)
+
+    def _read_ellipsefit():
+        return legacyhalos.io.read_ellipsefit(galaxy, galaxydir, verbose=False)
+
+    def _integrate():
+        return integrate_one(galaxy, galaxydir)
+
+    def _smoothed():
+        # Smoothed image, as in io._read_image_data.
+        if 'smoothed' not in state:
+            from scipy.ndimage import gaussian_filter
+            state['smoothed'] = gaussian_filter(truth['{}_image'.format(refband)], 2.0).astype('f4')
+        return state['smoothed']
+
+    def _stats(engine):
+        from legacyhalos.robust import clipped_stats
+        return lambda: clipped_stats(_smoothed(), sigma=3.0, engine=engine)
+
+    funcs = {'find_galaxy': _find_galaxy, 'build_mask': _build_mask,
+             'ellipsefit': _ellipsefit, 'ellipse_cog': _ellipse_cog,
+             'write_ellipsefit': _write_ellipsefit, 'read_ellipsefit': _read_ellipsefit,
+             'integrate': _integrate, 'stats_astropy': _stats('astropy'),
+             'stats_histogram': _stats('histogram'), 'stats_subsample': _stats('subsample')}
+
+    # Some benchmarks depend on the output of earlier ones.
+    requires = {'ellipse_cog': 'ellipsefit', 'write_ellipsefit': 'ellipsefit',
+                'read_ellipsefit': 'write_ellipsefit', 'integrate': 'write_ellipsefit'}
+    if 'ellipsefit' not in benchmarks and any(requires.get(bb) == 'ellipsefit' for bb in benchmarks):
+        benchmarks = ['ellipsefit'] + list(benchmarks)
+    if 'write_ellipsefit' not in benchmarks and any(requires.get(bb) == 'write_ellipsefit' for bb in benchmarks):
+        benchmarks = list(benchmarks) + ['write_ellipsefit']
+    benchmarks = [bb for bb in BENCHMARKS if bb in benchmarks]
+
+    status = {}
+    for name in benchmarks:
+        result = {'benchmark': name, 'size': size, 'nrepeat': nrepeat, 'nproc': nproc}
+        if name in requires and status.get(requires[name]) != 'ok':
+            result.update({'status': 'skipped', 'reason': 'requires {}'.format(requires[name])})
+        else:
+            try:
+                timing, out = timeit(funcs[name], nrepeat=nrepeat, quiet=quiet)
+                result.update(timing)
+                result['status'] = 'ok'
+                if name == 'ellipsefit':
+                    state['ellipsefit'] = out
+                    result['nsma'] = len(out.get('{}_sma'.format(refband), []))
+                if name.startswith('stats_'):
+                    from legacyhalos.robust import clipped_stats
+                    if 'stats' not in state:
+                        state['stats'] = clipped_stats(_smoothed(), sigma=3.0, engine='astropy')
+                    _, refmedian, refsigma = state['stats']
+                    result['median_error'] = float((out[1] - refmedian) / refsigma)
+                    result['sigma_error'] = float((out[2] - refsigma) / refsigma)
+            except ImportError as err:
+                result.update({'status': 'skipped', 'reason': str(err)})
+            except Exception as err:
+                result.update({'status': 'failed', 'reason': '{}: {}'.format(type(err).__name__, err)})
+        status[name] = result['status']
+        if verbose:
+            if result['status'] == 'ok':
+                print('  {:<18s} {:5d} pix: {:8.3f} sec (wall) {:8.3f} sec (cpu)'.format(
+                    name, size, result['wall_median'], result['cpu_median']), end='')
+                if 'median_error' in result:
+                    print(' error {:.2g} (median) {:.2g} (sigma)'.format(
+                        result['median_error'], result['sigma_error']), end='')
+                print()
+            else:
+                print('  {:<18s} {:5d} pix: {} ({})'.format(name, size, result['status'], result['reason']))
+        results.append(result)
+
+    tmpdir.cleanup()
+    return results
+
+def run_benchmarks(sizes=DEFAULT_SIZES, nrepeat=3, nproc=1, seed=1, benchmarks=BENCHMARKS,
+                   outfile=None, quiet=True, verbose=True):
+    """Run the benchmarks on synthetic galaxies of each size and optionally
+    write the results to a JSON file.
+
+    """
+    from legacyhalos.pool import close_pool
+
+    out = {'meta': _metadata(nproc), 'results': []}
+    out['meta'].update({'sizes': [int(size) for size in sizes], 'seed': seed})
+    try:
+        for size in sizes:
+            if verbose:
+                print('Benchmarking a {}x{} galaxy.'.format(size, size))
+            out['results'] += benchmark_size(int(size), nrepeat=nrepeat, nproc=nproc, seed=seed,
+                                             benchmarks=benchmarks, quiet=quiet, verbose=verbose)
+    finally:
+        close_pool()
+
+    if outfile is not None:
+        with open(outfile, 'w') as F:
+            json.dump(out, F, indent=1)
+        if verbose:
+            print('Wrote {}'.format(outfile))
+    return out
+
+def read_benchmarks(benchfile):
+    with open(benchfile, 'r') as F:
+        return json.load(F)
+
+def compare_benchmarks(new, old, key='wall_median', threshold=0.1, verbose=True):
+    """Compare two sets of benchmarks (dictionaries or JSON files).
+
+    Returns a list of (benchmark, size, old, new, ratio) tuples; ratio>1+threshold
+    is flagged as a regression (and ratio<1-threshold as an improvement).
+
+    """
+    if type(new) is str:
+        new = read_benchmarks(new)
+    if type(old) is str:
+        old = read_benchmarks(old)
+
+    oldresults = {(rr['benchmark'], rr['size']): rr for rr in old['results'] if rr['status'] == 'ok'}
+    out = []
+    for rr in new['results']:
+        thiskey = (rr['benchmark'], rr['size'])
+        if rr['status'] != 'ok' or thiskey not in oldresults:
+            continue
+        oldval, newval = oldresults[thiskey][key], rr[key]
+        ratio = newval / oldval if oldval > 0 else np.inf
+        out.append((rr['benchmark'], rr['size'], oldval, newval, ratio))
+        if verbose:
+            if ratio > 1 + threshold:
+                flag = 'SLOWER'
+            elif ratio < 1 - threshold:
+                flag = 'faster'
+            else:
+                flag = ''
+            print('{:<18s} {:5d} pix: {:8.3f} --> {:8.3f} sec ({:5.2f}x) {}'.format(
+                rr['benchmark'], rr['size'], oldval, newval, ratio, flag))
+    return out
@@ -0,0 +1,135 @@
+"""
+legacyhalos.checkpoint
+======================
+
+Fine-grained checkpoints for ellipse fitting, so a job killed partway through a
+large galaxy (e.g., by the wall-clock limit of the queue) resumes from the last
+finished unit of work rather than from scratch.
+
+ellipse.ellipsefit_multiband saves one checkpoint per band and stage--the
+isophotes ('isophotes-{band}') and the curve of growth ('cog-{band}')--to the
+{galaxy}-{filesuffix}-ellipse-checkpoint directory next to the output file, and
+removes the directory once the galaxy is finished. Each unit is an .npz file,
+written atomically, together with the state of the random number generator
+after that unit, so the resumed results are identical to those of an
+uninterrupted run.
+
+The checkpoints are only reused if the signature of the fit (the geometry, the
+sma grid, the fitting options and a checksum of the input images) has not
+changed; otherwise they are discarded.
+
+Checkpointing is enabled with checkpoint=True or by setting
+${LEGACYHALOS_CHECKPOINT}=1.
+
+"""
+import os, json, shutil, zlib, pdb
+import numpy as np
+import numpy.ma as ma
+
+def checkpoint_enabled():
+    """Whether ${LEGACYHALOS_CHECKPOINT} turns on checkpointing."""
+    return os.getenv('LEGACYHALOS_CHECKPOINT', '').strip().lower() in ('1', 'true', 'yes')
+
+def image_checksum(img):
+    """Cheap checksum of a (masked) image, to detect changed inputs."""
+    crc = zlib.crc32(np.ascontiguousarray(ma.getdata(img)).view(np.uint8))
+    mask = ma.getmask(img)
+    if mask is not ma.nomask:
+        crc = zlib.crc32(np.ascontiguousarray(mask).view(np.uint8), crc)
+    return crc
+
+def _jsonify(obj):
+    if isinstance(obj, dict):
+        return {str(key): _jsonify(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        return [_jsonify(val) for val in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+class EllipseCheckpoint(object):
+    """Checkpoints of the ellipse-fitting of one galaxy.
+
+    signature - JSON-serializable dictionary which identifies the fit; existing
+      checkpoints with a different signature are discarded
+    clobber - discard any existing checkpoints
+
+    """
+    def __init__(self, galaxy, galaxydir, signature, filesuffix='', galaxy_id='',
+                 clobber=False):
+        if type(galaxy_id) is not str:
+            galaxy_id = str(galaxy_id)
+        galid = '' if galaxy_id.strip() == '' else '-{}'.format(galaxy_id)
+        fsuff = '' if filesuffix.strip() == '' else '-{}'.format(filesuffix)
+        self.checkpointdir = os.path.join(galaxydir, '{}{}{}-ellipse-checkpoint'.format(
+            galaxy, fsuff, galid))
+        self.signature = _jsonify(signature)
+
+        sigfile = os.path.join(self.checkpointdir, 'signature.json')
+        if os.path.isdir(self.checkpointdir):
+            oldsignature = None
+            if os.path.isfile(sigfile):
+                try:
+                    with open(sigfile, 'r') as F:
+                        oldsignature = json.load(F)
+                except ValueError:
+                    pass
+            if clobber or oldsignature != self.signature:
+                if oldsignature is not None:
+                    print('Discarding stale ellipse-fitting checkpoints in {}'.format(self.checkpointdir))
+                shutil.rmtree(self.checkpointdir, ignore_errors=True)
+
+        if not os.path.isdir(self.checkpointdir):
+            os.makedirs(self.checkpointdir, exist_ok=True)
+            self._write_atomic(sigfile, lambda F: F.write(json.dumps(self.signature).encode()))
+
+    def _unitfile(self, unit):
+        return os.path.join(self.checkpointdir, '{}.npz'.format(unit))
+
+    @staticmethod
+    def _write_atomic(outfile, write):
+        tmpfile = '{}.tmp-{}'.format(outfile, os.getpid())
+        with open(tmpfile, 'wb') as F:
+            write(F)
+        os.replace(tmpfile, outfile)
+
+    def has(self, unit):
+        return os.path.isfile(self._unitfile(unit))
+
+    def save(self, unit, results, rand=None):
+        """Save a dictionary of numpy arrays and scalars (and, optionally, the
+        state of a RandomState object) as one unit of work.
+
+        """
+        out = {'value_{}'.format(key): np.asarray(val) for key, val in results.items()}
+        if rand is not None:
+            _, keys, pos, has_gauss, cached_gaussian = rand.get_state()
+            out.update({'rand_keys': keys, 'rand_pos': pos, 'rand_has_gauss': has_gauss,
+                        'rand_cached_gaussian': cached_gaussian})
+        self._write_atomic(self._unitfile(unit), lambda F: np.savez(F, **out))
+
+    def load(self, unit, rand=None):
+        """Load one unit of work, or return None if it has not been saved (or
+        cannot be read). Restores the state of rand, if given.
+
+        """
+        unitfile = self._unitfile(unit)
+        if not os.path.isfile(unitfile):
+            return None
+        try:
+            with np.load(unitfile, allow_pickle=False) as npz:
+                results = {key[6:]: npz[key][()] if npz[key].ndim == 0 else npz[key]
+                           for key in npz.files if key.startswith('value_')}
+                if rand is not None:
+                    if 'rand_keys' not in npz.files:
+                        return None
+                    rand.set_state(('MT19937', npz['rand_keys'], int(npz['rand_pos']),
+                                    int(npz['rand_has_gauss']), float(npz['rand_cached_gaussian'])))
+        except Exception as err:
+            print('Ignoring unreadable checkpoint {}: {}'.format(unitfile, err))
+            return None
+        return results
+
+    def clear(self):
+        """Remove the checkpoints once the galaxy is finished."""
+        shutil.rmtree(self.checkpointdir, ignore_errors=True)
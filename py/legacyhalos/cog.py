@@ -0,0 +1,391 @@
+"""
+legacyhalos.cog
+===============
+
+Fast curve-of-growth (elliptical aperture photometry) measurements.
+
+Rather than re-integrating the image inside every aperture (as in
+ellipse.apphot_one), here we compute the elliptical radius of every pixel once,
+accumulate the pixels which are fully enclosed by each aperture with a single
+cumulative sum, and compute the exact fractional overlap (equivalent to
+photutils' method='exact') only for the pixels straddling each aperture
+boundary.
+
+"""
+import pdb
+import numpy as np
+
+from legacyhalos.geometry import _elliptical_radius, half_pixel
+
+def _sector_area(ux, uy, vx, vy):
+    """Signed area of the sector of the unit circle between vectors u and v."""
+    return 0.5 * np.arctan2(ux * vy - uy * vx, ux * vx + uy * vy)
+
+def _segment_area_unit_circle(ax, ay, bx, by):
+    """Signed area of the intersection of the triangle (origin, a, b) with the unit
+    circle. All inputs are arrays.
+
+    """
+    dx, dy = bx - ax, by - ay
+    dd = dx * dx + dy * dy
+    ad = ax * dx + ay * dy
+    disc = ad * ad - dd * (ax * ax + ay * ay - 1)
+
+    # Where the (infinite) line intersects the circle, clip the two crossing
+    # points to the segment; otherwise the segment is entirely outside.
+    cross = disc > 0
+    sq = np.sqrt(np.where(cross, disc, 0.0))
+    t1 = np.where(cross, np.clip((-ad - sq) / dd, 0, 1), 0.0)
+    t2 = np.where(cross, np.clip((-ad + sq) / dd, 0, 1), 0.0)
+
+    px, py = ax + t1 * dx, ay + t1 * dy
+    qx, qy = ax + t2 * dx, ay + t2 * dy
+
+    # outside (sector) + inside (triangle) + outside (sector)
+    area = (_sector_area(ax, ay, px, py) + 0.5 * (px * qy - py * qx) +
+            _sector_area(qx, qy, bx, by))
+    return area
+
+def pixel_overlap(dx, dy, aa, bb, theta):
+    """Exact fractional overlap between unit pixels and an ellipse.
+
+    dx, dy - pixel center minus the ellipse center [pixels]
+    aa, bb - semi-major and semi-minor axes [pixels]
+    theta - position angle of the semi-major axis, counter-clockwise from the
+      x-axis [radians]
+
+    The pixel is transformed into the frame where the ellipse is the unit circle
+    and the area of the resulting parallelogram inside the circle is summed over
+    its four edges.
+
+    """
+    cost, sint = np.cos(theta), np.sin(theta)
+    uu, vv = [], []
+    for cx, cy in ((-0.5, -0.5), (0.5, -0.5), (0.5, 0.5), (-0.5, 0.5)):
+        xx, yy = dx + cx, dy + cy
+        uu.append((xx * cost + yy * sint) / aa)
+        vv.append((-xx * sint + yy * cost) / bb)
+
+    area = np.zeros(np.broadcast(dx, dy, aa, bb).shape)
+    for ii in range(4):
+        jj = (ii + 1) % 4
+        area += _segment_area_unit_circle(uu[ii], vv[ii], uu[jj], vv[jj])
+
+    return np.clip(np.abs(area) * aa * bb, 0.0, 1.0)
+
+def nested_apphot(img, mask, theta, x0, y0, sma, ba, pixscale, var=None,
+                  chunksize=2**20, grid=None):
+    """Elliptical aperture photometry in a set of nested apertures in a single
+    pass through the image.
+
+    img - image [nanomaggies/arcsec2]
+    mask - Boolean mask (True-->masked) or None
+    theta - position angle [radians]; see pixel_overlap
+    x0, y0 - center of the apertures (x is the column index) [pixels]
+    sma - semi-major axis of each aperture, in increasing order [pixels]
+    ba - minor-to-major axis ratio of the apertures
+    var - optional variance image [nanomaggies**2/arcsec**4]
+    chunksize - maximum number of (pixel, aperture) pairs along the aperture
+      boundaries to process at once
+    grid - optional geometry.EllipticalGrid of this image and geometry, whose
+      (cached) radius map, pixel order, and aperture-boundary overlaps are used
+      instead of recomputing them, e.g., for every band of a galaxy
+
+    Returns the flux [nanomaggies] in each aperture and, if var is not None,
+    its uncertainty, matching ellipse.apphot_one (which remains the reference
+    implementation). Masked and non-finite pixels contribute zero.
+
+    """
+    sma = np.atleast_1d(np.asarray(sma, dtype='f8'))
+    nsma = len(sma)
+    if nsma == 0:
+        return np.array([]), (None if var is None else np.array([]))
+    assert(np.all(np.diff(sma) > 0))
+
+    img = np.asarray(img)
+    if mask is None or mask is np.ma.nomask:
+        good = np.ones(img.shape, bool)
+    else:
+        good = ~np.asarray(mask, bool)
+
+    # Largest elliptical radius of any point in a pixel relative to its center.
+    halfpix = half_pixel(theta, ba)
+
+    if grid is not None:
+        assert(grid.matches(img.shape, x0, y0, theta, ba))
+        return _nested_apphot_grid(grid, img, good, sma, halfpix, pixscale,
+                                   var=var, chunksize=chunksize)
+
+    # Only keep the pixels which can overlap the largest aperture.
+    yy, xx = np.nonzero(good)
+    dx, dy = xx - x0, yy - y0
+    rad = _elliptical_radius(dx, dy, theta, ba)
+    keep = (rad - halfpix) < sma[-1]
+    yy, xx, dx, dy, rad = yy[keep], xx[keep], dx[keep], dy[keep], rad[keep]
+
+    flux = img[yy, xx].astype('f8')
+    flux[~np.isfinite(flux)] = 0.0
+    if var is not None:
+        fvar = np.asarray(var)[yy, xx].astype('f8')
+        fvar[~np.isfinite(fvar)] = 0.0
+
+    # Pixels with rad+halfpix <= sma are entirely within the aperture.
+    rout = rad + halfpix
+    srt = np.argsort(rout, kind='stable')
+    ninside = np.searchsorted(rout[srt], sma, side='right')
+    cogflux = np.hstack((0.0, np.cumsum(flux[srt])))[ninside]
+    if var is not None:
+        cogvar = np.hstack((0.0, np.cumsum(fvar[srt])))[ninside]
+
+    # The remaining pixels straddle the boundary of a contiguous range of
+    # apertures.
+    ipix, ksma = boundary_pairs(rad, halfpix, sma)
+    for start in range(0, len(ipix), chunksize):
+        _ipix = ipix[start:start+chunksize]
+        _ksma = ksma[start:start+chunksize]
+        aa = sma[_ksma]
+        frac = pixel_overlap(dx[_ipix], dy[_ipix], aa, aa * ba, theta)
+        cogflux += np.bincount(_ksma, weights=frac * flux[_ipix], minlength=nsma)
+        if var is not None:
+            cogvar += np.bincount(_ksma, weights=frac * fvar[_ipix], minlength=nsma)
+
+    return _cog_units(cogflux, None if var is None else cogvar, pixscale)
+
+def boundary_pairs(rad, halfpix, sma):
+    """Pairs of (pixel, aperture) indices for the pixels with
+    rad-halfpix < sma < rad+halfpix, i.e., which straddle the boundary of an
+    aperture, ordered by pixel and then by aperture.
+
+    """
+    klo = np.searchsorted(sma, rad - halfpix, side='right')
+    khi = np.searchsorted(sma, rad + halfpix, side='left')
+    npair = np.clip(khi - klo, 0, None)
+    ipix = np.repeat(np.arange(len(rad)), npair)
+    offset = np.arange(len(ipix)) - np.repeat(np.cumsum(npair) - npair, npair)
+    ksma = np.repeat(klo, npair) + offset
+    return ipix, ksma
+
+def _cog_units(cogflux, cogvar, pixscale):
+    cogflux = cogflux * pixscale**2 # [nanomaggies]
+    if cogvar is None:
+        cogferr = None
+    else:
+        with np.errstate(invalid='ignore'):
+            cogferr = np.sqrt(cogvar) * pixscale**2 # [nanomaggies]
+    return cogflux, cogferr
+
+def _nested_apphot_grid(grid, img, good, sma, halfpix, pixscale, var=None,
+                        chunksize=2**20):
+    """nested_apphot using the radius map, pixel order, and boundary overlaps
+    cached in an EllipticalGrid. Only the unmasked pixels are picked out of the
+    cached (ordered) arrays, so the sums are accumulated in exactly the same
+    order as in nested_apphot and the results are identical.
+
+    """
+    nsma = len(sma)
+
+    flat = img.ravel().astype('f8')
+    flat[~np.isfinite(flat)] = 0.0
+    if var is not None:
+        fvarflat = np.asarray(var).ravel().astype('f8')
+        fvarflat[~np.isfinite(fvarflat)] = 0.0
+
+    kept = good.ravel() * ((grid.radius.ravel() - halfpix) < sma[-1])
+    order = grid.order[kept[grid.order]]
+    ninside = np.searchsorted(grid.radius.ravel()[order] + halfpix, sma, side='right')
+    cogflux = np.hstack((0.0, np.cumsum(flat[order])))[ninside]
+    if var is not None:
+        cogvar = np.hstack((0.0, np.cumsum(fvarflat[order])))[ninside]
+
+    pix, ksma, frac = grid.boundary_overlaps(sma)
+    use = good.ravel()[pix]
+    pix, ksma, frac = pix[use], ksma[use], frac[use]
+    for start in range(0, len(pix), chunksize):
+        _pix = pix[start:start+chunksize]
+        _ksma = ksma[start:start+chunksize]
+        _frac = frac[start:start+chunksize]
+        cogflux += np.bincount(_ksma, weights=_frac * flat[_pix], minlength=nsma)
+        if var is not None:
+            cogvar += np.bincount(_ksma, weights=_frac * fvarflat[_pix], minlength=nsma)
+
+    return _cog_units(cogflux, None if var is None else cogvar, pixscale)
+
+def _nested_apphot_shared(args):
+    """Wrapper function for the multiprocessing."""
+    return nested_apphot_shared(*args)
+
+def nested_apphot_shared(shared, sharedvar, theta, x0, y0, sma, ba, pixscale):
+    """Call nested_apphot on a (masked) image and variance image published to the
+    worker processes (see legacyhalos.isophote.publish_image).
+
+    """
+    import numpy.ma as ma
+    from legacyhalos.isophote import attach_image
+
+    img = attach_image(shared)
+    var = None if sharedvar is None else attach_image(sharedvar)
+    with np.errstate(all='ignore'):
+        return nested_apphot(ma.getdata(img), ma.getmask(img), theta, x0, y0,
+                             sma, ba, pixscale, var=var)
+
+def nested_apphot_multiband(pool, imgs, variances, theta, x0, y0, sma, ba, pixscale,
+                            scratchdir=None):
+    """Measure the curve of growth of several images (e.g., bands) concurrently on
+    the worker pool, one task per image.
+
+    imgs - dictionary of masked images, keyed by band
+    variances - dictionary of variance images (or None), with the same keys
+    sma - dictionary of semi-major axes with the same keys
+
+    Returns a dictionary of (cogflux, cogferr) tuples identical to the output of
+    nested_apphot.
+
+    """
+    from legacyhalos.isophote import publish_image, release_image
+
+    keys = list(imgs.keys())
+    shared = []
+    try:
+        for key in keys:
+            shared.append(publish_image(imgs[key], scratchdir=scratchdir))
+            if variances[key] is None:
+                shared.append(None)
+            else:
+                shared.append(publish_image(variances[key], scratchdir=scratchdir))
+        cogphot = pool.map(_nested_apphot_shared, [(
+            shared[2*ii], shared[2*ii+1], theta, x0, y0, sma[key], ba, pixscale)
+            for ii, key in enumerate(keys)])
+    finally:
+        for one in shared:
+            release_image(one)
+
+    return dict(zip(keys, cogphot))
+
+def cog_model(radius, params, r0=10.0):
+    """Evaluate the curve-of-growth model (see ellipse.CogModel),
+
+      m(r) = mtot + m0 * (1 - exp(-alpha1 * (r/r0)**(-alpha2)))
+
+    for one or more sets of parameters.
+
+    radius - [arcsec]
+    params - array of (mtot, m0, alpha1, alpha2), optionally with shape [nstart, 4]
+
+    Returns an array of shape [nstart, len(radius)] (or [len(radius)] for a single
+    set of parameters).
+
+    """
+    params = np.asarray(params, 'f8')
+    mtot, m0, alpha1, alpha2 = [params[..., ii, np.newaxis] for ii in range(4)]
+    uu = (np.asarray(radius, 'f8') / r0)**(-alpha2)
+    return mtot + m0 * (1 - np.exp(-alpha1 * uu))
+
+def cog_jacobian(radius, params, r0=10.0):
+    """Analytic derivatives of cog_model with respect to (mtot, m0, alpha1,
+    alpha2), with shape [nstart, len(radius), 4].
+
+    """
+    params = np.atleast_2d(np.asarray(params, 'f8'))
+    m0, alpha1, alpha2 = [params[:, ii, np.newaxis] for ii in range(1, 4)]
+    logr = np.log(np.asarray(radius, 'f8') / r0)
+    uu = np.exp(-alpha2 * logr)
+    ee = np.exp(-alpha1 * uu)
+
+    jac = np.empty(params.shape[:1] + logr.shape + (4,))
+    jac[..., 0] = 1.0
+    jac[..., 1] = 1 - ee
+    jac[..., 2] = m0 * ee * uu
+    jac[..., 3] = -m0 * alpha1 * ee * uu * logr
+    return jac
+
+def fit_cog(radius, mag, weights, params0, bounds=None, r0=10.0, maxiter=100,
+            ftol=1.49012e-08, xtol=1.49012e-08):
+    """Fit the curve-of-growth model from several starting points at once with a
+    vectorized Levenberg-Marquardt optimizer and analytic derivatives.
+
+    Every starting point is iterated in lock-step (each with its own damping
+    parameter) until its fractional change in chi2 or in the parameters drops
+    below ftol or xtol, or after maxiter iterations. A starting point whose
+    damping grows beyond 1e10 (i.e., no step reduces chi2) is abandoned as a
+    failed fit, like the minpack errors of astropy's LevMarLSQFitter. As with
+    LevMarLSQFitter, the parameters are clipped to their bounds after every
+    step.
+
+    radius, mag - curve of growth [arcsec, mag]
+    weights - inverse uncertainty of mag
+    params0 - starting parameters with shape [nstart, 4]
+    bounds - list of (lower, upper) bounds for each parameter (None is unbounded)
+
+    Returns the best-fitting parameters [nstart, 4], the (unreduced) chi2 of
+    each fit [nstart], and a boolean success flag [nstart], which is False if
+    the fit did not converge or the curvature matrix is singular at the
+    solution (i.e., the parameter covariance is undefined).
+
+    """
+    radius, mag, weights = [np.asarray(xx, 'f8') for xx in (radius, mag, weights)]
+    params = np.atleast_2d(np.array(params0, 'f8'))
+    nstart, nparam = params.shape
+
+    lo, hi = np.full(nparam, -np.inf), np.full(nparam, np.inf)
+    if bounds is not None:
+        for ii, (bmin, bmax) in enumerate(bounds):
+            if bmin is not None:
+                lo[ii] = bmin
+            if bmax is not None:
+                hi[ii] = bmax
+    params = np.clip(params, lo, hi)
+
+    def _residuals(pp):
+        with np.errstate(all='ignore'):
+            resid = weights * (mag - cog_model(radius, pp, r0=r0))
+            chi2 = np.sum(resid**2, axis=1)
+        chi2[~np.isfinite(chi2)] = np.inf
+        return resid, chi2
+
+    resid, chi2 = _residuals(params)
+    lam = np.full(nstart, 1e-3)
+    active = np.isfinite(chi2)
+    converged = np.zeros(nstart, bool)
+
+    for _ in range(maxiter):
+        if not np.any(active):
+            break
+        with np.errstate(all='ignore'):
+            jac = weights[:, np.newaxis] * cog_jacobian(radius, params[active], r0=r0)
+            alpha = np.einsum('ski,skj->sij', jac, jac)
+            beta = np.einsum('ski,sk->si', jac, resid[active])
+            damped = alpha + lam[active, np.newaxis, np.newaxis] * \
+                (alpha * np.eye(nparam))
+            step = np.einsum('sij,sj->si', np.linalg.pinv(damped), beta)
+        step[~np.isfinite(step)] = 0.0
+
+        trial = np.clip(params[active] + step, lo, hi)
+        tresid, tchi2 = _residuals(trial)
+
+        better = tchi2 < chi2[active]
+        indx = np.where(active)[0]
+        with np.errstate(all='ignore'):
+            dchi2 = (chi2[active] - tchi2) / np.maximum(chi2[active], np.finfo(float).tiny)
+            dparam = np.max(np.abs(trial - params[active]) /
+                            (np.abs(params[active]) + xtol), axis=1)
+
+        up = indx[better]
+        params[up], resid[up], chi2[up] = trial[better], tresid[better], tchi2[better]
+        lam[up] /= 10
+        lam[indx[~better]] *= 10
+
+        done = better * ((dchi2 <= ftol) | (dparam <= xtol))
+        stuck = lam[indx] > 1e10 # not converged
+        converged[indx[done]] = True
+        active[indx[done | stuck]] = False
+
+    # Check that the curvature matrix is invertible at the solution.
+    with np.errstate(all='ignore'):
+        jac = weights[:, np.newaxis] * cog_jacobian(radius, params, r0=r0)
+        alpha = np.einsum('ski,skj->sij', jac, jac)
+        finite = np.all(np.isfinite(alpha), axis=(1, 2))
+        alpha[~finite] = 0.0
+        rank = np.linalg.matrix_rank(alpha)
+    success = converged * finite * (rank == nparam) * np.isfinite(chi2)
+
+    return params, chi2, success
@@ -31,17 +31,87 @@ desiutil.dust
 
 Get :math:`E(B-V)` values from the `Schlegel, Finkbeiner & Davis (1998; SFD98)`_ dust map.
 
+The hemisphere maps are memory-mapped read-only rather than read into memory,
+and each map is opened only once per process and shared by all the
+:class:`SFDMap` instances (and, after a fork, by the workers of a
+multiprocessing pool). Uncompressed maps are mapped in place; compressed or
+scaled maps are converted once to an uncompressed, native-endian cache file
+(whose data start on a page boundary) in :func:`legacyhalos.misc.cache_dir`.
+
 .. _`Schlegel, Finkbeiner & Davis (1998; SFD98)`: http://adsabs.harvard.edu/abs/1998ApJ...500..525S.
 """
 
 import os
+import hashlib
 import numpy as np
-from astropy.io.fits import getdata
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 
+# Memory-mapped hemisphere maps opened in this process, keyed on the file.
+_MAPS = {}
+
+
+def _memmap_map(fname, cachedir=None):
+    """Read-only memory map of a dust map, and its header.
+
+    Parameters
+    ----------
+    fname : :class:`str`
+        File name of one hemisphere of the dust map.
+    cachedir : :class:`str`, optional
+        Directory of the uncompressed copy of maps which cannot be mapped in
+        place; defaults to the ``dust`` subdirectory of
+        :func:`legacyhalos.misc.cache_dir`.
 
-def _bilinear_interpolate(data, y, x):
+    Returns
+    -------
+    :class:`tuple`
+        The map, a read-only :class:`~numpy.memmap`, and its
+        :class:`~astropy.io.fits.Header`.
+    """
+    from astropy.io import fits
+
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if key in _MAPS:
+        return _MAPS[key]
+
+    with fits.open(fname, memmap=False) as hdul:
+        header = hdul[0].header.copy()
+        shape = tuple(header['NAXIS{}'.format(ii)] for ii in range(header['NAXIS'], 0, -1))
+        inplace = (not fname.endswith(('.gz', '.bz2', '.zip', '.Z')) and
+                   header['BITPIX'] in (-32, -64) and
+                   header.get('BSCALE', 1) == 1 and header.get('BZERO', 0) == 0)
+        if inplace:
+            offset = hdul.fileinfo(0)['datLoc']
+            dtype = '>f{}'.format(abs(header['BITPIX']) // 8)
+            data = np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            if cachedir is None:
+                from legacyhalos.misc import cache_dir
+                cachedir = os.path.join(cache_dir(), 'dust')
+            tag = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+            cachefile = os.path.join(cachedir, '{}-{}.raw'.format(
+                os.path.basename(fname).split('.')[0], tag))
+            if not os.path.isfile(cachefile):
+                # The data type is saved alongside, in case the map is scaled.
+                dtype = hdul[0].data.dtype.newbyteorder('=')
+                os.makedirs(cachedir, exist_ok=True)
+                tmpfile = '{}.tmp-{}'.format(cachefile, os.getpid())
+                hdul[0].data.astype(dtype).tofile(tmpfile)
+                with open(tmpfile + '.dtype', 'w') as F:
+                    F.write(dtype.str)
+                os.replace(tmpfile + '.dtype', cachefile + '.dtype')
+                os.replace(tmpfile, cachefile)
+            with open(cachefile + '.dtype', 'r') as F:
+                dtype = np.dtype(F.read().strip())
+            data = np.memmap(cachefile, dtype=dtype, mode='r', shape=shape)
+
+    _MAPS[key] = (data, header)
+    return _MAPS[key]
+
+
+def _bilinear_interpolate(data, y, x, scaling=None):
     """Map a two-dimensional integer pixel-array at float coordinates.
 
     Parameters
@@ -54,6 +124,9 @@ def _bilinear_interpolate(data, y, x):
     x : :class:`float` or :class:`~numpy.ndarray`
         x coordinates (each integer x is a column) of
         location in pixel-space at which to interpolate.
+    scaling : :class:`float`, optional
+        Multiplicative factor by which to scale the data values (in the
+        precision of the data, as if the whole array had been scaled).
 
     Returns
     -------
@@ -62,7 +135,7 @@ def _bilinear_interpolate(data, y, x):
 
     Notes
     -----
-    Taken in full from https://github.com/kbarbary/sfdmap/
+    Adapted from https://github.com/kbarbary/sfdmap/
     """
     yfloor = np.floor(y)
     xfloor = np.floor(x)
@@ -70,9 +143,9 @@ def _bilinear_interpolate(data, y, x):
     xw = x - xfloor
 
     # pixel locations
-    y0 = yfloor.astype(np.int)
+    y0 = yfloor.astype(int)
     y1 = y0 + 1
-    x0 = xfloor.astype(np.int)
+    x0 = xfloor.astype(int)
     x1 = x0 + 1
 
     # clip locations out of range
@@ -82,10 +155,16 @@ def _bilinear_interpolate(data, y, x):
     x0 = np.maximum(x0, 0)
     x1 = np.minimum(x1, nx-1)
 
-    return ((1.0-xw) * (1.0-yw) * data[y0, x0] +
-            xw       * (1.0-yw) * data[y0, x1] +
-            (1.0-xw) * yw       * data[y1, x0] +
-            xw       * yw       * data[y1, x1])
+    def _pixels(yy, xx):
+        values = np.array(data[yy, xx])
+        if scaling is not None:
+            values *= scaling
+        return values
+
+    return ((1.0-xw) * (1.0-yw) * _pixels(y0, x0) +
+            xw       * (1.0-yw) * _pixels(y0, x1) +
+            (1.0-xw) * yw       * _pixels(y1, x0) +
+            xw       * yw       * _pixels(y1, x1))
 
 
 class _Hemisphere(object):
@@ -97,11 +176,15 @@ class _Hemisphere(object):
         File name containing one hemisphere of the dust map.
     scaling : :class:`float`
         Multiplicative factor by which to scale the dust map.
+    cachedir : :class:`str`, optional
+        Directory of the uncompressed copy of the map, if needed (see
+        :func:`_memmap_map`).
 
     Attributes
     ----------
-    data : :class:`~numpy.ndarray`
-        Pixelated array of dust map values.
+    data : :class:`~numpy.memmap`
+        Pixelated array of (unscaled) dust map values, memory-mapped
+        read-only.
     crpix1, crpix2 : :class:`float`
         World Coordinate System: Represent the 1-indexed
         X and Y pixel numbers of the poles.
@@ -112,17 +195,17 @@ class _Hemisphere(object):
 
     Notes
     -----
-    Taken in full from https://github.com/kbarbary/sfdmap/
+    Adapted from https://github.com/kbarbary/sfdmap/
     """
-    def __init__(self, fname, scaling):
-        self.data, header = getdata(fname, header=True)
-        self.data *= scaling
+    def __init__(self, fname, scaling, cachedir=None):
+        self.data, header = _memmap_map(fname, cachedir=cachedir)
+        self.scaling = scaling
         self.crpix1 = header['CRPIX1']
         self.crpix2 = header['CRPIX2']
         self.lam_scal = header['LAM_SCAL']
         self.sign = header['LAM_NSGP']  # north = 1, south = -1
 
-    def ebv(self, l, b, interpolate):
+    def ebv(self, l, b, interpolate, chunksize=2**18):
         """Project Galactic longitude/latitude to lambert pixels (See SFD98).
 
         Parameters
@@ -131,12 +214,23 @@ class _Hemisphere(object):
             Galactic longitude and latitude.
         interpolate : :class:`bool`
             If ``True`` use bilinear interpolation to obtain values.
+        chunksize : :class:`int`, optional
+            Number of coordinates processed at a time, which bounds the size
+            of the temporary arrays.
 
         Returns
         -------
         :class:`~numpy.ndarray`
             Reddening values.
         """
+        values = np.empty(len(l))
+        for start in range(0, len(l), chunksize):
+            values[start:start+chunksize] = self._ebv(l[start:start+chunksize],
+                                                      b[start:start+chunksize],
+                                                      interpolate)
+        return values
+
+    def _ebv(self, l, b, interpolate):
         x = (self.crpix1 - 1.0 +
              self.lam_scal * np.cos(l) *
              np.sqrt(1.0 - self.sign * np.sin(b)))
@@ -146,15 +240,17 @@ class _Hemisphere(object):
 
         # Get map values at these pixel coordinates.
         if interpolate:
-            return _bilinear_interpolate(self.data, y, x)
+            return _bilinear_interpolate(self.data, y, x, scaling=self.scaling)
         else:
-            x = np.round(x).astype(np.int)
-            y = np.round(y).astype(np.int)
+            x = np.round(x).astype(int)
+            y = np.round(y).astype(int)
 
             # some valid coordinates are right on the border (e.g., x/y = 4096)
             x = np.clip(x, 0, self.data.shape[1]-1)
             y = np.clip(y, 0, self.data.shape[0]-1)
-            return self.data[y, x]
+            values = np.array(self.data[y, x])
+            values *= self.scaling
+            return values
 
 
 class SFDMap(object):
@@ -162,8 +258,10 @@ class SFDMap(object):
 
     Use this class for repeated retrieval of E(B-V) values when
     there is no way to retrieve all the values at the same time: It keeps
-    a reference to the FITS data from the maps so that each FITS image
-    is read only once.
+    a reference to the (memory-mapped) maps so that each FITS image
+    is opened only once. Call :meth:`load` before creating a pool of
+    worker processes to share the maps with them; pickling an instance
+    does not copy the maps.
 
     Parameters
     ----------
@@ -180,13 +278,16 @@ class SFDMap(object):
         Scale all E(B-V) map values by this multiplicative factor.
         Pass scaling=0.86 for the recalibration from
         `Schlafly & Finkbeiner (2011) <http://adsabs.harvard.edu/abs/2011ApJ...737..103S)>`_.
+    cachedir : :class:`str`, optional
+        Directory of the uncompressed copy of compressed maps; defaults to
+        the ``dust`` subdirectory of :func:`legacyhalos.misc.cache_dir`.
 
     Notes
     -----
     Modified from https://github.com/kbarbary/sfdmap/
     """
     def __init__(self, mapdir=None, north="SFD_dust_4096_ngp.fits",
-                 south="SFD_dust_4096_sgp.fits", scaling=1.):
+                 south="SFD_dust_4096_sgp.fits", scaling=1., cachedir=None):
 
         if mapdir is None:
             mapdir = os.environ.get('DUST_DIR', '')
@@ -197,6 +298,29 @@ class SFDMap(object):
         self.hemispheres = {'north': None, 'south': None}
 
         self.scaling = scaling
+        self.cachedir = cachedir
+
+    def _hemisphere(self, pole):
+        """Initialize a hemisphere if it hasn't already been done."""
+        if self.hemispheres[pole] is None:
+            fname = os.path.join(self.mapdir, self.fnames[pole])
+            self.hemispheres[pole] = _Hemisphere(fname, self.scaling,
+                                                 cachedir=self.cachedir)
+        return self.hemispheres[pole]
+
+    def load(self):
+        """Open (memory-map) both hemispheres now rather than on first use.
+        """
+        for pole in ('north', 'south'):
+            self._hemisphere(pole)
+        return self
+
+    def __getstate__(self):
+        # The maps are reopened (from the memory maps of the receiving
+        # process, if any) rather than pickled.
+        state = self.__dict__.copy()
+        state['hemispheres'] = {'north': None, 'south': None}
+        return state
 
     def ebv(self, *args, **kwargs):
         """Get E(B-V) value(s) at given coordinate(s).
@@ -275,12 +399,7 @@ class SFDMap(object):
             if not np.any(mask):
                 continue
 
-            # Initialize hemisphere if it hasn't already been done.
-            if self.hemispheres[pole] is None:
-                fname = os.path.join(self.mapdir, self.fnames[pole])
-                self.hemispheres[pole] = _Hemisphere(fname, self.scaling)
-
-            values[mask] = self.hemispheres[pole].ebv(l[mask], b[mask],
+            values[mask] = self._hemisphere(pole).ebv(l[mask], b[mask],
                                                       interpolate)
 
         if return_scalar:
@@ -301,5 +420,6 @@ def ebv(*args, **kwargs):
     m = SFDMap(mapdir=kwargs.get('mapdir', None),
                north=kwargs.get('north', "SFD_dust_4096_ngp.fits"),
                south=kwargs.get('south', "SFD_dust_4096_sgp.fits"),
-               scaling=kwargs.get('scaling', 1.))
+               scaling=kwargs.get('scaling', 1.),
+               cachedir=kwargs.get('cachedir', None))
     return m.ebv(*args, **kwargs)
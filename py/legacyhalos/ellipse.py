@@ -69,21 +69,93 @@ def apphot_one(img, mask, theta, x0, y0, aa, bb, pixscale, variance=False, iscir
         apphot = mu_flux * pixscale**2 # [nanomaggies]
     return apphot
 
+def sbradius_mc_polyfit(rr, sb, sberr, rand, nmc=20):
+    """Monte Carlo estimate of the radius at which the surface brightness profile
+    crosses zero, by perturbing the profile within its errors and fitting a line
+    to each realization with np.polyfit. Reference implementation for
+    sbradius_mc.
+
+    rr - radius**0.25 [arcsec**0.25]
+    sb - surface brightness minus the threshold [mag/arcsec2]
+    sberr - uncertainty in sb [mag/arcsec2]
+
+    Returns the radius [arcsec] of each realization.
+
+    """
+    rcut = []
+    for ii in np.arange(nmc):
+        sbfit = rand.normal(sb, sberr)
+        coeff = np.polyfit(sbfit, rr, 1)
+        rcut.append((np.polyval(coeff, 0))**4)
+    return np.array(rcut)
+
+def sbradius_mc(rr, sb, sberr, rand, nmc=20):
+    """Vectorized version of sbradius_mc_polyfit: draw all the realizations at
+    once and solve the nmc linear least-squares problems in closed form.
+
+    The realizations are drawn in the same order from rand, so for a given
+    random state the results are the same as sbradius_mc_polyfit (to within
+    roundoff).
+
+    """
+    sbfit = rand.normal(sb, sberr, size=(nmc, len(sb))) # [nmc, npts]
+
+    # Least-squares line rr = slope * sbfit + intercept for each realization;
+    # we only need the intercept (i.e., rr at sb=0).
+    xmean = np.mean(sbfit, axis=1)
+    ymean = np.mean(rr)
+    dx = sbfit - xmean[:, np.newaxis]
+    slope = np.sum(dx * (rr - ymean), axis=1) / np.sum(dx**2, axis=1)
+    return (ymean - slope * xmean)**4
+
 def ellipse_cog(bands, data, refellipsefit, pixscalefactor,
                 pixscale, igal=0, pool=None, seed=1,
-                sbthresh=REF_SBTHRESH):
+                sbthresh=REF_SBTHRESH, cog_engine='nested',
+                sbradius_engine='vectorized', cogfit_engine='analytic',
+                concurrent_bands=False, checkpoint=None):
     """Measure the curve of growth (CoG) by performing elliptical aperture
     photometry.
 
     maxsma in pixels
     pixscalefactor - assumed to be constant for all bandpasses!
 
+    cog_engine - 'nested' (default) measures all the apertures (and their
+      variance) in a single pass (see legacyhalos.cog.nested_apphot);
+      'photutils' calls apphot_one for each aperture and serves as the
+      reference implementation.
+
+    sbradius_engine - 'vectorized' (default) draws all the Monte Carlo
+      realizations used to measure radius_sbXX at once (see sbradius_mc);
+      'polyfit' fits each realization separately (see sbradius_mc_polyfit).
+
+    cogfit_engine - 'analytic' (default) fits the curve-of-growth model from all
+      the starting points at once, using analytic derivatives (see
+      legacyhalos.cog.fit_cog); 'astropy' fits each starting point in turn with
+      astropy's LevMarLSQFitter.
+
+    concurrent_bands - measure the (nested) aperture photometry of all the bands
+      at once, one task per band on the worker pool, rather than one band after
+      another in this process. The results are identical.
+
+    checkpoint - optional checkpoint.EllipseCheckpoint object; the results of
+      each band are saved as they are measured and the bands which were already
+      measured (by an interrupted job) are read back instead.
+
     """
     import numpy.ma as ma
     import astropy.table
     from astropy.utils.exceptions import AstropyUserWarning
     from scipy import integrate
     from scipy.interpolate import interp1d
+    from legacyhalos.cog import nested_apphot, nested_apphot_multiband, fit_cog, cog_model
+    from legacyhalos.geometry import EllipticalGrid
+
+    if cog_engine not in ('nested', 'photutils'):
+        raise ValueError('Unrecognized cog_engine {}'.format(cog_engine))
+    if sbradius_engine not in ('vectorized', 'polyfit'):
+        raise ValueError('Unrecognized sbradius_engine {}'.format(sbradius_engine))
+    if cogfit_engine not in ('analytic', 'astropy'):
+        raise ValueError('Unrecognized cogfit_engine {}'.format(cogfit_engine))
 
     rand = np.random.RandomState(seed)
     
@@ -121,11 +193,10 @@ def ellipse_cog(bands, data, refellipsefit, pixscalefactor,
                 continue
 
         # Monte Carlo to get the radius
-        rcut = []
-        for ii in np.arange(20):
-            sbfit = rand.normal(sb[keep], sberr[keep])
-            coeff = np.polyfit(sbfit, rr[keep], 1)
-            rcut.append((np.polyval(coeff, 0))**4)
+        if sbradius_engine == 'vectorized':
+            rcut = sbradius_mc(rr[keep], sb[keep], sberr[keep], rand)
+        else:
+            rcut = sbradius_mc_polyfit(rr[keep], sb[keep], sberr[keep], rand)
         meanrcut, sigrcut = np.mean(rcut), np.std(rcut)
         #print(rcut, meanrcut, sigrcut)
 
@@ -141,10 +212,17 @@ def ellipse_cog(bands, data, refellipsefit, pixscalefactor,
         results['radius_sb{:0g}'.format(sbcut)] = np.float32(meanrcut)
         results['radius_sb{:0g}_err'.format(sbcut)] = np.float32(sigrcut)
 
-    for filt in bands:
-        img = ma.getdata(data['{}_masked'.format(filt)][igal]) # [nanomaggies/arcsec2]
-        mask = ma.getmask(data['{}_masked'.format(filt)][igal])
+    if eps == 0:
+        iscircle = True
+    else:
+        iscircle = False
+        
+    x0 = refellipsefit['x0'] * pixscalefactor
+    y0 = refellipsefit['y0'] * pixscalefactor
 
+    # Semi-major axes of the apertures in each band.
+    allsma, allvar = {}, {}
+    for filt in bands:
         deltaa_filt = deltaa * pixscalefactor
 
         if filt in refellipsefit['bands']:
@@ -157,15 +235,55 @@ def ellipse_cog(bands, data, refellipsefit, pixscalefactor,
             maxsma = sbprofile['sma_{}'.format(refband)].max()        # [pixels]
             #minsma = 3 * refellipsefit['psfsigma_{}'.format(refband)] # [pixels]
             
-        sma = np.arange(deltaa_filt, maxsma * pixscalefactor, deltaa_filt)
-        smb = sma * eps
-        if eps == 0:
-            iscircle = True
+        allsma[filt] = np.arange(deltaa_filt, maxsma * pixscalefactor, deltaa_filt)
+
+        if '{}_var'.format(filt) in data.keys():
+            allvar[filt] = data['{}_var'.format(filt)][igal] # [nanomaggies**2/arcsec**4]
         else:
-            iscircle = False
-        
-        x0 = refellipsefit['x0'] * pixscalefactor
-        y0 = refellipsefit['y0'] * pixscalefactor
+            allvar[filt] = None
+
+    # Optionally measure the aperture photometry in all the bands at once on the
+    # worker pool; the (fast) curve-of-growth modeling below is done serially so
+    # the random draws are the same either way.
+    if checkpoint is not None:
+        todo = [filt for filt in bands if not checkpoint.has('cog-{}'.format(filt))]
+    else:
+        todo = bands
+    if concurrent_bands and cog_engine == 'nested' and pool is not None and len(todo) > 0:
+        # note: the apertures have smb = sma * eps (see below)
+        cogphot = nested_apphot_multiband(
+            pool, {filt: data['{}_masked'.format(filt)][igal] for filt in todo},
+            {filt: allvar[filt] for filt in todo}, theta, x0, y0,
+            {filt: allsma[filt] for filt in todo}, 1.0 if iscircle else eps, pixscale)
+    else:
+        cogphot = {}
+
+    # The elliptical radius of every pixel (and their order) is the same in every
+    # band with the same image shape, so compute it only once.
+    grids = {}
+
+    def _checkpoint_band(filt):
+        if checkpoint is not None:
+            checkpoint.save('cog-{}'.format(filt), {key: val for key, val in results.items()
+                                                     if key.startswith('{}_'.format(filt))},
+                            rand=rand)
+
+    for filt in bands:
+        # Resume from the checkpoint, including the state of the random number
+        # generator, so the results of the remaining bands do not change.
+        if checkpoint is not None:
+            saved = checkpoint.load('cog-{}'.format(filt), rand=rand)
+            if saved is not None:
+                print('Read the {}-band curve of growth from the checkpoint.'.format(filt))
+                results.update(saved)
+                continue
+
+        img = ma.getdata(data['{}_masked'.format(filt)][igal]) # [nanomaggies/arcsec2]
+        mask = ma.getmask(data['{}_masked'.format(filt)][igal])
+
+        sma = allsma[filt]
+        smb = sma * eps
+        var = allvar[filt]
 
         #im = np.log10(img) ; im[mask] = 0 ; plt.clf() ; plt.imshow(im, origin='lower') ; plt.scatter(y0, x0, s=50, color='red') ; plt.savefig('junk.png')
         #pdb.set_trace()
@@ -173,23 +291,34 @@ def ellipse_cog(bands, data, refellipsefit, pixscalefactor,
         with np.errstate(all='ignore'):
             with warnings.catch_warnings():
                 warnings.simplefilter('ignore', category=AstropyUserWarning)
-                cogflux = pool.map(_apphot_one, [(img, mask, theta, x0, y0, aa, bb, pixscale, False, iscircle)
-                                                for aa, bb in zip(sma, smb)])
+                if filt in cogphot:
+                    cogflux, cogferr = cogphot[filt]
+                elif cog_engine == 'nested':
+                    # note: the apertures have smb = sma * eps (see above)
+                    if img.shape not in grids:
+                        grids[img.shape] = EllipticalGrid(img.shape, x0, y0, theta,
+                                                          1.0 if iscircle else eps)
+                    cogflux, cogferr = nested_apphot(img, mask, theta, x0, y0, sma,
+                                                     1.0 if iscircle else eps,
+                                                     pixscale, var=var, grid=grids[img.shape])
+                else:
+                    cogflux = pool.map(_apphot_one, [(img, mask, theta, x0, y0, aa, bb, pixscale, False, iscircle)
+                                                    for aa, bb in zip(sma, smb)])
+                    if var is not None:
+                        cogferr = pool.map(_apphot_one, [(var, mask, theta, x0, y0, aa, bb, pixscale, True, iscircle)
+                                                        for aa, bb in zip(sma, smb)])
+                    else:
+                        cogferr = None
+
                 if len(cogflux) > 0:
                     cogflux = np.hstack(cogflux)
                 else:
                     cogflux = np.array([0.0])
-
-                if '{}_var'.format(filt) in data.keys():
-                    var = data['{}_var'.format(filt)][igal] # [nanomaggies**2/arcsec**4]
-                    cogferr = pool.map(_apphot_one, [(var, mask, theta, x0, y0, aa, bb, pixscale, True, iscircle)
-                                                    for aa, bb in zip(sma, smb)])
+                if cogferr is not None:
                     if len(cogferr) > 0:
                         cogferr = np.hstack(cogferr)
                     else:
                         cogferr = np.array([0.0])
-                else:
-                    cogferr = None
 
         # Aperture fluxes can be negative (or nan?) sometimes--
         with warnings.catch_warnings():
@@ -220,6 +349,7 @@ def ellipse_cog(bands, data, refellipsefit, pixscalefactor,
             for sbcut in sbthresh:
                 results['{}_mag_sb{:0g}'.format(filt, sbcut)] = np.float32(-1)
                 results['{}_mag_sb{:0g}_err'.format(filt, sbcut)] = np.float32(-1)
+            _checkpoint_band(filt)
             continue
 
         sma_arcsec = sma[ok] * pixscale             # [arcsec]
@@ -260,19 +390,30 @@ def ellipse_cog(bands, data, refellipsefit, pixscalefactor,
             else:
                 params[ii, :] += rand.normal(scale=0.2 * pinfo.default, size=nball)
                 
+        # Fit up until the curve of growth turns over, but no less than the
+        # second moment of the light distribution! Pretty fragile..
+        these = np.where(np.diff(cogmag) < 0)[0]
+        if len(these) > 5: # this is bad if we don't have at least 5 points!
+            if sma_arcsec[these[0]] < (refellipsefit['majoraxis'] * pixscale * pixscalefactor):
+                these = np.where(sma_arcsec < refellipsefit['majoraxis'] * pixscale * pixscalefactor)[0]
+
         # perform the fit nball times
         chi2fail = 1e6
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            chi2 = np.zeros(nball) + chi2fail
-            for jj in range(nball):
-                cogmodel.parameters = params[:, jj]
-                # Fit up until the curve of growth turns over, but no less than
-                # the second moment of the light distribution! Pretty fragile..
-                these = np.where(np.diff(cogmag) < 0)[0]
-                if len(these) > 5: # this is bad if we don't have at least 5 points!
-                    if sma_arcsec[these[0]] < (refellipsefit['majoraxis'] * pixscale * pixscalefactor):
-                        these = np.where(sma_arcsec < refellipsefit['majoraxis'] * pixscale * pixscalefactor)[0]
+        chi2 = np.zeros(nball) + chi2fail
+        if cogfit_engine == 'analytic':
+            bounds = [getattr(cogmodel, pp).bounds for pp in cogmodel.param_names]
+            if len(these) > 5: # can happen in corner cases (e.g., PGC155984)
+                ballparams, _, success = fit_cog(sma_arcsec[these], cogmag[these], 1/cogmagerr[these],
+                                                 params.T, bounds=bounds, r0=cogmodel.r0, maxiter=100)
+                bestfit = cog_model(sma_arcsec, ballparams, r0=cogmodel.r0)
+                chi2 = np.sum( (cogmag - bestfit)**2 / cogmagerr**2, axis=1 ) / dof
+                chi2[~np.isfinite(chi2)] = chi2fail
+                params[:, success] = ballparams[success, :].T # update
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                for jj in range(nball):
+                    cogmodel.parameters = params[:, jj]
                     if len(these) > 5: # can happen in corner cases (e.g., PGC155984)
                         ballfit = cogfitter(cogmodel, sma_arcsec[these], cogmag[these],
                                             maxiter=100, weights=1/cogmagerr[these])
@@ -295,7 +436,13 @@ def ellipse_cog(bands, data, refellipsefit, pixscalefactor,
         mindx = np.argmin(chi2)
         minchi2 = chi2[mindx]
         cogmodel.parameters = params[:, mindx]
-        P = cogfitter(cogmodel, sma_arcsec, cogmag, weights=1/cogmagerr, maxiter=100)
+        if cogfit_engine == 'analytic':
+            bestparams, _, _ = fit_cog(sma_arcsec, cogmag, 1/cogmagerr, params[:, mindx],
+                                       bounds=bounds, r0=cogmodel.r0, maxiter=100)
+            cogmodel.parameters = bestparams[0, :]
+            P = cogmodel
+        else:
+            P = cogfitter(cogmodel, sma_arcsec, cogmag, weights=1/cogmagerr, maxiter=100)
         print('{} CoG modeling succeeded with a chi^2 minimum of {:.2f}'.format(filt, minchi2))
         
         #P = cogfitter(cogmodel, sma_arcsec, cogmag, weights=1/cogmagerr)
@@ -349,6 +496,8 @@ def ellipse_cog(bands, data, refellipsefit, pixscalefactor,
             else:
                 results[magkey] = np.float32(-1.0)
                 results[magerrkey] = np.float32(-1.0)
+
+        _checkpoint_band(filt)
                 
     #pdb.set_trace()
         
@@ -383,10 +532,13 @@ def _unmask_center(img):
     img.mask[xx**2 + yy**2 <= rad**2] = ma.nomask
     return img
 
-def _unpack_isofit(ellipsefit, filt, isofit, failed=False):
+def _unpack_isofit(ellipsefit, filt, isofit, failed=False, sma_stop=None):
     """Unpack the IsophotList objects into a dictionary because the resulting pickle
     files are huge.
 
+    sma_stop - semi-major axis [pixels] at which the integration stopped (see
+      isophote.integrate_isophotes_adaptive); defaults to the last isophote
+
     https://photutils.readthedocs.io/en/stable/api/photutils.isophote.IsophoteList.html#photutils.isophote.IsophoteList
 
     """
@@ -412,8 +564,11 @@ def _unpack_isofit(ellipsefit, filt, isofit, failed=False):
             '{}_stop_code'.format(filt): np.array([-1]).astype(np.int16),
             '{}_ndata'.format(filt): np.array([-1]).astype(np.int16), 
             '{}_nflag'.format(filt): np.array([-1]).astype(np.int16), 
-            '{}_niter'.format(filt): np.array([-1]).astype(np.int16)})
+            '{}_niter'.format(filt): np.array([-1]).astype(np.int16),
+            '{}_sma_stop'.format(filt): np.float32(-1)})
     else:
+        if sma_stop is None:
+            sma_stop = np.max(isofit.sma) if len(isofit) > 0 else -1
         ellipsefit.update({
             '{}_sma'.format(filt): isofit.sma.astype(np.int16),
             '{}_intens'.format(filt): isofit.intens.astype('f4'),
@@ -435,7 +590,8 @@ def _unpack_isofit(ellipsefit, filt, isofit, failed=False):
             '{}_stop_code'.format(filt): isofit.stop_code.astype(np.int16),
             '{}_ndata'.format(filt): isofit.ndata.astype(np.int16),
             '{}_nflag'.format(filt): isofit.nflag.astype(np.int16),
-            '{}_niter'.format(filt): isofit.niter.astype(np.int16)})
+            '{}_niter'.format(filt): isofit.niter.astype(np.int16),
+            '{}_sma_stop'.format(filt): np.float32(sma_stop)})
         
     return ellipsefit
 
@@ -673,13 +829,83 @@ def _fitgeometry_refband(ellipsefit, geometry0, majoraxis, refband='r', verbose=
 
     return ellipsefit
 
+def _unmasked_images(ellipsefit, data, bands, igal, box):
+    """Gather the images of the bands whose central pixels are not masked (see
+    ellipsefit_multiband for this corner case), flagging the other bands as
+    failed.
+
+    """
+    imgs = {}
+    for filt in bands:
+        img = data['{}_masked'.format(filt)][igal]
+        val = [img.mask[int(xb+ellipsefit['x0']), int(yb+ellipsefit['y0'])] for xb in box for yb in box]
+        if np.any(val):
+            print('Central pixel in {}-band is masked; resorting to extreme measures!'.format(filt))
+            ellipsefit = _unpack_isofit(ellipsefit, filt, None, failed=True)
+        else:
+            imgs[filt] = img
+    return ellipsefit, imgs
+
+def _ellipsefit_bands_concurrent(ellipsefit, data, bands, igal, sma, box, pool,
+                                 integrmode, sclip, nclip, nproc=1, nlevel=1):
+    """Integrate the isophotes of all the bands with a single pass over the worker
+    pool (see isophote.integrate_isophotes_multiband), rather than one band after
+    another. The results are identical.
+
+    """
+    from legacyhalos.isophote import integrate_isophotes_multiband
+
+    ellipsefit, imgs = _unmasked_images(ellipsefit, data, bands, igal, box)
+
+    print('Fitting {} bands concurrently took...'.format(len(imgs)), end='')
+    t0 = time.time()
+    isofit = integrate_isophotes_multiband(
+        pool, imgs, sma, ellipsefit['pa'], ellipsefit['eps'], ellipsefit['x0'],
+        ellipsefit['y0'], 1.0, integrmode, sclip, nclip, nproc=nproc, nlevel=nlevel)
+    for filt in imgs.keys():
+        ellipsefit = _unpack_isofit(ellipsefit, filt, isofit[filt])
+    print('...{:.3f} sec'.format(time.time() - t0))
+
+    return ellipsefit
+
+def _ellipsefit_bands_adaptive(ellipsefit, data, bands, igal, maxsma, logstep, box,
+                               pool, integrmode, sclip, nclip, snrmin=1.0, nlow=3,
+                               logsma=True, nproc=1, nlevel=1):
+    """Integrate the isophotes of all the bands on an adaptive sma grid, stopping
+    each band once its profile has faded into the noise (see
+    isophote.integrate_isophotes_adaptive).
+
+    """
+    from legacyhalos.isophote import integrate_isophotes_adaptive
+
+    ellipsefit, imgs = _unmasked_images(ellipsefit, data, bands, igal, box)
+
+    print('Fitting {} bands on an adaptive grid took...'.format(len(imgs)), end='')
+    t0 = time.time()
+    isofit, smastop = integrate_isophotes_adaptive(
+        pool, imgs, maxsma, ellipsefit['pa'], ellipsefit['eps'], ellipsefit['x0'],
+        ellipsefit['y0'], 1.0, integrmode, sclip, nclip, logstep,
+        refkey=ellipsefit['refband'], snrmin=snrmin, nlow=nlow, logsma=logsma,
+        nproc=nproc, nlevel=nlevel)
+    for filt in imgs.keys():
+        ellipsefit = _unpack_isofit(ellipsefit, filt, isofit[filt], sma_stop=smastop[filt])
+    print('...{:.3f} sec'.format(time.time() - t0))
+    for filt in imgs.keys():
+        print('  {}-band: nsma={}, stopped at sma={:.0f} pix'.format(
+            filt, len(isofit[filt]), smastop[filt]))
+
+    return ellipsefit
+
 def ellipsefit_multiband(galaxy, galaxydir, data, igal=0, galaxy_id='',
                          refband='r', nproc=1, 
                          integrmode='median', nclip=3, sclip=3,
                          maxsma=None, logsma=True, delta_logsma=5.0, delta_sma=1.0,
                          sbthresh=REF_SBTHRESH,
                          galaxyinfo=None, input_ellipse=None, fitgeometry=False,
-                         nowrite=False, verbose=False):
+                         isophot_engine='shared', cog_engine='nested',
+                         concurrent_bands=False, multires=False,
+                         adaptive_sma=False, sma_snrmin=1.0, sma_nlow=3,
+                         checkpoint=None, nowrite=False, verbose=False):
     """Multi-band ellipse-fitting, broadly based on--
     https://github.com/astropy/photutils-datasets/blob/master/notebooks/isophote/isophote_example4.ipynb
 
@@ -690,8 +916,54 @@ def ellipsefit_multiband(galaxy, galaxydir, data, igal=0, galaxy_id='',
     galaxy_id - add a unique ID number to the output filename (via
       io.write_ellipsefit).
 
+    isophot_engine - 'shared' (default) publishes each image to the worker
+      processes once and distributes chunks of sma (see legacyhalos.isophote);
+      'pickle' sends the full image with every sma (the original behavior).
+      Both give identical results.
+
+    cog_engine - curve-of-growth engine; see ellipse_cog.
+
+    concurrent_bands - schedule the isophotes (and then the aperture sums of
+      the curve of growth) of all the bands together on the worker pool,
+      instead of one band after another, which keeps all the processes busy
+      for small galaxies with only a few isophotes per band; the
+      curve-of-growth fits stay serial (see ellipse_cog). Requires
+      isophot_engine='shared'.
+
+    multires - sample the outer isophotes from block-averaged images and thin
+      out the isophotes which are closer together than one block (see
+      legacyhalos.multires). Requires isophot_engine='shared'.
+
+    adaptive_sma - rather than a fixed grid, integrate the isophotes of all the
+      bands outward on an adaptive sma grid, which is finer where the
+      reference-band profile bends sharply and coarser where it is smooth (with
+      the same nominal spacing as the fixed grid, i.e., delta_logsma in
+      log-sma or, if logsma=False, delta_sma in sma), and stop each band
+      once sma_nlow consecutive isophotes have a signal-to-noise ratio below
+      sma_snrmin. The semi-major axis at which each band stopped is written to
+      {band}_sma_stop (see isophote.integrate_isophotes_adaptive). Requires
+      isophot_engine='shared'.
+
+    checkpoint - save the isophotes and the curve of growth of each band as
+      they are measured, and resume from them if the fitting of this galaxy was
+      interrupted (see legacyhalos.checkpoint); the default (None) is to
+      checkpoint if ${LEGACYHALOS_CHECKPOINT} is set.
+
     """
-    import multiprocessing
+    from legacyhalos.pool import get_pool
+    from legacyhalos.isophote import integrate_isophotes
+    from legacyhalos.telemetry import record_metric
+    from legacyhalos.multires import pyramid_nlevel, multires_sma
+    from legacyhalos.checkpoint import EllipseCheckpoint, checkpoint_enabled, image_checksum
+
+    if isophot_engine not in ('shared', 'pickle'):
+        raise ValueError('Unrecognized isophot_engine {}'.format(isophot_engine))
+    if concurrent_bands and isophot_engine != 'shared':
+        raise ValueError('concurrent_bands requires isophot_engine=shared')
+    if multires and isophot_engine != 'shared':
+        raise ValueError('multires requires isophot_engine=shared')
+    if adaptive_sma and isophot_engine != 'shared':
+        raise ValueError('adaptive_sma requires isophot_engine=shared')
 
     bands, refband, refpixscale = data['bands'], data['refband'], data['refpixscale']
     filesuffix = data['filesuffix']
@@ -809,7 +1081,7 @@ def ellipsefit_multiband(galaxy, galaxydir, data, igal=0, galaxy_id='',
                     # recalculate the ratio so that the remaining values will scale correctly
                     ratio = (float(limit)/result[-1]) ** (1.0/(n-len(result)))
             # round, re-adjust to 0 indexing (i.e. minus 1) and return np.uint64 array
-            return np.array(list(map(lambda x: round(x)-1, result)), dtype=np.int)
+            return np.array(list(map(lambda x: round(x)-1, result)), dtype=int)
 
         # this algorithm can fail if there are too few points
         nsma = np.ceil(maxsma / delta_logsma).astype('int')
@@ -825,58 +1097,148 @@ def ellipsefit_multiband(galaxy, galaxydir, data, igal=0, galaxy_id='',
     # integrate.simps because the x-axis values have to be unique.
     assert(len(np.unique(sma)) == len(sma))
 
+    # Optionally sample the outer isophotes from block-averaged images, dropping
+    # the (redundant) isophotes spaced by less than one block (which the adaptive
+    # grid does not need).
+    if multires:
+        nlevel = pyramid_nlevel(np.max(sma))
+        if not adaptive_sma:
+            sma = multires_sma(sma, nlevel)
+        print('  multires: nlevel={}, nsma={}'.format(nlevel, len(sma)))
+    else:
+        nlevel = 1
+
     nbox = 3
     box = np.arange(nbox)-nbox // 2
     
     # Now get the surface brightness profile.  Need some more code for this to
-    # work with fitgeometry=True...
-    pool = multiprocessing.Pool(nproc)
+    # work with fitgeometry=True... Note that the (persistent) pool is reused by
+    # every galaxy processed by this process; see legacyhalos.pool.
+    pool = get_pool(nproc)
+
+    # Optionally resume from the bands which were finished before this galaxy
+    # was interrupted.
+    if checkpoint is None:
+        checkpoint = checkpoint_enabled()
+    if checkpoint:
+        signature = {'bands': bands, 'refband': refband, 'igal': igal,
+                     'x0': ellipsefit['x0'], 'y0': ellipsefit['y0'],
+                     'eps': ellipsefit['eps'], 'pa': ellipsefit['pa'],
+                     'input_ellipse': [input_ellipse['eps'], input_ellipse['pa']] if input_ellipse else None,
+                     'maxsma': maxsma, 'sma': sma, 'nlevel': nlevel,
+                     'integrmode': integrmode, 'sclip': sclip, 'nclip': nclip,
+                     'adaptive_sma': adaptive_sma, 'sma_snrmin': sma_snrmin,
+                     'sma_nlow': sma_nlow, 'sbthresh': sbthresh, 'cog_engine': cog_engine,
+                     'isophot_engine': isophot_engine,
+                     'checksum': [image_checksum(data['{}_masked'.format(filt)][igal])
+                                  for filt in bands]}
+        for filt in bands:
+            if '{}_var'.format(filt) in data.keys():
+                signature['checksum'].append(image_checksum(data['{}_var'.format(filt)][igal]))
+        ckpt = EllipseCheckpoint(galaxy, galaxydir, signature, filesuffix=filesuffix,
+                                 galaxy_id=galaxy_id)
+    else:
+        ckpt = None
 
-    tall = time.time()
-    for filt in bands:
-        print('Fitting {}-band took...'.format(filt), end='')
-        img = data['{}_masked'.format(filt)][igal]
+    def _checkpoint_isophotes(filts):
+        if ckpt is not None:
+            for filt in filts:
+                ckpt.save('isophotes-{}'.format(filt), {key: val for key, val in ellipsefit.items()
+                                                        if key.startswith('{}_'.format(filt))})
 
-        # Loop on the reference band isophotes.
-        t0 = time.time()
-        #isobandfit = pool.map(_integrate_isophot_one, [(iso, img, pixscalefactor, integrmode, sclip, nclip)
-
-        # In extreme cases, and despite my best effort in io.read_multiband, the
-        # image at the central position of the galaxy can end up masked, which
-        # always points to a deeper issue with the data (e.g., bleed trail,
-        # extremely bright star, etc.). Capture that corner case here.
-        imasked, val = False, []
-        for xb in box:
-            for yb in box:
-                val.append(img.mask[int(xb+ellipsefit['x0']), int(yb+ellipsefit['y0'])])
-        if np.any(val):
-            imasked = True
+    fitbands = []
+    for filt in bands:
+        saved = ckpt.load('isophotes-{}'.format(filt)) if ckpt is not None else None
+        if saved is None:
+            fitbands.append(filt)
+        else:
+            print('Read the {}-band isophotes from the checkpoint.'.format(filt))
+            ellipsefit.update(saved)
+    # The bands share the adaptive grid, so they have to be refit together.
+    if adaptive_sma and len(fitbands) > 0:
+        fitbands = bands
 
-        if imasked:
-        #if img.mask[np.int(ellipsefit['x0']), np.int(ellipsefit['y0'])]:
-            print(' Central pixel is masked; resorting to extreme measures!')
-            ellipsefit = _unpack_isofit(ellipsefit, filt, None, failed=True)
+    tall = time.time()
+    if adaptive_sma:
+        # Same nominal spacing as the fixed (logsma or linear) grid.
+        if logsma:
+            step = np.log(maxsma) / max(np.ceil(maxsma / delta_logsma) - 1, 1)
         else:
-            isobandfit = pool.map(_integrate_isophot_one, [(
-                img, _sma, ellipsefit['pa'], ellipsefit['eps'], ellipsefit['x0'],
-                ellipsefit['y0'], 1.0, integrmode, sclip, nclip) for _sma in sma])
-            ellipsefit = _unpack_isofit(ellipsefit, filt, IsophoteList(isobandfit))
+            step = delta_sma # [pixels]
+        ellipsefit = _ellipsefit_bands_adaptive(
+            ellipsefit, data, fitbands, igal, maxsma, step, box, pool, integrmode,
+            sclip, nclip, snrmin=sma_snrmin, nlow=sma_nlow, logsma=logsma,
+            nproc=nproc, nlevel=nlevel)
+        _checkpoint_isophotes(fitbands)
+    elif concurrent_bands:
+        ellipsefit = _ellipsefit_bands_concurrent(
+            ellipsefit, data, fitbands, igal, sma, box, pool, integrmode, sclip,
+            nclip, nproc=nproc, nlevel=nlevel)
+        _checkpoint_isophotes(fitbands)
+    else:
+        for filt in fitbands:
+            print('Fitting {}-band took...'.format(filt), end='')
+            img = data['{}_masked'.format(filt)][igal]
+
+            # Loop on the reference band isophotes.
+            t0 = time.time()
+            #isobandfit = pool.map(_integrate_isophot_one, [(iso, img, pixscalefactor, integrmode, sclip, nclip)
+
+            # In extreme cases, and despite my best effort in io.read_multiband, the
+            # image at the central position of the galaxy can end up masked, which
+            # always points to a deeper issue with the data (e.g., bleed trail,
+            # extremely bright star, etc.). Capture that corner case here.
+            imasked, val = False, []
+            for xb in box:
+                for yb in box:
+                    val.append(img.mask[int(xb+ellipsefit['x0']), int(yb+ellipsefit['y0'])])
+            if np.any(val):
+                imasked = True
+
+            if imasked:
+            #if img.mask[np.int(ellipsefit['x0']), np.int(ellipsefit['y0'])]:
+                print(' Central pixel is masked; resorting to extreme measures!')
+                ellipsefit = _unpack_isofit(ellipsefit, filt, None, failed=True)
+            elif isophot_engine == 'shared':
+                isobandfit = integrate_isophotes(
+                    pool, img, sma, ellipsefit['pa'], ellipsefit['eps'], ellipsefit['x0'],
+                    ellipsefit['y0'], 1.0, integrmode, sclip, nclip, nproc=nproc,
+                    nlevel=nlevel)
+                ellipsefit = _unpack_isofit(ellipsefit, filt, isobandfit)
+            else:
+                isobandfit = pool.map(_integrate_isophot_one, [(
+                    img, _sma, ellipsefit['pa'], ellipsefit['eps'], ellipsefit['x0'],
+                    ellipsefit['y0'], 1.0, integrmode, sclip, nclip) for _sma in sma])
+                ellipsefit = _unpack_isofit(ellipsefit, filt, IsophoteList(isobandfit))
+            _checkpoint_isophotes([filt])
         
-        print('...{:.3f} sec'.format(time.time() - t0))
+            print('...{:.3f} sec'.format(time.time() - t0))
     print('Time for all images = {:.3f} min'.format((time.time()-tall)/60))
 
+    if adaptive_sma:
+        sma = np.unique(np.hstack([ellipsefit['{}_sma'.format(filt)] for filt in bands]))
+        sma = sma[sma >= 0]
+
+    nisophote = np.sum([np.sum(ellipsefit['{}_sma'.format(filt)] >= 0) for filt in bands])
+    record_metric(nisophote=int(nisophote), nsma=len(sma), maxsma=float(maxsma),
+                  time_isophote=time.time()-tall)
+    if adaptive_sma:
+        record_metric(**{'{}_sma_stop'.format(filt): float(ellipsefit['{}_sma_stop'.format(filt)])
+                         for filt in bands})
+
     ellipsefit['success'] = True
 
     # Perform elliptical aperture photometry--
     print('Performing elliptical aperture photometry.')
     t0 = time.time()
     cog = ellipse_cog(bands, data, ellipsefit, 1.0, refpixscale,
-                      igal=igal, pool=pool, sbthresh=sbthresh)
+                      igal=igal, pool=pool, sbthresh=sbthresh,
+                      cog_engine=cog_engine, concurrent_bands=concurrent_bands,
+                      checkpoint=ckpt)
     ellipsefit.update(cog)
     del cog
     print('Time = {:.3f} min'.format( (time.time() - t0) / 60))
-
-    pool.close()
+    record_metric(time_cog=time.time()-t0)
 
     # Write out
     if not nowrite:
@@ -894,6 +1256,9 @@ def ellipsefit_multiband(galaxy, galaxydir, data, igal=0, galaxy_id='',
                                         verbose=True,
                                         filesuffix=filesuffix)
 
+    if ckpt is not None:
+        ckpt.clear()
+
     return ellipsefit
 
 def legacyhalos_ellipse(galaxy, galaxydir, data, galaxyinfo=None,
@@ -902,12 +1267,23 @@ def legacyhalos_ellipse(galaxy, galaxydir, data, galaxyinfo=None,
                         nclip=3, sclip=3, sbthresh=REF_SBTHRESH,
                         delta_sma=1.0, delta_logsma=5, maxsma=None, logsma=True,
                         input_ellipse=None, fitgeometry=False,
+                        concurrent_bands=False, multires=False, adaptive_sma=False,
+                        sma_snrmin=1.0, sma_nlow=3, checkpoint=None,
                         verbose=False, debug=False):
                         
     """Top-level wrapper script to do ellipse-fitting on a single galaxy.
 
     fitgeometry - fit for the ellipse parameters (do not use the mean values
       from MGE).
+    concurrent_bands - fit all the bands together; see ellipsefit_multiband.
+    multires - sample the outer isophotes from block-averaged images; see
+      ellipsefit_multiband.
+    adaptive_sma - integrate on an adaptive sma grid and stop each band at the
+      noise; see ellipsefit_multiband.
+    sma_snrmin, sma_nlow - when to stop each band with adaptive_sma; see
+      ellipsefit_multiband.
+    checkpoint - checkpoint (and resume) each band and stage; see
+      ellipsefit_multiband.
 
     """
     if bool(data):
@@ -928,6 +1304,10 @@ def legacyhalos_ellipse(galaxy, galaxydir, data, galaxyinfo=None,
                                               refband=refband, nproc=nproc, sbthresh=sbthresh,
                                               integrmode=integrmode, nclip=nclip, sclip=sclip,                                           
                                               input_ellipse=input_ellipse, 
+                                              concurrent_bands=concurrent_bands,
+                                              multires=multires, adaptive_sma=adaptive_sma,
+                                              sma_snrmin=sma_snrmin, sma_nlow=sma_nlow,
+                                              checkpoint=checkpoint,
                                               verbose=verbose, fitgeometry=False)
         return 1
     else:
@@ -0,0 +1,371 @@
+"""
+legacyhalos.ellipsestore
+========================
+
+Batched, columnar store of the ellipse-fitting results, as an alternative to
+writing (and later re-reading) one small FITS file per galaxy.
+
+Each writing process (i.e., MPI rank) appends one row per galaxy to its own
+FITS binary table in the store directory, so there are only as many files as
+processes. The surface-brightness and curve-of-growth profiles are kept in
+variable-length array columns, and the readers use fitsio to project only the
+requested columns and rows.
+
+The store is enabled by pointing ${LEGACYHALOS_ELLIPSE_STORE} at a directory,
+in which case io.write_ellipsefit, io.read_ellipsefit, io.ellipsefit_exists, and
+io.copy_ellipsefit use it transparently. If a galaxy is written more than once,
+the most recent row wins.
+
+The readers look galaxies up in an index of the store, which is built once per
+process (reading only the key columns of every file) and then kept up to date
+with the rows appended by the process itself. Rows appended by other processes
+after it was built are only seen once it is rebuilt with
+get_store_index(storedir, refresh=True); in the pipeline the store is read
+once the (ellipse-fitting) stage which writes it is complete, e.g., when
+building the SGA catalog (see SGA._init_ellipse_SGA).
+
+"""
+import os, time, socket, glob, pdb
+import numpy as np
+
+import fitsio
+
+EXTNAME = 'ELLIPSE'
+KEYCOLS = ['STORE_GALAXY', 'STORE_ID', 'STORE_SUFFIX', 'STORE_TIME']
+STRLEN = 40 # minimum width of new string columns (longer values widen them)
+
+# Cached (per-process) index of the rows in the store, keyed on the store
+# directory: the key columns (and modification time) of each file and the most
+# recent row of each galaxy.
+_STORE_INDEX = {}
+
+def ellipse_store_dir():
+    """Name of the store directory, or None if it has not been configured."""
+    storedir = os.getenv('LEGACYHALOS_ELLIPSE_STORE')
+    if storedir is not None and storedir.strip() == '':
+        storedir = None
+    return storedir
+
+def ellipse_store_file(storedir):
+    """File written by this process (one per host and process ID)."""
+    return os.path.join(storedir, 'ellipse-{}-{}.fits'.format(socket.gethostname(), os.getpid()))
+
+def ellipse_store_files(storedir):
+    return sorted(glob.glob(os.path.join(storedir, 'ellipse-*.fits')))
+
+def _key(galaxy, galaxy_id='', filesuffix=''):
+    key = []
+    for val in (galaxy, galaxy_id, filesuffix):
+        if isinstance(val, bytes):
+            val = val.decode('ascii')
+        key.append(str(val).strip())
+    return tuple(key)
+
+def _quantity_value(value, unit):
+    """Value as written by io.write_ellipsefit, where the integer (or Boolean)
+    columns with an astropy unit become floating-point Quantity columns.
+
+    """
+    if type(unit) is not str:
+        arr = np.asarray(value)
+        if arr.dtype.kind in ('i', 'u', 'b'):
+            return arr.astype('f8') if arr.ndim > 0 else np.float64(arr)
+    return value
+
+def _store_columns(galaxy, ellipsefit, galaxyinfo=None, galaxy_id='',
+                   filesuffix='', sbthresh=None):
+    """Flatten the ellipsefit (and galaxyinfo) dictionaries into a list of (column,
+    value, unit) tuples, checking the data model exactly as in
+    io.write_ellipsefit.
+
+    """
+    from legacyhalos.io import _get_ellipse_datamodel
+
+    if sbthresh is None:
+        from legacyhalos.ellipse import REF_SBTHRESH as sbthresh
+
+    galaxy, galaxy_id, filesuffix = _key(galaxy, galaxy_id, filesuffix)
+    cols = [('STORE_GALAXY', galaxy, ''), ('STORE_ID', galaxy_id, ''),
+            ('STORE_SUFFIX', filesuffix, ''), ('STORE_TIME', time.time(), 's')]
+
+    colnames = []
+    if galaxyinfo:
+        for key in galaxyinfo.keys():
+            data, unit = galaxyinfo[key]
+            cols.append((key.upper(), _quantity_value(data, unit), str(unit)))
+            colnames.append(key)
+
+    datakeys = ellipsefit.keys()
+    for key, unit in _get_ellipse_datamodel(sbthresh):
+        if key not in datakeys:
+            raise ValueError('Data model change -- no column {} for galaxy {}!'.format(key, galaxy))
+        cols.append((key.upper(), _quantity_value(ellipsefit[key], unit), str(unit)))
+        colnames.append(key)
+
+    if np.logical_not(np.all(np.isin([*datakeys], colnames))):
+        raise ValueError('Data model change -- non-documented columns have been added to ellipsefit dictionary!')
+
+    return cols
+
+def _store_header():
+    """io.legacyhalos_header (an astropy header) as fitsio header records."""
+    from legacyhalos.io import legacyhalos_header
+    return [dict(name=card.keyword, value=card.value, comment=card.comment)
+            for card in legacyhalos_header().cards]
+
+def _strlen(value):
+    """Length of the longest string in value."""
+    return max([len(val) for val in np.atleast_1d(np.asarray(value)).ravel()] + [0])
+
+def _column_strlen(dtype):
+    """Number of characters of a string column."""
+    if dtype.kind == 'U':
+        return dtype.itemsize // 4
+    return dtype.itemsize
+
+def _widen_strings(storefile, dtype, cols):
+    """Rewrite storefile with wider string columns if any of the (string) values
+    of the new row would not fit (and be truncated). Returns the data type of
+    the (possibly rewritten) table.
+
+    """
+    descr, widen = [], False
+    for name, value, _ in cols:
+        coldtype = dtype[name]
+        shape = coldtype.shape
+        if shape != ():
+            coldtype = coldtype.base
+        if coldtype.kind in ('U', 'S') and _strlen(value) > _column_strlen(coldtype):
+            coldtype = np.dtype('{}{}'.format(coldtype.kind, _strlen(value)))
+            widen = True
+        descr.append((name, coldtype, shape) if shape != () else (name, coldtype))
+    if not widen:
+        return dtype
+
+    newdtype = np.dtype(descr)
+    with fitsio.FITS(storefile) as ff:
+        hdr = ff[EXTNAME].read_header()
+        data = ff[EXTNAME].read(vstorage='object')
+    units = [hdr.get('TUNIT{}'.format(ii+1), '') for ii in range(len(dtype.names))]
+    out = np.zeros(len(data), dtype=newdtype)
+    for name in dtype.names:
+        out[name] = data[name]
+
+    tmpfile = '{}.tmp'.format(storefile)
+    fitsio.write(tmpfile, out, extname=EXTNAME, header=_store_header(),
+                 units=units, clobber=True)
+    os.replace(tmpfile, storefile)
+    return newdtype
+
+def _column_dtype(value):
+    """Data type of a new column: numeric and string scalars are fixed-width,
+    string arrays are fixed-shape, and numeric arrays are variable-length.
+
+    """
+    arr = np.asarray(value)
+    if arr.dtype.kind in ('U', 'S'):
+        width = max([STRLEN] + [len(val) for val in arr.ravel()])
+        if arr.ndim == 0:
+            return 'U{}'.format(width)
+        return ('U{}'.format(width), arr.shape)
+    if arr.ndim == 0:
+        return arr.dtype.str
+    return 'O'
+
+def append_ellipsefit(storefile, galaxy, ellipsefit, galaxyinfo=None, galaxy_id='',
+                      filesuffix='', sbthresh=None, verbose=False):
+    """Append the ellipse-fitting results for one galaxy to storefile, creating it
+    if necessary. Every row in a file must have the same data model.
+
+    """
+    cols = _store_columns(galaxy, ellipsefit, galaxyinfo=galaxyinfo, galaxy_id=galaxy_id,
+                          filesuffix=filesuffix, sbthresh=sbthresh)
+    _append_columns(storefile, galaxy, cols, verbose=verbose)
+
+def _append_columns(storefile, galaxy, cols, verbose=False):
+    """Append one row, given as a list of (column, value, unit) tuples."""
+    names = [col[0] for col in cols]
+
+    exists = os.path.isfile(storefile)
+    if exists:
+        with fitsio.FITS(storefile) as ff:
+            template = ff[EXTNAME].read(rows=[0], vstorage='object')
+            nrows = ff[EXTNAME].get_nrows()
+        if template.dtype.names != tuple(names):
+            raise ValueError('Data model change -- columns of {} do not match those of {}!'.format(
+                galaxy, storefile))
+        dtype = _widen_strings(storefile, template.dtype, cols)
+    else:
+        template, nrows = None, 0
+        dtype = np.dtype([(name, _column_dtype(value)) for name, value, _ in cols])
+
+    row = np.zeros(1, dtype=dtype)
+    for name, value, _ in cols:
+        if dtype[name].kind == 'O':
+            value = np.atleast_1d(np.asarray(value)).ravel()
+            if template is not None:
+                value = value.astype(template[name][0].dtype)
+            row[name][0] = value
+        else:
+            row[name] = value
+
+    if verbose:
+        print('Appending {} to {}'.format(galaxy, storefile))
+    if exists:
+        with fitsio.FITS(storefile, 'rw') as ff:
+            ff[EXTNAME].append(row)
+    else:
+        storedir = os.path.dirname(storefile)
+        if storedir != '' and not os.path.isdir(storedir):
+            os.makedirs(storedir, exist_ok=True)
+        units = [unit for _, _, unit in cols]
+        fitsio.write(storefile, row, extname=EXTNAME, header=_store_header(),
+                     units=units, clobber=True)
+
+    # Keep the index of this process (if it has been built) up to date.
+    store = _STORE_INDEX.get(_storekey(os.path.dirname(storefile)))
+    if store is not None:
+        _update_index(store['index'], _key(*[row[col][0] for col in KEYCOLS[:3]]),
+                      storefile, nrows, row['STORE_TIME'][0])
+
+def _storekey(storedir):
+    return os.path.abspath(storedir)
+
+def _update_index(index, key, storefile, irow, tt):
+    if key not in index or tt >= index[key][2]:
+        index[key] = (storefile, irow, tt)
+
+def get_store_index(storedir, refresh=False):
+    """Map (galaxy, galaxy_id, filesuffix) --> (storefile, row, time) for the most
+    recent row of every galaxy in the store, reading only the key columns.
+
+    The index is built once per process (see the module documentation); with
+    refresh=True it is rebuilt, re-reading only the files which have changed.
+
+    """
+    store = _STORE_INDEX.get(_storekey(storedir))
+    if store is not None and not refresh:
+        return store['index']
+
+    files = {} if store is None else store['files']
+    index = {}
+    for storefile in ellipse_store_files(storedir):
+        mtime = os.path.getmtime(storefile)
+        if storefile not in files or files[storefile][0] != mtime:
+            files[storefile] = (mtime, fitsio.read(storefile, ext=EXTNAME, columns=KEYCOLS))
+        keys = files[storefile][1]
+        for irow, (gal, galid, fsuff, tt) in enumerate(zip(keys['STORE_GALAXY'], keys['STORE_ID'],
+                                                              keys['STORE_SUFFIX'], keys['STORE_TIME'])):
+            _update_index(index, _key(gal, galid, fsuff), storefile, irow, tt)
+
+    _STORE_INDEX[_storekey(storedir)] = {'files': files, 'index': index}
+    return index
+
+def in_ellipse_store(storedir, galaxy, galaxy_id='', filesuffix=''):
+    """Whether the store has (a row for) a galaxy."""
+    return _key(galaxy, galaxy_id, filesuffix) in get_store_index(storedir)
+
+def copy_ellipse_store(storedir, galaxy, galaxy_id='', infilesuffix='', outfilesuffix='',
+                       verbose=False):
+    """Store equivalent of copying an ellipse file: append the (most recent) row
+    of a galaxy again with another filesuffix.
+
+    """
+    index = get_store_index(storedir)
+    infile, irow, _ = index[_key(galaxy, galaxy_id, infilesuffix)]
+    with fitsio.FITS(infile) as ff:
+        hdr = ff[EXTNAME].read_header()
+        data = ff[EXTNAME].read(rows=[irow], vstorage='object')
+    cols = []
+    for ii, name in enumerate(data.dtype.names):
+        value = data[name][0]
+        if name == 'STORE_SUFFIX':
+            value = _key(galaxy, galaxy_id, outfilesuffix)[2]
+        elif name == 'STORE_TIME':
+            value = time.time()
+        elif data.dtype[name].base.kind == 'S':
+            value = np.char.decode(value, 'ascii')
+        cols.append((name, value, hdr.get('TUNIT{}'.format(ii+1), '')))
+    _append_columns(ellipse_store_file(storedir), galaxy, cols, verbose=verbose)
+
+def read_ellipse_store(storedir, galaxy=None, galaxy_id=None, filesuffix='',
+                       columns=None, refresh=False):
+    """Read a subset of columns and galaxies from the store into a Table (one row
+    per galaxy, in the order requested).
+
+    galaxy - galaxy name or list of names (default is every galaxy with this
+      filesuffix)
+    galaxy_id - matching galaxy ID or list of IDs (default is '')
+    columns - list of (case-insensitive) columns to read (default is all)
+    refresh - rebuild the index of the store (see get_store_index)
+
+    Galaxies which are not in the store are silently skipped; check the
+    STORE_GALAXY column of the output.
+
+    """
+    from astropy.table import Table, vstack
+
+    index = get_store_index(storedir, refresh=refresh)
+    if galaxy is None:
+        keys = sorted([key for key in index.keys() if key[2] == str(filesuffix).strip()])
+    else:
+        galaxy = np.atleast_1d(galaxy)
+        if galaxy_id is None:
+            galaxy_id = np.repeat('', len(galaxy))
+        keys = [_key(gal, galid, filesuffix) for gal, galid in zip(galaxy, np.atleast_1d(galaxy_id))]
+    keys = [key for key in keys if key in index]
+    if len(keys) == 0:
+        return Table()
+
+    if columns is not None:
+        columns = KEYCOLS + [col.upper() for col in columns if col.upper() not in KEYCOLS]
+
+    # Read each file once, in row order, and then restore the requested order.
+    rows = {}
+    for storefile, irow, _ in [index[key] for key in keys]:
+        rows.setdefault(storefile, []).append(irow)
+
+    out, outkeys = [], []
+    for storefile in sorted(rows.keys()):
+        irows = np.unique(rows[storefile])
+        data = fitsio.read(storefile, ext=EXTNAME, columns=columns, rows=irows,
+                           vstorage='object')
+        out.append(Table(data))
+        outkeys += [(storefile, irow) for irow in irows]
+    out = vstack(out, metadata_conflicts='silent') if len(out) > 1 else out[0]
+
+    outrow = {outkey: ii for ii, outkey in enumerate(outkeys)}
+    srt = [outrow[index[key][:2]] for key in keys]
+    return out[srt]
+
+def read_ellipsefit_store(storedir, galaxy, galaxy_id='', filesuffix='', verbose=True):
+    """Store equivalent of io.read_ellipsefit. Returns an empty dictionary if the
+    galaxy is not in the store.
+
+    """
+    data = read_ellipse_store(storedir, galaxy=galaxy, galaxy_id=galaxy_id,
+                              filesuffix=filesuffix)
+    if len(data) == 0:
+        if verbose:
+            print('Galaxy {} not found in ellipse store {}!'.format(galaxy, storedir))
+        return dict()
+
+    # Convert the values exactly as io.read_ellipsefit does, so they have the
+    # same types (e.g., float64 and int64 arrays) as if read from a file.
+    ellipsefit = {}
+    for key in data.colnames:
+        if key in KEYCOLS:
+            continue
+        val = data[key][0]
+        if isinstance(val, (str, bytes)):
+            val = val.strip()
+        else:
+            val = np.asarray(val)
+            if val.dtype.kind in ('U', 'S'):
+                val = np.char.strip(val)
+            val = val.tolist()
+            if np.logical_not(np.isscalar(val)) and len(val) > 0:
+                val = np.array(val)
+        ellipsefit[key.lower()] = val # lowercase!
+
+    return ellipsefit
@@ -0,0 +1,109 @@
+"""
+legacyhalos.geometry
+====================
+
+Cached elliptical-radius maps of an image.
+
+The same ellipse geometry (center, position angle, and axis ratio) is used over
+and over again for a given galaxy by the curve-of-growth photometry of every
+band. EllipticalGrid computes the elliptical radius of every pixel once,
+together with the order of the pixels in radius and the fractional overlaps of
+the pixels along the aperture boundaries, so cog.nested_apphot does not repeat
+the full-frame trigonometry, sorting, or overlap geometry for each band.
+
+Conventions: x0, y0 are the column and row of the center [pixels] and theta is
+the position angle of the major axis measured counter-clockwise from the x
+(column) axis [radians], as in photutils and cog.nested_apphot.
+
+"""
+import pdb
+import numpy as np
+
+def _elliptical_radius(dx, dy, theta, ba):
+    """Elliptical radius (i.e., semi-major axis) passing through (dx, dy)."""
+    cost, sint = np.cos(theta), np.sin(theta)
+    xp = dx * cost + dy * sint
+    yp = -dx * sint + dy * cost
+    return np.hypot(xp, yp / ba)
+
+def half_pixel(theta, ba):
+    """Largest elliptical radius of any point in a pixel relative to its center."""
+    dcorner = np.array([-0.5, 0.5, 0.5, -0.5]), np.array([-0.5, -0.5, 0.5, 0.5])
+    return _elliptical_radius(dcorner[0], dcorner[1], theta, ba).max()
+
+class EllipticalGrid(object):
+    """Elliptical radius map of an image of a given shape.
+
+    shape - (nrow, ncol) shape of the image
+    x0, y0 - center (column, row) [pixels]
+    theta - position angle of the major axis [radians]
+    ba - minor-to-major axis ratio
+
+    """
+    def __init__(self, shape, x0, y0, theta, ba):
+        self.shape = tuple(int(nn) for nn in shape)
+        self.x0, self.y0, self.theta, self.ba = float(x0), float(y0), float(theta), float(ba)
+        self.halfpix = half_pixel(self.theta, self.ba)
+        self._radius = None
+        self._order = None
+        self._overlaps = None # (sma, pixel, aperture, fractional overlap)
+
+    @property
+    def radius(self):
+        """Elliptical radius (semi-major axis of the ellipse through the center
+        of each pixel) [pixels].
+
+        """
+        if self._radius is None:
+            yy, xx = np.ogrid[0:self.shape[0], 0:self.shape[1]]
+            self._radius = _elliptical_radius(xx - self.x0, yy - self.y0, self.theta, self.ba)
+        return self._radius
+
+    @property
+    def order(self):
+        """Flattened pixel indices sorted (stably) by their outer radius,
+        radius+halfpix.
+
+        """
+        if self._order is None:
+            self._order = np.argsort((self.radius + self.halfpix).ravel(), kind='stable')
+        return self._order
+
+    def boundary_overlaps(self, sma, chunksize=2**20):
+        """Fractional overlap (see cog.pixel_overlap) of every pixel straddling
+        the boundary of each aperture of semi-major axis sma [pixels, increasing].
+
+        Returns the flattened pixel indices, aperture indices, and overlaps,
+        ordered by pixel and then by aperture, as in cog.nested_apphot. They are
+        computed once and reused for the same sma, or for any sma which is the
+        beginning of it (e.g., a smaller maximum radius in another band).
+
+        """
+        from legacyhalos.cog import pixel_overlap, boundary_pairs
+
+        sma = np.asarray(sma, 'f8')
+        nsma = len(sma)
+        if self._overlaps is not None:
+            oldsma, pix, ksma, frac = self._overlaps
+            if len(oldsma) >= nsma and np.array_equal(oldsma[:nsma], sma):
+                if len(oldsma) > nsma:
+                    use = ksma < nsma
+                    pix, ksma, frac = pix[use], ksma[use], frac[use]
+                return pix, ksma, frac
+
+        flat = np.flatnonzero((self.radius - self.halfpix).ravel() < sma[-1])
+        ipix, ksma = boundary_pairs(self.radius.ravel()[flat], self.halfpix, sma)
+        pix = flat[ipix]
+        frac = np.zeros(len(pix))
+        for start in range(0, len(pix), chunksize):
+            _pix = pix[start:start+chunksize]
+            yy, xx = np.divmod(_pix, self.shape[1])
+            aa = sma[ksma[start:start+chunksize]]
+            frac[start:start+chunksize] = pixel_overlap(xx - self.x0, yy - self.y0, aa,
+                                                        aa * self.ba, self.theta)
+        self._overlaps = (sma.copy(), pix, ksma, frac)
+        return pix, ksma, frac
+
+    def matches(self, shape, x0, y0, theta, ba):
+        return (self.shape == tuple(int(nn) for nn in shape) and self.x0 == float(x0) and
+                self.y0 == float(y0) and self.theta == float(theta) and self.ba == float(ba))
@@ -0,0 +1,159 @@
+"""
+legacyhalos.groups
+==================
+
+Group finding on the sphere with diameter-scaled linking lengths.
+
+Two galaxies are linked if their (scaled) circular apertures overlap, i.e., if
+their separation is less than 0.5*mfac*(diam1+diam2), and groups are the sets of
+galaxies connected by such links. find_groups reproduces the grouping of
+build_group_catalog in bin/virgofilaments/virgofilaments-spheregroup, namely--
+
+  * galaxies are first grouped with friends-of-friends (pydl spheregroup) with
+    a linking length dmax, and only pairs in the same friends-of-friends group
+    are linked as above; and
+  * galaxies larger than dmax are also linked to every galaxy with which they
+    overlap (without mfac), 0.5*(diam1+diam2), wherever it is.
+
+but instead of comparing all the pairs of galaxies in each friends-of-friends
+group and then looping over the large galaxies, the candidate pairs are found
+with a KD-tree of the unit vectors of the galaxies, each pair by a search
+(scaled by the diameter) around its larger member, and the groups are the
+connected components (i.e., union-find) of the links. The cost scales as the
+number of galaxies (and close pairs), so million-object parent catalogs take a
+few minutes.
+
+"""
+import pdb
+import numpy as np
+
+def radec2xyz(ra, dec):
+    """Unit vectors of ra, dec [degrees]; returns an [n, 3] array."""
+    ra, dec = np.radians(ra), np.radians(dec)
+    cosdec = np.cos(dec)
+    return np.vstack((cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec))).T
+
+def _chord(sep):
+    """Chord length of an angular separation [degrees]."""
+    return 2 * np.sin(np.radians(np.clip(sep, 0, 180)) / 2)
+
+def separation(xyz1, xyz2):
+    """Angular separation between unit vectors [degrees], as
+    astrometry.util.starutil_numpy.degrees_between.
+
+    """
+    chord = np.sqrt(np.sum((xyz1 - xyz2)**2, axis=-1))
+    return np.degrees(2 * np.arcsin(np.clip(chord / 2, 0, 1)))
+
+def connected_groups(ngal, pairs):
+    """Group index of each of ngal objects given the [npair, 2] array of linked
+    pairs; each group is labeled by the smallest index of its members.
+
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+                       shape=(ngal, ngal))
+    _, label = connected_components(graph, directed=False)
+    first = np.full(label.max() + 1 if ngal > 0 else 0, ngal, dtype=np.intp)
+    np.minimum.at(first, label, np.arange(ngal))
+    return first[label]
+
+def friends_of_friends(ra, dec, linklength, tree=None):
+    """Friends-of-friends groups with a linking length [degrees], like pydl
+    spheregroup; returns the group index (see connected_groups) of each object.
+
+    """
+    from scipy.spatial import cKDTree
+
+    xyz = radec2xyz(ra, dec)
+    if tree is None:
+        tree = cKDTree(xyz)
+    pairs = tree.query_pairs(_chord(linklength) * (1 + 1e-12), output_type='ndarray')
+    pairs = pairs[separation(xyz[pairs[:, 0]], xyz[pairs[:, 1]]) <= linklength]
+    return connected_groups(len(xyz), pairs)
+
+def find_groups(ra, dec, diam, mfac=2.0, dmax=10.0/60.0):
+    """Group galaxies whose circular apertures overlap (see the module
+    documentation).
+
+    ra, dec - coordinates [degrees]
+    diam - diameters [arcmin]
+    mfac - scale factor of the diameters
+    dmax - friends-of-friends linking length [degrees]
+
+    Returns the group index (the smallest index of the members of each group)
+    and the multiplicity of the group of each galaxy.
+
+    """
+    from scipy.spatial import cKDTree
+
+    ra, dec = np.asarray(ra, 'f8'), np.asarray(dec, 'f8')
+    diam = np.asarray(diam, 'f8') / 60.0 # [degrees]
+    ngal = len(ra)
+    if ngal == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=np.int16)
+
+    xyz = radec2xyz(ra, dec)
+    tree = cKDTree(xyz)
+    fof = friends_of_friends(ra, dec, dmax, tree=tree)
+
+    # Candidate pairs: each galaxy searches for the galaxies no larger than
+    # itself out to the largest separation at which they can be linked.
+    radius = _chord(max(mfac, 1.0) * np.nan_to_num(diam)) * (1 + 1e-12)
+    near = tree.query_ball_point(xyz, radius, return_sorted=False)
+    nnear = np.array([len(nn) for nn in near])
+    big = np.repeat(np.arange(ngal), nnear)
+    small = np.concatenate(near).astype(np.intp)
+
+    keep = (diam[small] < diam[big]) | ((diam[small] == diam[big]) & (small < big))
+    big, small = big[keep], small[keep]
+
+    sep = separation(xyz[big], xyz[small])
+    sumdiam = diam[big] + diam[small]
+    link = (fof[big] == fof[small]) & (sep < 0.5 * mfac * sumdiam)
+    link |= (diam[big] > dmax) & (sep < 0.5 * sumdiam)
+
+    groupid = connected_groups(ngal, np.vstack((big[link], small[link])).T)
+    mult = np.bincount(groupid, minlength=ngal)[groupid].astype(np.int16)
+    return groupid, mult
+
+def group_properties(ra, dec, diam, groupid):
+    """Diameter-weighted center, diameter, and primary (largest) member of each
+    group.
+
+    ra, dec - coordinates [degrees]
+    diam - diameters [arcmin]
+    groupid - group index of each galaxy (e.g., from find_groups)
+
+    Returns, for each galaxy, the center of its group (ra, dec [degrees]), the
+    diameter of the group [arcmin; the distance between the center and the
+    outermost member plus the diameter of that member], and whether it is the
+    primary of its group (its largest member, the first one in case of a tie).
+    The groups with one member are simply the galaxy itself.
+
+    """
+    ra, dec, diam = np.asarray(ra, 'f8'), np.asarray(dec, 'f8'), np.asarray(diam)
+    ngal = len(ra)
+    _, inv, mult = np.unique(groupid, return_inverse=True, return_counts=True)
+    inv = inv.ravel()
+
+    weight = diam.astype('f8')
+    wsum = np.bincount(inv, weights=weight)
+    groupra = (np.bincount(inv, weights=weight * ra) / wsum)[inv]
+    groupdec = (np.bincount(inv, weights=weight * dec) / wsum)[inv]
+
+    pad = separation(radec2xyz(ra, dec), radec2xyz(groupra, groupdec)) + diam / 60.0
+    maxpad = np.full(len(mult), -np.inf)
+    np.maximum.at(maxpad, inv, pad)
+    groupdiam = maxpad[inv] * 60 # [arcmin]
+
+    order = np.lexsort((np.arange(ngal), -diam, inv))
+    primary = np.zeros(ngal, bool)
+    primary[order[np.concatenate(([0], np.cumsum(mult)[:-1]))]] = True
+
+    single = mult[inv] == 1
+    groupra[single], groupdec[single], groupdiam[single] = ra[single], dec[single], diam[single]
+    return groupra, groupdec, groupdiam, primary
@@ -0,0 +1,207 @@
+"""
+legacyhalos.halomass
+====================
+
+Fast conversions between halo-mass definitions (e.g., M200m to M200c).
+
+colossus.halo.mass_defs.changeMassDefinition solves for the radius enclosing
+the new overdensity, one halo at a time, which is slow for large catalogs.
+MassDefinitionTable tabulates the conversion, log10(Mout/Min), once on a grid of
+log10(Min) and redshift for a given cosmology, pair of mass definitions, and
+(constant) concentration, and interpolates it with a bicubic spline.
+
+The table is built lazily, the first time it is needed, and saved to
+${LEGACYHALOS_CACHE_DIR} (default ~/.cache/legacyhalos), so it is only ever
+computed once. When it is built, the interpolated masses are checked against
+colossus at randomly chosen points between the grid nodes and the table is
+rejected (ValueError) if they differ by more than tol (1e-4 dex, i.e., 0.02%,
+by default). Masses and redshifts outside of the grid are converted directly
+with colossus.
+
+"""
+import os, json, hashlib, pdb
+import numpy as np
+
+HALOMASS_TOLERANCE = 1e-4 # [dex]
+
+# Tables used in this process, keyed on their signature.
+_TABLES = {}
+
+def _colossus_version():
+    try:
+        import colossus
+        return getattr(colossus, '__version__', 'unknown')
+    except ImportError:
+        return 'unknown'
+
+def change_mass_definition(mass, redshift, mdef_in, mdef_out, c=3.5):
+    """Convert masses one at a time with colossus (for the current colossus
+    cosmology), assuming an NFW profile with constant concentration c.
+
+    """
+    from colossus.halo import mass_defs
+
+    mass, redshift = np.broadcast_arrays(np.atleast_1d(mass).astype('f8'),
+                                         np.atleast_1d(redshift).astype('f8'))
+    out = np.zeros_like(mass)
+    for ii, (mm, zz) in enumerate(zip(mass.flat, redshift.flat)):
+        mc, _, _ = mass_defs.changeMassDefinition(mm, c, zz, mdef_in, mdef_out)
+        out.flat[ii] = mc
+    return out
+
+class MassDefinitionTable(object):
+    """Interpolation table of the conversion between two mass definitions.
+
+    cosmo_name, cosmo_params - colossus cosmology (see
+      colossus.cosmology.cosmology.setCosmology)
+    mdef_in, mdef_out - input and output mass definitions (e.g., '200m', '200c')
+    c - concentration (of an NFW profile, in the input mass definition)
+    logmass - (min, max, step) of the grid of log10(Min) [Msun/h]
+    redshift - (min, max, step) of the grid of redshift
+    tol - maximum tolerated interpolation error [dex]
+    nvalidate - number of random points at which the table is validated
+    cachedir - directory of the persisted table (default misc.cache_dir());
+      set to False to not read or write it
+
+    Call the table with arrays of Min and redshift to get Mout.
+
+    """
+    def __init__(self, cosmo_name, cosmo_params, mdef_in, mdef_out, c=3.5,
+                 logmass=(11.0, 16.5, 0.05), redshift=(0.0, 2.0, 0.025),
+                 tol=HALOMASS_TOLERANCE, nvalidate=200, cachedir=None):
+        self.cosmo_name = cosmo_name
+        self.cosmo_params = dict(cosmo_params)
+        self.mdef_in, self.mdef_out, self.c = mdef_in, mdef_out, float(c)
+        self.tol, self.nvalidate = tol, nvalidate
+
+        self.logmass = np.linspace(logmass[0], logmass[1], int(np.round((logmass[1]-logmass[0])/logmass[2]))+1)
+        self.redshift = np.linspace(redshift[0], redshift[1], int(np.round((redshift[1]-redshift[0])/redshift[2]))+1)
+
+        self.signature = {'cosmo_name': cosmo_name, 'cosmo_params': sorted(self.cosmo_params.items()),
+                          'mdef_in': mdef_in, 'mdef_out': mdef_out, 'c': self.c,
+                          'logmass': list(logmass), 'redshift': list(redshift),
+                          'colossus': _colossus_version()}
+        self.key = hashlib.sha1(json.dumps(self.signature, sort_keys=True).encode()).hexdigest()[:16]
+
+        if cachedir is None:
+            from legacyhalos.misc import cache_dir
+            cachedir = cache_dir()
+        self.cachefile = None
+        if cachedir:
+            self.cachefile = os.path.join(cachedir, 'massdef-{}-{}-{}.npz'.format(
+                mdef_in, mdef_out, self.key))
+
+        self._spline = None
+        self.maxerror = None
+
+    def set_cosmology(self):
+        """Make this the current colossus cosmology."""
+        from colossus.cosmology import cosmology
+        return cosmology.setCosmology(self.cosmo_name, self.cosmo_params)
+
+    def _read(self):
+        if self.cachefile is None or not os.path.isfile(self.cachefile):
+            return None
+        try:
+            with np.load(self.cachefile, allow_pickle=False) as npz:
+                if str(npz['signature']) != json.dumps(self.signature, sort_keys=True):
+                    return None
+                table, maxerror = npz['table'], float(npz['maxerror'])
+        except Exception as err:
+            print('Ignoring unreadable mass-definition table {}: {}'.format(self.cachefile, err))
+            return None
+        if table.shape != (len(self.logmass), len(self.redshift)) or not maxerror <= self.tol:
+            return None
+        return table, maxerror
+
+    def _write(self, table, maxerror):
+        if self.cachefile is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cachefile), exist_ok=True)
+            tmpfile = '{}.tmp-{}'.format(self.cachefile, os.getpid())
+            with open(tmpfile, 'wb') as F:
+                np.savez(F, table=table, maxerror=maxerror, logmass=self.logmass,
+                         redshift=self.redshift, signature=json.dumps(self.signature, sort_keys=True))
+            os.replace(tmpfile, self.cachefile)
+        except OSError as err:
+            print('Unable to write mass-definition table {}: {}'.format(self.cachefile, err))
+
+    def _build(self):
+        """Tabulate log10(Mout/Min) with colossus."""
+        from colossus.halo import mass_defs
+
+        self.set_cosmology()
+        mass = 10**self.logmass
+        table = np.zeros((len(self.logmass), len(self.redshift)))
+        for jj, zz in enumerate(self.redshift):
+            mout, _, _ = mass_defs.changeMassDefinition(mass, np.full_like(mass, self.c), zz,
+                                                        self.mdef_in, self.mdef_out)
+            table[:, jj] = np.log10(mout) - self.logmass
+        return table
+
+    def validate(self, nvalidate=None, seed=1):
+        """Maximum difference [dex] between the interpolated and colossus masses
+        at nvalidate random points within the grid.
+
+        """
+        if nvalidate is None:
+            nvalidate = self.nvalidate
+        rand = np.random.RandomState(seed)
+        logm = rand.uniform(self.logmass[0], self.logmass[-1], nvalidate)
+        zz = rand.uniform(self.redshift[0], self.redshift[-1], nvalidate)
+        self.set_cosmology()
+        truth = np.log10(change_mass_definition(10**logm, zz, self.mdef_in, self.mdef_out, c=self.c))
+        return np.max(np.abs(self._interp(logm, zz) - truth))
+
+    def load(self):
+        """Read the table from the cache or, if needed, build, validate, and save it."""
+        from scipy.interpolate import RectBivariateSpline
+
+        if self._spline is not None:
+            return self
+        cached = self._read()
+        if cached is not None:
+            table, self.maxerror = cached
+            self._spline = RectBivariateSpline(self.logmass, self.redshift, table, kx=3, ky=3)
+            return self
+
+        table = self._build()
+        self._spline = RectBivariateSpline(self.logmass, self.redshift, table, kx=3, ky=3)
+        maxerror = self.validate()
+        if not maxerror <= self.tol:
+            self._spline = None
+            raise ValueError('Interpolated {}-->{} masses differ from colossus by {:.2e} dex (> {:.2e} dex).'.format(
+                self.mdef_in, self.mdef_out, maxerror, self.tol))
+        self.maxerror = maxerror
+        self._write(table, maxerror)
+        return self
+
+    def _interp(self, logm, zz):
+        return logm + self._spline.ev(logm, zz)
+
+    def __call__(self, mass, redshift):
+        """Convert Min [Msun/h] at redshift to Mout [Msun/h]."""
+        self.load()
+        mass, redshift = np.broadcast_arrays(np.asarray(mass, 'f8'), np.asarray(redshift, 'f8'))
+        logm = np.log10(mass)
+        out = np.zeros(mass.shape)
+
+        inside = ((logm >= self.logmass[0]) * (logm <= self.logmass[-1]) *
+                  (redshift >= self.redshift[0]) * (redshift <= self.redshift[-1]))
+        out[inside] = 10**self._interp(logm[inside], redshift[inside])
+        if not np.all(inside):
+            self.set_cosmology()
+            out[~inside] = change_mass_definition(mass[~inside], redshift[~inside], self.mdef_in,
+                                                  self.mdef_out, c=self.c)
+        return out
+
+def get_table(cosmo_name, cosmo_params, mdef_in, mdef_out, c=3.5, **kwargs):
+    """MassDefinitionTable for a cosmology and pair of mass definitions, reusing
+    the one already loaded in this process, if any.
+
+    """
+    table = MassDefinitionTable(cosmo_name, cosmo_params, mdef_in, mdef_out, c=c, **kwargs)
+    if table.key not in _TABLES:
+        _TABLES[table.key] = table
+    return _TABLES[table.key]
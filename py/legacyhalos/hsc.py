@@ -76,8 +76,9 @@ def get_galaxy_galaxydir(cat, datadir=None, htmldir=None, html=False):
         return galaxy, galaxydir
 
 def missing_files(args, sample, size=1, clobber_overwrite=None):
-    import multiprocessing
     from legacyhalos.io import _missing_files_one
+    from legacyhalos.pool import get_pool
+    from legacyhalos.statedb import missing_files as statedb_missing_files
 
     dependson = None
     if args.htmlplots is False and args.htmlindex is False:
@@ -144,7 +145,7 @@ def missing_files(args, sample, size=1, clobber_overwrite=None):
         ngal = len(sample)
     indices = np.arange(ngal)
 
-    pool = multiprocessing.Pool(args.nproc)
+    pool = get_pool(args.nproc)
     missargs = []
     for gal, gdir in zip(np.atleast_1d(galaxy), np.atleast_1d(galaxydir)):
         #missargs.append([gal, gdir, filesuffix, dependson, clobber])
@@ -157,7 +158,9 @@ def missing_files(args, sample, size=1, clobber_overwrite=None):
     if args.verbose:
         t0 = time.time()
         print('Finding missing files...', end='')
-    todo = np.array(pool.map(_missing_files_one, missargs))
+    todo = statedb_missing_files(np.atleast_1d(galaxy), filesuffix, dependson=dependson, clobber=clobber)
+    if todo is None:
+        todo = np.array(pool.map(_missing_files_one, missargs))
     if args.verbose:
         print('...took {:.3f} min'.format((time.time() - t0)/60))
 
@@ -202,6 +205,7 @@ def mpi_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--nproc', default=1, type=int, help='number of multiprocessing processes per MPI rank.')
     parser.add_argument('--mpi', action='store_true', help='Use MPI parallelism')
+    parser.add_argument('--static-schedule', action='store_true', help='Divide the galaxies across MPI ranks ahead of time rather than dynamically.')
 
     parser.add_argument('--first', type=int, help='Index of first object to process.')
     parser.add_argument('--last', type=int, help='Index of last object to process.')
@@ -227,6 +231,15 @@ def mpi_args():
 
     parser.add_argument('--force', action='store_true', help='Use with --coadds; ignore previous pickle files.')
     parser.add_argument('--count', action='store_true', help='Count how many objects are left to analyze and then return.')
+    parser.add_argument('--prefetch', action='store_true', help='Use with --ellipse; stage the inputs of the next galaxy in node-local scratch in the background.')
+    parser.add_argument('--prefetch-maxgb', default=4.0, type=float, help='Maximum node-local scratch space used by --prefetch (GB).')
+    parser.add_argument('--concurrent-bands', action='store_true', help='Use with --ellipse; fit the isophotes and aperture photometry of all the bands together on the worker pool.')
+    parser.add_argument('--multires', action='store_true', help='Use with --ellipse; sample the outer isophotes from block-averaged images.')
+    parser.add_argument('--stats-engine', default='astropy', type=str, choices=['astropy', 'histogram', 'subsample'],
+                        help='Use with --ellipse; engine for the sigma-clipped image statistics (see legacyhalos.robust).')
+    parser.add_argument('--adaptive-sma', action='store_true', help='Use with --ellipse; integrate on an adaptive sma grid and stop each band at the noise.')
+    parser.add_argument('--sma-snrmin', default=1.0, type=float, help='Use with --adaptive-sma; minimum signal-to-noise ratio of an isophote.')
+    parser.add_argument('--sma-nlow', default=3, type=int, help='Use with --adaptive-sma; stop a band after this many consecutive isophotes below --sma-snrmin.')
     parser.add_argument('--debug', action='store_true', help='Log to STDOUT and build debugging plots.')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose output.')
     parser.add_argument('--clobber', action='store_true', help='Overwrite existing files.')                                
@@ -598,7 +611,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
 def read_multiband(galaxy, galaxydir, galaxy_id, filesuffix='custom',
                    refband='r', bands=['g', 'r', 'z'], pixscale=0.262,
                    redshift=None, fill_value=0.0, sky_tests=False,
-                   verbose=False):
+                   stats_engine='astropy', verbose=False):
     """Read the multi-band images (converted to surface brightness) and create a
     masked array suitable for ellipse-fitting.
 
@@ -715,7 +728,8 @@ def read_multiband(galaxy, galaxydir, galaxy_id, filesuffix='custom',
 
     # Read the basic imaging data and masks.
     data = _read_image_data(data, filt2imfile, starmask=starmask,
-                            fill_value=fill_value, verbose=verbose)
+                            fill_value=fill_value, stats_engine=stats_engine,
+                            verbose=verbose)
     
     # Find the central.
     samplefile = os.path.join(galaxydir, '{}-{}.fits'.format(galaxy, filt2imfile['sample']))
@@ -770,10 +784,23 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                  filesuffix='custom', bands=['g', 'r', 'z'], refband='r',
                  input_ellipse=None, 
                  sky_tests=False, unwise=False, verbose=False,
-                 debug=False, logfile=None):
+                 debug=False, logfile=None, inputdir=None,
+                 concurrent_bands=False, multires=False, adaptive_sma=False,
+                 sma_snrmin=1.0, sma_nlow=3, stats_engine='astropy'):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the legacyhalos project.
 
+    inputdir - read the input files from this directory (e.g., staged by
+      legacyhalos.prefetch) instead of galaxydir
+    concurrent_bands - fit all the bands together on the worker pool (see
+      legacyhalos.mpi.call_ellipse)
+    multires - sample the outer isophotes from block-averaged images (see
+      legacyhalos.mpi.call_ellipse)
+    adaptive_sma, sma_snrmin, sma_nlow - integrate on an adaptive sma grid and
+      stop each band at the noise (see legacyhalos.mpi.call_ellipse)
+    stats_engine - engine for the sigma-clipped statistics of the images (see
+      legacyhalos.robust.clipped_stats)
+
     """
     import astropy.table
     from copy import deepcopy
@@ -783,19 +810,24 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
         onegal = onegal[0] # create a Row object
     galaxy_id = onegal[GALAXYCOLUMN]
 
+    if inputdir is None:
+        inputdir = galaxydir
+
     if logfile:
         from contextlib import redirect_stdout, redirect_stderr
         with open(logfile, 'a') as log:
             with redirect_stdout(log), redirect_stderr(log):
-                data, galaxyinfo = read_multiband(galaxy, galaxydir, galaxy_id, bands=bands,
+                data, galaxyinfo = read_multiband(galaxy, inputdir, galaxy_id, bands=bands,
                                                   filesuffix=filesuffix, refband=refband,
                                                   pixscale=pixscale, redshift=onegal[ZCOLUMN],
-                                                  sky_tests=sky_tests, verbose=verbose)
+                                                  sky_tests=sky_tests, stats_engine=stats_engine,
+                                                  verbose=verbose)
     else:
-        data, galaxyinfo = read_multiband(galaxy, galaxydir, galaxy_id, bands=bands,
+        data, galaxyinfo = read_multiband(galaxy, inputdir, galaxy_id, bands=bands,
                                           filesuffix=filesuffix, refband=refband,
                                           pixscale=pixscale, redshift=onegal[ZCOLUMN],
-                                          sky_tests=sky_tests, verbose=verbose)
+                                          sky_tests=sky_tests, stats_engine=stats_engine,
+                                          verbose=verbose)
 
     maxsma, delta_logsma = None, 6
     #maxsma, delta_logsma = 200, 10
@@ -821,14 +853,14 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                                        delta_logsma=delta_logsma, maxsma=maxsma,
                                        write_donefile=False,
                                        input_ellipse=input_ellipse,
-                                       verbose=verbose, debug=True)#, logfile=logfile)# no logfile and debug=True, otherwise this will crash
+                                       concurrent_bands=concurrent_bands, multires=multires,
+                                       adaptive_sma=adaptive_sma, sma_snrmin=sma_snrmin,
+                                       sma_nlow=sma_nlow, verbose=verbose, debug=True)#, logfile=logfile)# no logfile and debug=True, otherwise this will crash
 
                 # no need to redo the nominal ellipse-fitting
                 if isky == 0:
-                    inellipsefile = os.path.join(galaxydir, '{}-{}-{}-ellipse.fits'.format(galaxy, skydata['filesuffix'], galaxy_id))
-                    outellipsefile = os.path.join(galaxydir, '{}-{}-{}-ellipse.fits'.format(galaxy, data['filesuffix'], galaxy_id))
-                    print('Copying {} --> {}'.format(inellipsefile, outellipsefile))
-                    shutil.copy2(inellipsefile, outellipsefile)
+                    legacyhalos.io.copy_ellipsefit(galaxy, galaxydir, skydata['filesuffix'], data['filesuffix'],
+                                                   galaxy_id=galaxy_id)
             return err
 
         t0 = time.time()
@@ -867,7 +899,9 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                          bands=bands, refband=refband, sbthresh=SBTHRESH,
                          delta_logsma=delta_logsma, maxsma=maxsma,
                          input_ellipse=input_ellipse,
-                         verbose=verbose, debug=debug, logfile=logfile)
+                         concurrent_bands=concurrent_bands, multires=multires,
+                         adaptive_sma=adaptive_sma, sma_snrmin=sma_snrmin,
+                         sma_nlow=sma_nlow, verbose=verbose, debug=debug, logfile=logfile)
 
 def make_html(sample=None, datadir=None, htmldir=None, bands=('g', 'r', 'z'),
               refband='r', pixscale=0.262, zcolumn='Z', intflux=None,
@@ -6,7 +6,6 @@ Code to integrate the surface brightness profiles, including extrapolation.
 
 """
 import os, warnings, pdb
-import multiprocessing
 import numpy as np
 
 from scipy.interpolate import interp1d
@@ -14,6 +13,7 @@ from astropy.table import Table, Column, vstack, hstack
     
 import legacyhalos.io
 import legacyhalos.misc
+import legacyhalos.pool
 import legacyhalos.hsc
 import legacyhalos.ellipse
 
@@ -215,7 +215,7 @@ def legacyhalos_integrate(sample, galaxy=None, galaxydir=None, nproc=1,
 
     # Divide the sample by cores.
     if nproc > 1:
-        pool = multiprocessing.Pool(nproc)
+        pool = legacyhalos.pool.get_pool(nproc)
         out = pool.map(_integrate_one, args)
     else:
         out = list()
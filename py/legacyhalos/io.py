@@ -214,6 +214,7 @@ def _get_ellipse_datamodel(sbthresh, bands=['g', 'r', 'z']):
         cols.append(('{}_ndata'.format(band), ''))
         cols.append(('{}_nflag'.format(band), ''))
         cols.append(('{}_niter'.format(band), ''))
+        cols.append(('{}_sma_stop'.format(band), u.pixel))
         cols.append(('{}_cog_sma'.format(band), u.arcsec))
         cols.append(('{}_cog_mag'.format(band), u.mag))
         cols.append(('{}_cog_magerr'.format(band), u.mag))
@@ -235,19 +236,33 @@ def _get_ellipse_datamodel(sbthresh, bands=['g', 'r', 'z']):
     return cols
 
 def write_ellipsefit(galaxy, galaxydir, ellipsefit, filesuffix='', galaxy_id='',
-                     galaxyinfo=None, refband='r', sbthresh=None, verbose=False):
+                     galaxyinfo=None, refband='r', sbthresh=None, storedir=None,
+                     verbose=False):
     """Write out a FITS file based on the output of
     legacyhalos.ellipse.ellipse_multiband..
 
     ellipsefit - input dictionary
+    storedir - if not None (default is ${LEGACYHALOS_ELLIPSE_STORE}), append the
+      results to the batched ellipse store in this directory (see
+      legacyhalos.ellipsestore) instead of writing a file for this galaxy
 
     """
     from astropy.io import fits
     from astropy.table import QTable
+    from legacyhalos.ellipsestore import ellipse_store_dir, ellipse_store_file, append_ellipsefit
 
     if type(galaxy_id) is not str:
         galaxy_id = str(galaxy_id)
 
+    if storedir is None:
+        storedir = ellipse_store_dir()
+    if storedir is not None:
+        append_ellipsefit(ellipse_store_file(storedir), galaxy, ellipsefit,
+                          galaxyinfo=galaxyinfo, galaxy_id=galaxy_id,
+                          filesuffix=filesuffix, sbthresh=sbthresh,
+                          verbose=verbose)
+        return
+
     if galaxy_id.strip() == '':
         galid = ''
     else:
@@ -335,11 +350,26 @@ def write_ellipsefit(galaxy, galaxydir, ellipsefit, filesuffix='', galaxy_id='',
     #out.write(ellipsefitfile, overwrite=True)
     #fitsio.write(ellipsefitfile, out.as_array(), extname='ELLIPSE', header=hdr, clobber=True)
 
-def read_ellipsefit(galaxy, galaxydir, filesuffix='', galaxy_id='', verbose=True):
+def read_ellipsefit(galaxy, galaxydir, filesuffix='', galaxy_id='', storedir=None,
+                    verbose=True):
     """Read the output of write_ellipsefit. Convert the astropy Table into a
     dictionary so we can use a bunch of legacy code.
 
+    storedir - if not None (default is ${LEGACYHALOS_ELLIPSE_STORE}), read from
+      the batched ellipse store in this directory, falling back to the
+      per-galaxy file if the galaxy is not in the store
+
     """
+    from legacyhalos.ellipsestore import ellipse_store_dir, read_ellipsefit_store
+
+    if storedir is None:
+        storedir = ellipse_store_dir()
+    if storedir is not None:
+        ellipsefit = read_ellipsefit_store(storedir, galaxy, galaxy_id=galaxy_id,
+                                           filesuffix=filesuffix, verbose=False)
+        if bool(ellipsefit):
+            return ellipsefit
+
     if galaxy_id.strip() == '':
         galid = ''
     else:
@@ -368,6 +398,58 @@ def read_ellipsefit(galaxy, galaxydir, filesuffix='', galaxy_id='', verbose=True
 
     return ellipsefit
 
+def _ellipsefit_file(galaxy, galaxydir, filesuffix='', galaxy_id=''):
+    if galaxy_id.strip() == '':
+        galid = ''
+    else:
+        galid = '-{}'.format(galaxy_id)
+    if filesuffix.strip() == '':
+        fsuff = ''
+    else:
+        fsuff = '-{}'.format(filesuffix)
+    return os.path.join(galaxydir, '{}{}{}-ellipse.fits'.format(galaxy, fsuff, galid))
+
+def ellipsefit_exists(galaxy, galaxydir, filesuffix='', galaxy_id='', storedir=None):
+    """Whether the output of write_ellipsefit exists, either in the batched
+    ellipse store (see read_ellipsefit) or as a file.
+
+    """
+    from legacyhalos.ellipsestore import ellipse_store_dir, in_ellipse_store
+
+    if storedir is None:
+        storedir = ellipse_store_dir()
+    if storedir is not None and in_ellipse_store(storedir, galaxy, galaxy_id=str(galaxy_id),
+                                                 filesuffix=filesuffix):
+        return True
+    return os.path.isfile(_ellipsefit_file(galaxy, galaxydir, filesuffix=filesuffix,
+                                           galaxy_id=str(galaxy_id)))
+
+def copy_ellipsefit(galaxy, galaxydir, infilesuffix, outfilesuffix, galaxy_id='',
+                    storedir=None, verbose=True):
+    """Copy the output of write_ellipsefit from one filesuffix to another, in the
+    batched ellipse store (if the galaxy is there) or as a file.
+
+    """
+    import shutil
+    from legacyhalos.ellipsestore import ellipse_store_dir, in_ellipse_store, copy_ellipse_store
+
+    galaxy_id = str(galaxy_id)
+    if storedir is None:
+        storedir = ellipse_store_dir()
+    if storedir is not None and in_ellipse_store(storedir, galaxy, galaxy_id=galaxy_id,
+                                                 filesuffix=infilesuffix):
+        if verbose:
+            print('Copying {} {} --> {} in {}'.format(galaxy, infilesuffix, outfilesuffix, storedir))
+        copy_ellipse_store(storedir, galaxy, galaxy_id=galaxy_id, infilesuffix=infilesuffix,
+                           outfilesuffix=outfilesuffix)
+        return
+
+    inellipsefile = _ellipsefit_file(galaxy, galaxydir, filesuffix=infilesuffix, galaxy_id=galaxy_id)
+    outellipsefile = _ellipsefit_file(galaxy, galaxydir, filesuffix=outfilesuffix, galaxy_id=galaxy_id)
+    if verbose:
+        print('Copying {} --> {}'.format(inellipsefile, outellipsefile))
+    shutil.copy2(inellipsefile, outellipsefile)
+
 def write_sersic(galaxy, galaxydir, sersic, modeltype='single', verbose=False):
     """Pickle a dictionary of photutils.isophote.isophote.IsophoteList objects (see,
     e.g., ellipse.fit_multiband).
@@ -469,120 +551,246 @@ def _get_psfsize_and_depth(tractor, bands, pixscale, incenter=False):
         
     return out
 
+# Steps timed by _read_image_data.
+READ_IMAGE_STEPS = ('read', 'starmask', 'smooth', 'sigma_clip', 'dilate', 'variance', 'wcs_psf')
+
+# Default maximum number of threads used by _read_image_data.
+READ_IMAGE_NTHREADS = 2
+
+def _read_image_files(imfiles, verbose=False):
+    """Read the image, model, inverse variance, and PSF files of one band; see
+    _read_image_data. fitsio holds the GIL while it decompresses, so the bands
+    are read one after another in the calling thread.
+
+    """
+    from time import perf_counter
+
+    # Read the data and initialize the mask with the inverse variance image,
+    # if available.
+    t0 = perf_counter()
+    if verbose:
+        print('Reading {}'.format(imfiles['image']))
+        print('Reading {}'.format(imfiles['model']))
+    image = fitsio.read(imfiles['image'])
+    hdr = fitsio.read_header(imfiles['image'], ext=1)
+    model = fitsio.read(imfiles['model'])
+    if 'invvar' in imfiles.keys():
+        if verbose:
+            print('Reading {}'.format(imfiles['invvar']))
+        invvar = fitsio.read(imfiles['invvar'])
+    else:
+        invvar = None
+    if verbose:
+        print('Reading {}'.format(imfiles['psf']))
+    psfimg = fitsio.read(imfiles['psf'])
+
+    return {'image': image, 'hdr': hdr, 'model': model, 'invvar': invvar,
+            'psfimg': psfimg, 'timing': {'read': perf_counter() - t0}}
+
+def _preprocess_image_band(band, starmask, stats_engine='astropy'):
+    """Build the mask, residual mask, and variance of one band read by
+    _read_image_files; see _read_image_data.
+
+    Only numpy / scipy / skimage are called here, which release the GIL in the
+    expensive (filtering and morphology) steps and hold no shared state, so the
+    bands can be preprocessed in separate threads. Returns a dictionary of the
+    products and the time spent in each step [s].
+
+    """
+    from time import perf_counter
+    from scipy.ndimage import binary_dilation, gaussian_filter
+    from skimage.transform import resize
+    from legacyhalos.robust import clipped_stats
+
+    # Take the images out of the dictionary so the model can be freed as soon
+    # as it has been used.
+    image, hdr, model, invvar, psfimg, timing = [band.pop(key) for key in (
+        'image', 'hdr', 'model', 'invvar', 'psfimg', 'timing')]
+
+    if invvar is not None:
+        mask = invvar <= 0 # True-->bad, False-->good
+    else:
+        mask = np.zeros_like(image).astype(bool)
+
+    sz = image.shape
+
+    ## optional additional (scalar) sky-subtraction
+    #if 'sky' in imfiles.keys():
+    #    #print('Subtracting!!! ', imfiles['sky'])
+    #    image += imfiles['sky']
+    #    model += imfiles['sky']
+
+    # GALEX, unWISE need to be resized.
+    if starmask.shape == sz:
+        doresize = False
+    else:
+        doresize = True
+
+    # Add in the star mask, resizing if necessary for this image/pixel scale.
+    t0 = perf_counter()
+    if doresize:
+        _starmask = resize(starmask, mask.shape, mode='reflect')
+        mask = np.logical_or(mask, _starmask)
+    else:
+        mask = np.logical_or(mask, starmask)
+    timing['starmask'] = perf_counter() - t0
+
+    # Flag significant residual pixels after subtracting *all* the models
+    # (we will restore the pixels of the galaxies of interest below).
+    t0 = perf_counter()
+    resid = gaussian_filter(image - model, 2.0)
+    del model
+    timing['smooth'] = perf_counter() - t0
+
+    t0 = perf_counter()
+    _, _, sig = clipped_stats(resid, sigma=3.0, engine=stats_engine)
+    residual_mask = np.abs(resid) > 5*sig
+    del resid
+    timing['sigma_clip'] = perf_counter() - t0
+
+    # Dilate the mask and mask out a 2% border.
+    t0 = perf_counter()
+    mask = binary_dilation(mask, iterations=2)
+    edge = int(0.02*sz[0])
+    mask[:edge, :] = True
+    mask[:, :edge] = True
+    mask[:, sz[0]-edge:] = True
+    mask[sz[0]-edge:, :] = True
+    timing['dilate'] = perf_counter() - t0
+
+    t0 = perf_counter()
+    if invvar is not None:
+        var = np.zeros_like(invvar)
+        ok = invvar > 0
+        var[ok] = 1 / invvar[ok]
+        negative = np.any(invvar < 0)
+    else:
+        var, negative = None, False
+    timing['variance'] = perf_counter() - t0
+
+    return {'image': image, 'hdr': hdr, 'mask': mask, 'var': var, 'negative': negative,
+            'psfimg': psfimg, 'sigma': sig, 'residual_mask': residual_mask,
+            'doresize': doresize, 'timing': timing}
+
+def _read_image_band(filt, imfiles, starmask, stats_engine='astropy', verbose=False):
+    """Read and preprocess the data in one band; see _read_image_data."""
+    return _preprocess_image_band(_read_image_files(imfiles, verbose=verbose),
+                                  starmask, stats_engine=stats_engine)
+
 def _read_image_data(data, filt2imfile, starmask=None, fill_value=0.0,
-                     verbose=False):
+                     nthreads=None, stats_engine='astropy', verbose=False):
     """Helper function for the project-specific read_multiband method.
 
     Read the multi-band images and inverse variance images and pack them into a
     dictionary. Also create an initial pixel-level mask and handle images with
     different pixel scales (e.g., GALEX and WISE images).
 
+    The bands are independent until they are packed together. fitsio holds the
+    GIL while it decompresses, so the files are read in this thread, one band
+    after another, but each band is then preprocessed (smoothing, clipping,
+    dilation; see _preprocess_image_band) in a pool of nthreads threads while
+    the next one is read. At most nthreads bands (default READ_IMAGE_NTHREADS)
+    are being preprocessed at any time, which bounds the memory held by their
+    model and residual images; nthreads=1 reads and preprocesses the bands one
+    after another. The results do not depend on nthreads. The time spent in
+    each step (see READ_IMAGE_STEPS), summed over the bands, is printed if
+    verbose=True and reported to the stage telemetry (see
+    legacyhalos.telemetry), so the wall-clock time can be compared with the
+    serial sum.
+
+    stats_engine - engine used to measure the (sigma-clipped) noise of the
+      smoothed residual image in each band; see legacyhalos.robust.clipped_stats.
+
     """
-    from astropy.stats import sigma_clipped_stats
-    from scipy.ndimage.morphology import binary_dilation
-    from scipy.ndimage.filters import gaussian_filter
+    from time import perf_counter
     from skimage.transform import resize
 
     from tractor.psf import PixelizedPSF
     from tractor.tractortime import TAITime
     from astrometry.util.util import Tan
     from legacypipe.survey import LegacySurveyWcs
+    from legacyhalos.telemetry import record_metric
+    from legacyhalos.robust import STATS_ENGINES
+
+    if stats_engine not in STATS_ENGINES:
+        raise ValueError('Unrecognized stats_engine {}'.format(stats_engine))
 
     bands, refband = data['bands'], data['refband']
 
-    # Loop on each filter and return the masked data.
-    residual_mask = None
-    for filt in bands:
-        # Read the data and initialize the mask with the inverse variance image,
-        # if available.
-        if verbose:
-            print('Reading {}'.format(filt2imfile[filt]['image']))
-            print('Reading {}'.format(filt2imfile[filt]['model']))
-        image = fitsio.read(filt2imfile[filt]['image'])
-        hdr = fitsio.read_header(filt2imfile[filt]['image'], ext=1)
-        model = fitsio.read(filt2imfile[filt]['model'])
-
-        sz = image.shape
-
-        ## optional additional (scalar) sky-subtraction
-        #if 'sky' in filt2imfile[filt].keys():
-        #    #print('Subtracting!!! ', filt2imfile[filt]['sky'])
-        #    image += filt2imfile[filt]['sky']
-        #    model += filt2imfile[filt]['sky']
-
-        # GALEX, unWISE need to be resized.
-        if starmask.shape == sz:
-            doresize = False
-        else:
-            doresize = True
-
-        # Initialize the mask based on the inverse variance
-        if 'invvar' in filt2imfile[filt].keys():
-            if verbose:
-                print('Reading {}'.format(filt2imfile[filt]['invvar']))
-            invvar = fitsio.read(filt2imfile[filt]['invvar'])
-            mask = invvar <= 0 # True-->bad, False-->good
-        else:
-            invvar = None
-            mask = np.zeros_like(image).astype(bool)
+    if nthreads is None:
+        nthreads = READ_IMAGE_NTHREADS
+    nthreads = max(1, min(int(nthreads), len(bands)))
+
+    tstart = perf_counter()
+    if nthreads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        futures = []
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            for filt in bands:
+                # Do not read ahead of the bands still being preprocessed.
+                if len(futures) >= nthreads:
+                    futures[-nthreads].result()
+                band = _read_image_files(filt2imfile[filt], verbose=verbose)
+                futures.append(executor.submit(_preprocess_image_band, band, starmask,
+                                               stats_engine=stats_engine))
+                del band
+            perband = [future.result() for future in futures]
+    else:
+        perband = [_read_image_band(filt, filt2imfile[filt], starmask,
+                                    stats_engine=stats_engine, verbose=verbose)
+                   for filt in bands]
 
-        # Retrieve the PSF and WCS.
+    # Pack the bands into the dictionary in order; the PSF and WCS objects
+    # are built here, in the main thread.
+    residual_mask = None
+    timing = dict((step, 0.0) for step in READ_IMAGE_STEPS)
+    for filt, band in zip(bands, perband):
+        t0 = perf_counter()
         if filt == refband:
-            HH, WW = sz
+            HH, WW = band['image'].shape
             data['refband_width'] = WW
             data['refband_height'] = HH
-            
-        if verbose:
-            print('Reading {}'.format(filt2imfile[filt]['psf']))
-        psfimg = fitsio.read(filt2imfile[filt]['psf'])
-        data['{}_psf'.format(filt)] = PixelizedPSF(psfimg)
 
-        mjd_tai = hdr['MJD_MEAN'] # [TAI]
+        # Retrieve the PSF and WCS.
+        data['{}_psf'.format(filt)] = PixelizedPSF(band['psfimg'])
+
+        mjd_tai = band['hdr']['MJD_MEAN'] # [TAI]
         wcs = Tan(filt2imfile[filt]['image'], 1)
 
         data['{}_wcs'.format(filt)] = LegacySurveyWcs(wcs, TAITime(None, mjd=mjd_tai))
+        band['timing']['wcs_psf'] = perf_counter() - t0
 
-        # Add in the star mask, resizing if necessary for this image/pixel scale.
-        if doresize:
-            _starmask = resize(starmask, mask.shape, mode='reflect')
-            mask = np.logical_or(mask, _starmask)
-        else:
-            mask = np.logical_or(mask, starmask)
-
-        # Flag significant residual pixels after subtracting *all* the models
-        # (we will restore the pixels of the galaxies of interest below).
-        resid = gaussian_filter(image - model, 2.0)
-        _, _, sig = sigma_clipped_stats(resid, sigma=3.0)
-        data['{}_sigma'.format(filt)] = sig
+        data['{}_sigma'.format(filt)] = band['sigma']
         if residual_mask is None:
-            residual_mask = np.abs(resid) > 5*sig
+            residual_mask = band['residual_mask']
         else:
-            _residual_mask = np.abs(resid) > 5*sig
-            if doresize:
+            _residual_mask = band['residual_mask']
+            if band['doresize']:
                 _residual_mask = resize(_residual_mask, residual_mask.shape, mode='reflect')
             residual_mask = np.logical_or(residual_mask, _residual_mask)
 
-        # Dilate the mask, mask out a 10% border, and pack into a dictionary.
-        mask = binary_dilation(mask, iterations=2)
-        edge = np.int(0.02*sz[0])
-        mask[:edge, :] = True
-        mask[:, :edge] = True
-        mask[:, sz[0]-edge:] = True
-        mask[sz[0]-edge:, :] = True
-
-        data[filt] = ma.masked_array(image, mask) # [nanomaggies]
+        data[filt] = ma.masked_array(band['image'], band['mask']) # [nanomaggies]
         ma.set_fill_value(data[filt], fill_value)
 
-        if invvar is not None:
-            var = np.zeros_like(invvar)
-            ok = invvar > 0
-            var[ok] = 1 / invvar[ok]
-            data['{}_var_'.format(filt)] = var # [nanomaggies**2]
+        if band['var'] is not None:
+            data['{}_var_'.format(filt)] = band['var'] # [nanomaggies**2]
             #data['{}_var'.format(filt)] = var / thispixscale**4 # [nanomaggies**2/arcsec**4]
-            if np.any(invvar < 0):
+            if band['negative']:
                 print('Warning! Negative pixels in the {}-band inverse variance map!'.format(filt))
                 #pdb.set_trace()
 
+        for step in READ_IMAGE_STEPS:
+            timing[step] += band['timing'].get(step, 0.0)
+
     data['residual_mask'] = residual_mask
+    walltime = perf_counter() - tstart
+
+    if verbose:
+        print('Read {} bands in {:.2f} sec using {} thread(s); time per step (summed over bands):'.format(
+            len(bands), walltime, nthreads))
+        for step in READ_IMAGE_STEPS:
+            print('  {:<12s} {:8.3f} sec'.format(step, timing[step]))
+    record_metric(read_nthreads=nthreads, read_walltime=walltime,
+                  **dict(('read_{}_time'.format(step), timing[step]) for step in READ_IMAGE_STEPS))
 
     return data
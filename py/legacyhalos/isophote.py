@@ -0,0 +1,347 @@
+"""
+legacyhalos.isophote
+====================
+
+Shared-memory engine for integrating isophotes in parallel.
+
+The masked image (and its mask) for each band is written once to a
+memory-mapped scratch file, typically on /dev/shm, and the worker processes
+attach to it by name. Each task then only carries a chunk of semi-major axes
+instead of a pickled copy of the full masked image.
+
+integrate_isophotes_adaptive instead measures the isophotes outward on an
+adaptive semi-major axis grid and stops each band once its profile has faded
+into the noise.
+
+"""
+import os, shutil, tempfile, pdb
+import numpy as np
+import numpy.ma as ma
+
+def _scratch_dir(scratchdir=None):
+    """Default location of the memory-mapped images: /dev/shm if available
+    (i.e., RAM-backed), otherwise the system temporary directory.
+
+    """
+    if scratchdir is None:
+        scratchdir = os.getenv('LEGACYHALOS_SHM_DIR')
+    if scratchdir is None and os.path.isdir('/dev/shm'):
+        scratchdir = '/dev/shm'
+    return tempfile.mkdtemp(prefix='legacyhalos-', dir=scratchdir)
+
+def publish_image(img, scratchdir=None):
+    """Write a (masked) image to a memory-mapped scratch file so that it can be
+    shared with the worker processes.
+
+    Returns a small, picklable dictionary which is passed to each task in lieu
+    of the image itself. Call release_image() when done.
+
+    """
+    outdir = _scratch_dir(scratchdir)
+
+    imgfile = os.path.join(outdir, 'image.npy')
+    np.save(imgfile, ma.getdata(img))
+
+    # Preserve ma.nomask (rather than an all-False mask) so the image is
+    # reconstructed exactly as it was passed.
+    mask = ma.getmask(img)
+    if mask is ma.nomask:
+        maskfile = None
+    else:
+        maskfile = os.path.join(outdir, 'mask.npy')
+        np.save(maskfile, mask)
+
+    if ma.isMaskedArray(img):
+        fill_value = img.fill_value
+    else:
+        fill_value = None
+
+    shared = {'dir': outdir, 'image': imgfile, 'mask': maskfile,
+              'masked': ma.isMaskedArray(img), 'fill_value': fill_value}
+    return shared
+
+def release_image(shared):
+    """Remove the scratch files written by publish_image."""
+    if shared is not None and os.path.isdir(shared['dir']):
+        shutil.rmtree(shared['dir'], ignore_errors=True)
+
+def attach_image(shared):
+    """Rebuild the (masked) image from the memory-mapped scratch files without
+    copying the pixels. Called in the worker processes.
+
+    The image is not cached: the mapping is released as soon as the task drops
+    its reference, so no worker still maps the scratch files (which, on
+    /dev/shm, use memory until they are unmapped) once release_image removes
+    them.
+
+    """
+    data = np.asarray(np.load(shared['image'], mmap_mode='r'))
+    if shared['masked']:
+        if shared['mask'] is None:
+            img = ma.masked_array(data)
+        else:
+            mask = np.asarray(np.load(shared['mask'], mmap_mode='r'))
+            img = ma.masked_array(data, mask)
+        ma.set_fill_value(img, shared['fill_value'])
+    else:
+        img = data
+    return img
+
+def _publish_images(imgs, nlevel=1, scratchdir=None):
+    """Publish a dictionary of images (or, if nlevel>1, of image pyramids; see
+    legacyhalos.multires) to the worker processes.
+
+    The pyramids are built without a variance image: the isophotes only need
+    the block-averaged pixels (their errors come from the scatter of the
+    samples, as at full resolution), and read_multiband does not provide one.
+    The propagated variance is only used by multires.validate_multires.
+
+    """
+    from legacyhalos.multires import image_pyramid
+
+    shared = {}
+    try:
+        for key in imgs.keys():
+            if nlevel > 1:
+                shared[key] = [publish_image(level, scratchdir=scratchdir) for level, _ in
+                               image_pyramid(imgs[key], var=None, nlevel=nlevel)]
+            else:
+                shared[key] = publish_image(imgs[key], scratchdir=scratchdir)
+    except:
+        _release_images(shared)
+        raise
+    return shared
+
+def _release_images(shared):
+    for key in shared.keys():
+        for one in (shared[key] if type(shared[key]) is list else [shared[key]]):
+            release_image(one)
+
+def _integrate_isophot_chunk(args):
+    """Wrapper function for the multiprocessing."""
+    return integrate_isophot_chunk(*args)
+
+def integrate_isophot_chunk(shared, sma, theta, eps, x0, y0, pixscalefactor,
+                            integrmode, sclip, nclip):
+    """Integrate the ellipse profile at a chunk of semi-major axes using the
+    shared image, or the shared image pyramid if shared is a list (see
+    legacyhalos.multires).
+
+    """
+    from legacyhalos.ellipse import integrate_isophot_one
+    from legacyhalos.multires import integrate_isophot_multires
+
+    if type(shared) is list:
+        pyramid = [attach_image(level) for level in shared]
+    else:
+        img = attach_image(shared)
+
+    out = []
+    for _sma in sma:
+        if type(shared) is list:
+            iso = integrate_isophot_multires(pyramid, _sma * pixscalefactor, theta, eps,
+                                             x0 * pixscalefactor, y0 * pixscalefactor,
+                                             integrmode, sclip, nclip)
+        else:
+            iso = integrate_isophot_one(img, _sma, theta, eps, x0, y0, pixscalefactor,
+                                        integrmode, sclip, nclip)
+        # Drop the reference to the (shared) image so it does not get pickled
+        # on the way back to the parent process; the isophote has already been
+        # measured and the geometry is retained.
+        iso.sample.image = None
+        out.append(iso)
+    return out
+
+def integrate_isophotes(pool, img, sma, theta, eps, x0, y0, pixscalefactor,
+                        integrmode, sclip, nclip, nproc=1, nchunk=None,
+                        nlevel=1, scratchdir=None):
+    """Integrate the ellipse profile at every semi-major axis, publishing the
+    image to the worker processes once and distributing chunks of sma.
+
+    The output is identical to mapping ellipse.integrate_isophot_one over sma.
+
+    nchunk - number of sma chunks (default is four per process, for load
+      balancing)
+    nlevel - if >1, sample the outer isophotes from a pyramid of nlevel
+      block-averaged images (see legacyhalos.multires)
+
+    """
+    isofit = integrate_isophotes_multiband(
+        pool, {'img': img}, sma, theta, eps, x0, y0, pixscalefactor, integrmode,
+        sclip, nclip, nproc=nproc, nchunk=nchunk, nlevel=nlevel,
+        scratchdir=scratchdir)
+    return isofit['img']
+
+def integrate_isophotes_multiband(pool, imgs, sma, theta, eps, x0, y0, pixscalefactor,
+                                  integrmode, sclip, nclip, nproc=1, nchunk=None,
+                                  nlevel=1, scratchdir=None):
+    """Integrate the ellipse profile of several images (e.g., bands) at every
+    semi-major axis with a single pass over the worker pool, so the workers stay
+    busy even if each image only has a handful of isophotes.
+
+    imgs - dictionary of images, keyed by band
+    nchunk - total number of sma chunks, divided evenly among the images
+      (default is four per process, for load balancing)
+    nlevel - number of levels of the image pyramids (see integrate_isophotes)
+
+    Returns a dictionary of IsophoteList objects with the same keys as imgs, each
+    identical to the output of integrate_isophotes.
+
+    """
+    from photutils.isophote import IsophoteList
+
+    keys = list(imgs.keys())
+    if len(sma) == 0 or len(keys) == 0:
+        return {key: IsophoteList([]) for key in keys}
+
+    if nchunk is None:
+        nchunk = 4 * nproc
+    nchunk = int(np.clip(np.ceil(nchunk / len(keys)), 1, len(sma)))
+    smachunks = np.array_split(sma, nchunk)
+
+    shared = {}
+    try:
+        shared = _publish_images(imgs, nlevel=nlevel, scratchdir=scratchdir)
+        isofit = pool.map(_integrate_isophot_chunk, [(
+            shared[key], _sma, theta, eps, x0, y0, pixscalefactor, integrmode,
+            sclip, nclip) for key in keys for _sma in smachunks])
+    finally:
+        _release_images(shared)
+
+    out = {}
+    for ikey, key in enumerate(keys):
+        chunks = isofit[ikey*nchunk:(ikey+1)*nchunk]
+        out[key] = IsophoteList([iso for chunk in chunks for iso in chunk])
+    return out
+
+def adaptive_sma_logstep(sma, intens, int_err, logstep, tol=0.01, snrmin=1.0,
+                         maxfactor=2.0, logsma=True):
+    """Spacing in ln(sma) of the next isophotes of an adaptive sma grid.
+
+    Interpolating the profile ln(I) linearly in ln(sma) between isophotes spaced
+    by h errs by up to h^2*|C|/8, where C = d^2 ln(I) / d ln(sma)^2 is the local
+    curvature of the profile (measured here from the three outermost isophotes
+    with intens/int_err>snrmin), so the spacing is set to sqrt(8*tol/|C|),
+    which is finer where the profile bends sharply and coarser where it is
+    smooth, within a factor of maxfactor of the nominal spacing logstep. Until
+    the curvature can be measured the nominal spacing is used, and once the
+    profile has faded into the noise the coarsest spacing is used.
+
+    sma, intens, int_err - semi-major axes [pixels], intensities and their
+      uncertainties measured so far
+    tol - tolerance of the interpolated profile [ln(intensity)]
+    logsma - if False, the grid is linear: the profile is interpolated in sma
+      rather than ln(sma), and logstep and the returned spacing are in pixels
+
+    """
+    sma, intens, int_err = np.asarray(sma, 'f8'), np.asarray(intens, 'f8'), np.asarray(int_err, 'f8')
+    if len(sma) == 0:
+        return logstep
+    with np.errstate(invalid='ignore'):
+        good = np.isfinite(intens) * (intens > snrmin * int_err) * (intens > 0) * (sma > 0)
+    if not good[-1]:
+        return logstep * maxfactor
+    if np.sum(good) < 3:
+        return logstep
+
+    rr = sma[good][-3:]
+    if logsma:
+        rr = np.log(rr)
+    lni = np.log(intens[good][-3:])
+    h1, h2 = rr[1] - rr[0], rr[2] - rr[1]
+    curv = 2 * ((lni[2] - lni[1]) / h2 - (lni[1] - lni[0]) / h1) / (h1 + h2)
+    return float(np.clip(np.sqrt(8 * tol / max(np.abs(curv), 1e-10)),
+                         logstep / maxfactor, logstep * maxfactor))
+
+def integrate_isophotes_adaptive(pool, imgs, maxsma, theta, eps, x0, y0, pixscalefactor,
+                                 integrmode, sclip, nclip, logstep, refkey=None,
+                                 snrmin=1.0, nlow=3, nbatch=None, tol=0.01,
+                                 logsma=True, nproc=1, nlevel=1, scratchdir=None):
+    """Integrate the ellipse profile of several images (e.g., bands) on an
+    adaptive semi-major axis grid, stopping each image once its profile has
+    faded into the noise.
+
+    The isophotes are measured outward, starting at sma=0, in waves of nbatch
+    semi-major axes (default max(4, nproc)) with the images published to the
+    worker processes only once. The spacing in log-sma of each wave is set by
+    adaptive_sma_logstep (with nominal spacing logstep and tolerance tol) from
+    the profile measured so far in refkey (or, once refkey has stopped, the first
+    image still being integrated), and the steps are rounded to at least one
+    pixel so the sma values stay unique integers (see ellipse._unpack_isofit). All the images therefore share the
+    same grid, and each one is truncated at the isophote where nlow consecutive
+    isophotes have intens/int_err < snrmin (isophotes with a non-finite
+    signal-to-noise ratio are ignored), or at maxsma.
+
+    If logsma=False the grid is instead adapted in sma, with a nominal spacing
+    of logstep pixels (e.g., the delta_sma of a linear grid).
+
+    Returns a dictionary of IsophoteList objects with the same keys as imgs and a
+    dictionary of the semi-major axis [pixels] at which each image stopped.
+
+    """
+    from photutils.isophote import IsophoteList
+
+    keys = list(imgs.keys())
+    if refkey not in keys and len(keys) > 0:
+        refkey = keys[0]
+    if nbatch is None:
+        nbatch = max(4, nproc)
+
+    isolist = {key: [] for key in keys}
+    smastop = {key: np.float32(-1) for key in keys}
+    nlowsnr = {key: 0 for key in keys}
+    active = list(keys)
+
+    shared = {}
+    try:
+        shared = _publish_images(imgs, nlevel=nlevel, scratchdir=scratchdir)
+        sma = []
+        while len(active) > 0:
+            # Extend the grid using the profile of the reference image.
+            gridkey = refkey if refkey in active else active[0]
+            dlogsma = adaptive_sma_logstep([iso.sma for iso in isolist[gridkey]],
+                                           [iso.intens for iso in isolist[gridkey]],
+                                           [iso.int_err for iso in isolist[gridkey]],
+                                           logstep, tol=tol, snrmin=snrmin,
+                                           logsma=logsma)
+            wave = []
+            nextsma = sma[-1] if len(sma) > 0 else 0.0
+            while len(wave) < nbatch:
+                if len(sma) + len(wave) > 0:
+                    if logsma:
+                        nextsma += max(1.0, np.round(nextsma * dlogsma))
+                    else:
+                        nextsma += max(1.0, np.round(dlogsma))
+                if nextsma > maxsma:
+                    break
+                wave.append(nextsma)
+            if len(wave) == 0:
+                break
+            sma += wave
+
+            nchunk = int(np.clip(np.ceil(4 * nproc / len(active)), 1, len(wave)))
+            smachunks = np.array_split(np.array(wave, 'f4'), nchunk)
+            isofit = pool.map(_integrate_isophot_chunk, [(
+                shared[key], _sma, theta, eps, x0, y0, pixscalefactor, integrmode,
+                sclip, nclip) for key in active for _sma in smachunks])
+
+            for ikey, key in enumerate(list(active)):
+                chunks = isofit[ikey*nchunk:(ikey+1)*nchunk]
+                for iso in [iso for chunk in chunks for iso in chunk]:
+                    isolist[key].append(iso)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        snr = iso.intens / iso.int_err
+                    if np.isfinite(snr):
+                        nlowsnr[key] = nlowsnr[key] + 1 if snr < snrmin else 0
+                    if nlowsnr[key] >= nlow:
+                        smastop[key] = np.float32(iso.sma)
+                        active.remove(key)
+                        break
+    finally:
+        _release_images(shared)
+
+    # Images which were integrated all the way to maxsma.
+    for key in keys:
+        if smastop[key] < 0 and len(isolist[key]) > 0:
+            smastop[key] = np.float32(isolist[key][-1].sma)
+    return {key: IsophoteList(isolist[key]) for key in keys}, smastop
@@ -115,8 +115,9 @@ def get_galaxy_galaxydir(cat, datadir=None, htmldir=None, html=False,
         return galaxy, galaxydir
 
 def missing_files(args, sample, size=1, clobber_overwrite=None):
-    import multiprocessing
     from legacyhalos.io import _missing_files_one
+    from legacyhalos.pool import get_pool
+    from legacyhalos.statedb import missing_files as statedb_missing_files
 
     dependson = None
     if args.htmlplots is False and args.htmlindex is False:
@@ -183,7 +184,7 @@ def missing_files(args, sample, size=1, clobber_overwrite=None):
         ngal = len(sample)
     indices = np.arange(ngal)
 
-    pool = multiprocessing.Pool(args.nproc)
+    pool = get_pool(args.nproc)
     missargs = []
     for gal, gdir in zip(np.atleast_1d(galaxy), np.atleast_1d(galaxydir)):
         #missargs.append([gal, gdir, filesuffix, dependson, clobber])
@@ -196,7 +197,9 @@ def missing_files(args, sample, size=1, clobber_overwrite=None):
     if args.verbose:
         t0 = time.time()
         print('Finding missing files...', end='')
-    todo = np.array(pool.map(_missing_files_one, missargs))
+    todo = statedb_missing_files(np.atleast_1d(galaxy), filesuffix, dependson=dependson, clobber=clobber)
+    if todo is None:
+        todo = np.array(pool.map(_missing_files_one, missargs))
     if args.verbose:
         print('...took {:.3f} min'.format((time.time() - t0)/60))
 
@@ -241,6 +244,7 @@ def mpi_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--nproc', default=1, type=int, help='number of multiprocessing processes per MPI rank.')
     parser.add_argument('--mpi', action='store_true', help='Use MPI parallelism')
+    parser.add_argument('--static-schedule', action='store_true', help='Divide the galaxies across MPI ranks ahead of time rather than dynamically.')
 
     parser.add_argument('--sdss', action='store_true', help='Analyze the SDSS galaxies.')
 
@@ -273,6 +277,15 @@ def mpi_args():
 
     parser.add_argument('--force', action='store_true', help='Use with --coadds; ignore previous pickle files.')
     parser.add_argument('--count', action='store_true', help='Count how many objects are left to analyze and then return.')
+    parser.add_argument('--prefetch', action='store_true', help='Use with --ellipse; stage the inputs of the next galaxy in node-local scratch in the background.')
+    parser.add_argument('--prefetch-maxgb', default=4.0, type=float, help='Maximum node-local scratch space used by --prefetch (GB).')
+    parser.add_argument('--concurrent-bands', action='store_true', help='Use with --ellipse; fit the isophotes and aperture photometry of all the bands together on the worker pool.')
+    parser.add_argument('--multires', action='store_true', help='Use with --ellipse; sample the outer isophotes from block-averaged images.')
+    parser.add_argument('--stats-engine', default='astropy', type=str, choices=['astropy', 'histogram', 'subsample'],
+                        help='Use with --ellipse; engine for the sigma-clipped image statistics (see legacyhalos.robust).')
+    parser.add_argument('--adaptive-sma', action='store_true', help='Use with --ellipse; integrate on an adaptive sma grid and stop each band at the noise.')
+    parser.add_argument('--sma-snrmin', default=1.0, type=float, help='Use with --adaptive-sma; minimum signal-to-noise ratio of an isophote.')
+    parser.add_argument('--sma-nlow', default=3, type=int, help='Use with --adaptive-sma; stop a band after this many consecutive isophotes below --sma-snrmin.')
     parser.add_argument('--debug', action='store_true', help='Log to STDOUT and build debugging plots.')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose output.')
     parser.add_argument('--clobber', action='store_true', help='Overwrite existing files.')                                
@@ -381,7 +394,7 @@ def get_mstarbins(deltam=0.1, satellites=False):
     
     return mstarbins
 
-def lambda2mhalo(richness, redshift=0.3, Saro=False):
+def lambda2mhalo(richness, redshift=0.3, Saro=False, engine='table'):
     """
     Convert cluster richness, lambda, to halo mass, given various 
     calibrations.
@@ -393,17 +406,18 @@ def lambda2mhalo(richness, redshift=0.3, Saro=False):
     Other SDSS-based calibrations: Li et al. 2016; Miyatake et al. 2016; 
     Farahi et al. 2016; Baxter et al. 2016.
 
+    The conversion from M200m to M200c uses an interpolation table (see
+    legacyhalos.halomass; engine='table', the default) or colossus directly, one
+    cluster at a time (engine='colossus').
+
     TODO: Return the variance!
 
     """
-    from colossus.halo import mass_defs
-    #from colossus.halo import concentration
-    from colossus.cosmology import cosmology
+    from legacyhalos import halomass
 
     #cosmo = legacyhalos_cosmology()
     #cosmology.setCosmology(cosmology.fromAstropy(cosmo, ns=0.96, sigma8=0.82))
     params = {'flat': True, 'H0': 70, 'Om0': 0.3, 'Ob0': 0.049, 'sigma8': 0.82, 'ns': 0.95}
-    cosmo = cosmology.setCosmology('myCosmo', params)
     
     if Saro:
         pass
@@ -426,10 +440,15 @@ def lambda2mhalo(richness, redshift=0.3, Saro=False):
     #M200c, _, _ = mass_adv.changeMassDefinitionCModel(M200m, redshift, '200m', '200c')
 
     # Assume a constant concentration.
-    M200c = np.zeros_like(M200m)
-    for ii, (mm, zz) in enumerate(zip(M200m, zredshift)):
-        mc, _, _ = mass_defs.changeMassDefinition(mm, 3.5, zz, '200m', '200c')
-        M200c[ii] = mc
+    if engine == 'table':
+        table = halomass.get_table('myCosmo', params, '200m', '200c', c=3.5)
+        M200c = table(M200m, zredshift)
+    elif engine == 'colossus':
+        from colossus.cosmology import cosmology
+        cosmology.setCosmology('myCosmo', params)
+        M200c = halomass.change_mass_definition(M200m, zredshift, '200m', '200c', c=3.5)
+    else:
+        raise ValueError('Unrecognized engine {}'.format(engine))
         
     return np.log10(M200c)
 
@@ -609,7 +628,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
     import numpy.ma as ma
     from copy import copy
     from legacyhalos.mge import find_galaxy
-    from legacyhalos.misc import srcs2image, ellipse_mask
+    from legacyhalos.misc import SourceModelCache, ellipse_mask_bbox
 
     import matplotlib.pyplot as plt
     from astropy.visualization import simple_norm
@@ -621,7 +640,7 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
     #box = np.arange(nbox)-nbox // 2
     #box = np.meshgrid(np.arange(nbox), np.arange(nbox))[0]-nbox//2
 
-    xobj, yobj = np.ogrid[0:data['refband_height'], 0:data['refband_width']]
+    shape = (data['refband_height'], data['refband_width'])
 
     # If the row-index of the central galaxy is not provided, use the source
     # nearest to the center of the field.
@@ -645,6 +664,10 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
     else:
         psfsrcs = None
 
+    # Render each Tractor source once per band; all the model images below are
+    # (different) subsets of the same catalog.
+    modelcache = SourceModelCache(tractor)
+
     def tractor2mge(indx, factor=1.0):
     #def tractor2mge(indx, majoraxis=None):
         # Convert a Tractor catalog entry to an MGE object.
@@ -666,10 +689,10 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         mgegalaxy.theta = (270 - pa) % 180
         mgegalaxy.majoraxis = factor * tractor.shape_r[indx] / filt2pixscale[refband] # [pixels]
 
-        objmask = ellipse_mask(mgegalaxy.xmed, mgegalaxy.ymed, # object pixels are True
-                               mgegalaxy.majoraxis,
-                               mgegalaxy.majoraxis * (1-mgegalaxy.eps), 
-                               np.radians(mgegalaxy.theta-90), xobj, yobj)
+        objmask = ellipse_mask_bbox(mgegalaxy.xmed, mgegalaxy.ymed, # object pixels are True
+                                    mgegalaxy.majoraxis,
+                                    mgegalaxy.majoraxis * (1-mgegalaxy.eps), 
+                                    np.radians(mgegalaxy.theta-90), shape)
 
         return mgegalaxy, objmask
 
@@ -689,11 +712,13 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
         iclose = np.where([centralmask[np.int(by), np.int(bx)]
                            for by, bx in zip(tractor.by, tractor.bx)])[0]
         
+        notclose = np.delete(np.arange(len(tractor)), iclose)
         srcs = tractor.copy()
-        srcs.cut(np.delete(np.arange(len(tractor)), iclose))
-        model = srcs2image(srcs, data['{}_wcs'.format(refband)],
-                           band=refband.lower(),
-                           pixelized_psf=data['{}_psf'.format(refband)])
+        srcs.cut(notclose)
+        model = modelcache.model(data['{}_wcs'.format(refband)],
+                                 band=refband.lower(),
+                                 pixelized_psf=data['{}_psf'.format(refband)],
+                                 indx=notclose)
 
         img = data[refband].data - model
         img[centralmask] = data[refband].data[centralmask]
@@ -765,12 +790,11 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
             if len(satindx) == 0:
                 raise ValueError('All satellites have been dropped!')
 
-            satsrcs = srcs.copy()
             #satsrcs = tractor.copy()
-            satsrcs.cut(satindx)
-            satimg = srcs2image(satsrcs, data['{}_wcs'.format(filt)],
-                                band=filt.lower(),
-                                pixelized_psf=data['{}_psf'.format(filt)])
+            satimg = modelcache.model(data['{}_wcs'.format(filt)],
+                                      band=filt.lower(),
+                                      pixelized_psf=data['{}_psf'.format(filt)],
+                                      indx=notclose[satindx])
             satmask = np.logical_or(satmask, satimg > 10*data['{}_sigma'.format(filt)])
             #if True:
             #    import matplotlib.pyplot as plt
@@ -795,9 +819,10 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
 
             img = ma.getdata(data[filt]).copy()
             if psfsrcs:
-                psfimg = srcs2image(psfsrcs, data['{}_wcs'.format(filt)],
-                                    band=filt.lower(),
-                                    pixelized_psf=data['{}_psf'.format(filt)])
+                psfimg = modelcache.model(data['{}_wcs'.format(filt)],
+                                          band=filt.lower(),
+                                          pixelized_psf=data['{}_psf'.format(filt)],
+                                          indx=psfindx)
                 #data[psfimgkey].append(psfimg)
                 img -= psfimg
 
@@ -823,7 +848,8 @@ def _build_multiband_mask(data, tractor, filt2pixscale, fill_value=0.0,
 
 def read_multiband(galaxy, galaxydir, galaxy_id, filesuffix='custom',
                    refband='r', bands=['g', 'r', 'z'], pixscale=0.262,
-                   redshift=None, fill_value=0.0, sky_tests=False, verbose=False):
+                   redshift=None, fill_value=0.0, sky_tests=False, stats_engine='astropy',
+                   verbose=False):
     """Read the multi-band images (converted to surface brightness) and create a
     masked array suitable for ellipse-fitting.
 
@@ -940,7 +966,8 @@ def read_multiband(galaxy, galaxydir, galaxy_id, filesuffix='custom',
 
     # Read the basic imaging data and masks.
     data = _read_image_data(data, filt2imfile, starmask=starmask,
-                            fill_value=fill_value, verbose=verbose)
+                            fill_value=fill_value, stats_engine=stats_engine,
+                            verbose=verbose)
     
     # Find the central.
     samplefile = os.path.join(galaxydir, '{}-{}.fits'.format(galaxy, filt2imfile['sample']))
@@ -994,10 +1021,23 @@ def read_multiband(galaxy, galaxydir, galaxy_id, filesuffix='custom',
 def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                  filesuffix='custom', bands=['g', 'r', 'z'], refband='r',
                  sky_tests=False, unwise=False, verbose=False,
-                 debug=False, logfile=None):
+                 debug=False, logfile=None, inputdir=None,
+                 concurrent_bands=False, multires=False, adaptive_sma=False,
+                 sma_snrmin=1.0, sma_nlow=3, stats_engine='astropy'):
     """Wrapper on legacyhalos.mpi.call_ellipse but with specific preparatory work
     and hooks for the legacyhalos project.
 
+    inputdir - read the input files from this directory (e.g., staged by
+      legacyhalos.prefetch) instead of galaxydir
+    concurrent_bands - fit all the bands together on the worker pool (see
+      legacyhalos.mpi.call_ellipse)
+    multires - sample the outer isophotes from block-averaged images (see
+      legacyhalos.mpi.call_ellipse)
+    adaptive_sma, sma_snrmin, sma_nlow - integrate on an adaptive sma grid and
+      stop each band at the noise (see legacyhalos.mpi.call_ellipse)
+    stats_engine - engine for the sigma-clipped statistics of the images (see
+      legacyhalos.robust.clipped_stats)
+
     """
     import astropy.table
     from copy import deepcopy
@@ -1007,19 +1047,24 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
         onegal = onegal[0] # create a Row object
     galaxy_id = onegal['ID_CENT'][0]
 
+    if inputdir is None:
+        inputdir = galaxydir
+
     if logfile:
         from contextlib import redirect_stdout, redirect_stderr
         with open(logfile, 'a') as log:
             with redirect_stdout(log), redirect_stderr(log):
-                data, galaxyinfo = read_multiband(galaxy, galaxydir, galaxy_id, bands=bands,
+                data, galaxyinfo = read_multiband(galaxy, inputdir, galaxy_id, bands=bands,
                                                   filesuffix=filesuffix, refband=refband,
                                                   pixscale=pixscale, redshift=onegal[ZCOLUMN],
-                                                  sky_tests=sky_tests, verbose=verbose)
+                                                  sky_tests=sky_tests, stats_engine=stats_engine,
+                                                  verbose=verbose)
     else:
-        data, galaxyinfo = read_multiband(galaxy, galaxydir, galaxy_id, bands=bands,
+        data, galaxyinfo = read_multiband(galaxy, inputdir, galaxy_id, bands=bands,
                                           filesuffix=filesuffix, refband=refband,
                                           pixscale=pixscale, redshift=onegal[ZCOLUMN],
-                                          sky_tests=sky_tests, verbose=verbose)
+                                          sky_tests=sky_tests, stats_engine=stats_engine,
+                                          verbose=verbose)
 
     maxsma, delta_logsma = None, 6
     #maxsma, delta_logsma = 200, 10
@@ -1044,14 +1089,14 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                                        bands=bands, refband=refband, sbthresh=SBTHRESH,
                                        delta_logsma=delta_logsma, maxsma=maxsma,
                                        write_donefile=False,
-                                       verbose=verbose, debug=True)#, logfile=logfile)# no logfile and debug=True, otherwise this will crash
+                                       concurrent_bands=concurrent_bands, multires=multires,
+                                       adaptive_sma=adaptive_sma, sma_snrmin=sma_snrmin,
+                                       sma_nlow=sma_nlow, verbose=verbose, debug=True)#, logfile=logfile)# no logfile and debug=True, otherwise this will crash
 
                 # no need to redo the nominal ellipse-fitting
                 if isky == 0:
-                    inellipsefile = os.path.join(galaxydir, '{}-{}-{}-ellipse.fits'.format(galaxy, skydata['filesuffix'], galaxy_id))
-                    outellipsefile = os.path.join(galaxydir, '{}-{}-{}-ellipse.fits'.format(galaxy, data['filesuffix'], galaxy_id))
-                    print('Copying {} --> {}'.format(inellipsefile, outellipsefile))
-                    shutil.copy2(inellipsefile, outellipsefile)
+                    legacyhalos.io.copy_ellipsefit(galaxy, galaxydir, skydata['filesuffix'], data['filesuffix'],
+                                                   galaxy_id=galaxy_id)
             return err
 
         t0 = time.time()
@@ -1089,7 +1134,9 @@ def call_ellipse(onegal, galaxy, galaxydir, pixscale=0.262, nproc=1,
                          pixscale=pixscale, nproc=nproc, 
                          bands=bands, refband=refband, sbthresh=SBTHRESH,
                          delta_logsma=delta_logsma, maxsma=maxsma,
-                         verbose=verbose, debug=debug, logfile=logfile)
+                         concurrent_bands=concurrent_bands, multires=multires,
+                         adaptive_sma=adaptive_sma, sma_snrmin=sma_snrmin,
+                         sma_nlow=sma_nlow, verbose=verbose, debug=debug, logfile=logfile)
 
 def get_integrated_filename():
     """Return the name of the file containing the integrated photometry."""
@@ -8,6 +8,16 @@ Miscellaneous utility code used by various scripts.
 import os, sys
 import numpy as np
 
+def cache_dir():
+    """Directory of persistent caches (e.g., interpolation tables and dust maps):
+    ${LEGACYHALOS_CACHE_DIR}, or ~/.cache/legacyhalos by default.
+
+    """
+    cachedir = os.getenv('LEGACYHALOS_CACHE_DIR')
+    if cachedir is None or cachedir.strip() == '':
+        cachedir = os.path.join(os.path.expanduser('~'), '.cache', 'legacyhalos')
+    return cachedir
+
 def viewer_inspect(cat, galaxycolname='GALAXY'):
     """Write a little catalog that can be uploaded to the viewer.
 
@@ -45,14 +55,9 @@ def imagetool_inspect(cat, group=False):
                     gal = 'galaxy'
             ff.write('{} {:.6f} {:.6f}\n'.format(gal, ra, dec))
 
-def srcs2image(cat, wcs, band='r', allbands='grz', pixelized_psf=None, psf_sigma=1.0):
-    """Build a model image from a Tractor catalog or a list of sources.
-
-    issrcs - if True, then cat is already a list of sources.
-
-    """
-    import tractor, legacypipe, astrometry
-    from legacypipe.catalog import read_fits_catalog
+def _model_tim(wcs, band='r', pixelized_psf=None, psf_sigma=1.0):
+    """Build an empty (sky-free) Tractor image on which to render models."""
+    import tractor, legacypipe
 
     if type(wcs) is tractor.wcs.ConstantFitsWcs or type(wcs) is legacypipe.survey.LegacySurveyWcs:
         shape = wcs.wcs.shape
@@ -71,6 +76,18 @@ def srcs2image(cat, wcs, band='r', allbands='grz', pixelized_psf=None, psf_sigma
                         photocal=tractor.basics.LinearPhotoCal(1.0, band=band.lower()),
                         sky=tractor.sky.ConstantSky(0.0),
                         name='model-{}'.format(band))
+    return tim
+
+def srcs2image(cat, wcs, band='r', allbands='grz', pixelized_psf=None, psf_sigma=1.0):
+    """Build a model image from a Tractor catalog or a list of sources.
+
+    issrcs - if True, then cat is already a list of sources.
+
+    """
+    import tractor, legacypipe, astrometry
+    from legacypipe.catalog import read_fits_catalog
+
+    tim = _model_tim(wcs, band=band, pixelized_psf=pixelized_psf, psf_sigma=psf_sigma)
 
     # Do we have a tractor catalog or a list of sources?
     if type(cat) is astrometry.util.fits.tabledata:
@@ -83,12 +100,141 @@ def srcs2image(cat, wcs, band='r', allbands='grz', pixelized_psf=None, psf_sigma
 
     return mod
 
+class SourceModelCache(object):
+    """Model images of arbitrary subsets of the sources in a Tractor catalog.
+
+    Each source is rendered at most once per band (and WCS and PSF) into its
+    own bounding-box patch, and the model of any subset of sources is then
+    assembled from the patches (or by subtracting the complement from the
+    model of all the sources, whichever is fewer operations). This is
+    equivalent to calling srcs2image on the subset, but building, e.g., the
+    "all but the central" models of N centrals in a group takes O(N_src) rather
+    than O(N_central x N_src) renders.
+
+    """
+    def __init__(self, cat, psf_sigma=1.0):
+        self.cat = cat
+        self.psf_sigma = psf_sigma
+        self._cache = {}
+
+    def patches(self, wcs, band='r', pixelized_psf=None):
+        """Return the model of all the sources and the list of per-source patches
+        (None for sources which do not touch the image).
+
+        """
+        from legacypipe.catalog import read_fits_catalog
+
+        key = (band.lower(), id(wcs), id(pixelized_psf))
+        if key not in self._cache:
+            tim = _model_tim(wcs, band=band, pixelized_psf=pixelized_psf,
+                             psf_sigma=self.psf_sigma)
+            srcs = read_fits_catalog(self.cat, bands=[band.lower()])
+            if len(srcs) != len(self.cat):
+                raise ValueError('Unable to convert every row of the Tractor catalog to a source.')
+
+            total = np.zeros(tim.shape)
+            patches = []
+            for src in srcs:
+                patch = src.getModelPatch(tim)
+                if patch is not None:
+                    patch.addTo(total)
+                patches.append(patch)
+            self._cache[key] = (total, patches)
+
+        return self._cache[key]
+
+    def model(self, wcs, band='r', pixelized_psf=None, indx=None):
+        """Model image of the sources in indx (default is all the sources), in
+        32-bit precision like srcs2image.
+
+        """
+        total, patches = self.patches(wcs, band=band, pixelized_psf=pixelized_psf)
+        if indx is None:
+            return total.astype('f4')
+
+        keep = np.zeros(len(patches), bool)
+        keep[np.asarray(indx, dtype=int)] = True
+        if np.sum(keep) > len(patches) / 2:
+            model, sign, these = total.copy(), -1.0, np.where(~keep)[0]
+        else:
+            model, sign, these = np.zeros_like(total), 1.0, np.where(keep)[0]
+        for ii in these:
+            if patches[ii] is not None:
+                patches[ii].addTo(model, scale=sign)
+
+        return model.astype('f4')
+
 def ellipse_mask(xcen, ycen, semia, semib, phi, x, y):
     """Simple elliptical mask."""
     xp = (x-xcen) * np.cos(phi) + (y-ycen) * np.sin(phi)
     yp = -(x-xcen) * np.sin(phi) + (y-ycen) * np.cos(phi)
     return (xp / semia)**2 + (yp/semib)**2 <= 1
 
+def ellipse_bbox(xcen, ycen, semia, semib, phi, shape):
+    """Bounding box (a tuple of slices, clipped to an image of the given shape)
+    of the ellipse in ellipse_mask, or None if it does not overlap the image.
+
+    """
+    if not np.all(np.isfinite([xcen, ycen, semia, semib, phi])):
+        return None
+    cosphi, sinphi = np.cos(phi), np.sin(phi)
+    dx = np.sqrt((semia * cosphi)**2 + (semib * sinphi)**2)
+    dy = np.sqrt((semia * sinphi)**2 + (semib * cosphi)**2)
+    x0, x1 = max(int(np.floor(xcen - dx)), 0), min(int(np.ceil(xcen + dx)) + 1, shape[0])
+    y0, y1 = max(int(np.floor(ycen - dy)), 0), min(int(np.ceil(ycen + dy)) + 1, shape[1])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return slice(x0, x1), slice(y0, y1)
+
+def paint_ellipse(mask, xcen, ycen, semia, semib, phi, value=True):
+    """Set (Boolean mask) or OR in the bits of value (integer bitmask) for the
+    pixels of mask inside the ellipse, evaluating only the pixels within its
+    bounding box. The mask is modified in place and returned.
+
+    As in ellipse_mask, x (and xcen) run along the first (row) axis.
+
+    """
+    bbox = ellipse_bbox(xcen, ycen, semia, semib, phi, mask.shape)
+    if bbox is None:
+        return mask
+    xx = np.arange(bbox[0].start, bbox[0].stop)[:, np.newaxis]
+    yy = np.arange(bbox[1].start, bbox[1].stop)[np.newaxis, :]
+    inside = ellipse_mask(xcen, ycen, semia, semib, phi, xx, yy)
+    if mask.dtype == bool:
+        mask[bbox] |= inside
+    else:
+        mask[bbox] |= np.where(inside, value, 0).astype(mask.dtype)
+    return mask
+
+def ellipse_mask_bbox(xcen, ycen, semia, semib, phi, shape):
+    """Equivalent to ellipse_mask over the full (np.ogrid) image of the given
+    shape, but only evaluated inside the bounding box of the ellipse.
+
+    """
+    return paint_ellipse(np.zeros(shape, bool), xcen, ycen, semia, semib, phi)
+
+def ellipse_shrink_factor(xcen, ycen, semia, semib, phi, x, y, shrink):
+    """Find the largest scale factor of the ellipse (from the grid shrink, tried
+    in decreasing order) for which none of the points (x, y) fall inside it.
+
+    This is equivalent to building ellipse_mask for each factor and checking
+    the mask at the points, but solves the criterion directly from the
+    elliptical radius of the points. Returns the factor (the smallest one if
+    every factor fails) and the array of rejected factors.
+
+    """
+    x, y = np.asarray(x, dtype='f8'), np.asarray(y, dtype='f8')
+    xp = (x-xcen) * np.cos(phi) + (y-ycen) * np.sin(phi)
+    yp = -(x-xcen) * np.sin(phi) + (y-ycen) * np.cos(phi)
+    rr2 = np.min((xp / semia)**2 + (yp / semib)**2)
+
+    shrink = np.sort(np.atleast_1d(shrink))[::-1]
+    ok = shrink**2 < rr2
+    if np.any(ok):
+        iok = np.argmax(ok)
+        return shrink[iok], shrink[:iok]
+    return shrink[-1], shrink
+
 def simple_wcs(onegal, radius=None, factor=1.0, pixscale=0.262, zcolumn='Z'):
     '''Build a simple WCS object for a single galaxy.
 
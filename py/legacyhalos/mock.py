@@ -0,0 +1,278 @@
+"""
+legacyhalos.mock
+================
+
+Synthetic galaxies for testing and benchmarking the pipeline without any survey
+data.
+
+simulate_galaxy builds a multiband, PSF-convolved Sersic galaxy (plus a handful
+of fainter satellites and stars), with noise, inverse-variance weights and a
+mask, and packages it in the same 'data' dictionary which read_multiband
+produces after _build_multiband_mask (i.e., the input to
+ellipse.ellipsefit_multiband and ellipse.ellipse_cog). It also returns a fake
+Tractor catalog of the sources, which can be converted with
+mock_tractor_catalog into the astrometry.net fits_table and WCS/PSF objects
+expected by _build_multiband_mask.
+
+"""
+import pdb
+import numpy as np
+
+MOCK_BANDS = ('g', 'r', 'z')
+MOCK_COLORS = {'g': 0.7, 'r': 0.0, 'z': -0.5} # [mag] relative to r
+MOCK_DEPTH = {'g': 24.5, 'r': 24.0, 'z': 23.0} # [5-sigma PSF depth, AB mag]
+MOCK_PSFSIZE = {'g': 1.4, 'r': 1.3, 'z': 1.2} # [FWHM, arcsec]
+
+def sersic_bn(n):
+    """Approximation to b_n from Ciotti & Bertin (1999)."""
+    return 2*n - 1/3 + 4/(405*n) + 46/(25515*n**2)
+
+def sersic_image(shape, x0, y0, flux, r50, n=1.0, ba=1.0, pa=0.0, nsub=1):
+    """Render an elliptical Sersic profile normalized to a total flux.
+
+    shape - image shape (nrow, ncol)
+    x0, y0 - center (x is the column index) [pixels]
+    flux - total flux [nanomaggies]
+    r50 - half-light semi-major axis [pixels]
+    ba, pa - minor-to-major axis ratio and position angle (counter-clockwise
+      from the x-axis, as in photutils) [degrees]
+    nsub - sub-sample each pixel nsub x nsub times
+
+    """
+    nrow, ncol = shape
+    off = (np.arange(nsub) + 0.5) / nsub - 0.5
+    yy, xx = np.mgrid[0:nrow, 0:ncol].astype('f8')
+
+    theta = np.radians(pa)
+    cost, sint = np.cos(theta), np.sin(theta)
+    bn = sersic_bn(n)
+
+    img = np.zeros(shape)
+    for dy in off:
+        for dx in off:
+            _dx, _dy = xx + dx - x0, yy + dy - y0
+            xp = _dx * cost + _dy * sint
+            yp = (-_dx * sint + _dy * cost) / ba
+            rr = np.hypot(xp, yp) / r50
+            img += np.exp(-bn * (rr**(1/n) - 1))
+
+    total = np.sum(img)
+    if total > 0:
+        img *= flux / total
+    return img
+
+def gaussian_psf(fwhm, pixscale=0.262, size=None):
+    """Normalized, circular Gaussian PSF stamp with odd size.
+
+    fwhm - [arcsec]
+
+    """
+    sigma = fwhm / 2.3548 / pixscale # [pixels]
+    if size is None:
+        size = 2 * int(np.ceil(4 * sigma)) + 1
+    half = size // 2
+    yy, xx = np.mgrid[-half:half+1, -half:half+1]
+    psf = np.exp(-0.5 * (xx**2 + yy**2) / sigma**2)
+    return psf / np.sum(psf)
+
+def _depth2sigma(depth, psfsize, pixscale):
+    """Per-pixel noise [nanomaggies] given a 5-sigma point-source depth."""
+    flux5 = 10**(-0.4 * (depth - 22.5))
+    neff = 4 * np.pi * (psfsize / 2.3548 / pixscale)**2 # effective area [pixels]
+    return flux5 / 5 / np.sqrt(neff)
+
+def mock_sources(size, r50=None, nsat=5, nstar=3, seed=1):
+    """Draw a central galaxy and some satellites and stars.
+
+    Returns a structured array with one row per source (the central is first)
+    with the Tractor-like columns used by the pipeline.
+
+    """
+    rand = np.random.RandomState(seed)
+    if r50 is None:
+        r50 = size / 12.0
+
+    nsrc = 1 + nsat + nstar
+    src = np.zeros(nsrc, dtype=[('type', 'U3'), ('bx', 'f8'), ('by', 'f8'),
+                                ('flux_r', 'f8'), ('shape_r', 'f8'), ('sersic', 'f8'),
+                                ('ba', 'f8'), ('pa', 'f8')])
+
+    src['type'][0] = 'SER'
+    src['bx'][0] = (size - 1) / 2 + rand.uniform(-0.5, 0.5)
+    src['by'][0] = (size - 1) / 2 + rand.uniform(-0.5, 0.5)
+    # r=16 for a 256-pixel cutout, with the same surface brightness at any size
+    src['flux_r'][0] = 10**(-0.4 * (16.0 - 22.5)) * (size / 256)**2
+    src['shape_r'][0] = r50
+    src['sersic'][0] = rand.uniform(1.0, 4.0)
+    src['ba'][0] = rand.uniform(0.4, 0.9)
+    src['pa'][0] = rand.uniform(0, 180)
+
+    # Keep the other sources away from the center of the central.
+    for ii in range(1, nsrc):
+        while True:
+            bx, by = rand.uniform(0.05, 0.95, 2) * (size - 1)
+            if np.hypot(bx - src['bx'][0], by - src['by'][0]) > 2 * r50:
+                break
+        src['bx'][ii], src['by'][ii] = bx, by
+        if ii <= nsat:
+            src['type'][ii] = 'EXP'
+            src['flux_r'][ii] = src['flux_r'][0] * 10**rand.uniform(-2.5, -1)
+            src['shape_r'][ii] = r50 * rand.uniform(0.05, 0.2)
+            src['sersic'][ii] = 1.0
+            src['ba'][ii] = rand.uniform(0.3, 1.0)
+            src['pa'][ii] = rand.uniform(0, 180)
+        else:
+            src['type'][ii] = 'PSF'
+            src['flux_r'][ii] = src['flux_r'][0] * 10**rand.uniform(-2, 0)
+            src['ba'][ii] = 1.0
+
+    return src
+
+def simulate_galaxy(size=256, bands=MOCK_BANDS, refband='r', pixscale=0.262,
+                    r50=None, nsat=5, nstar=3, redshift=0.05,
+                    fill_value=0.0, seed=1):
+    """Simulate a multiband image of a galaxy and package it like the output of
+    read_multiband (after _build_multiband_mask).
+
+    size - width and height of the (square) images [pixels]
+    r50 - half-light radius of the central [pixels]; default is size/12
+
+    Returns the data dictionary, the source list (see mock_sources), and a
+    dictionary with the noiseless images, (unmasked) noisy images, inverse
+    variance images, PSF stamps, and masks of each band, which can be used to
+    build the inputs to _build_multiband_mask.
+
+    """
+    import numpy.ma as ma
+    from scipy.signal import fftconvolve
+
+    rand = np.random.RandomState(seed)
+    src = mock_sources(size, r50=r50, nsat=nsat, nstar=nstar, seed=seed)
+    shape = (size, size)
+    cen = src[0]
+
+    data = {'bands': list(bands), 'refband': refband, 'refpixscale': np.float32(pixscale),
+            'filesuffix': 'mock', 'failed': False, 'galaxy_id': '',
+            'refband_width': size, 'refband_height': size}
+    truth = {'src': src, 'redshift': redshift}
+
+    # Mask a few "bright stars" (away from the central) and some random bad
+    # pixels (e.g., cosmic rays).
+    yy, xx = np.ogrid[0:size, 0:size]
+    mask = np.zeros(shape, bool)
+    for istar in np.where(src['type'] == 'PSF')[0][:2]:
+        mask |= np.hypot(xx - src['bx'][istar], yy - src['by'][istar]) < 0.02 * size + 3
+    mask.flat[rand.choice(size * size, size=size * size // 2000, replace=False)] = True
+    mask[np.hypot(xx - cen['bx'], yy - cen['by']) < 3] = False
+
+    for filt in bands:
+        psfsize = MOCK_PSFSIZE.get(filt, 1.3)
+        depth = MOCK_DEPTH.get(filt, 24.0)
+        psf = gaussian_psf(psfsize, pixscale=pixscale)
+
+        model = np.zeros(shape)
+        for one in src:
+            flux = one['flux_r'] * 10**(-0.4 * MOCK_COLORS.get(filt, 0.0))
+            if one['type'] == 'PSF':
+                ix, iy = int(np.round(one['bx'])), int(np.round(one['by']))
+                model[iy, ix] += flux
+            else:
+                model += sersic_image(shape, one['bx'], one['by'], flux, one['shape_r'],
+                                      n=one['sersic'], ba=one['ba'], pa=one['pa'])
+        model = fftconvolve(model, psf, mode='same')
+
+        sigma = _depth2sigma(depth, psfsize, pixscale)
+        image = model + rand.normal(scale=sigma, size=shape)
+        ivar = np.full(shape, 1 / sigma**2, dtype='f4')
+
+        data['psfsize_{}'.format(filt)] = np.float32(psfsize)
+        data['psfdepth_{}'.format(filt)] = np.float32(depth)
+
+        # [nanomaggies/arcsec**2] and [nanomaggies**2/arcsec**4]
+        img = ma.masked_array((image / pixscale**2).astype('f4'), mask.copy())
+        ma.set_fill_value(img, fill_value)
+        data['{}_masked'.format(filt)] = [img]
+        data['{}_var'.format(filt)] = [np.full(shape, sigma**2 / pixscale**4, dtype='f4')]
+
+        truth['{}_model'.format(filt)] = model
+        truth['{}_image'.format(filt)] = image
+        truth['{}_invvar'.format(filt)] = ivar
+        truth['{}_psf'.format(filt)] = psf
+    truth['mask'] = mask
+
+    # Initial geometry, in the conventions of find_galaxy (note that x and y
+    # are swapped relative to photutils).
+    pa = (cen['pa'] + 90) % 180 # [degrees, from the y-axis]
+    data['mge'] = [{
+        'largeshift': False,
+        'ra': 180.0, 'dec': 0.0, 'bx': cen['bx'], 'by': cen['by'],
+        'ra_x0': 180.0, 'dec_y0': 0.0,
+        'mw_transmission_g': np.float32(1), 'mw_transmission_r': np.float32(1),
+        'mw_transmission_z': np.float32(1),
+        'eps': np.float32(1 - cen['ba']), 'pa': np.float32(pa),
+        'theta': np.float32((270 - pa) % 180),
+        'majoraxis': np.float32(3 * cen['shape_r']),
+        'xmed': np.float32(cen['by']), 'ymed': np.float32(cen['bx']),
+        'xpeak': np.float32(cen['by']), 'ypeak': np.float32(cen['bx'])}]
+
+    return data, src, truth
+
+def mock_tractor_catalog(src, truth, bands=MOCK_BANDS, refband='r', pixscale=0.262,
+                         ra=180.0, dec=0.0):
+    """Build the inputs to _build_multiband_mask from the output of
+    simulate_galaxy: a Tractor catalog (astrometry.net fits_table) and a data
+    dictionary with the unmasked images, variance, WCS and PSF of each band.
+
+    Requires the tractor, legacypipe, and astrometry.net packages.
+
+    """
+    import numpy.ma as ma
+    from astrometry.util.fits import fits_table
+    from astrometry.util.util import Tan
+    from tractor.wcs import ConstantFitsWcs
+    from tractor.psf import PixelizedPSF
+
+    size = truth['mask'].shape[0]
+    wcs = Tan(ra, dec, (size + 1) / 2, (size + 1) / 2, -pixscale / 3600, 0.0,
+              0.0, pixscale / 3600, float(size), float(size))
+
+    nsrc = len(src)
+    tractor = fits_table()
+    tractor.type = np.array(src['type'])
+    tractor.bx = src['bx'].astype('f4')
+    tractor.by = src['by'].astype('f4')
+    _ra, _dec = [], []
+    for bx, by in zip(src['bx'], src['by']):
+        rr, dd = wcs.pixelxy2radec(bx + 1, by + 1)
+        _ra.append(rr)
+        _dec.append(dd)
+    tractor.ra, tractor.dec = np.array(_ra), np.array(_dec)
+
+    # Tractor conventions: shape_r [arcsec], (e1, e2) ellipticity components.
+    ee = (1 - src['ba']) / (1 + src['ba'])
+    phi = np.radians(src['pa'])
+    tractor.shape_r = (src['shape_r'] * pixscale).astype('f4')
+    tractor.shape_e1 = (ee * np.cos(2 * phi)).astype('f4')
+    tractor.shape_e2 = (ee * np.sin(2 * phi)).astype('f4')
+    tractor.sersic = src['sersic'].astype('f4')
+    for filt in bands:
+        flux = src['flux_r'] * 10**(-0.4 * MOCK_COLORS.get(filt, 0.0))
+        setattr(tractor, 'flux_{}'.format(filt), flux.astype('f4'))
+        setattr(tractor, 'flux_ivar_{}'.format(filt), np.ones(nsrc, 'f4'))
+        setattr(tractor, 'mw_transmission_{}'.format(filt), np.ones(nsrc, 'f4'))
+    tractor.ref_cat = np.array(['L3'] + ['  '] * (nsrc - 1))
+    tractor.ref_id = np.array([1] + [-1] * (nsrc - 1))
+
+    data = {'bands': list(bands), 'refband': refband,
+            'refband_width': size, 'refband_height': size,
+            'galaxy_indx': np.array([0]),
+            'residual_mask': np.zeros((size, size), bool)}
+    for filt in bands:
+        mask = truth['mask'] | (truth['{}_invvar'.format(filt)] <= 0)
+        data[filt] = ma.masked_array(truth['{}_image'.format(filt)], mask)
+        data['{}_var_'.format(filt)] = 1 / truth['{}_invvar'.format(filt)]
+        data['{}_wcs'.format(filt)] = ConstantFitsWcs(wcs)
+        data['{}_psf'.format(filt)] = PixelizedPSF(truth['{}_psf'.format(filt)].astype('f4'))
+    filt2pixscale = {filt: pixscale for filt in bands}
+
+    return data, tractor, filt2pixscale
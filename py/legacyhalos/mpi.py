@@ -5,12 +5,14 @@ legacyhalos.mpi
 Code to deal with the MPI portion of the pipeline.
 
 """
-import os, time, subprocess, pdb
+import time, pdb
 import numpy as np
 from contextlib import redirect_stdout, redirect_stderr
 
 import legacyhalos.io
 import legacyhalos.html
+from legacyhalos.statedb import record_state, stage_name
+from legacyhalos.telemetry import StageTelemetry
 
 def _start(galaxy, log=None, seed=None):
     if seed:
@@ -18,30 +20,60 @@ def _start(galaxy, log=None, seed=None):
     print('Started working on galaxy {} at {}'.format(
         galaxy, time.asctime()), flush=True, file=log)
 
-def _done(galaxy, galaxydir, err, t0, stage, filesuffix=None, log=None):
+def _done(galaxy, galaxydir, err, t0, stage, filesuffix=None, log=None,
+          telemetry=None):
     if filesuffix is None:
         suffix = ''
     else:
         suffix = '-{}'.format(filesuffix)
     if err == 0:
         print('ERROR: galaxy {}; please check the logfile.'.format(galaxy), flush=True, file=log)
-        donefile = os.path.join(galaxydir, '{}{}-{}.isfail'.format(galaxy, suffix, stage))
+        status = 'fail'
     else:
-        donefile = os.path.join(galaxydir, '{}{}-{}.isdone'.format(galaxy, suffix, stage))
-        
-    cmd = 'touch {}'.format(donefile)
-    subprocess.call(cmd.split())
+        status = 'done'
+
+    # Touch the sentinel (isdone or isfail) file and record the state in the
+    # database, if configured.
+    donesuffix = '{}-{}.is{}'.format(suffix, stage, status)
+    record_state(galaxy, galaxydir, donesuffix, tstart=t0)
+
+    if telemetry is not None:
+        telemetry.stage = stage_name(donesuffix)
+        telemetry.finish(status)
         
     print('Finished galaxy {} in {:.3f} minutes.'.format(
           galaxy, (time.time() - t0)/60), flush=True, file=log)
     
+def _mosaic_diameter(data):
+    """Diameter of the mosaic [arcmin] for the telemetry, or None if the data
+    could not be read (which legacyhalos_ellipse handles).
+
+    """
+    try:
+        return data['refband_width'] * data['refpixscale'] / 60
+    except (KeyError, TypeError):
+        return None
+
 def call_ellipse(galaxy, galaxydir, data, galaxyinfo=None,
                  pixscale=0.262, nproc=1, bands=['g', 'r', 'z'], refband='r',
-                 delta_logsma=5, maxsma=None, logsma=True,
+                 delta_logsma=5, maxsma=None, logsma=True, delta_sma=1.0,
                  verbose=False, debug=False, write_donefile=True,
-                 logfile=None, input_ellipse=None, sbthresh=None):
+                 logfile=None, input_ellipse=None, sbthresh=None,
+                 concurrent_bands=False, multires=False, adaptive_sma=False,
+                 sma_snrmin=1.0, sma_nlow=3, checkpoint=None):
     """Wrapper script to do ellipse-fitting.
 
+    concurrent_bands - fit all the bands together on the worker pool (see
+      ellipse.ellipsefit_multiband)
+    multires - sample the outer isophotes from block-averaged images (see
+      legacyhalos.multires)
+    adaptive_sma - integrate on an adaptive sma grid and stop each band at the
+      noise (see ellipse.ellipsefit_multiband)
+    sma_snrmin, sma_nlow - stop each band with adaptive_sma once sma_nlow
+      consecutive isophotes have a signal-to-noise ratio below sma_snrmin
+    checkpoint - checkpoint each band and stage so an interrupted galaxy can be
+      resumed (see legacyhalos.checkpoint); default is ${LEGACYHALOS_CHECKPOINT}
+
     """
     import legacyhalos.ellipse
 
@@ -50,30 +82,43 @@ def call_ellipse(galaxy, galaxydir, data, galaxyinfo=None,
     #    zcolumn = 'Z_LAMBDA'
 
     t0 = time.time()
-    if debug:
-        _start(galaxy)
-        err = legacyhalos.ellipse.legacyhalos_ellipse(
-            galaxy, galaxydir, data, galaxyinfo=galaxyinfo,
-            bands=bands, refband=refband,
-            pixscale=pixscale, nproc=nproc,
-            sbthresh=sbthresh, input_ellipse=input_ellipse,
-            delta_logsma=delta_logsma, maxsma=maxsma, logsma=logsma,
-            verbose=verbose, debug=debug)
-        if write_donefile:
-            _done(galaxy, galaxydir, err, t0, 'ellipse', data['filesuffix'])
-    else:
-        with open(logfile, 'a') as log:
-            with redirect_stdout(log), redirect_stderr(log):
-                _start(galaxy, log=log)
-                err, filesuffix = legacyhalos.ellipse.legacyhalos_ellipse(
-                    galaxy, galaxydir, data, galaxyinfo=galaxyinfo,
-                    bands=bands, refband=refband,
-                    pixscale=pixscale, nproc=nproc,
-                    sbthresh=sbthresh, input_ellipse=input_ellipse,
-                    delta_logsma=delta_logsma, maxsma=maxsma, logsma=logsma,
-                    verbose=verbose)
-                if write_donefile:
-                    _done(galaxy, galaxydir, err, t0, 'ellipse', data['filesuffix'], log=log)
+    with StageTelemetry(galaxy, 'ellipse', diameter=_mosaic_diameter(data)) as telemetry:
+        if debug:
+            _start(galaxy)
+            err = legacyhalos.ellipse.legacyhalos_ellipse(
+                galaxy, galaxydir, data, galaxyinfo=galaxyinfo,
+                bands=bands, refband=refband,
+                pixscale=pixscale, nproc=nproc,
+                sbthresh=sbthresh, input_ellipse=input_ellipse,
+                delta_logsma=delta_logsma, maxsma=maxsma, logsma=logsma,
+                delta_sma=delta_sma,
+                concurrent_bands=concurrent_bands, multires=multires,
+                adaptive_sma=adaptive_sma, sma_snrmin=sma_snrmin,
+                sma_nlow=sma_nlow, checkpoint=checkpoint,
+                verbose=verbose, debug=debug)
+            if write_donefile:
+                _done(galaxy, galaxydir, err, t0, 'ellipse', data['filesuffix'],
+                      telemetry=telemetry)
+        else:
+            with open(logfile, 'a') as log:
+                with redirect_stdout(log), redirect_stderr(log):
+                    _start(galaxy, log=log)
+                    err, filesuffix = legacyhalos.ellipse.legacyhalos_ellipse(
+                        galaxy, galaxydir, data, galaxyinfo=galaxyinfo,
+                        bands=bands, refband=refband,
+                        pixscale=pixscale, nproc=nproc,
+                        sbthresh=sbthresh, input_ellipse=input_ellipse,
+                        delta_logsma=delta_logsma, maxsma=maxsma, logsma=logsma,
+                        delta_sma=delta_sma,
+                        concurrent_bands=concurrent_bands, multires=multires,
+                        adaptive_sma=adaptive_sma, sma_snrmin=sma_snrmin,
+                        sma_nlow=sma_nlow, checkpoint=checkpoint,
+                        verbose=verbose)
+                    if write_donefile:
+                        _done(galaxy, galaxydir, err, t0, 'ellipse', data['filesuffix'], log=log,
+                              telemetry=telemetry)
+        if not write_donefile:
+            telemetry.finish('fail' if err == 0 else 'done')
 
     return err
 
@@ -129,37 +174,39 @@ def call_htmlplots(onegal, galaxy, survey, pixscale=0.262, nproc=1,
                    get_galaxy_galaxydir=None, read_multiband=None):
     """Wrapper script to build the pipeline coadds."""
     t0 = time.time()
-
-    if debug:
-        _start(galaxy)
-        err = legacyhalos.html.make_plots(
-            onegal, datadir=datadir, htmldir=htmldir, survey=survey, 
-            pixscale=pixscale, zcolumn=zcolumn, galaxy_id=galaxy_id,
-            nproc=nproc, barlen=barlen, barlabel=barlabel,
-            radius_mosaic_arcsec=radius_mosaic_arcsec,
-            maketrends=False, ccdqa=ccdqa,
-            clobber=clobber, verbose=verbose, 
-            cosmo=cosmo, galex=galex, just_coadds=just_coadds,
-            get_galaxy_galaxydir=get_galaxy_galaxydir,
-            read_multiband=read_multiband)
-        if write_donefile:
-            _done(galaxy, survey.output_dir, err, t0, 'html')
-    else:
-        with open(logfile, 'a') as log:
-            with redirect_stdout(log), redirect_stderr(log):
-                _start(galaxy, log=log)
-                err = legacyhalos.html.make_plots(
-                    onegal, datadir=datadir, htmldir=htmldir, survey=survey, 
-                    pixscale=pixscale, zcolumn=zcolumn, galaxy_id=galaxy_id,
-                    nproc=nproc, barlen=barlen, barlabel=barlabel,
-                    radius_mosaic_arcsec=radius_mosaic_arcsec,
-                    maketrends=False, ccdqa=ccdqa,
-                    clobber=clobber, verbose=verbose,
-                    cosmo=cosmo, galex=galex, just_coadds=just_coadds,
-                    get_galaxy_galaxydir=get_galaxy_galaxydir,
-                    read_multiband=read_multiband)
-                if write_donefile:
-                    _done(galaxy, survey.output_dir, err, t0, 'html')
+    with StageTelemetry(galaxy, 'html') as telemetry:
+        if debug:
+            _start(galaxy)
+            err = legacyhalos.html.make_plots(
+                onegal, datadir=datadir, htmldir=htmldir, survey=survey, 
+                pixscale=pixscale, zcolumn=zcolumn, galaxy_id=galaxy_id,
+                nproc=nproc, barlen=barlen, barlabel=barlabel,
+                radius_mosaic_arcsec=radius_mosaic_arcsec,
+                maketrends=False, ccdqa=ccdqa,
+                clobber=clobber, verbose=verbose, 
+                cosmo=cosmo, galex=galex, just_coadds=just_coadds,
+                get_galaxy_galaxydir=get_galaxy_galaxydir,
+                read_multiband=read_multiband)
+            if write_donefile:
+                _done(galaxy, survey.output_dir, err, t0, 'html', telemetry=telemetry)
+        else:
+            with open(logfile, 'a') as log:
+                with redirect_stdout(log), redirect_stderr(log):
+                    _start(galaxy, log=log)
+                    err = legacyhalos.html.make_plots(
+                        onegal, datadir=datadir, htmldir=htmldir, survey=survey, 
+                        pixscale=pixscale, zcolumn=zcolumn, galaxy_id=galaxy_id,
+                        nproc=nproc, barlen=barlen, barlabel=barlabel,
+                        radius_mosaic_arcsec=radius_mosaic_arcsec,
+                        maketrends=False, ccdqa=ccdqa,
+                        clobber=clobber, verbose=verbose,
+                        cosmo=cosmo, galex=galex, just_coadds=just_coadds,
+                        get_galaxy_galaxydir=get_galaxy_galaxydir,
+                        read_multiband=read_multiband)
+                    if write_donefile:
+                        _done(galaxy, survey.output_dir, err, t0, 'html', telemetry=telemetry)
+        if not write_donefile:
+            telemetry.finish('fail' if err == 0 else 'done')
 
 def call_custom_coadds(onegal, galaxy, survey, run, radius_mosaic, nproc=1,
                        pixscale=0.262, racolumn='RA', deccolumn='DEC',
@@ -180,34 +227,37 @@ def call_custom_coadds(onegal, galaxy, survey, run, radius_mosaic, nproc=1,
     import legacyhalos.coadds
     
     t0 = time.time()
-    if debug:
-        _start(galaxy)
-        err, filesuffix = legacyhalos.coadds.custom_coadds(
-            onegal, galaxy=galaxy, survey=survey, 
-            radius_mosaic=radius_mosaic, nproc=nproc, 
-            pixscale=pixscale, racolumn=racolumn, deccolumn=deccolumn,
-            largegalaxy=largegalaxy, pipeline=pipeline, custom=custom,
-            run=run, apodize=apodize, unwise=unwise, galex=galex, force=force, plots=plots,
-            verbose=verbose, cleanup=cleanup, write_all_pickles=write_all_pickles,
-            #no_subsky=no_subsky,
-            subsky_radii=subsky_radii, #ubercal_sky=ubercal_sky,
-            just_coadds=just_coadds,
-            require_grz=require_grz, no_gaia=no_gaia, no_tycho=no_tycho)
-        _done(galaxy, survey.output_dir, err, t0, 'coadds', filesuffix)
-    else:
-        with open(logfile, 'a') as log:
-            with redirect_stdout(log), redirect_stderr(log):
-                _start(galaxy, log=log)
-                err, filesuffix = legacyhalos.coadds.custom_coadds(
-                    onegal, galaxy=galaxy, survey=survey, 
-                    radius_mosaic=radius_mosaic, nproc=nproc, 
-                    pixscale=pixscale, racolumn=racolumn, deccolumn=deccolumn, 
-                    largegalaxy=largegalaxy, pipeline=pipeline, custom=custom,
-                    run=run, apodize=apodize, unwise=unwise, galex=galex, force=force, plots=plots,
-                    verbose=verbose, cleanup=cleanup, write_all_pickles=write_all_pickles,
-                    #no_subsky=no_subsky,
-                    subsky_radii=subsky_radii, #ubercal_sky=ubercal_sky,
-                    just_coadds=just_coadds,
-                    require_grz=require_grz, no_gaia=no_gaia, no_tycho=no_tycho,
-                    log=log)
-                _done(galaxy, survey.output_dir, err, t0, 'coadds', filesuffix, log=log)
+    with StageTelemetry(galaxy, 'coadds', diameter=2 * radius_mosaic / 60) as telemetry: # [arcmin]
+        if debug:
+            _start(galaxy)
+            err, filesuffix = legacyhalos.coadds.custom_coadds(
+                onegal, galaxy=galaxy, survey=survey, 
+                radius_mosaic=radius_mosaic, nproc=nproc, 
+                pixscale=pixscale, racolumn=racolumn, deccolumn=deccolumn,
+                largegalaxy=largegalaxy, pipeline=pipeline, custom=custom,
+                run=run, apodize=apodize, unwise=unwise, galex=galex, force=force, plots=plots,
+                verbose=verbose, cleanup=cleanup, write_all_pickles=write_all_pickles,
+                #no_subsky=no_subsky,
+                subsky_radii=subsky_radii, #ubercal_sky=ubercal_sky,
+                just_coadds=just_coadds,
+                require_grz=require_grz, no_gaia=no_gaia, no_tycho=no_tycho)
+            _done(galaxy, survey.output_dir, err, t0, 'coadds', filesuffix,
+                  telemetry=telemetry)
+        else:
+            with open(logfile, 'a') as log:
+                with redirect_stdout(log), redirect_stderr(log):
+                    _start(galaxy, log=log)
+                    err, filesuffix = legacyhalos.coadds.custom_coadds(
+                        onegal, galaxy=galaxy, survey=survey, 
+                        radius_mosaic=radius_mosaic, nproc=nproc, 
+                        pixscale=pixscale, racolumn=racolumn, deccolumn=deccolumn, 
+                        largegalaxy=largegalaxy, pipeline=pipeline, custom=custom,
+                        run=run, apodize=apodize, unwise=unwise, galex=galex, force=force, plots=plots,
+                        verbose=verbose, cleanup=cleanup, write_all_pickles=write_all_pickles,
+                        #no_subsky=no_subsky,
+                        subsky_radii=subsky_radii, #ubercal_sky=ubercal_sky,
+                        just_coadds=just_coadds,
+                        require_grz=require_grz, no_gaia=no_gaia, no_tycho=no_tycho,
+                        log=log)
+                    _done(galaxy, survey.output_dir, err, t0, 'coadds', filesuffix, log=log,
+                          telemetry=telemetry)
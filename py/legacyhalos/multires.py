@@ -0,0 +1,282 @@
+"""
+legacyhalos.multires
+====================
+
+Multi-resolution isophote sampling.
+
+At large semi-major axis each isophote averages thousands of pixels, so
+sampling the native-resolution image is mostly wasted effort (and, with the
+fine delta_sma used for the largest galaxies, many neighboring isophotes sample
+nearly the same pixels). Here we build a pyramid of block-averaged images
+(factors of 2, 4, 8, ... per side), excluding the masked pixels and propagating
+the variance of each block mean, and sample every isophote on the coarsest
+level on which its semi-major axis is still at least MULTIRES_MINSMA (coarse)
+pixels. The geometry and errors of the resulting isophotes are converted back to
+native pixels, so they can be used in lieu of the output of
+ellipse.integrate_isophot_one.
+
+As at full resolution, the uncertainty of each isophote comes from the scatter
+of its (block-averaged) samples. The pyramids used by the pipeline (see
+isophote._publish_images) therefore carry no variance; the propagated variance
+is only used to compare the two methods in validate_multires.
+
+validate_multires compares the multi-resolution and full-resolution profiles of
+an image (see bin/legacyhalos/legacyhalos-validate-multires).
+
+"""
+import time, pdb
+import numpy as np
+import numpy.ma as ma
+
+MULTIRES_MINSMA = 25.0 # minimum semi-major axis on any level [level pixels]
+MULTIRES_MINFRAC = 0.5 # minimum fraction of unmasked pixels in a block
+MULTIRES_MAXLEVEL = 6 # i.e., up to 64x64 blocks
+
+def block_average(img, var=None, factor=2, minfrac=MULTIRES_MINFRAC):
+    """Average an image (and propagate its variance) in factor x factor blocks.
+
+    Masked pixels are excluded from each block mean and blocks with fewer than
+    minfrac of their pixels unmasked are masked. The image is trimmed to a
+    multiple of factor on each side (which only removes partial blocks at the
+    upper edges, so the origin is unchanged).
+
+    img - 2D (masked) image
+    var - optional variance image; the variance of each block mean is
+      sum(var) / n**2 over its n unmasked pixels
+
+    Returns the block-averaged masked image and variance (or None).
+
+    """
+    data = ma.getdata(img).astype('f8')
+    mask = ma.getmaskarray(img)
+    ny, nx = (np.array(data.shape) // factor) * factor
+    shape = (ny // factor, factor, nx // factor, factor)
+
+    good = ~mask[:ny, :nx]
+    npix = np.sum(good.reshape(shape), axis=(1, 3))
+    total = np.sum(np.where(good, data[:ny, :nx], 0.0).reshape(shape), axis=(1, 3))
+
+    keep = npix >= max(minfrac * factor**2, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(keep, total / npix, 0.0)
+
+    out = ma.masked_array(mean.astype(data.dtype if data.dtype.kind == 'f' else 'f8'), ~keep)
+    if ma.isMaskedArray(img):
+        ma.set_fill_value(out, img.fill_value)
+
+    outvar = None
+    if var is not None:
+        var = np.asarray(var, 'f8')[:ny, :nx]
+        vtotal = np.sum(np.where(good, var, 0.0).reshape(shape), axis=(1, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            outvar = np.where(keep, vtotal / npix**2, 0.0)
+    return out, outvar
+
+def image_pyramid(img, var=None, nlevel=4, minfrac=MULTIRES_MINFRAC):
+    """Build a pyramid of images block-averaged by factors of 2**level.
+
+    Returns a list of (image, variance) tuples; level 0 is the input image.
+    Each level is averaged from the previous one, which is equivalent to
+    averaging the original image in 2**level blocks (except for how partially
+    masked blocks are handled).
+
+    """
+    pyramid = [(img, None if var is None else np.asarray(var))]
+    for _ in range(1, nlevel):
+        pimg, pvar = pyramid[-1]
+        if min(pimg.shape) < 2:
+            break
+        pyramid.append(block_average(pimg, var=pvar, factor=2, minfrac=minfrac))
+    return pyramid
+
+def pyramid_nlevel(maxsma, minsma=MULTIRES_MINSMA, maxlevel=MULTIRES_MAXLEVEL):
+    """Number of pyramid levels needed to sample semi-major axes up to maxsma."""
+    if maxsma <= minsma:
+        return 1
+    return int(np.clip(np.floor(np.log2(maxsma / minsma)) + 1, 1, maxlevel + 1))
+
+def pyramid_level(sma, nlevel, minsma=MULTIRES_MINSMA):
+    """Coarsest level on which the semi-major axis (in native pixels) is still at
+    least minsma level pixels.
+
+    """
+    sma = np.asarray(sma, 'f8')
+    with np.errstate(divide='ignore'):
+        level = np.floor(np.log2(np.where(sma > 0, sma, 1.0) / minsma))
+    return np.clip(level, 0, nlevel - 1).astype(int)
+
+def multires_sma(sma, nlevel, minsma=MULTIRES_MINSMA):
+    """Drop the semi-major axes which are closer than one (coarse) pixel of their
+    level to the previous isophote, since they would sample (nearly) the same
+    block-averaged pixels.
+
+    """
+    sma = np.asarray(sma)
+    if len(sma) == 0:
+        return sma
+    level = pyramid_level(sma, nlevel, minsma=minsma)
+    keep = [0]
+    for ii in range(1, len(sma)):
+        if sma[ii] - sma[keep[-1]] >= 2**level[ii] - 1e-6:
+            keep.append(ii)
+    return sma[np.array(keep)]
+
+def _to_native(iso, factor, integrmode='median'):
+    """Convert the geometry and errors of an isophote measured on a level
+    block-averaged by factor back to native pixels.
+
+    The point-sampling integration modes ('bilinear' and 'nearest_neighbor')
+    take one sample per (coarse) pixel along the ellipse, i.e., factor times
+    fewer samples than at native resolution, each with factor times smaller
+    scatter, so their int_err is scaled up by sqrt(factor) to match the error of
+    the native-resolution isophote. The sector-averaging modes ('mean' and
+    'median') take the same number of samples on every level.
+
+    """
+    geometry = iso.sample.geometry
+    geometry.sma *= factor
+    geometry.x0 = (geometry.x0 + 0.5) * factor - 0.5
+    geometry.y0 = (geometry.y0 + 0.5) * factor - 0.5
+
+    # Older versions of photutils store these as attributes, rather than
+    # properties of the geometry.
+    for attr in ('sma', 'x0', 'y0'):
+        if attr in iso.__dict__:
+            setattr(iso, attr, getattr(geometry, attr))
+
+    for attr in ('x0_err', 'y0_err'):
+        if getattr(iso, attr, None) is not None:
+            setattr(iso, attr, getattr(iso, attr) * factor)
+    if getattr(iso, 'grad', None) is not None:
+        iso.grad = iso.grad / factor
+    if integrmode in ('bilinear', 'nearest_neighbor') and getattr(iso, 'int_err', None) is not None:
+        iso.int_err = iso.int_err * np.sqrt(factor)
+    # Per-(native)-pixel standard deviation; each sample averages factor**2
+    # times more native pixels.
+    if getattr(iso, 'pix_stddev', None) is not None:
+        iso.pix_stddev = iso.pix_stddev * factor
+    return iso
+
+def integrate_isophot_multires(pyramid, sma, theta, eps, x0, y0, integrmode,
+                               sclip, nclip, minsma=MULTIRES_MINSMA):
+    """Integrate the ellipse profile at a single semi-major axis, sampling the
+    appropriate level of the image pyramid.
+
+    pyramid - list of images (or (image, variance) tuples; see image_pyramid)
+    sma, x0, y0 - in native pixels
+
+    """
+    from legacyhalos.ellipse import integrate_isophot_one
+
+    level = int(pyramid_level(sma, len(pyramid), minsma=minsma))
+    img = pyramid[level]
+    if type(img) is tuple:
+        img = img[0]
+
+    if level == 0:
+        return integrate_isophot_one(img, sma, theta, eps, x0, y0, 1.0,
+                                     integrmode, sclip, nclip)
+
+    factor = 2**level
+    iso = integrate_isophot_one(img, sma / factor, theta, eps, (x0 + 0.5) / factor - 0.5,
+                                (y0 + 0.5) / factor - 0.5, 1.0, integrmode, sclip, nclip)
+    return _to_native(iso, factor, integrmode=integrmode)
+
+def _isophote_noise(iso, var, factor=1):
+    """Uncertainty in the mean intensity of an isophote from the (propagated)
+    variance at its sample points.
+
+    iso - isophote measured on the level block-averaged by factor (with its
+      geometry already converted to native pixels; see _to_native)
+    var - variance image of that level
+
+    """
+    if var is None:
+        return np.nan
+    try:
+        angles, radii = iso.sample.values[0], iso.sample.values[1] # [level pixels]
+    except (AttributeError, IndexError, TypeError):
+        return np.nan
+    if len(radii) == 0:
+        return np.nan
+
+    geometry = iso.sample.geometry # [native pixels]
+    xx = radii * np.cos(angles + geometry.pa) + (geometry.x0 + 0.5) / factor - 0.5
+    yy = radii * np.sin(angles + geometry.pa) + (geometry.y0 + 0.5) / factor - 0.5
+    ix = np.clip(np.round(xx).astype(int), 0, var.shape[1] - 1)
+    iy = np.clip(np.round(yy).astype(int), 0, var.shape[0] - 1)
+    vv = var[iy, ix]
+    vv = vv[np.isfinite(vv) * (vv > 0)]
+    if len(vv) == 0:
+        return np.nan
+    return np.sqrt(np.sum(vv)) / len(vv)
+
+def validate_multires(img, sma, theta, eps, x0, y0, var=None, integrmode='median',
+                      sclip=3, nclip=3, minsma=MULTIRES_MINSMA, verbose=True):
+    """Compare the multi-resolution and full-resolution surface brightness profiles
+    of an image on the same grid of semi-major axes.
+
+    Returns a table with the intensity (and error) of each isophote from both
+    methods, the fractional difference, and the difference in units of the
+    combined uncertainty (computed from the propagated variance, if var is
+    given, otherwise from the isophote errors), and a summary dictionary with
+    the timing of each method.
+
+    """
+    from astropy.table import Table
+    from legacyhalos.ellipse import integrate_isophot_one
+
+    sma = np.asarray(sma, 'f8')
+    nlevel = pyramid_nlevel(np.max(sma), minsma=minsma)
+
+    t0 = time.time()
+    native = [integrate_isophot_one(img, _sma, theta, eps, x0, y0, 1.0, integrmode,
+                                    sclip, nclip) for _sma in sma]
+    tnative = time.time() - t0
+
+    t0 = time.time()
+    pyramid = image_pyramid(img, var=var, nlevel=nlevel)
+    multi = [integrate_isophot_multires(pyramid, _sma, theta, eps, x0, y0, integrmode,
+                                        sclip, nclip, minsma=minsma) for _sma in sma]
+    tmulti = time.time() - t0
+
+    level = pyramid_level(sma, len(pyramid), minsma=minsma)
+    out = Table()
+    out['SMA'] = sma.astype('f4')
+    out['LEVEL'] = level.astype(np.int16)
+    out['INTENS'] = np.array([iso.intens for iso in native], 'f4')
+    out['INTENS_ERR'] = np.array([iso.int_err for iso in native], 'f4')
+    out['INTENS_MULTIRES'] = np.array([iso.intens for iso in multi], 'f4')
+    out['INTENS_ERR_MULTIRES'] = np.array([iso.int_err for iso in multi], 'f4')
+    if var is not None:
+        out['NOISE'] = np.array([_isophote_noise(iso, pyramid[0][1]) for iso in native], 'f4')
+        out['NOISE_MULTIRES'] = np.array([_isophote_noise(iso, pyramid[ll][1], factor=2**ll)
+                                          for iso, ll in zip(multi, level)], 'f4')
+        err = np.hypot(out['NOISE'], out['NOISE_MULTIRES'])
+    else:
+        err = np.hypot(out['INTENS_ERR'], out['INTENS_ERR_MULTIRES'])
+
+    diff = out['INTENS_MULTIRES'] - out['INTENS']
+    with np.errstate(all='ignore'):
+        out['FRACDIFF'] = (diff / out['INTENS']).astype('f4')
+        out['CHI'] = (diff / err).astype('f4')
+
+    summary = {'nsma': len(sma), 'nlevel': len(pyramid), 'time_native': tnative,
+               'time_multires': tmulti, 'speedup': tnative / tmulti if tmulti > 0 else np.inf}
+    for ll in range(len(pyramid)):
+        these = (level == ll) * np.isfinite(out['CHI']) * np.isfinite(out['FRACDIFF'])
+        summary['level{}_nsma'.format(ll)] = int(np.sum(level == ll))
+        if np.sum(these) > 0:
+            summary['level{}_fracdiff_median'.format(ll)] = float(np.median(np.abs(out['FRACDIFF'][these])))
+            summary['level{}_chi_rms'.format(ll)] = float(np.sqrt(np.mean(out['CHI'][these]**2)))
+
+    if verbose:
+        print('Multi-resolution validation: {} isophotes on {} levels; {:.2f} sec (native) vs {:.2f} sec (multires), speedup {:.1f}x'.format(
+            summary['nsma'], summary['nlevel'], tnative, tmulti, summary['speedup']))
+        for ll in range(len(pyramid)):
+            if 'level{}_chi_rms'.format(ll) in summary:
+                print('  Level {} ({}x{} blocks): {:4d} isophotes, median |dI/I|={:.4f}, rms(dI/sigma)={:.2f}'.format(
+                    ll, 2**ll, 2**ll, summary['level{}_nsma'.format(ll)],
+                    summary['level{}_fracdiff_median'.format(ll)], summary['level{}_chi_rms'.format(ll)]))
+
+    return out, summary
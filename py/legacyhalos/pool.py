@@ -0,0 +1,90 @@
+"""
+legacyhalos.pool
+================
+
+Long-lived multiprocessing pool shared by every galaxy and pipeline stage in a
+given process (or MPI rank).
+
+Creating a fresh multiprocessing.Pool for every galaxy re-forks the worker
+processes (and re-imports photutils, astropy, etc.), which is a fixed cost that
+dominates the run time for small galaxies. Instead, call get_pool(nproc), which
+creates the pool on first use and returns the same pool thereafter. The pool is
+closed at interpreter exit, or explicitly with close_pool(); the drivers run
+their main function inside a worker_pool() block so the workers are terminated
+if anything goes wrong (otherwise an MPI rank can hang waiting for them).
+
+Note that the workers always write to the original stdout and stderr of the
+process (not to any per-galaxy logfile which was active when the pool was
+created, since that file is closed long before the workers are done).
+
+"""
+import sys, atexit, multiprocessing
+from contextlib import contextmanager
+
+_POOL = None
+_POOL_NPROC = None
+
+def _init_worker():
+    """Detach the workers from any redirected (per-galaxy) stdout or stderr."""
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+
+def get_pool(nproc=1):
+    """Return the process-wide worker pool with nproc processes, creating (or
+    re-creating, if the requested size has changed) it as needed.
+
+    """
+    global _POOL, _POOL_NPROC
+
+    nproc = max(int(nproc), 1)
+    if _POOL is not None and _POOL_NPROC != nproc:
+        close_pool()
+    if _POOL is None:
+        _POOL = multiprocessing.Pool(nproc, initializer=_init_worker)
+        _POOL_NPROC = nproc
+    return _POOL
+
+def worker_pids():
+    """Process IDs of the workers of the process-wide pool (if any), i.e., of
+    the live pool-worker children of this process.
+
+    """
+    if _POOL is None:
+        return []
+    return [proc.pid for proc in multiprocessing.active_children()
+            if 'PoolWorker' in proc.name and proc.pid is not None]
+
+def close_pool(terminate=False):
+    """Shut down the process-wide worker pool, if it exists.
+
+    terminate - kill the workers immediately (e.g., after an exception) rather
+      than waiting for any outstanding tasks to finish
+
+    """
+    global _POOL, _POOL_NPROC
+
+    if _POOL is None:
+        return
+    pool, _POOL, _POOL_NPROC = _POOL, None, None
+    if terminate:
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+
+@contextmanager
+def worker_pool():
+    """Context manager which shuts down the process-wide worker pool (created
+    within the block with get_pool, if at all) when the block exits, terminating
+    the workers on failure.
+
+    """
+    try:
+        yield
+    except BaseException:
+        close_pool(terminate=True)
+        raise
+    else:
+        close_pool()
+
+atexit.register(close_pool)
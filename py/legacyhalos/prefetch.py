@@ -0,0 +1,203 @@
+"""
+legacyhalos.prefetch
+====================
+
+Background prefetching of the input files of the next galaxy.
+
+The *-mpi drivers process one galaxy at a time, and each rank otherwise waits
+on the shared file system while read_multiband reads (and decompresses) the
+coadds, Tractor catalog, and maskbits image of every galaxy. InputPrefetcher
+copies the inputs of the next galaxy to node-local scratch in a background
+thread while the current galaxy is being fit, decompressing the tile-compressed
+(.fits.fz) images on the way, so read_multiband can read them from the scratch
+directory (see inputdir) at local-disk or memory (e.g., /dev/shm) speed.
+
+With the dynamic schedule (see legacyhalos.scheduler) the next galaxy of a rank
+is not known until it is handed out, so the drivers claim it ahead of time with
+scheduler.upcoming before prefetching it.
+
+The scratch space used is bounded by maxbytes, which must hold the inputs of
+the galaxy being fit plus those of the next one: a galaxy whose (decompressed)
+inputs do not fit is simply read from its original directory. The staged files
+are removed with release once the galaxy has been fit (and all of them with
+close, or when the process exits).
+
+The scratch directory is, in order of precedence, the scratchdir argument,
+${LEGACYHALOS_PREFETCH_DIR}, or /dev/shm (or the default temporary directory,
+if /dev/shm does not exist).
+
+"""
+import os, glob, shutil, tempfile, threading, atexit, pdb
+import numpy as np
+
+def prefetch_files(galaxy, galaxydir, filesuffix, bands=('g', 'r', 'z')):
+    """Input files of read_multiband for one galaxy: the per-band coadds, the
+    maskbits image, the Tractor catalog, and the sample file.
+
+    """
+    infiles = []
+    for band in bands:
+        infiles += sorted(glob.glob(os.path.join(galaxydir, '{}-{}-*-{}.fits.fz'.format(
+            galaxy, filesuffix, band))))
+    for suffix in ('maskbits.fits.fz', 'tractor.fits'):
+        infile = os.path.join(galaxydir, '{}-{}-{}'.format(galaxy, filesuffix, suffix))
+        if os.path.isfile(infile):
+            infiles.append(infile)
+    infiles += sorted(glob.glob(os.path.join(galaxydir, '{}-*sample.fits'.format(galaxy))))
+    return infiles
+
+def _is_compressed(infile):
+    return infile.endswith('.fz')
+
+def staged_size(infile, decompress=True):
+    """Size of a file once staged [bytes]; compressed images are decompressed.
+
+    The header of a tile-compressed image describes the binary table holding
+    the compressed tiles; the dimensions and type of the image itself are in
+    the ZNAXISn and ZBITPIX keywords. Every header and data unit is padded to a
+    multiple of 2880 bytes, and each header is allowed one more block for the
+    free space cfitsio can leave in it.
+
+    """
+    size = os.path.getsize(infile)
+    if decompress and _is_compressed(infile):
+        import fitsio
+        def _blocks(nbytes):
+            return 2880 * int(np.ceil(nbytes / 2880))
+        hdr0 = fitsio.read_header(infile, ext=0)
+        hdr = fitsio.read_header(infile, ext=1)
+        prefix = 'Z' if hdr.get('ZIMAGE', False) else ''
+        naxis = hdr['{}NAXIS'.format(prefix)]
+        npix = np.prod([hdr['{}NAXIS{}'.format(prefix, ii+1)] for ii in range(naxis)])
+        bitpix = hdr['{}BITPIX'.format(prefix)]
+        nhdr = sum(_blocks(80 * (len(hh) + 1)) + 2880 for hh in (hdr0, hdr))
+        size = max(size, nhdr + _blocks(int(npix) * abs(bitpix) // 8))
+    return size
+
+def stage_file(infile, outfile, decompress=True):
+    """Copy one input file, decompressing a tile-compressed image into a plain
+    image extension (with the same header) so it is read exactly as before.
+
+    """
+    tmpfile = '{}.tmp'.format(outfile)
+    if decompress and _is_compressed(infile):
+        import fitsio
+        with fitsio.FITS(infile) as F:
+            hdr0 = F[0].read_header()
+            hdr1 = F[1].read_header()
+            img = F[1].read()
+        with fitsio.FITS(tmpfile, 'rw', clobber=True) as F:
+            F.write(None, header=hdr0)
+            F.write(img, header=hdr1)
+    else:
+        shutil.copyfile(infile, tmpfile)
+    os.replace(tmpfile, outfile)
+
+class InputPrefetcher(object):
+    """Stage the input files of upcoming galaxies in node-local scratch.
+
+    scratchdir - node-local directory (see the module documentation)
+    maxbytes - maximum scratch space used at any time [bytes]
+    decompress - decompress the .fits.fz images while staging them
+
+    Call prefetch for the next galaxy, which returns immediately, and inputdir
+    for the current one, which waits for its files (if they were prefetched)
+    and returns the directory to read them from.
+
+    """
+    def __init__(self, scratchdir=None, maxbytes=4*1024**3, decompress=True):
+        from concurrent.futures import ThreadPoolExecutor
+
+        if scratchdir is None:
+            scratchdir = os.getenv('LEGACYHALOS_PREFETCH_DIR')
+        if scratchdir is None or scratchdir.strip() == '':
+            scratchdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        if scratchdir is not None:
+            os.makedirs(scratchdir, exist_ok=True)
+        self.rootdir = tempfile.mkdtemp(prefix='legacyhalos-prefetch-', dir=scratchdir)
+        self.maxbytes = maxbytes
+        self.decompress = decompress
+
+        # One thread, so the galaxies are staged in order and the main thread
+        # is never competing with more than one reader.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._reserved = {} # bytes of scratch space reserved by each galaxy
+        self._pending = {} # galaxy --> future
+
+        # Do not leave staged files behind if the driver dies.
+        atexit.register(self.close)
+
+    def _stagedir(self, galaxy):
+        return os.path.join(self.rootdir, galaxy)
+
+    def _stage(self, galaxy, infiles):
+        stagedir = self._stagedir(galaxy)
+        try:
+            os.makedirs(stagedir, exist_ok=True)
+            for infile in infiles:
+                stage_file(infile, os.path.join(stagedir, os.path.basename(infile)),
+                           decompress=self.decompress)
+        except Exception as err:
+            shutil.rmtree(stagedir, ignore_errors=True)
+            return err
+        return None
+
+    def prefetch(self, galaxy, galaxydir, filesuffix, bands=('g', 'r', 'z')):
+        """Start staging the inputs of a galaxy in the background. Returns False
+        if they would not fit in the scratch space (or there are none).
+
+        """
+        if galaxy in self._pending:
+            return True
+        infiles = prefetch_files(galaxy, galaxydir, filesuffix, bands=bands)
+        if len(infiles) == 0:
+            return False
+        try:
+            nbytes = sum(staged_size(infile, decompress=self.decompress) for infile in infiles)
+        except Exception:
+            return False
+        with self._lock:
+            if sum(self._reserved.values()) + nbytes > self.maxbytes:
+                return False
+            self._reserved[galaxy] = nbytes
+        self._pending[galaxy] = self._executor.submit(self._stage, galaxy, infiles)
+        return True
+
+    def inputdir(self, galaxy, galaxydir):
+        """Directory to read the inputs of a galaxy from: the staged copy, once
+        it is complete, or galaxydir if it was not prefetched or staging failed.
+
+        """
+        future = self._pending.pop(galaxy, None)
+        if future is None:
+            return galaxydir
+        err = future.result()
+        if err is not None:
+            print('Prefetching the inputs of {} failed ({}); reading from {}'.format(
+                galaxy, err, galaxydir), flush=True)
+            return galaxydir
+        return self._stagedir(galaxy)
+
+    def release(self, galaxy):
+        """Remove the staged inputs of a galaxy and free its scratch space."""
+        future = self._pending.pop(galaxy, None)
+        if future is not None:
+            future.cancel()
+            if not future.cancelled():
+                future.result()
+        shutil.rmtree(self._stagedir(galaxy), ignore_errors=True)
+        with self._lock:
+            self._reserved.pop(galaxy, None)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+        self._pending, self._reserved = {}, {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
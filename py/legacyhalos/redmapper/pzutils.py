@@ -33,9 +33,36 @@ def p_in_lambdabin(lambda_val, lambda_err, lm_min, lm_max):
 
     return p
 
-def p_in_zbin(pz, pzbins, zmin, zmax, verbose=False):
-    """Compute the probability that a given galaxy is in a specified bin in redshift
-    for an input sample of galaxies.
+def p_in_lambdabins(lambda_val, lambda_err, lm_min, lm_max):
+    """Vectorized version of p_in_lambdabin for a set of lambda bins [lm_min,
+    lm_max]; returns an array of size [nbin, ngal].
+
+    The error function is evaluated only once at each distinct bin edge, which
+    the bins (e.g., contiguous ones) often share. The output is identical to
+    calling p_in_lambdabin for each bin, including its treatment of galaxies
+    with zero (or NaN) lambda_err, whose probability is left at zero.
+
+    """
+    from scipy.special import erf
+    lm_min, lm_max = np.atleast_1d(lm_min), np.atleast_1d(lm_max)
+
+    isnan = np.isnan(lambda_err)
+    if np.sum(isnan) > 0:
+        lambda_err[isnan] = 0.0
+
+    alist = np.where( lambda_err > 0 )[0]
+    p = np.zeros((len(lm_min), len(lambda_val)), dtype=np.asarray(lambda_val).dtype)
+    if len(alist) > 0:
+        edges, indx = np.unique(np.hstack((lm_min, lm_max)), return_inverse=True)
+        imin, imax = indx[:len(lm_min)], indx[len(lm_min):]
+        erfs = np.array([erf( (edge - lambda_val[alist]) / lambda_err[alist] / np.sqrt(2) )
+                         for edge in edges])
+        p[:, alist] = 0.5*(erfs[imax, :] - erfs[imin, :])
+    return p
+
+def _p_in_bin_loop(pz, pzbins, zmin, zmax):
+    """Probability that each galaxy is in the bin [zmin, zmax], integrating its
+    (linearly interpolated) PDF pz tabulated at pzbins; see p_in_zbin.
 
     """
     dz = np.copy(pzbins[:, 1] - pzbins[:, 0])
@@ -93,66 +120,108 @@ def p_in_zbin(pz, pzbins, zmin, zmax, verbose=False):
 
     return p
 
-def p_in_mstarbin(pofm, pofm_bins, mstarmin, mstarmax, verbose=False):
-    """Compute the probability that a given galaxy is in a specified bin of stellar
-    mass for an input sample of galaxies.
+def _p_in_bins(pz, pzbins, zmin, zmax):
+    """Vectorized version of _p_in_bin_loop for all the galaxies and a set of
+    bins [zmin, zmax]; returns an array of size [nbin, ngal].
+
+    The four cases of _p_in_bin_loop (the PDF entirely inside the bin, or cut
+    by zmax, zmin, or both) are evaluated for all galaxies at once: the sums of
+    the PDF over whole pzbins intervals are differences of its cumulative sum,
+    which is computed once for all the bins, and the partial (trapezoidal)
+    intervals at the edges of the bin use the same expressions as the loop.
+    pzbins must be increasing along each row.
 
     """
-    dz = np.copy(pofm_bins[:, 1] - pofm_bins[:, 0])
-    p = np.zeros(len(pofm))
+    pz, pzbins = np.asarray(pz), np.asarray(pzbins)
+    zmin, zmax = np.atleast_1d(zmin), np.atleast_1d(zmax)
+    ngal, npz = pz.shape
+    rows = np.arange(ngal)
 
-    # Case 1: PDF is entirely in the pofm_bins range.
-    alist = np.where( (mstarmin < np.min(pofm_bins, 1)) * (mstarmax > np.max(pofm_bins, 1)) )[0]
-    if len(alist) != 0:
-        p[alist] = 0 * alist + 1.0
+    dz = np.copy(pzbins[:, 1] - pzbins[:, 0])
+    binmin, binmax = np.min(pzbins, 1), np.max(pzbins, 1)
 
-    # Case 2: mstarmax cutoff is in the pofm_bins range.
-    blist = np.where( (mstarmin < np.min(pofm_bins, 1)) * (mstarmax < np.max(pofm_bins, 1)) *
-                      (mstarmax > np.min(pofm_bins, 1)) )[0]
-    if len(blist) > 0:
-        for i in range(len(blist)):
-            bmax = np.max( np.where(pofm_bins[blist[i], :] < mstarmax)[0] )
-            slope = ( pofm[blist[i], bmax + 1] - pofm[blist[i], bmax] ) / dz[blist[i]]
-            p[blist[i]] = ( np.sum( pofm[blist[i], :bmax+1] ) * dz[blist[i]] - pofm[blist[i], bmax] *
-                            dz[blist[i]] / 2.0 + (pofm[blist[i], bmax] * 2 + slope * (mstarmax - pofm_bins[blist[i], bmax]) ) *
-                            (mstarmax - pofm_bins[blist[i], bmax]) / 2.0 )
-            #print p[blist[i]],slope,pofm_bins[blist[i],bmax],pofm_bins[blist[i],bmax+1]
-
-    # Case 3: mstarmin cutoff is in the pofm_bins range.
-    blist = np.where( (mstarmax > np.max(pofm_bins, 1)) * (mstarmin > np.min(pofm_bins, 1)) * (mstarmin < np.max(pofm_bins,1)) )[0]
-    if len(blist) > 0:
-        for i in range(len(blist)):
-            bmin = np.min( np.where(pofm_bins[blist[i], :] > mstarmin)[0] )
-            slope = ( pofm[blist[i], bmin] - pofm[blist[i], bmin-1]) / dz[blist[i]]
-            p[blist[i]] = ( np.sum(pofm[blist[i], bmin:]) * dz[blist[i]] - pofm[blist[i], bmin] *
-                            dz[blist[i]] / 2.0 + (pofm[blist[i], bmin] * 2 - slope * (pofm_bins[blist[i], bmin] - mstarmin) ) *
-                            (pofm_bins[blist[i], bmin] - mstarmin) / 2.0 )
-
-    # Case 4: mstarmax and mstarmin cutoff are both in the pofm_bins range.
-    clist = np.where( (mstarmax < np.max(pofm_bins, 1)) * (mstarmin > np.min(pofm_bins, 1)) )[0]
-    if len(clist) > 0:
-        for i in range(len(clist)):
-            cmin = np.min( np.where(pofm_bins[clist[i],:] > mstarmin)[0] )
-            cmax = np.max( np.where(pofm_bins[clist[i],:] < mstarmax)[0] )
-            slope_min = (pofm[clist[i], cmin] - pofm[clist[i], cmin - 1]) / dz[clist[i]]
-            slope_max = (pofm[clist[i], cmax + 1] - pofm[clist[i], cmax]) / dz[clist[i]]
-
-            p[clist[i]] = ( np.sum(dz[clist[i]] * pofm[clist[i], cmin:cmax + 1]) -
-                            pofm[clist[i], cmax] * dz[clist[i]] / 2.0 +
-                            (pofm[clist[i], cmax] * 2 + slope_max * (mstarmax-pofm_bins[clist[i],cmax]) ) *
-                            (mstarmax - pofm_bins[clist[i], cmax]) / 2.0 - pofm[clist[i], cmin] * dz[clist[i]] / 2.0 +
-                            (pofm[clist[i], cmin] * 2 - slope_min * (pofm_bins[clist[i], cmin] - mstarmin) ) *
-                            (pofm_bins[clist[i], cmin] - mstarmin) / 2.0 )
+    cumpz = np.zeros((ngal, npz + 1), dtype=np.result_type(pz.dtype, np.float64))
+    np.cumsum(pz, axis=1, out=cumpz[:, 1:])
 
-    ## Clamp probabilities in excess of unity due to numerical roundoff.
-    #plist = np.where( p > 1 )[0]
-    #if len(plist) > 0:
-    #    if verbose:
-    #        print('Clamping p(z) to unity for {} galaxies to unity.'.format(len(plist)))
-    #    p[plist] = 1
+    def _upper(kk, zz):
+        # last interval, from pzbins[kk] up to zz
+        pzk, zk = pz[rows, kk], pzbins[rows, kk]
+        slope = ( pz[rows, kk + 1] - pzk ) / dz
+        return - pzk * dz / 2.0 + (pzk * 2 + slope * (zz - zk) ) * (zz - zk) / 2.0
+
+    def _lower(kk, zz):
+        # first interval, from zz up to pzbins[kk]
+        pzk, zk = pz[rows, kk], pzbins[rows, kk]
+        slope = ( pzk - pz[rows, kk - 1] ) / dz
+        return - pzk * dz / 2.0 + (pzk * 2 - slope * (zk - zz) ) * (zk - zz) / 2.0
+
+    p = np.zeros((len(zmin), ngal))
+    for ii, (_zmin, _zmax) in enumerate(zip(zmin, zmax)):
+        # last pzbin below zmax and first pzbin above zmin
+        kmax = np.clip(np.sum(pzbins < _zmax, axis=1) - 1, 0, npz - 2)
+        kmin = np.clip(npz - np.sum(pzbins > _zmin, axis=1), 1, npz - 1)
 
+        case1 = (_zmin < binmin) * (_zmax > binmax)
+        case2 = (_zmin < binmin) * (_zmax < binmax) * (_zmax > binmin)
+        case3 = (_zmax > binmax) * (_zmin > binmin) * (_zmin < binmax)
+        case4 = (_zmax < binmax) * (_zmin > binmin)
+
+        p[ii, case1] = 1.0
+        if np.any(case2):
+            upper = _upper(kmax, _zmax)
+            p[ii, case2] = (cumpz[rows, kmax + 1] * dz + upper)[case2]
+        if np.any(case3):
+            lower = _lower(kmin, _zmin)
+            p[ii, case3] = ( (cumpz[:, npz] - cumpz[rows, kmin]) * dz + lower )[case3]
+        if np.any(case4):
+            upper, lower = _upper(kmax, _zmax), _lower(kmin, _zmin)
+            inner = np.maximum(cumpz[rows, kmax + 1] - cumpz[rows, kmin], 0.0)
+            p[ii, case4] = ( dz * inner + upper + lower )[case4]
     return p
 
+def p_in_zbin(pz, pzbins, zmin, zmax, verbose=False, engine='vectorized'):
+    """Compute the probability that a given galaxy is in a specified bin in redshift
+    for an input sample of galaxies.
+
+    engine - 'vectorized' (default) handles all the galaxies at once (see
+      p_in_zbins); 'loop' loops on them, and agrees to round-off
+
+    """
+    if engine == 'vectorized':
+        return _p_in_bins(pz, pzbins, zmin, zmax)[0]
+    elif engine == 'loop':
+        return _p_in_bin_loop(pz, pzbins, zmin, zmax)
+    else:
+        raise ValueError('Unrecognized engine {}'.format(engine))
+
+def p_in_zbins(pz, pzbins, zmin, zmax):
+    """Compute the probability that each galaxy is in each of a set of redshift
+    bins [zmin, zmax]; returns an array of size [nbin, ngal].
+
+    """
+    return _p_in_bins(pz, pzbins, zmin, zmax)
+
+def p_in_mstarbin(pofm, pofm_bins, mstarmin, mstarmax, verbose=False, engine='vectorized'):
+    """Compute the probability that a given galaxy is in a specified bin of stellar
+    mass for an input sample of galaxies.
+
+    engine - 'vectorized' (default) or 'loop'; see p_in_zbin
+
+    """
+    if engine == 'vectorized':
+        return _p_in_bins(pofm, pofm_bins, mstarmin, mstarmax)[0]
+    elif engine == 'loop':
+        return _p_in_bin_loop(pofm, pofm_bins, mstarmin, mstarmax)
+    else:
+        raise ValueError('Unrecognized engine {}'.format(engine))
+
+def p_in_mstarbins(pofm, pofm_bins, mstarmin, mstarmax):
+    """Compute the probability that each galaxy is in each of a set of stellar
+    mass bins [mstarmin, mstarmax]; returns an array of size [nbin, ngal].
+
+    """
+    return _p_in_bins(pofm, pofm_bins, mstarmin, mstarmax)
+
 def bootstrap_resample_simple(ngal, nboot=10, seed=None):
     """Generate nboot bootstrap samples of ngal galaxies.
 
@@ -162,6 +231,112 @@ def bootstrap_resample_simple(ngal, nboot=10, seed=None):
     rand = np.random.RandomState(seed)
     return rand.randint( ngal, size=(nboot, ngal) )
 
+def bootstrap_weights(ngal, nboot=10, seed=None, chunksize=2**22):
+    """Bootstrap samples of ngal galaxies as a sparse [nboot, ngal] matrix of the
+    number of times each galaxy is drawn.
+
+    The samples are identical to those of bootstrap_resample_simple with the same
+    seed, but they are drawn a few at a time, so the full [nboot, ngal] array of
+    indices is never in memory.
+
+    """
+    from scipy.sparse import csr_matrix, vstack
+
+    rand = np.random.RandomState(seed)
+    nchunk = max(chunksize // max(ngal, 1), 1)
+    weights = []
+    for start in range(0, nboot, nchunk):
+        nn = min(nchunk, nboot - start)
+        indx = rand.randint( ngal, size=(nn, ngal) )
+        rows = np.repeat(np.arange(nn), ngal)
+        chunk = csr_matrix((np.ones(nn * ngal), (rows, indx.ravel())), shape=(nn, ngal))
+        chunk.sum_duplicates()
+        weights.append(chunk)
+    if len(weights) == 0:
+        return csr_matrix((0, ngal))
+    return vstack(weights, format='csr')
+
+def jackknife_weights(pix, jackpix):
+    """Jackknife regions as a sparse [njack, ngal] matrix which is one for the
+    galaxies in each region and zero otherwise.
+
+    pix - HEALPix pixel of each galaxy (see misc.radec2pix)
+    jackpix - pixel of each jackknife region (e.g., the HPXPIXEL column of the
+      table written by misc.jackknife_samples)
+
+    """
+    from scipy.sparse import csr_matrix
+
+    pix, jackpix = np.asarray(pix), np.asarray(jackpix)
+    srt = np.argsort(jackpix)
+    ii = np.searchsorted(jackpix[srt], pix).clip(0, len(jackpix) - 1)
+    good = np.where(jackpix[srt][ii] == pix)[0]
+    return csr_matrix((np.ones(len(good)), (srt[ii[good]], good)),
+                      shape=(len(jackpix), len(pix)))
+
+def resample_sums(weights, *pbins, chunksize=2**22):
+    """Total probability of every combination of bins for a set of resamples.
+
+    weights - [nsample, ngal] (sparse) matrix of the weight of each galaxy in each
+      resample (see bootstrap_weights and jackknife_weights)
+    pbins - one or more [nbin, ngal] arrays of the probability that each galaxy
+      is in each bin (e.g., from p_in_zbins and p_in_lambdabins)
+
+    Returns an [nsample, nbin1, nbin2, ...] array of the weighted sum over
+    galaxies of the product of the probabilities, i.e., np.sum(weights[kk] *
+    pbins[0][:, np.newaxis, ..., :] * pbins[1][np.newaxis, :, ..., :] * ...,
+    axis=-1) for each resample kk, computed as one matrix product.
+
+    """
+    from scipy.sparse import csc_matrix
+
+    shape = tuple(len(pp) for pp in pbins)
+    ngal = pbins[0].shape[1]
+    nprod = int(np.prod(shape))
+    weights = csc_matrix(weights)
+    nsample = weights.shape[0]
+
+    # Bootstrap weights are mostly nonzero, so they are multiplied as dense
+    # blocks (with BLAS); sparse weights (e.g., jackknife regions) are not.
+    dense = weights.nnz > 0.1 * nsample * ngal
+
+    # Build the [ngal, nprod] matrix of the products of the bin probabilities
+    # a few galaxies at a time.
+    out = np.zeros((nsample, nprod))
+    nchunk = max(chunksize // max(nprod, nsample if dense else 1, 1), 1)
+    for start in range(0, ngal, nchunk):
+        prod = np.ones((min(nchunk, ngal - start), 1))
+        for pp in pbins:
+            pp = np.asarray(pp[:, start:start+nchunk]).T
+            prod = (prod[:, :, np.newaxis] * pp[:, np.newaxis, :]).reshape(len(pp), -1)
+        chunk = weights[:, start:start+nchunk]
+        if dense:
+            out += np.dot(chunk.toarray(), prod)
+        else:
+            out += chunk @ prod
+    return out.reshape((weights.shape[0],) + shape)
+
+def resample_covariance(stat, stat_resample, jackknife=False):
+    """Variance and covariance of a statistic from its resampled values.
+
+    stat - [nbin1, ..., nbinN] statistic of the full sample
+    stat_resample - [nsample, nbin1, ..., nbinN] statistic of each resample
+    jackknife - use the jackknife, rather than the bootstrap, normalization
+
+    Returns the [nbin1, ..., nbinN] standard deviation and the [nbin1, ...,
+    nbinN, nbinN] covariance between the bins of the last axis.
+
+    """
+    nsample = len(stat_resample)
+    resid = stat[np.newaxis, ...] - stat_resample
+    if jackknife:
+        norm = (nsample - 1) / nsample
+    else:
+        norm = 1 / (nsample - 1)
+    err = np.sqrt( np.sum(resid**2, axis=0) * norm )
+    covar = np.einsum('k...i,k...j->...ij', resid, resid) * norm
+    return err, covar
+
 ##Single random selection from P(z) distribution
 #def select_rand_z(pz,pzbins):
 #    z = -1.
@@ -12,11 +12,11 @@ import legacyhalos.misc
 from legacyhalos.redmapper import pzutils
 
 def compute_nofz(cat=None, nboot=None, seed=None, area=None,
-               dz=0.2, descale=False, verbose=True):
+               dz=0.2, descale=False, outfile=None, verbose=True):
     '''Calculate n(z) for several thresholds in lambda.
 
-    Outputs the results to a file.  Incorporates P(z) and error estimation
-    Setting descale=True 
+    Incorporates P(z) and error estimation; optionally outputs the results to a
+    text file.
 
     Parameters
     ----------
@@ -32,11 +32,17 @@ def compute_nofz(cat=None, nboot=None, seed=None, area=None,
         Redshift binning width.
     descale : :class:`bool`, optional, default False
         Apply scaleval correction to lambda_chisq (see Sec 5.1 in Rykoff+14).
+    outfile : :class:`str`, optional, default None
+        Output text file name; default is to not write out the results.
     verbose : :class:`bool`, optional, default True
         Be loquacious! 
 
     Returns
     -------
+    nofz : :class:`numpy.ndarray`
+        [nlambda, nz] comoving number density [Mpc**-3].
+    nofz_err : :class:`numpy.ndarray`
+        [nlambda, nz] bootstrap uncertainty in nofz (zero unless nboot is given).
 
     Raises
     ------
@@ -53,7 +59,7 @@ def compute_nofz(cat=None, nboot=None, seed=None, area=None,
     
     # Optionally create bootstrap subsamples.
     if nboot is not None:
-        bootindx = pzutils.bootstrap_resample_simple(ngal, nboot=nboot, seed=seed)
+        bootweights = pzutils.bootstrap_weights(ngal, nboot=nboot, seed=seed) # [nboot, ngal]
 
     mylambda = cat['LAMBDA_CHISQ'].data
     mylambda_err = cat['LAMBDA_CHISQ_E'].data
@@ -83,45 +89,28 @@ def compute_nofz(cat=None, nboot=None, seed=None, area=None,
         vol[jj] = ( ( cosmo.comoving_volume(zmax[jj]) - cosmo.comoving_volume(zmin[jj]) ).value *
                     area / (4*np.pi*180**2/np.pi**2) )
 
-    nofz = np.zeros([nlambda, nz])     # output probability map
-    p_zbin = np.zeros([nz, ngal])      # P(z|lambda) summed over all galaxies
-    p_lbin = np.zeros([nlambda, ngal]) # P(lambda|z) summed over all galaxies
+    # P(lambda|z) and P(z|lambda) of every galaxy in every bin.
+    if verbose:
+        print('Get probabilities for being in {} lambda and {} redshift bins.'.format(nlambda, nz))
+    p_lbin = pzutils.p_in_lambdabins(mylambda, mylambda_err, lmin, lmax).astype('f8') # [nlambda, ngal]
+    p_zbin = pzutils.p_in_zbins(cat['PZ'].data, cat['PZBINS'].data, zmin, zmax)       # [nz, ngal]
 
-    for ii in range(nlambda):
-        if verbose:
-            print('Get probabilities for being in lambda bin {:02d}/{:02d}, {:.1f}-{:.1f}'.format(
-                ii, nlambda, lmin[ii], lmax[ii]))
-        p_lbin[ii] = pzutils.p_in_lambdabin(mylambda, mylambda_err, lmin[ii], lmax[ii])
-        for jj in range(nz):
-            if verbose:
-                print('Looping over redshift bin {:02d}/{:02d}, {:.3f}-{:.3f}'.format(
-                    jj, nz, zmin[jj], zmax[jj]))
-            if ii == 0:
-                p_zbin[jj] = pzutils.p_in_zbin(cat['PZ'].data, cat['PZBINS'].data, zmin[jj], zmax[jj])
-            nofz[ii, jj] =  np.sum(p_zbin[jj] * p_lbin[ii]) / vol[jj] # [Mpc**-3]
+    nofz = np.dot(p_lbin, p_zbin.T) / vol[np.newaxis, :] # [nlambda, nz, Mpc**-3]
 
     # Estimate the variance using the bootstrap samples.
     nofz_err = np.zeros_like(nofz)
     if nboot is not None:
-        nofz_boot = np.zeros([nboot, nlambda, nz])
-        for ii in range(nboot):
-            for jj in range(nlambda):
-                for kk in range(nz):
-                    # Total the probabilities for each bootstrap sample.
-                    nofz_boot[ii, jj, kk] = np.sum( p_zbin[kk, bootindx[ii]] * p_lbin[jj, bootindx[ii]] ) / vol[kk]
-
-        for ii in range(nlambda):
-            for jj in range(nz):
-                nofz_err[ii, jj] = np.sum( (nofz[ii, jj] - nofz_boot[:, ii, jj])**2 ) / (nboot - 1)
-
-    # Write out.
-    outfile = 'junk.txt'
-    #outfile = outdir + "nz_lm_"+str(lmin[i])+"_"+str(lmax[i])+".dat"
-    #if descale:
-    #    outfile = outdir + "nz_desc_lm_"+str(lmin[i])+"_"+str(lmax[i])+".dat"
-
-    with open(outfile, 'w') as out:
-        for ii in range(nlambda):
-            for jj in range(nz):
-                out.write( '{:06.3f} {:06.3f} {:06.3f} {:06.3f} {:.5e} {:.3e}\n'.format(
-                    lmin[ii], lmax[ii], zmin[jj], zmax[jj], nofz[ii, jj], np.sqrt(nofz_err[ii, jj]) ) )
+        nofz_boot = pzutils.resample_sums(bootweights, p_lbin, p_zbin) / vol[np.newaxis, np.newaxis, :]
+        nofz_err, _ = pzutils.resample_covariance(nofz, nofz_boot)
+
+    # Optionally write out.
+    if outfile is not None:
+        if verbose:
+            print('Writing {}'.format(outfile))
+        with open(outfile, 'w') as out:
+            for ii in range(nlambda):
+                for jj in range(nz):
+                    out.write( '{:06.3f} {:06.3f} {:06.3f} {:06.3f} {:.5e} {:.3e}\n'.format(
+                        lmin[ii], lmax[ii], zmin[jj], zmax[jj], nofz[ii, jj], nofz_err[ii, jj] ) )
+
+    return nofz, nofz_err
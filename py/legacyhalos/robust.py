@@ -0,0 +1,265 @@
+"""
+legacyhalos.robust
+==================
+
+Fast, robust (sigma-clipped) statistics of the background of large images.
+
+clipped_stats returns the sigma-clipped mean, median, and standard deviation
+of the unmasked, finite pixels of an image, like
+astropy.stats.sigma_clipped_stats, with a choice of engine--
+
+  astropy - astropy.stats.sigma_clipped_stats itself (exact, but it computes a
+    full median of the surviving pixels in every iteration, which is slow for
+    large mosaics).
+  histogram - one pass over the image bins the pixels within width robust
+    standard deviations (1.4826 times the median absolute deviation of a random
+    subsample) of the median into nbins bins, accumulating the number of pixels
+    in each bin; the pixels outside of this window (e.g., the galaxies and
+    stars) are kept and sorted. The clipping iterations then only use the
+    cumulative counts, with the bins straddling the clipping limits counted
+    fractionally, so the mean, median, and standard deviation are accurate to
+    a small fraction of the bin width, 2*width*sigma/nbins (sigma/800 with the
+    defaults). That assumes the values are spread out within each bin, which
+    is not the case for discrete (integer-valued) data, e.g., raw counts: a
+    bin then holds one value, which is either clipped or not, and the median
+    is one of the values (or the mean of two of them). So integer-valued
+    images (integer types, or floats whose subsample is integer-valued) are
+    binned with one bin per integer instead, which gives the same answer as
+    astropy, provided the window spans fewer than nbins integers; otherwise
+    (i.e., for sigma >~ nbins/(2*width), or about 800 with the defaults), the
+    binning is the same as for continuous data, with the same accuracy.
+  subsample - astropy.stats.sigma_clipped_stats on nsample randomly chosen
+    pixels; the statistical error of the median is about
+    1.25*sigma/sqrt(nsample) (sigma/400 with the defaults).
+
+The clipping follows astropy: the pixels beyond sigma standard deviations of
+the median are rejected, iteratively, until none are rejected or after
+maxiters iterations.
+
+See bin/legacyhalos/legacyhalos-benchmark (benchmarks stats_astropy,
+stats_histogram, and stats_subsample) for a comparison of the speed and
+accuracy of the engines.
+
+"""
+import pdb
+import numpy as np
+import numpy.ma as ma
+
+STATS_ENGINES = ('astropy', 'histogram', 'subsample')
+
+def _good_values(data, mask=None):
+    """Flattened unmasked, finite values of a (masked) array."""
+    if mask is None:
+        mask = ma.getmask(data)
+    data = np.asarray(ma.getdata(data))
+    good = np.isfinite(data)
+    if mask is not ma.nomask and mask is not None:
+        good &= ~np.asarray(mask, bool)
+    if np.all(good):
+        return data.ravel()
+    return data[good]
+
+def _subsample(vals, nsample, seed):
+    if len(vals) <= nsample:
+        return vals
+    rand = np.random.RandomState(seed)
+    return vals[rand.randint(0, len(vals), nsample)]
+
+class _BinnedPixels(object):
+    """Pixel values binned for repeated sigma-clipping; see clipped_stats.
+
+    All the values are stored relative to the center of the window, to limit the
+    round-off error of the variance.
+
+    discrete - the values are integers; use one bin (centered) on each integer
+      and treat each bin as a single value, rather than spreading its pixels out
+      uniformly across it
+
+    """
+    def __init__(self, vals, center, halfwidth, nbins, discrete=False, chunksize=2**22):
+        if discrete:
+            center = np.round(center)
+            nbins = 2 * int(np.ceil(halfwidth)) + 1
+            halfwidth = nbins / 2
+        self.discrete = discrete
+        self.center = center
+        self.halfwidth = halfwidth
+        self.binsize = 2 * halfwidth / nbins
+        self.nbins = nbins
+        self.edges = -halfwidth + self.binsize * np.arange(nbins + 1)
+
+        # Only the number of pixels in each bin is accumulated; the pixels are
+        # taken to be at the center of their bin for the sums.
+        counts = np.zeros(nbins)
+        below, above = [], []
+        scale = np.float32(1 / self.binsize)
+        for start in range(0, len(vals), chunksize):
+            chunk = vals[start:start+chunksize]
+            pos = (chunk - np.float32(center - halfwidth)) * scale
+            low, high = pos < 0, pos >= nbins
+            below.append(chunk[low].astype('f8') - center)
+            above.append(chunk[high].astype('f8') - center)
+            inside = ~(low | high)
+            counts += np.bincount(pos[inside].astype(np.intp), minlength=nbins)
+        mid = 0.5 * (self.edges[1:] + self.edges[:-1])
+        if discrete:
+            mid = np.round(mid)
+        self.mid = mid
+        sums, sumsqs = counts * mid, counts * mid**2
+
+        # Cumulative count, sum, and sum of squares at the bin edges, for the
+        # binned pixels, and at each (sorted) value, for the pixels outside of
+        # the window.
+        self.cum = [np.concatenate(([0.0], np.cumsum(xx))) for xx in (counts, sums, sumsqs)]
+        self.tails = []
+        for tail in (below, above):
+            tail = np.sort(np.concatenate(tail))
+            self.tails.append((tail, [np.concatenate(([0.0], np.cumsum(xx)))
+                                      for xx in (np.ones_like(tail), tail, tail**2)]))
+
+    def _binned(self, xx, side='left'):
+        """Cumulative count, sum, and sum of squares of the binned pixels below xx,
+        interpolating linearly within the bins (or, for discrete values, below
+        or at xx with side='right').
+
+        """
+        if self.discrete:
+            kk = np.searchsorted(self.mid, xx, side=side)
+            return [cum[kk] for cum in self.cum]
+        xx = np.clip(xx, -self.halfwidth, self.halfwidth)
+        return [np.interp(xx, self.edges, cum) for cum in self.cum]
+
+    def _tail(self, itail, xmin, xmax):
+        """First index, and count, sum, and sum of squares, of the pixels outside
+        the window with xmin <= value <= xmax.
+
+        """
+        tail, cum = self.tails[itail]
+        i0 = np.searchsorted(tail, xmin, side='left')
+        i1 = np.searchsorted(tail, xmax, side='right')
+        return i0, [cc[i1] - cc[i0] for cc in cum]
+
+    def stats(self, xmin, xmax):
+        """Number, mean, median, and standard deviation of the pixels with
+        xmin <= value <= xmax.
+
+        """
+        xmin, xmax = xmin - self.center, xmax - self.center
+        b0, b1 = self._binned(xmin, side='left'), self._binned(xmax, side='right')
+        ilow, lowsum = self._tail(0, xmin, xmax)
+        ihigh, highsum = self._tail(1, xmin, xmax)
+        npix, total, totalsq = [lowsum[ii] + (b1[ii] - b0[ii]) + highsum[ii] for ii in range(3)]
+        if npix <= 0:
+            return 0.0, np.nan, np.nan, np.nan
+
+        mean = total / npix
+        std = np.sqrt(max(totalsq / npix - mean**2, 0.0))
+
+        # Median: the value below which half of the selected pixels lie or, for
+        # discrete values, the middle value (or the mean of the two middle
+        # values), as np.median.
+        half, nlow, nbin = npix / 2, lowsum[0], b1[0] - b0[0]
+        if self.discrete:
+            ranks = np.unique([np.floor((npix + 1) / 2), np.ceil((npix + 1) / 2)])
+            median = np.mean([self._value(rank, ilow, nlow, b0[0], nbin, ihigh)
+                              for rank in ranks])
+        elif half <= nlow:
+            median = self._tail_value(0, ilow, half)
+        elif half <= nlow + nbin:
+            target = b0[0] + (half - nlow)
+            kk = min(max(np.searchsorted(self.cum[0], target, side='left'), 1), self.nbins)
+            ncount = self.cum[0][kk] - self.cum[0][kk-1]
+            frac = (target - self.cum[0][kk-1]) / ncount if ncount > 0 else 0.5
+            median = self.edges[kk-1] + frac * self.binsize
+        else:
+            median = self._tail_value(1, ihigh, half - nlow - nbin)
+        return npix, mean + self.center, median + self.center, std
+
+    def _value(self, rank, ilow, nlow, nbelow, nbin, ihigh):
+        """Value of the selected pixel of the given rank (starting at one), for
+        discrete values.
+
+        """
+        if rank <= nlow:
+            return self._tail_value(0, ilow, rank)
+        if rank <= nlow + nbin:
+            kk = np.searchsorted(self.cum[0], nbelow + rank - nlow - 0.5, side='left')
+            return self.mid[min(max(kk, 1), self.nbins) - 1]
+        return self._tail_value(1, ihigh, rank - nlow - nbin)
+
+    def _tail_value(self, itail, i0, rank):
+        tail = self.tails[itail][0]
+        ii = min(i0 + max(int(np.ceil(rank)) - 1, 0), len(tail) - 1)
+        return tail[ii]
+
+def _histogram_stats(vals, sigma=3.0, maxiters=5, nbins=2**14, width=10.0,
+                     nsample=2**18, seed=1):
+    """Sigma-clipped mean, median, and standard deviation; see clipped_stats."""
+    sub = _subsample(vals, nsample, seed)
+    center = np.median(sub)
+    scale = 1.4826 * np.median(np.abs(sub - center))
+    if not scale > 0:
+        scale = np.std(sub)
+    if not (np.isfinite(center) and scale > 0):
+        return None # degenerate (e.g., constant) image
+
+    discrete = vals.dtype.kind in 'iub' or bool(np.all(sub == np.round(sub)))
+    discrete = discrete and 2 * np.ceil(width * scale) + 1 <= nbins
+    binned = _BinnedPixels(vals, center, width * scale, nbins, discrete=discrete)
+
+    xmin, xmax = -np.inf, np.inf
+    npix, mean, median, std = binned.stats(xmin, xmax)
+    for _ in range(maxiters):
+        # Like astropy, the clipping limits can only shrink.
+        xmin, xmax = max(xmin, median - sigma * std), min(xmax, median + sigma * std)
+        _npix, _mean, _median, _std = binned.stats(xmin, xmax)
+        if _npix <= 0:
+            break
+        nclip = npix - _npix
+        npix, mean, median, std = _npix, _mean, _median, _std
+        if nclip < 0.5:
+            break
+    return mean, median, std
+
+def clipped_stats(data, mask=None, sigma=3.0, maxiters=5, engine='astropy',
+                  nbins=2**14, width=10.0, nsample=2**18, seed=1):
+    """Sigma-clipped mean, median, and standard deviation of an image.
+
+    data - image (or masked array)
+    mask - boolean image (True-->masked); default is the mask of data, if any
+    sigma - clipping threshold [standard deviations]
+    maxiters - maximum number of clipping iterations
+    engine - 'astropy' (default), 'histogram', or 'subsample'; see the module
+      documentation
+    nbins, width - number of bins, and half-width of the window [robust standard
+      deviations], for the histogram engine
+    nsample, seed - number of pixels and random seed used by the subsample
+      engine and to center the histogram window
+
+    Returns the tuple (mean, median, std), as astropy.stats.sigma_clipped_stats.
+
+    """
+    from astropy.stats import sigma_clipped_stats
+
+    if engine not in STATS_ENGINES:
+        raise ValueError('Unrecognized stats engine {}'.format(engine))
+
+    if engine == 'astropy':
+        if mask is None:
+            mask = ma.getmask(data)
+            if mask is ma.nomask:
+                mask = None
+        return sigma_clipped_stats(ma.getdata(data), mask=mask, sigma=sigma, maxiters=maxiters)
+
+    vals = _good_values(data, mask=mask)
+    if len(vals) == 0:
+        return np.nan, np.nan, np.nan
+
+    if engine == 'subsample':
+        return sigma_clipped_stats(_subsample(vals, nsample, seed), sigma=sigma, maxiters=maxiters)
+
+    out = _histogram_stats(vals, sigma=sigma, maxiters=maxiters, nbins=nbins,
+                           width=width, nsample=nsample, seed=seed)
+    if out is None:
+        return sigma_clipped_stats(vals, sigma=sigma, maxiters=maxiters)
+    return out
@@ -0,0 +1,257 @@
+"""
+legacyhalos.scheduler
+=====================
+
+Dynamic (work-stealing) distribution of galaxies across MPI ranks.
+
+The missing_files functions divide the galaxies into one fixed group per rank
+ahead of time, but the run time depends so steeply on the size of the galaxy
+(and on whether it fails) that a few ranks can finish hours after the rest.
+Instead, every rank pulls the next galaxy from a single queue, ordered from the
+largest to the smallest, by atomically incrementing a shared counter (an MPI
+one-sided window on rank 0). The biggest (slowest) galaxies therefore start
+first and the small ones fill in the gaps at the end.
+
+The drivers (bin/*/*-mpi) simply replace the per-rank groups with
+dynamic_groups(groups, sample[DIAMCOLUMN], comm) and iterate over groups[rank]
+as before. A DynamicQueue cannot be indexed, however, since which galaxy a rank
+gets next is only decided when it asks for it: use upcoming to claim (and look
+up) the next galaxy of this rank ahead of time, e.g., to prefetch its inputs,
+and progress and describe for the log messages. Free the queue (collectively)
+with free once every rank is done with it.
+
+For testing without MPI, LocalCounter (a multiprocessing.Value) can stand in for
+the MPI counter and run_local processes a queue with several local "ranks".
+
+"""
+import pdb
+import numpy as np
+
+def largest_first(indices, weights=None):
+    """Sort indices in decreasing order of weights (e.g., the diameter of each
+    galaxy); ties keep their input order. weights is indexed by indices.
+
+    """
+    indices = np.asarray(indices).astype(int)
+    if weights is None or len(indices) == 0:
+        return indices
+    weights = np.asarray(weights)[indices]
+    weights = np.where(np.isfinite(weights), weights, -np.inf)
+    return indices[np.argsort(-weights, kind='stable')]
+
+class MPICounter(object):
+    """Shared counter stored in a one-sided MPI window on rank 0.
+
+    Creating the counter is collective, i.e., it must be called on every rank
+    of comm.
+
+    """
+    def __init__(self, comm):
+        from mpi4py import MPI
+
+        self.comm = comm
+        itemsize = MPI.INT64_T.Get_size()
+        self.win = MPI.Win.Allocate(itemsize if comm.rank == 0 else 0,
+                                    itemsize, comm=comm)
+        if comm.rank == 0:
+            self.win.Lock(0)
+            self.win.Put(np.zeros(1, dtype=np.int64), 0)
+            self.win.Unlock(0)
+        comm.barrier()
+
+    def _fetch_and_op(self, op, increment=1):
+        value = np.zeros(1, dtype=np.int64)
+        self.win.Lock(0)
+        self.win.Fetch_and_op(np.full(1, increment, dtype=np.int64), value, 0, 0, op)
+        self.win.Unlock(0)
+        return int(value[0])
+
+    def next(self):
+        """Atomically fetch-and-increment the counter."""
+        from mpi4py import MPI
+        return self._fetch_and_op(MPI.SUM)
+
+    def value(self):
+        """Current value of the counter (without incrementing it)."""
+        from mpi4py import MPI
+        return self._fetch_and_op(MPI.NO_OP)
+
+    def free(self):
+        """Free the MPI window; collective, like the constructor."""
+        if self.win is not None:
+            self.win.Free()
+            self.win = None
+
+class LocalCounter(object):
+    """Stand-in for MPICounter shared by local (forked) processes."""
+    def __init__(self):
+        import multiprocessing
+        self._value = multiprocessing.Value('q', 0)
+
+    def next(self):
+        with self._value.get_lock():
+            value = self._value.value
+            self._value.value += 1
+        return value
+
+    def value(self):
+        return self._value.value
+
+    def free(self):
+        pass
+
+class DynamicQueue(object):
+    """Iterable over the galaxy indices assigned, one at a time, to this rank.
+
+    len() returns the total number of galaxies in the queue (shared by all
+    ranks), so it is the same on every rank; count is the number of galaxies
+    handed to this rank so far and nleft the number not yet handed to any rank.
+
+    """
+    def __init__(self, indices, counter):
+        self.indices = indices
+        self.counter = counter
+        self.count = 0
+        self._claimed = None # position in the queue claimed ahead by peek
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _claim(self):
+        if self._claimed is None:
+            self._claimed = self.counter.next()
+        return self._claimed
+
+    def peek(self):
+        """Claim the galaxy this rank will process next (so no other rank can
+        take it) and return its index, or None if the queue is exhausted. The
+        claimed galaxy is the next one returned by the iterator, and calling
+        peek again returns it again.
+
+        """
+        pos = self._claim()
+        if pos >= len(self.indices):
+            return None
+        return self.indices[pos]
+
+    def nleft(self):
+        """Number of galaxies not yet handed to (or claimed by) any rank."""
+        return max(len(self.indices) - self.counter.value(), 0)
+
+    def __iter__(self):
+        while True:
+            pos = self._claim()
+            if pos >= len(self.indices):
+                return
+            self._claimed = None
+            self.count += 1
+            yield self.indices[pos]
+
+    def free(self):
+        """Free the shared counter; collective, i.e., call it on every rank once
+        all of them are done with the queue.
+
+        """
+        self.counter.free()
+
+def upcoming(group, count):
+    """Index of the galaxy which this rank will process after its count-th
+    (zero-indexed) galaxy of group, or None if there is none.
+
+    group - per-rank group (array of indices) or DynamicQueue; the next galaxy
+      of a DynamicQueue is claimed for this rank (see DynamicQueue.peek)
+
+    """
+    if isinstance(group, DynamicQueue):
+        return group.peek()
+    if count + 1 < len(group):
+        return group[count+1]
+    return None
+
+def describe(group):
+    """Number of galaxies in a per-rank group, for the log messages."""
+    if isinstance(group, DynamicQueue):
+        return '{} (shared by all ranks)'.format(len(group))
+    return '{}'.format(len(group))
+
+def progress(group, count):
+    """Progress of this rank after it started its count-th (zero-indexed)
+    galaxy of group, for the log messages.
+
+    """
+    if isinstance(group, DynamicQueue):
+        return '{} on this rank, {} / {} left'.format(count+1, group.nleft(), len(group))
+    return '{} / {}'.format(count+1, len(group))
+
+def free(groups):
+    """Free the queue shared by the per-rank groups, if any (collective)."""
+    freed = set()
+    for group in groups:
+        if isinstance(group, DynamicQueue) and id(group) not in freed:
+            group.free()
+            freed.add(id(group))
+
+def dynamic_groups(groups, weights=None, comm=None, counter=None):
+    """Replace the per-rank groups (as returned by missing_files) with a single,
+    largest-first queue shared by every rank.
+
+    groups - list (one per rank) of arrays of indices into the sample
+    weights - array with the same length as the sample; larger weights are
+      processed first (e.g., the galaxy diameter)
+    comm - MPI communicator; must be called collectively on every rank
+    counter - optional shared counter (default is an MPICounter on comm)
+
+    Returns a list with the same queue for every rank, so groups[rank] can be
+    iterated over as before (or with an empty array for every rank, if there
+    is nothing to do).
+
+    """
+    if len(groups) > 0:
+        indices = np.hstack(groups).astype(int)
+    else:
+        indices = np.array([], int)
+    indices = largest_first(indices, weights)
+
+    size = 1 if comm is None else comm.size
+    if len(indices) == 0:
+        # Nothing to share (on any rank, since the groups are the same on
+        # every rank), so do not allocate a counter.
+        return [indices] * size
+    if counter is None:
+        counter = MPICounter(comm)
+
+    queue = DynamicQueue(indices, counter)
+    return [queue] * size
+
+def _run_local_one(rank, queue, func, results):
+    """Process the queue on one local 'rank'."""
+    results.put([(ii, rank, func(ii)) for ii in queue])
+
+def run_local(indices, func, weights=None, size=2):
+    """Process indices with size local (forked) processes pulling from a shared
+    counter, as the MPI ranks do in the drivers. Useful for testing.
+
+    func - function of one galaxy index
+
+    Returns a list of (index, rank, func(index)) tuples in the order the tasks
+    were handed out.
+
+    """
+    import multiprocessing
+
+    groups = np.array_split(np.asarray(indices), size)
+    queue = dynamic_groups(groups, weights=weights, counter=LocalCounter())[0]
+
+    # The counter can only be shared by inheritance, so fork the ranks directly.
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_run_local_one, args=(rank, queue, func, results))
+             for rank in range(size)]
+    for proc in procs:
+        proc.start()
+    out = [result for _ in procs for result in results.get()]
+    for proc in procs:
+        proc.join()
+
+    order = {ii: jj for jj, ii in enumerate(queue.indices)}
+    return sorted(out, key=lambda result: order[result[0]])
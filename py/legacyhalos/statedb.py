@@ -0,0 +1,292 @@
+"""
+legacyhalos.statedb
+===================
+
+Transactional (SQLite) index of the pipeline state of each galaxy and stage,
+i.e., of the *.isdone / *.isfail sentinel files.
+
+Checking millions of sentinel files across the RA-slice directories costs
+minutes of metadata I/O on a parallel file system before any work starts. When
+the ${LEGACYHALOS_STATEDB} environment variable points to a database file,
+mpi._done (see record_state) records the state of each galaxy and stage there
+(along with the timing and host) and the missing_files functions of SGA,
+legacyhalos, and hsc find what is left to do with a single query. Existing
+sentinel files can be loaded once with import_sentinel_files (see
+bin/legacyhalos-import-state).
+
+The sentinel files are still written: building the catalogs and the ellipse
+fitting itself check them on disk, as do the missing_files functions of the
+other projects, so the database is an index of them, not a replacement.
+
+Every rank of a (multi-node) MPI job reads and writes the same database, so
+${LEGACYHALOS_STATEDB} must be on a file system which is shared by all the
+nodes and supports POSIX (fcntl) locks, e.g., the home or project file system
+(not node-local disk or /dev/shm, which the other nodes cannot see, nor a
+scratch file system mounted without locking). SQLite serializes the writes
+with these locks, in its default (rollback-journal) mode; write-ahead logging
+is not used since it does not work over a network file system.
+
+Stages are named after the sentinel files, e.g., a galaxy with a
+GALAXY-largegalaxy-ellipse.isdone file has stage='largegalaxy-ellipse' and
+status='done'.
+
+"""
+import os, time, socket, sqlite3, pdb
+from pathlib import Path
+from contextlib import closing
+import numpy as np
+
+_STATEDB = None
+
+def statedb_file():
+    """Name of the state database, or None if it has not been configured."""
+    dbfile = os.getenv('LEGACYHALOS_STATEDB')
+    if dbfile is not None and dbfile.strip() == '':
+        dbfile = None
+    return dbfile
+
+def get_statedb():
+    """Return the (cached) state database, or None if it has not been configured,
+    in which case the sentinel files are used.
+
+    """
+    global _STATEDB
+
+    dbfile = statedb_file()
+    if dbfile is None:
+        return None
+    if _STATEDB is None or _STATEDB.dbfile != dbfile:
+        _STATEDB = StateDB(dbfile)
+    return _STATEDB
+
+def stage_name(filesuffix):
+    """Convert a sentinel-file suffix (e.g., '-largegalaxy-ellipse.isdone') into a
+    stage name (e.g., 'largegalaxy-ellipse'). Returns None if filesuffix does not
+    refer to a sentinel file.
+
+    """
+    for ext in ('.isdone', '.isfail'):
+        if filesuffix.endswith(ext):
+            return filesuffix[:-len(ext)].lstrip('-')
+    return None
+
+class StateDB(object):
+    """Simple SQLite database with one row per (galaxy, stage).
+
+    dbfile - database file name; it must live on a file system which is shared
+      by every node of the job and has working POSIX locks (see the module
+      documentation)
+    timeout - number of seconds to wait for a lock held by another process
+
+    """
+    def __init__(self, dbfile, timeout=300.0):
+        self.dbfile = dbfile
+        self.timeout = timeout
+
+        dbdir = os.path.dirname(os.path.abspath(dbfile))
+        if not os.path.isdir(dbdir):
+            os.makedirs(dbdir, exist_ok=True)
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS state (
+                galaxy TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL,
+                galaxydir TEXT,
+                tstart REAL,
+                tend REAL,
+                elapsed REAL,
+                host TEXT,
+                pid INTEGER,
+                PRIMARY KEY (galaxy, stage))""")
+
+    def _connect(self):
+        return sqlite3.connect(self.dbfile, timeout=self.timeout)
+
+    def set_state(self, galaxy, stage, status, galaxydir=None, tstart=None,
+                  tend=None, host=None, pid=None):
+        """Record the status ('done' or 'fail') of a single galaxy and stage."""
+        self.set_states([(galaxy, stage, status, galaxydir, tstart, tend, host, pid)])
+
+    def set_states(self, records):
+        """Record the state of many (galaxy, stage) pairs in a single transaction.
+
+        records - list of (galaxy, stage, status, galaxydir, tstart, tend, host,
+          pid) tuples; any of the last five can be None
+
+        """
+        rows = []
+        for galaxy, stage, status, galaxydir, tstart, tend, host, pid in records:
+            if tend is None:
+                tend = time.time()
+            if tstart is None:
+                elapsed = None
+            else:
+                elapsed = tend - tstart
+            if host is None:
+                host = socket.gethostname()
+            if pid is None:
+                pid = os.getpid()
+            rows.append((str(galaxy), stage, status, galaxydir, tstart, tend,
+                         elapsed, host, pid))
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany('INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def get_states(self, stage):
+        """Return a dictionary mapping galaxy --> status for a single stage."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT galaxy, status FROM state WHERE stage = ?',
+                                (stage,)).fetchall()
+        return dict(rows)
+
+    def clear_states(self, galaxy, stage, status=None):
+        """Remove the state of a list of galaxies for a single stage, optionally
+        only those with a given status.
+
+        """
+        galaxy = [(str(gal), stage) for gal in np.atleast_1d(galaxy)]
+        with closing(self._connect()) as conn, conn:
+            if status is None:
+                conn.executemany('DELETE FROM state WHERE galaxy = ? AND stage = ?', galaxy)
+            else:
+                conn.executemany('DELETE FROM state WHERE galaxy = ? AND stage = ? AND status = ?',
+                                 [gal + (status,) for gal in galaxy])
+
+    def remove_sentinel_files(self, galaxy, stage, status):
+        """Remove the sentinel files of a list of galaxies for a single stage and
+        status, e.g., the .isfail files of failures which are to be reprocessed.
+
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT galaxy, galaxydir FROM state WHERE stage = ? AND status = ?',
+                                (stage, status)).fetchall()
+        galaxydir = dict(rows)
+        for gal in np.atleast_1d(galaxy):
+            gdir = galaxydir.get(str(gal))
+            if gdir is None:
+                continue
+            sentinel = os.path.join(gdir, '{}-{}.is{}'.format(gal, stage, status))
+            if os.path.isfile(sentinel):
+                os.remove(sentinel)
+
+    def missing(self, galaxy, stage, dependson=None, clobber=False):
+        """Database equivalent of io.missing_files_one for a list of galaxies.
+
+        Returns an array with 'done', 'todo', or 'fail' for each galaxy.
+
+        """
+        galaxy = np.array([str(gal) for gal in np.atleast_1d(galaxy)])
+        state = self.get_states(stage)
+        status = np.array([state.get(gal, '') for gal in galaxy])
+
+        todo = np.repeat('todo', len(galaxy)).astype('U4')
+        isdone = status == 'done'
+        if not clobber:
+            if dependson is None:
+                todo[isdone] = 'done'
+            else:
+                depstate = self.get_states(dependson)
+                depdone = np.array([depstate.get(gal, '') == 'done' for gal in galaxy], bool)
+                todo[isdone & depdone] = 'done'
+
+        # Failures are reported unless clobber=True, in which case we start over.
+        isfail = status == 'fail'
+        if np.any(isfail):
+            if clobber:
+                self.remove_sentinel_files(galaxy[isfail], stage, 'fail')
+                self.clear_states(galaxy[isfail], stage, status='fail')
+            else:
+                todo[isfail] = 'fail'
+
+        return todo
+
+def record_state(galaxy, galaxydir, donesuffix, tstart=None):
+    """Touch the sentinel file of a galaxy and stage and, if the database is
+    configured, record its state there, too.
+
+    donesuffix - suffix of the sentinel file (e.g., '-largegalaxy-ellipse.isdone'
+      or '-largegalaxy-ellipse.isfail')
+    tstart - time the stage was started (see time.time)
+
+    """
+    Path(os.path.join(galaxydir, '{}{}'.format(galaxy, donesuffix))).touch()
+
+    statedb = get_statedb()
+    if statedb is not None:
+        status = 'done' if donesuffix.endswith('.isdone') else 'fail'
+        statedb.set_state(galaxy, stage_name(donesuffix), status,
+                          galaxydir=galaxydir, tstart=tstart)
+
+def missing_files(galaxy, filesuffix, dependson=None, clobber=False):
+    """Use the state database (if configured) to determine which galaxies still
+    need to be processed. Returns None if the database is not configured or
+    filesuffix does not refer to a sentinel file, in which case the caller
+    should fall back to checking the files themselves.
+
+    """
+    statedb = get_statedb()
+    if statedb is None:
+        return None
+    stage = stage_name(filesuffix)
+    if stage is None:
+        return None
+    if dependson is not None:
+        dependson = stage_name(dependson)
+        if dependson is None:
+            return None
+    return statedb.missing(galaxy, stage, dependson=dependson, clobber=clobber)
+
+def _scan_sentinel_files_one(args):
+    """Wrapper for the multiprocessing."""
+    return scan_sentinel_files_one(*args)
+
+def scan_sentinel_files_one(topdir):
+    """Find all the sentinel files in the galaxy directories below topdir (e.g.,
+    an RA slice) with a single directory listing per galaxy.
+
+    """
+    records = []
+    with os.scandir(topdir) as galdirs:
+        for galdir in galdirs:
+            if not galdir.is_dir():
+                continue
+            galaxy = galdir.name
+            with os.scandir(galdir.path) as entries:
+                for entry in entries:
+                    if not entry.name.startswith(galaxy + '-'):
+                        continue
+                    for ext, status in (('.isdone', 'done'), ('.isfail', 'fail')):
+                        if entry.name.endswith(ext):
+                            stage = entry.name[len(galaxy)+1:-len(ext)]
+                            tend = entry.stat().st_mtime
+                            records.append((galaxy, stage, status, galdir.path,
+                                            None, tend, None, None))
+    return records
+
+def import_sentinel_files(datadir, statedb, nproc=1, verbose=False):
+    """Scan the sentinel files in every galaxy directory nested one level below
+    datadir (i.e., datadir/RASLICE/GALAXY) and load them into the state database.
+
+    If both an .isdone and an .isfail file exist, the galaxy is marked done.
+
+    """
+    from legacyhalos.pool import get_pool
+
+    t0 = time.time()
+    topdirs = sorted([entry.path for entry in os.scandir(datadir) if entry.is_dir()])
+    if nproc > 1:
+        records = get_pool(nproc).map(_scan_sentinel_files_one, [(topdir,) for topdir in topdirs])
+    else:
+        records = [scan_sentinel_files_one(topdir) for topdir in topdirs]
+    records = [rec for _records in records for rec in _records]
+
+    # done takes precedence over fail
+    records = sorted(records, key=lambda rec: rec[2] == 'done')
+    statedb.set_states(records)
+
+    if verbose:
+        print('Imported {} sentinel files from {} directories in {:.3f} min'.format(
+            len(records), len(topdirs), (time.time() - t0) / 60))
+
+    return len(records)
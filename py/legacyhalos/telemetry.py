@@ -0,0 +1,318 @@
+"""
+legacyhalos.telemetry
+=====================
+
+Structured timing and resource telemetry for each galaxy and pipeline stage.
+
+When the ${LEGACYHALOS_TELEMETRY} environment variable points to a directory,
+the mpi.call_* wrappers record, for every galaxy and stage, the wall-clock
+time, CPU time, peak resident memory, and bytes read and written (by the
+process itself and by the workers of the persistent pool; see
+legacyhalos.pool), plus any stage-specific quantities reported with
+record_metric (e.g., the number of isophotes fitted by ellipsefit_multiband).
+Each process appends one JSON object per line to its own
+telemetry-{host}-{pid}.jsonl file, so concurrent MPI ranks never write to the
+same file.
+
+summarize_telemetry (see bin/legacyhalos/legacyhalos-telemetry) gathers these
+files and reports the slowest galaxies, the time spent in each stage, and a
+power-law model of the run time as a function of the galaxy (mosaic)
+diameter, which predict_runtime can evaluate, e.g., to weight the galaxies in
+scheduler.dynamic_groups.
+
+The resource counters are read from /proc and are None on platforms without it.
+When telemetry is not configured StageTelemetry does nothing at all, so /proc
+(including the peak-memory reset of every pool worker) is never touched.
+
+"""
+import os, time, json, socket, pdb
+import numpy as np
+
+# Stack of the active StageTelemetry objects, so record_metric can attach
+# metrics to the current stage from deep inside the pipeline.
+_ACTIVE = []
+
+def telemetry_dir():
+    """Telemetry directory, or None if telemetry has not been configured."""
+    teldir = os.getenv('LEGACYHALOS_TELEMETRY')
+    if teldir is not None and teldir.strip() == '':
+        teldir = None
+    return teldir
+
+def telemetry_file(teldir):
+    """Per-process telemetry file."""
+    return os.path.join(teldir, 'telemetry-{}-{}.jsonl'.format(socket.gethostname(), os.getpid()))
+
+def _read_proc(pid, reset=False):
+    """CPU time [s], bytes read and written, and peak resident memory [bytes] of a
+    process from /proc. If reset=True, first reset the peak resident memory
+    (supported by Linux>=4.0) so it refers to what follows.
+
+    """
+    procdir = '/proc/{}'.format(pid)
+    out = {'cputime': None, 'read_bytes': None, 'write_bytes': None, 'maxrss': None}
+    try:
+        if reset:
+            with open(os.path.join(procdir, 'clear_refs'), 'w') as F:
+                F.write('5')
+        with open(os.path.join(procdir, 'stat'), 'r') as F:
+            # Skip past the (possibly space-containing) process name.
+            stat = F.read().rsplit(')', 1)[1].split()
+        out['cputime'] = (int(stat[11]) + int(stat[12])) / os.sysconf('SC_CLK_TCK') # utime+stime
+        with open(os.path.join(procdir, 'status'), 'r') as F:
+            for line in F:
+                if line.startswith('VmHWM:'):
+                    out['maxrss'] = int(line.split()[1]) * 1024
+        with open(os.path.join(procdir, 'io'), 'r') as F:
+            for line in F:
+                key, val = line.split(':')
+                if key == 'rchar':
+                    out['read_bytes'] = int(val)
+                elif key == 'wchar':
+                    out['write_bytes'] = int(val)
+    except (OSError, ValueError, IndexError):
+        pass
+    return out
+
+def _worker_pids():
+    from legacyhalos.pool import worker_pids
+    return worker_pids()
+
+def _diff(end, start):
+    if end is None or start is None:
+        return None
+    return end - start
+
+class StageTelemetry(object):
+    """Measure the resources used by one galaxy and stage.
+
+    Call start() before the work and finish(status) afterwards (or use the
+    object as a context manager), which appends a record to the per-process
+    telemetry file. If neither teldir nor ${LEGACYHALOS_TELEMETRY} is set, start
+    and finish are no-ops (and finish returns None). finish only acts once, so
+    it is safe to call it again, e.g., from __exit__ after an explicit call.
+
+    diameter - size of the galaxy or mosaic [arcmin], used by the run time model
+
+    """
+    def __init__(self, galaxy, stage, diameter=None, teldir=None, **metrics):
+        self.galaxy = galaxy
+        self.stage = stage
+        self.teldir = telemetry_dir() if teldir is None else teldir
+        self.metrics = {}
+        if diameter is not None:
+            self.metrics['diameter'] = float(diameter)
+        self.metrics.update(metrics)
+        self.record = None
+        self.enabled = self.teldir is not None
+        self._started = False
+
+    def start(self):
+        if not self.enabled:
+            return self
+        self.t0 = time.time()
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        self.self0 = _read_proc('self', reset=True)
+        self.workers0 = {pid: _read_proc(pid, reset=True) for pid in _worker_pids()}
+        _ACTIVE.append(self)
+        self._started = True
+        return self
+
+    def update(self, **metrics):
+        self.metrics.update(metrics)
+
+    def finish(self, status='done'):
+        if not self._started:
+            return self.record
+        self._started = False
+        wall = time.perf_counter() - self.wall0
+        cpu = time.process_time() - self.cpu0
+        if self in _ACTIVE:
+            _ACTIVE.remove(self)
+
+        self1 = _read_proc('self')
+        workers1 = {pid: _read_proc(pid) for pid in _worker_pids()}
+
+        # Only count the workers which were alive for the whole stage.
+        workercpu, workerread, workerwrite, workerrss = 0.0, 0, 0, 0
+        for pid, counters1 in workers1.items():
+            counters0 = self.workers0.get(pid)
+            if counters0 is None:
+                continue
+            workercpu += _diff(counters1['cputime'], counters0['cputime']) or 0.0
+            workerread += _diff(counters1['read_bytes'], counters0['read_bytes']) or 0
+            workerwrite += _diff(counters1['write_bytes'], counters0['write_bytes']) or 0
+            workerrss += counters1['maxrss'] or 0
+
+        read_bytes = _diff(self1['read_bytes'], self.self0['read_bytes'])
+        write_bytes = _diff(self1['write_bytes'], self.self0['write_bytes'])
+        if read_bytes is not None:
+            read_bytes += workerread
+        if write_bytes is not None:
+            write_bytes += workerwrite
+
+        record = {'galaxy': self.galaxy, 'stage': self.stage, 'status': status,
+                  'host': socket.gethostname(), 'pid': os.getpid(),
+                  'tstart': self.t0, 'walltime': wall,
+                  'cputime': cpu, 'cputime_workers': workercpu,
+                  'maxrss': self1['maxrss'], 'maxrss_workers': workerrss,
+                  'read_bytes': read_bytes, 'write_bytes': write_bytes,
+                  'nworkers': len(workers1)}
+        record.update(self.metrics)
+        self.record = record
+
+        write_telemetry(self.teldir, record)
+        return record
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.finish(status='done' if exc_type is None else 'fail')
+        return False
+
+def record_metric(**metrics):
+    """Attach metrics (e.g., nisophote=100) to the innermost active stage; a
+    no-op if no stage is being measured.
+
+    """
+    if len(_ACTIVE) > 0:
+        _ACTIVE[-1].update(**metrics)
+
+def write_telemetry(teldir, record):
+    """Append one record to the per-process telemetry file."""
+    def _default(obj):
+        if isinstance(obj, np.generic):
+            return obj.item()
+        return str(obj)
+
+    if not os.path.isdir(teldir):
+        os.makedirs(teldir, exist_ok=True)
+    with open(telemetry_file(teldir), 'a') as F:
+        F.write(json.dumps(record, default=_default) + '\n')
+
+def read_telemetry(teldir=None):
+    """Read all the telemetry records in a directory (or a list of files) into
+    an astropy Table.
+
+    """
+    import glob
+    from astropy.table import Table
+
+    if teldir is None:
+        teldir = telemetry_dir()
+    if type(teldir) is str:
+        if os.path.isdir(teldir):
+            telfiles = sorted(glob.glob(os.path.join(teldir, 'telemetry-*.jsonl')))
+        else:
+            telfiles = [teldir]
+    else:
+        telfiles = teldir
+
+    records = []
+    for telfile in telfiles:
+        with open(telfile, 'r') as F:
+            for line in F:
+                line = line.strip()
+                if line == '':
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print('Skipping corrupted line in {}'.format(telfile))
+    if len(records) == 0:
+        return Table()
+
+    # Not every stage records the same metrics.
+    colnames = []
+    for record in records:
+        colnames += [key for key in record.keys() if key not in colnames]
+    out = Table()
+    for col in colnames:
+        vals = [record.get(col) for record in records]
+        if all(type(val) in (int, float, bool) or val is None for val in vals) and \
+           any(val is not None for val in vals):
+            vals = np.array([np.nan if val is None else val for val in vals], dtype='f8')
+        else:
+            vals = np.array(['' if val is None else str(val) for val in vals])
+        out[col] = vals
+    return out
+
+def fit_runtime_model(diameter, walltime):
+    """Fit walltime = A * diameter**alpha (by least squares in log space).
+
+    Returns a dictionary with the amplitude A [s], the slope alpha, the scatter
+    in log10(walltime) [dex], and the number of galaxies used.
+
+    """
+    diameter, walltime = np.asarray(diameter, 'f8'), np.asarray(walltime, 'f8')
+    good = np.isfinite(diameter) * np.isfinite(walltime) * (diameter > 0) * (walltime > 0)
+    if np.sum(good) < 2 or len(np.unique(diameter[good])) < 2:
+        return {'amplitude': None, 'alpha': None, 'scatter': None, 'ngal': int(np.sum(good))}
+
+    logd, logt = np.log10(diameter[good]), np.log10(walltime[good])
+    alpha, logamp = np.polyfit(logd, logt, 1)
+    scatter = np.std(logt - (logamp + alpha * logd))
+    return {'amplitude': float(10**logamp), 'alpha': float(alpha),
+            'scatter': float(scatter), 'ngal': int(np.sum(good))}
+
+def predict_runtime(model, diameter):
+    """Evaluate the run time [s] predicted by a fit_runtime_model model."""
+    diameter = np.asarray(diameter, 'f8')
+    if model['amplitude'] is None:
+        return np.ones_like(diameter)
+    return model['amplitude'] * diameter**model['alpha']
+
+def summarize_telemetry(tel, nslow=10, verbose=True):
+    """Summarize the telemetry table (see read_telemetry).
+
+    Returns a dictionary with, for each stage, the number of galaxies and
+    failures, the total and median wall and CPU time, the median and maximum
+    peak memory, the slowest galaxies, and the run time model.
+
+    """
+    summary = {}
+    if len(tel) == 0:
+        return summary
+
+    for stage in sorted(set(tel['stage'])):
+        T = tel[tel['stage'] == stage]
+        walltime = np.asarray(T['walltime'], 'f8')
+        cputime = np.asarray(T['cputime'], 'f8')
+        if 'cputime_workers' in T.colnames:
+            cputime = cputime + np.nan_to_num(np.asarray(T['cputime_workers'], 'f8'))
+        srt = np.argsort(walltime)[::-1][:nslow]
+
+        out = {'ngal': len(T), 'nfail': int(np.sum(T['status'] == 'fail')),
+               'walltime_total': float(np.sum(walltime)),
+               'walltime_median': float(np.median(walltime)),
+               'cputime_total': float(np.sum(cputime)),
+               'slowest': [(str(T['galaxy'][ii]), float(walltime[ii])) for ii in srt]}
+        if 'maxrss' in T.colnames:
+            rss = np.asarray(T['maxrss'], 'f8')
+            if np.any(np.isfinite(rss)):
+                out['maxrss_median'] = float(np.nanmedian(rss))
+                out['maxrss_max'] = float(np.nanmax(rss))
+        if 'diameter' in T.colnames:
+            ok = T['status'] == 'done'
+            out['model'] = fit_runtime_model(np.asarray(T['diameter'], 'f8')[ok], walltime[ok])
+        summary[stage] = out
+
+    if verbose:
+        for stage, out in summary.items():
+            print('Stage {}: {} galaxies ({} failed), {:.2f} hr total (wall), {:.2f} hr (cpu), median {:.1f} sec'.format(
+                stage, out['ngal'], out['nfail'], out['walltime_total']/3600,
+                out['cputime_total']/3600, out['walltime_median']))
+            if 'maxrss_max' in out:
+                print('  Peak memory: median {:.2f} GB, max {:.2f} GB'.format(
+                    out['maxrss_median']/1024**3, out['maxrss_max']/1024**3))
+            if 'model' in out and out['model']['amplitude'] is not None:
+                print('  Run time = {:.3g} sec * (diameter/arcmin)^{:.2f} (scatter {:.2f} dex, N={})'.format(
+                    out['model']['amplitude'], out['model']['alpha'],
+                    out['model']['scatter'], out['model']['ngal']))
+            print('  Slowest galaxies:')
+            for gal, walltime in out['slowest']:
+                print('    {:<30s} {:10.1f} sec'.format(gal, walltime))
+
+    return summary
@@ -0,0 +1,173 @@
+import os, shutil, tempfile, unittest
+from unittest import mock
+import numpy as np
+import numpy.ma as ma
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+def mock_ellipsefit(bands=('g', 'r', 'z'), shape=(91, 91), seed=1):
+    """Exponential disk imaged in several bands and the (reference) isophotes
+    needed to measure its curve of growth with ellipse_cog.
+
+    """
+    rand = np.random.RandomState(seed)
+    x0, y0, pa, eps, scale = 45.3, 44.8, 30.0, 0.3, 5.0 # [pixels]
+    theta = np.radians(pa - 90)
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    dx, dy = xx - x0, yy - y0
+    xp = dx * np.cos(theta) + dy * np.sin(theta)
+    yp = -dx * np.sin(theta) + dy * np.cos(theta)
+    rell = np.hypot(xp, yp / (1 - eps))
+
+    data, ellipsefit = {}, {'bands': list(bands), 'refband': 'r', 'pixscale': 0.262,
+                            'x0': x0, 'y0': y0, 'pa': pa, 'eps': eps, 'majoraxis': 25.0}
+    sma = np.arange(0.5, 40.0, 1.5)
+    for ii, filt in enumerate(bands):
+        amp = 20.0 * (ii + 1)
+        img = amp * np.exp(-rell / scale) + rand.normal(0, 0.02, shape)
+        mask = np.hypot(xx - 15, yy - 70) < 4
+        data['{}_masked'.format(filt)] = [ma.masked_array(img, mask)]
+        data['{}_var'.format(filt)] = [np.full(shape, 0.02**2)]
+        ellipsefit['psfsize_{}'.format(filt)] = 1.2
+        ellipsefit['{}_sma'.format(filt)] = sma
+        ellipsefit['{}_intens'.format(filt)] = amp * np.exp(-sma / scale) / 0.262**2
+        ellipsefit['{}_intens_err'.format(filt)] = 0.02 * np.exp(-sma / scale / 2) / 0.262**2
+    return data, ellipsefit
+
+class TestEllipseCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.galaxydir = tempfile.mkdtemp()
+        self.signature = {'bands': ['g', 'r'], 'sma': np.arange(3.0), 'igal': np.int64(0)}
+
+    def tearDown(self):
+        shutil.rmtree(self.galaxydir)
+
+    def test_save_load(self):
+        """The results and the state of the random number generator survive the
+        round trip.
+
+        """
+        from legacyhalos.checkpoint import EllipseCheckpoint
+
+        ckpt = EllipseCheckpoint('NGC1234', self.galaxydir, self.signature, filesuffix='largegalaxy')
+        self.assertTrue(os.path.isdir(os.path.join(self.galaxydir, 'NGC1234-largegalaxy-ellipse-checkpoint')))
+        self.assertFalse(ckpt.has('cog-g'))
+        self.assertIsNone(ckpt.load('cog-g'))
+
+        rand = np.random.RandomState(1)
+        rand.normal(size=3) # leave a cached Gaussian
+        results = {'g_cog_mag': np.float32([20.1, 19.5]), 'g_cog_params_mtot': np.float32(17.2),
+                   'g_mag_sb25': np.float32(-1)}
+        ckpt.save('cog-g', results, rand=rand)
+        truth = rand.normal(size=5)
+
+        ckpt = EllipseCheckpoint('NGC1234', self.galaxydir, self.signature, filesuffix='largegalaxy')
+        self.assertTrue(ckpt.has('cog-g'))
+        newrand = np.random.RandomState(99)
+        saved = ckpt.load('cog-g', rand=newrand)
+        self.assertEqual(sorted(saved.keys()), sorted(results.keys()))
+        for key in results:
+            np.testing.assert_array_equal(saved[key], results[key])
+            self.assertEqual(saved[key].dtype, results[key].dtype)
+        np.testing.assert_array_equal(newrand.normal(size=5), truth)
+
+        # a unit saved without the random state cannot restore it
+        ckpt.save('isophotes-g', {'g_sma': np.arange(4.0)})
+        self.assertIsNotNone(ckpt.load('isophotes-g'))
+        self.assertIsNone(ckpt.load('isophotes-g', rand=newrand))
+
+        ckpt.clear()
+        self.assertFalse(os.path.isdir(ckpt.checkpointdir))
+
+    def test_stale(self):
+        """Checkpoints with a different signature (or with clobber=True) are
+        discarded; unreadable ones are ignored.
+
+        """
+        from legacyhalos.checkpoint import EllipseCheckpoint
+
+        ckpt = EllipseCheckpoint('NGC1234', self.galaxydir, self.signature)
+        ckpt.save('isophotes-g', {'g_sma': np.arange(4.0)})
+        ckpt.save('isophotes-r', {'r_sma': np.arange(4.0)})
+
+        ckpt = EllipseCheckpoint('NGC1234', self.galaxydir, dict(self.signature))
+        self.assertTrue(ckpt.has('isophotes-g') and ckpt.has('isophotes-r'))
+
+        for key, value in (('sma', np.arange(4.0)), ('isophot_engine', 'pickle')):
+            signature = dict(self.signature)
+            signature[key] = value
+            ckpt = EllipseCheckpoint('NGC1234', self.galaxydir, signature)
+            self.assertFalse(ckpt.has('isophotes-g') or ckpt.has('isophotes-r'))
+            ckpt.save('isophotes-g', {'g_sma': np.arange(4.0)})
+
+        ckpt = EllipseCheckpoint('NGC1234', self.galaxydir, signature, clobber=True)
+        self.assertFalse(ckpt.has('isophotes-g'))
+
+        with open(ckpt._unitfile('isophotes-g'), 'w') as F:
+            F.write('not an npz file')
+        self.assertTrue(ckpt.has('isophotes-g'))
+        self.assertIsNone(ckpt.load('isophotes-g'))
+
+@unittest.skipUnless(_importable('astrometry') and _importable('photutils'),
+                     'legacyhalos.ellipse needs astrometry.net and photutils')
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.galaxydir = tempfile.mkdtemp()
+        self.data, self.ellipsefit = mock_ellipsefit()
+        self.bands = self.ellipsefit['bands']
+
+    def tearDown(self):
+        shutil.rmtree(self.galaxydir)
+
+    def _ellipse_cog(self, checkpoint=None):
+        from legacyhalos.ellipse import ellipse_cog
+        return ellipse_cog(self.bands, self.data, self.ellipsefit, 1.0, 0.262,
+                           sbthresh=[22, 23, 24], checkpoint=checkpoint)
+
+    def test_resume(self):
+        """ellipse_cog interrupted after each band resumes from the checkpoint
+        (including the state of the random number generator) and gives the
+        same results as an uninterrupted run.
+
+        """
+        from legacyhalos.cog import nested_apphot
+        from legacyhalos.checkpoint import EllipseCheckpoint
+
+        truth = self._ellipse_cog()
+        for filt in self.bands:
+            self.assertGreater(truth['{}_cog_params_mtot'.format(filt)], 0)
+
+        for nfinished in range(len(self.bands)):
+            ckpt = EllipseCheckpoint('NGC1234', self.galaxydir, {'bands': self.bands}, clobber=True)
+            save = ckpt.save
+
+            def _save(unit, *args, **kwargs):
+                if unit == 'cog-{}'.format(self.bands[nfinished]):
+                    raise KeyboardInterrupt # the job is killed
+                return save(unit, *args, **kwargs)
+
+            with mock.patch.object(ckpt, 'save', side_effect=_save):
+                with self.assertRaises(KeyboardInterrupt):
+                    self._ellipse_cog(checkpoint=ckpt)
+            self.assertEqual([ckpt.has('cog-{}'.format(filt)) for filt in self.bands],
+                             [ii < nfinished for ii in range(len(self.bands))])
+
+            # only the unfinished bands are measured again
+            ckpt = EllipseCheckpoint('NGC1234', self.galaxydir, {'bands': self.bands})
+            with mock.patch('legacyhalos.cog.nested_apphot', wraps=nested_apphot) as apphot:
+                results = self._ellipse_cog(checkpoint=ckpt)
+            self.assertEqual(apphot.call_count, len(self.bands) - nfinished)
+            self.assertEqual(sorted(results.keys()), sorted(truth.keys()))
+            for key in truth:
+                np.testing.assert_array_equal(results[key], truth[key], err_msg=key)
+                self.assertEqual(np.asarray(results[key]).dtype, np.asarray(truth[key]).dtype)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import unittest, warnings
+from unittest import mock
+import numpy as np
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+def _photutils_apertures():
+    """ellipse.apphot_one uses the (pre-1.0) top-level photutils apertures."""
+    try:
+        from photutils import EllipticalAperture, aperture_photometry
+    except ImportError:
+        return False
+    return True
+
+def mock_galaxy(shape=(81, 93), x0=47.3, y0=38.6, theta=0.9, ba=0.55, seed=1):
+    """Image of an exponential disk plus noise, its variance, and a mask with a
+    masked star and a non-finite pixel.
+
+    """
+    rand = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    dx, dy = xx - x0, yy - y0
+    xp = dx * np.cos(theta) + dy * np.sin(theta)
+    yp = -dx * np.sin(theta) + dy * np.cos(theta)
+    img = 10 * np.exp(-np.hypot(xp, yp / ba) / 6) + rand.normal(0, 0.05, shape)
+    var = np.full(shape, 0.05**2) + 0.01 * np.abs(img)
+    mask = np.hypot(xx - 70, yy - 20) < 5
+    img[3, 4] = np.nan
+    return img, var, mask
+
+class TestCoG(unittest.TestCase):
+
+    def setUp(self):
+        self.img, self.var, self.mask = mock_galaxy()
+        self.geom = dict(theta=0.9, x0=47.3, y0=38.6, ba=0.55)
+        self.sma = np.arange(1.0, 40.0, 2.5)
+        self.pixscale = 0.262
+
+    @unittest.skipUnless(_importable('astrometry') and _photutils_apertures(),
+                         'requires astrometry.net and photutils<1.0')
+    def test_apphot_one(self):
+        """nested_apphot matches the photutils apertures of ellipse.apphot_one."""
+        from legacyhalos.cog import nested_apphot
+        from legacyhalos.ellipse import apphot_one
+
+        theta, x0, y0, ba = [self.geom[key] for key in ('theta', 'x0', 'y0', 'ba')]
+        # photutils propagates the NaN, nested_apphot ignores it
+        mask = self.mask | ~np.isfinite(self.img)
+        cogflux, cogferr = nested_apphot(self.img, mask, theta, x0, y0, self.sma, ba,
+                                         self.pixscale, var=self.var)
+        flux = np.hstack([apphot_one(self.img, mask, theta, x0, y0, aa, aa * ba, self.pixscale)
+                          for aa in self.sma])
+        ferr = np.hstack([apphot_one(self.var, mask, theta, x0, y0, aa, aa * ba, self.pixscale,
+                                     variance=True) for aa in self.sma])
+        np.testing.assert_allclose(cogflux, flux, rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(cogferr, ferr, rtol=1e-8, atol=1e-10)
+
+    def test_grid(self):
+        """The cached EllipticalGrid gives identical results, for several bands
+        (masks) and for a shorter set of apertures reusing the boundary overlaps.
+
+        """
+        from legacyhalos.cog import nested_apphot
+        from legacyhalos.geometry import EllipticalGrid
+
+        theta, x0, y0, ba = [self.geom[key] for key in ('theta', 'x0', 'y0', 'ba')]
+        grid = EllipticalGrid(self.img.shape, x0, y0, theta, ba)
+        for mask, sma in ((self.mask, self.sma), (None, self.sma), (~self.mask, self.sma[:5])):
+            cogflux, cogferr = nested_apphot(self.img, mask, theta, x0, y0, sma, ba,
+                                             self.pixscale, var=self.var)
+            gridflux, gridferr = nested_apphot(self.img, mask, theta, x0, y0, sma, ba,
+                                               self.pixscale, var=self.var, grid=grid)
+            np.testing.assert_array_equal(gridflux, cogflux)
+            np.testing.assert_array_equal(gridferr, cogferr)
+
+def mock_cog(seed=2):
+    """Noisy curve of growth drawn from the curve-of-growth model."""
+    from legacyhalos.cog import cog_model
+
+    rand = np.random.RandomState(seed)
+    radius = np.linspace(1.0, 45.0, 25) # [arcsec]
+    magerr = rand.uniform(0.01, 0.03, len(radius))
+    mag = cog_model(radius, [16.5, 6.0, 0.4, 0.9]) + rand.normal(0, magerr)
+    return radius, mag, magerr
+
+class TestFitCoG(unittest.TestCase):
+
+    def setUp(self):
+        self.radius, self.mag, self.magerr = mock_cog()
+        self.bounds = [(1, 30), (1, 30), (1e-3, 5), (1e-3, 5)]
+        self.params0 = np.array([[20.0, 10.0, 0.3, 0.5], [18.0, 8.0, 0.5, 1.0],
+                                 [15.0, 5.0, 0.2, 0.7], [22.0, 12.0, 0.25, 0.4]])
+
+    def test_jacobian(self):
+        """cog_jacobian matches the finite differences of cog_model."""
+        from legacyhalos.cog import cog_model, cog_jacobian
+
+        jac = cog_jacobian(self.radius, self.params0)
+        self.assertEqual(jac.shape, (len(self.params0), len(self.radius), 4))
+        for ii in range(4):
+            dp = np.zeros(4)
+            dp[ii] = 1e-6
+            deriv = (cog_model(self.radius, self.params0 + dp) -
+                     cog_model(self.radius, self.params0 - dp)) / 2e-6
+            np.testing.assert_allclose(jac[..., ii], deriv, rtol=1e-6, atol=1e-8)
+
+    @unittest.skipUnless(_importable('astrometry') and _photutils_apertures(),
+                         'requires astrometry.net and photutils<1.0')
+    def test_levmar(self):
+        """fit_cog finds the minimum found by LevMarLSQFitter with CogModel (or a
+        better one, when the latter gets stuck at the bounds), and both fail
+        after too few iterations.
+
+        """
+        import astropy.modeling
+        from legacyhalos.cog import fit_cog, cog_model
+        from legacyhalos.ellipse import CogModel
+
+        cogmodel = CogModel()
+        cogfitter = astropy.modeling.fitting.LevMarLSQFitter()
+        for maxiter in (100, 2):
+            params, chi2, success = fit_cog(self.radius, self.mag, 1/self.magerr, self.params0,
+                                            bounds=self.bounds, r0=cogmodel.r0, maxiter=maxiter)
+            np.testing.assert_allclose(chi2, np.sum(
+                ((self.mag - cog_model(self.radius, params)) / self.magerr)**2, axis=1))
+            nfit = 0
+            for jj, params0 in enumerate(self.params0):
+                cogmodel.parameters = params0
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    ballfit = cogfitter(cogmodel, self.radius, self.mag, maxiter=maxiter,
+                                        weights=1/self.magerr)
+                chi2fit = np.sum(((self.mag - ballfit(self.radius)) / self.magerr)**2)
+                if maxiter == 2:
+                    self.assertIsNone(cogfitter.fit_info['param_cov'])
+                    self.assertFalse(success[jj])
+                elif cogfitter.fit_info['param_cov'] is not None:
+                    nfit += 1
+                    self.assertTrue(success[jj])
+                    np.testing.assert_allclose(chi2[jj], chi2fit, rtol=1e-6)
+                    np.testing.assert_allclose(params[jj], ballfit.parameters, rtol=1e-4)
+                else:
+                    self.assertLess(chi2[jj], chi2fit)
+            if maxiter == 100:
+                self.assertGreater(nfit, 0)
+                self.assertTrue(np.all(success))
+
+    def test_stuck(self):
+        """Fits which cannot reduce chi2 (here, because every step goes uphill)
+        are failures, not converged.
+
+        """
+        import legacyhalos.cog
+        from legacyhalos.cog import fit_cog
+
+        jacobian = legacyhalos.cog.cog_jacobian
+        params, chi2, success = fit_cog(self.radius, self.mag, 1/self.magerr, self.params0,
+                                        bounds=self.bounds)
+        self.assertTrue(np.all(success))
+        with mock.patch('legacyhalos.cog.cog_jacobian',
+                        side_effect=lambda *args, **kwargs: -jacobian(*args, **kwargs)):
+            params, chi2, success = fit_cog(self.radius, self.mag, 1/self.magerr, self.params0,
+                                            bounds=self.bounds)
+        self.assertFalse(np.any(success))
+        np.testing.assert_array_equal(params, self.params0)
+
+if __name__ == '__main__':
+    unittest.main()
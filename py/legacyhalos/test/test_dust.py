@@ -0,0 +1,99 @@
+import os, pickle, shutil, tempfile, unittest
+import numpy as np
+
+def write_mock_maps(mapdir, npix=64, seed=1):
+    """Write small SFD-like maps: a float32 north map, which is memory-mapped in
+    place, and a scaled int16 south map, which is converted to the cache.
+
+    """
+    from astropy.io import fits
+
+    rand = np.random.RandomState(seed)
+    for pole, sign in (('ngp', 1), ('sgp', -1)):
+        data = rand.uniform(0.0, 2.0, (npix, npix)).astype('f4')
+        hdu = fits.PrimaryHDU(data)
+        hdu.header['CRPIX1'] = (npix + 1) / 2
+        hdu.header['CRPIX2'] = (npix + 1) / 2
+        hdu.header['LAM_SCAL'] = npix // 2 - 2
+        hdu.header['LAM_NSGP'] = sign
+        if pole == 'sgp':
+            hdu.scale('int16', bscale=1e-4, bzero=1.0)
+        hdu.writeto(os.path.join(mapdir, 'SFD_dust_4096_{}.fits'.format(pole)))
+
+def reference_ebv(mapdir, ra, dec, scaling=1.0, interpolate=True):
+    """E(B-V) from the maps read into memory, as in the original sfdmap code."""
+    from astropy.io import fits
+    from astropy.coordinates import SkyCoord
+    from astropy import units as u
+
+    c = SkyCoord(ra, dec, unit='degree', frame='icrs')
+    l, b = c.galactic.l.radian, c.galactic.b.radian
+    values = np.zeros(len(l))
+    for pole, these in (('ngp', b >= 0), ('sgp', b < 0)):
+        data, hdr = fits.getdata(os.path.join(mapdir, 'SFD_dust_4096_{}.fits'.format(pole)),
+                                 header=True)
+        data = data * np.float32(scaling)
+        sign = hdr['LAM_NSGP']
+        rr = hdr['LAM_SCAL'] * np.sqrt(1.0 - sign * np.sin(b[these]))
+        x = hdr['CRPIX1'] - 1.0 + rr * np.cos(l[these])
+        y = hdr['CRPIX2'] - 1.0 - sign * rr * np.sin(l[these])
+        if interpolate:
+            x0, y0 = np.floor(x).astype(int), np.floor(y).astype(int)
+            xw, yw = x - x0, y - y0
+            x1, y1 = np.minimum(x0 + 1, data.shape[1] - 1), np.minimum(y0 + 1, data.shape[0] - 1)
+            x0, y0 = np.maximum(x0, 0), np.maximum(y0, 0)
+            values[these] = ((1.0-xw) * (1.0-yw) * data[y0, x0] + xw * (1.0-yw) * data[y0, x1] +
+                             (1.0-xw) * yw * data[y1, x0] + xw * yw * data[y1, x1])
+        else:
+            x = np.clip(np.round(x).astype(int), 0, data.shape[1] - 1)
+            y = np.clip(np.round(y).astype(int), 0, data.shape[0] - 1)
+            values[these] = data[y, x]
+    return values
+
+class TestSFDMap(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mapdir = os.path.join(self.tmpdir, 'maps')
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+        os.makedirs(self.mapdir)
+        write_mock_maps(self.mapdir)
+
+        rand = np.random.RandomState(2)
+        self.ra = rand.uniform(0, 360, 500)
+        self.dec = np.degrees(np.arcsin(rand.uniform(-1, 1, 500)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ebv(self):
+        from legacyhalos.dust import SFDMap
+        for scaling in (1.0, 0.86):
+            sfd = SFDMap(mapdir=self.mapdir, scaling=scaling, cachedir=self.cachedir)
+            for interpolate in (True, False):
+                np.testing.assert_allclose(
+                    sfd.ebv(self.ra, self.dec, interpolate=interpolate),
+                    reference_ebv(self.mapdir, self.ra, self.dec, scaling=scaling,
+                                  interpolate=interpolate), rtol=1e-6)
+        # the scaled south map is converted to the cache
+        self.assertEqual(len([ff for ff in os.listdir(self.cachedir) if ff.endswith('.raw')]), 1)
+
+    def test_chunks(self):
+        """Evaluating the coordinates a few at a time gives identical values."""
+        from legacyhalos.dust import SFDMap
+        sfd = SFDMap(mapdir=self.mapdir, cachedir=self.cachedir)
+        hemi = sfd._hemisphere('north')
+        l, b = np.radians(self.ra), np.abs(np.radians(self.dec))
+        np.testing.assert_array_equal(hemi.ebv(l, b, True, chunksize=7), hemi.ebv(l, b, True))
+
+    def test_pickle(self):
+        """Pickling a loaded map does not copy the data."""
+        from legacyhalos.dust import SFDMap
+        sfd = SFDMap(mapdir=self.mapdir, cachedir=self.cachedir).load()
+        state = pickle.dumps(sfd)
+        self.assertLess(len(state), 64**2)
+        np.testing.assert_array_equal(pickle.loads(state).ebv(self.ra, self.dec),
+                                      sfd.ebv(self.ra, self.dec))
+
+if __name__ == '__main__':
+    unittest.main()
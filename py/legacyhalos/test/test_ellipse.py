@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+class RecordingRandomState(np.random.RandomState):
+    """RandomState which keeps a copy of every array drawn with normal."""
+    def __init__(self, seed):
+        super(RecordingRandomState, self).__init__(seed)
+        self.draws = []
+
+    def normal(self, *args, **kwargs):
+        draw = super(RecordingRandomState, self).normal(*args, **kwargs)
+        self.draws.append(np.atleast_2d(draw))
+        return draw
+
+@unittest.skipUnless(_importable('astrometry') and _importable('photutils'),
+                     'legacyhalos.ellipse needs astrometry.net and photutils')
+class TestSBRadius(unittest.TestCase):
+
+    def setUp(self):
+        # surface-brightness profile (minus the threshold) crossing zero
+        rand = np.random.RandomState(1)
+        self.rr = np.linspace(1.2, 2.4, 9) # radius**0.25
+        self.sberr = rand.uniform(0.02, 0.1, len(self.rr))
+        self.sb = 3.0 * (self.rr - 1.9) + rand.normal(0, self.sberr)
+
+    def test_polyfit(self):
+        """sbradius_mc draws the same realizations, in the same order, as the
+        np.polyfit loop and gives the same radii.
+
+        """
+        from legacyhalos.ellipse import sbradius_mc, sbradius_mc_polyfit
+
+        for nmc in (1, 20, 100):
+            loop = RecordingRandomState(5)
+            vect = RecordingRandomState(5)
+            rloop = sbradius_mc_polyfit(self.rr, self.sb, self.sberr, loop, nmc=nmc)
+            rvect = sbradius_mc(self.rr, self.sb, self.sberr, vect, nmc=nmc)
+
+            np.testing.assert_array_equal(np.vstack(vect.draws), np.vstack(loop.draws))
+            self.assertEqual(len(np.vstack(vect.draws)), nmc)
+            # the random state is left where it was, for the later draws
+            self.assertEqual(vect.randint(2**30), loop.randint(2**30))
+
+            self.assertEqual(rvect.shape, rloop.shape)
+            np.testing.assert_allclose(rvect, rloop, rtol=1e-10)
+
+if __name__ == '__main__':
+    unittest.main()
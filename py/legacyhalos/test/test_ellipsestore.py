@@ -0,0 +1,167 @@
+import os, shutil, tempfile, unittest
+from unittest import mock
+import numpy as np
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+def mock_ellipsefit(sbthresh, bands=('g', 'r', 'z'), failed='z', nsma=12, seed=1):
+    """Ellipse-fitting results with the data types of ellipse.ellipsefit_multiband,
+    including a band whose fit failed (see ellipse._unpack_isofit).
+
+    """
+    rand = np.random.RandomState(seed)
+    ellipsefit = {'bands': list(bands), 'refband': 'r', 'refpixscale': 0.262,
+                  'success': True, 'fitgeometry': False, 'input_ellipse': False,
+                  'largeshift': np.bool_(False), 'ra_x0': 150.123456789, 'dec_y0': 2.3456789,
+                  'x0': 100.25, 'y0': 99.75, 'eps': 0.3, 'pa': 45.0, 'theta': 135.0,
+                  'majoraxis': 40.5, 'maxsma': np.float32(95.0), 'integrmode': 'median',
+                  'sclip': np.int16(3), 'nclip': np.int16(2),
+                  'refband_width': 201, 'refband_height': 201}
+    for band in bands:
+        nn = 1 if band == failed else nsma
+        ellipsefit['psfsize_{}'.format(band)] = np.float32(1.2)
+        ellipsefit['psfdepth_{}'.format(band)] = np.float32(24.5)
+        ellipsefit['mw_transmission_{}'.format(band)] = np.float32(0.95)
+        ellipsefit['{}_sma'.format(band)] = (np.arange(nn) * 3 - (band == failed)).astype(np.int16)
+        for key in ('intens', 'intens_err', 'eps', 'eps_err', 'pa', 'pa_err', 'x0', 'x0_err',
+                    'y0', 'y0_err', 'a3', 'a3_err', 'a4', 'a4_err', 'rms', 'pix_stddev'):
+            ellipsefit['{}_{}'.format(band, key)] = rand.normal(size=nn).astype('f4')
+        for key in ('stop_code', 'ndata', 'nflag', 'niter'):
+            ellipsefit['{}_{}'.format(band, key)] = rand.randint(0, 50, nn).astype(np.int16)
+        ellipsefit['{}_sma_stop'.format(band)] = np.float32(3 * nn)
+        for key in ('cog_sma', 'cog_mag', 'cog_magerr'):
+            if band == failed:
+                ellipsefit['{}_{}'.format(band, key)] = np.float32(-1)
+            else:
+                ellipsefit['{}_{}'.format(band, key)] = rand.uniform(0, 20, nsma).astype('f4')
+        for key in ('mtot', 'm0', 'alpha1', 'alpha2', 'chi2'):
+            ellipsefit['{}_cog_params_{}'.format(band, key)] = np.float32(rand.uniform())
+        for thresh in sbthresh:
+            ellipsefit['{}_mag_sb{:0g}'.format(band, thresh)] = np.float32(18.0)
+            ellipsefit['{}_mag_sb{:0g}_err'.format(band, thresh)] = np.float32(0.01)
+    for thresh in sbthresh:
+        ellipsefit['radius_sb{:0g}'.format(thresh)] = np.float32(20.0)
+        ellipsefit['radius_sb{:0g}_err'.format(thresh)] = np.float32(0.5)
+    return ellipsefit
+
+@unittest.skipUnless(_importable('fitsio') and _importable('astrometry'),
+                     'legacyhalos.io needs fitsio and astrometry.net')
+class TestEllipseStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storedir = os.path.join(self.tmpdir, 'store')
+        self.environ = os.environ.get('LEGACYHALOS_ELLIPSE_STORE')
+        os.environ['LEGACYHALOS_ELLIPSE_STORE'] = self.storedir
+
+        # The header records the "git describe" version, which needs a tag.
+        from astropy.io import fits
+        self.header = mock.patch('legacyhalos.io.legacyhalos_header', lambda: fits.Header({'LEGHALOV': 'test'}))
+        self.header.start()
+
+    def tearDown(self):
+        self.header.stop()
+        from legacyhalos import ellipsestore
+        ellipsestore._STORE_INDEX.clear()
+        if self.environ is None:
+            del os.environ['LEGACYHALOS_ELLIPSE_STORE']
+        else:
+            os.environ['LEGACYHALOS_ELLIPSE_STORE'] = self.environ
+        shutil.rmtree(self.tmpdir)
+
+    def _append(self, storefile, galaxy, name, suffix='largegalaxy', sma=(1.0, 2.0)):
+        import time
+        from legacyhalos.ellipsestore import _append_columns
+        cols = [('STORE_GALAXY', galaxy, ''), ('STORE_ID', '1', ''),
+                ('STORE_SUFFIX', suffix, ''), ('STORE_TIME', time.time(), 's'),
+                ('NAME', name, ''), ('SMA', np.array(sma), 'pixel')]
+        _append_columns(storefile, galaxy, cols)
+
+    def test_index(self):
+        """Rows appended by this process are indexed; those of other processes
+        only once the index is refreshed.
+
+        """
+        from legacyhalos.ellipsestore import (ellipse_store_file, get_store_index,
+                                              read_ellipse_store)
+        from legacyhalos.io import ellipsefit_exists
+
+        storefile = ellipse_store_file(self.storedir)
+        self._append(storefile, 'gal0', 'NGC0001')
+        self.assertEqual(len(get_store_index(self.storedir)), 1)
+
+        self._append(storefile, 'gal1', 'NGC0002', sma=(1.0, 2.0, 3.0))
+        self.assertTrue(ellipsefit_exists('gal1', self.tmpdir, filesuffix='largegalaxy', galaxy_id='1'))
+
+        # Another process writes to its own file.
+        otherfile = os.path.join(self.tmpdir, 'ellipse-otherhost-1.fits')
+        self._append(otherfile, 'gal2', 'NGC0003')
+        shutil.move(otherfile, self.storedir)
+        self.assertFalse(ellipsefit_exists('gal2', self.tmpdir, filesuffix='largegalaxy', galaxy_id='1'))
+        self.assertEqual(len(get_store_index(self.storedir, refresh=True)), 3)
+        self.assertTrue(ellipsefit_exists('gal2', self.tmpdir, filesuffix='largegalaxy', galaxy_id='1'))
+
+        data = read_ellipse_store(self.storedir, galaxy=['gal2', 'gal1'], galaxy_id=['1', '1'],
+                                  filesuffix='largegalaxy')
+        self.assertEqual(list(data['STORE_GALAXY']), ['gal2', 'gal1'])
+        self.assertTrue(np.all(data['SMA'][1] == [1.0, 2.0, 3.0]))
+
+    def test_widen_strings(self):
+        """Longer strings widen the column instead of being truncated."""
+        from legacyhalos.ellipsestore import ellipse_store_file, read_ellipsefit_store
+
+        storefile = ellipse_store_file(self.storedir)
+        self._append(storefile, 'gal0', 'NGC0001')
+        longname = 'X' * 100
+        self._append(storefile, 'gal1', longname)
+
+        for galaxy, name in zip(['gal0', 'gal1'], ['NGC0001', longname]):
+            ellipsefit = read_ellipsefit_store(self.storedir, galaxy, galaxy_id='1',
+                                               filesuffix='largegalaxy')
+            self.assertEqual(ellipsefit['name'], name)
+            self.assertTrue(np.all(ellipsefit['sma'] == [1.0, 2.0]))
+
+    def test_copy(self):
+        from legacyhalos.ellipsestore import ellipse_store_file, read_ellipsefit_store
+        from legacyhalos.io import copy_ellipsefit, ellipsefit_exists
+
+        self._append(ellipse_store_file(self.storedir), 'gal0', 'NGC0001', suffix='sky00')
+        copy_ellipsefit('gal0', self.tmpdir, 'sky00', 'largegalaxy', galaxy_id='1', verbose=False)
+        self.assertTrue(ellipsefit_exists('gal0', self.tmpdir, filesuffix='largegalaxy', galaxy_id='1'))
+        ellipsefit = read_ellipsefit_store(self.storedir, 'gal0', galaxy_id='1',
+                                           filesuffix='largegalaxy')
+        self.assertEqual(ellipsefit['name'], 'NGC0001')
+
+    def test_ellipsefit(self):
+        """write_ellipsefit and read_ellipsefit give the same values, with the
+        same types, through the store as through a per-galaxy file.
+
+        """
+        import astropy.units as u
+        from legacyhalos.ellipse import REF_SBTHRESH
+        from legacyhalos.io import write_ellipsefit, read_ellipsefit
+
+        ellipsefit = mock_ellipsefit(REF_SBTHRESH)
+        galaxyinfo = {'galaxy': ('NGC0001', ''), 'ra': (150.1, u.deg), 'nobj': (3, u.pixel)}
+        args = ('gal0', self.tmpdir)
+        kwargs = dict(filesuffix='largegalaxy', galaxy_id='1')
+
+        write_ellipsefit(*args, dict(ellipsefit), galaxyinfo=galaxyinfo, **kwargs)
+        with mock.patch.dict(os.environ, {'LEGACYHALOS_ELLIPSE_STORE': ''}):
+            write_ellipsefit(*args, dict(ellipsefit), galaxyinfo=galaxyinfo, **kwargs)
+            fromfile = read_ellipsefit(*args, **kwargs)
+        fromstore = read_ellipsefit(*args, **kwargs)
+
+        self.assertEqual(sorted(fromstore.keys()), sorted(fromfile.keys()))
+        for key in fromfile.keys():
+            self.assertIs(type(fromstore[key]), type(fromfile[key]), key)
+            self.assertEqual(np.asarray(fromstore[key]).dtype, np.asarray(fromfile[key]).dtype, key)
+            np.testing.assert_array_equal(fromstore[key], fromfile[key], err_msg=key)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import os, ast, unittest
+import numpy as np
+
+SPHEREGROUP = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'bin',
+                           'virgofilaments', 'virgofilaments-spheregroup')
+
+def _load_function(scriptfile, name):
+    """Compile one function of a script (without running the script itself,
+    which needs its plotting packages and data).
+
+    """
+    import time, pdb
+    from astropy.table import Column
+
+    with open(scriptfile) as F:
+        tree = ast.parse(F.read(), filename=scriptfile)
+    func = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == name]
+    namespace = {'np': np, 'time': time, 'pdb': pdb, 'Column': Column}
+    exec(compile(ast.Module(body=func, type_ignores=[]), scriptfile, 'exec'), namespace)
+    return namespace[name]
+
+def mock_catalog(ngal=300, seed=1):
+    """Clustered galaxies (a few of them larger than 10 arcmin) near the pole and
+    across ra=0, so the groups wrap around on the sphere.
+
+    """
+    rand = np.random.RandomState(seed)
+    nclump = 15
+    ra0 = np.hstack((rand.uniform(-3, 3, nclump - 3), rand.uniform(0, 360, 3))) % 360
+    dec0 = np.hstack((rand.uniform(-2, 2, nclump - 3), rand.uniform(87, 89, 3)))
+    clump = rand.randint(nclump, size=ngal)
+    dec = np.clip(dec0[clump] + rand.normal(0, 0.3, ngal), -90, 90)
+    ra = (ra0[clump] + rand.normal(0, 0.3, ngal) / np.cos(np.radians(dec))) % 360
+    diam = 10**rand.uniform(-1, 0.8, ngal) # [arcmin]
+    diam[rand.choice(ngal, 5, replace=False)] = rand.uniform(12, 40, 5)
+    return ra, dec, diam
+
+def brute_force_groups(ra, dec, diam, mfac=2.0, dmax=10.0/60.0):
+    """Transcription of the linking rules of build_group_catalog (see
+    legacyhalos.groups) comparing every pair of galaxies.
+
+    """
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+
+    ngal = len(ra)
+    coord = SkyCoord(ra*u.deg, dec*u.deg)
+    sep = np.array([coord[ii].separation(coord).deg for ii in range(ngal)])
+    diam = diam / 60.0 # [degrees]
+    sumdiam = diam[:, np.newaxis] + diam[np.newaxis, :]
+
+    def _components(link):
+        groupid = np.arange(ngal)
+        for _ in range(ngal):
+            newid = np.array([groupid[link[ii]].min() for ii in range(ngal)])
+            if np.array_equal(newid, groupid):
+                break
+            groupid = newid
+        return groupid
+
+    link = sep <= dmax
+    fof = _components(link)
+
+    link = (fof[:, np.newaxis] == fof[np.newaxis, :]) * (sep < 0.5 * mfac * sumdiam)
+    big = diam > dmax
+    link |= (big[:, np.newaxis] | big[np.newaxis, :]) * (sep < 0.5 * sumdiam)
+    np.fill_diagonal(link, True)
+    groupid = _components(link)
+    mult = np.bincount(groupid, minlength=ngal)[groupid]
+    return groupid, mult
+
+class TestGroups(unittest.TestCase):
+
+    def test_brute_force(self):
+        from legacyhalos.groups import find_groups
+        ra, dec, diam = mock_catalog()
+        for mfac in (1.0, 2.0):
+            groupid, mult = find_groups(ra, dec, diam, mfac=mfac)
+            bruteid, brutemult = brute_force_groups(ra, dec, diam, mfac=mfac)
+            np.testing.assert_array_equal(groupid, bruteid)
+            np.testing.assert_array_equal(mult, brutemult)
+            self.assertGreater(np.max(mult), 2)
+
+    def test_empty(self):
+        from legacyhalos.groups import find_groups
+        groupid, mult = find_groups(np.array([]), np.array([]), np.array([]))
+        self.assertEqual(len(groupid), 0)
+        self.assertEqual(len(mult), 0)
+
+    @unittest.skipUnless(os.path.isfile(SPHEREGROUP), 'requires bin/virgofilaments/virgofilaments-spheregroup')
+    def test_group_name(self):
+        """build_group_catalog names each group after its primary (largest)
+        member, without truncating the name.
+
+        """
+        from astropy.table import Table
+        build_group_catalog = _load_function(SPHEREGROUP, 'build_group_catalog')
+
+        ra, dec, diam = mock_catalog()
+        # the largest galaxies have the longest names
+        big = np.argsort(diam)[-5:]
+        galaxy = np.array(['NGC{:04d}'.format(ii) if ii in big else 'G{}'.format(ii)
+                           for ii in range(len(ra))])
+        cat = Table({'GALAXY': galaxy, 'RA': ra, 'DEC': dec, 'DIAM': diam})
+        out = build_group_catalog(cat)
+
+        nchar = np.max([len(gg) for gg in galaxy]) + 6
+        self.assertEqual(out['GROUP_NAME'].dtype, np.dtype('<U{}'.format(nchar)))
+        groups = out['GROUP_MULT'] > 1
+        self.assertTrue(np.any(groups) and np.any(~groups))
+        self.assertTrue(np.all(out['GROUP_PRIMARY'][big]) and np.all(groups[big]))
+        for gal in out:
+            if gal['GROUP_MULT'] == 1:
+                self.assertEqual(gal['GROUP_NAME'], gal['GALAXY'])
+            else:
+                member = out['GROUP_ID'] == gal['GROUP_ID']
+                primary = member * out['GROUP_PRIMARY']
+                self.assertEqual(np.sum(primary), 1)
+                self.assertEqual(gal['GROUP_NAME'], '{}_GROUP'.format(out['GALAXY'][primary][0]))
+        for name in galaxy[big]:
+            self.assertIn('{}_GROUP'.format(name), out['GROUP_NAME'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import os, shutil, tempfile, unittest
+from unittest import mock
+import numpy as np
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+COSMO_PARAMS = {'flat': True, 'H0': 70, 'Om0': 0.3, 'Ob0': 0.049, 'sigma8': 0.82, 'ns': 0.95}
+
+@unittest.skipUnless(_importable('colossus'), 'requires colossus')
+class TestMassDefinitionTable(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def _table(self, **kwargs):
+        """Small (fast) table of the M200m-->M200c conversion."""
+        from legacyhalos.halomass import MassDefinitionTable
+        args = {'c': 3.5, 'logmass': (12.0, 15.0, 0.1), 'redshift': (0.0, 1.0, 0.1),
+                'nvalidate': 50, 'cachedir': self.cachedir}
+        args.update(kwargs)
+        return MassDefinitionTable('myCosmo', COSMO_PARAMS, '200m', '200c', **args)
+
+    def _colossus(self, table, mass, redshift):
+        from legacyhalos.halomass import change_mass_definition
+        table.set_cosmology()
+        return change_mass_definition(mass, redshift, table.mdef_in, table.mdef_out, c=table.c)
+
+    def test_colossus(self):
+        """The interpolated masses agree with colossus to within the tolerance."""
+        table = self._table()
+        rand = np.random.RandomState(1)
+        mass = 10**rand.uniform(12.0, 15.0, 300)
+        redshift = rand.uniform(0.0, 1.0, 300)
+        out = table(mass, redshift)
+        self.assertEqual(out.shape, mass.shape)
+        self.assertLessEqual(table.maxerror, table.tol)
+        truth = self._colossus(table, mass, redshift)
+        self.assertLess(np.max(np.abs(np.log10(out / truth))), table.tol)
+
+        # the masses are converted for each element of broadcast arrays
+        out = table(mass[:6].reshape(2, 3), 0.3)
+        np.testing.assert_allclose(out, self._colossus(table, mass[:6], 0.3).reshape(2, 3), rtol=1e-3)
+
+        # a table which is not accurate enough is rejected
+        with self.assertRaises(ValueError):
+            self._table(logmass=(12.0, 15.0, 0.75), redshift=(0.0, 1.0, 0.25), cachedir=False).load()
+
+    def test_cache(self):
+        """The table is saved once and read back by later instances, unless the
+        cached file is for a different table or is unreadable.
+
+        """
+        from legacyhalos.halomass import MassDefinitionTable, get_table, _TABLES
+
+        mass, redshift = np.array([3e12, 2e13, 7e14]), np.array([0.05, 0.4, 0.9])
+        table = self._table()
+        truth = table(mass, redshift)
+        self.assertTrue(os.path.isfile(table.cachefile))
+        self.assertEqual(os.path.dirname(table.cachefile), self.cachedir)
+
+        with mock.patch.object(MassDefinitionTable, '_build', side_effect=AssertionError('rebuilt')):
+            newtable = self._table()
+            self.assertEqual(newtable.cachefile, table.cachefile)
+            np.testing.assert_array_equal(newtable(mass, redshift), truth)
+            self.assertEqual(newtable.maxerror, table.maxerror)
+
+        # tables with different parameters have their own files...
+        other = self._table(c=5.0)
+        self.assertNotEqual(other.cachefile, table.cachefile)
+
+        # ...and a file with a different signature, or which cannot be read, is ignored
+        shutil.copy(table.cachefile, other.cachefile)
+        with mock.patch.object(MassDefinitionTable, '_build', autospec=True,
+                               side_effect=MassDefinitionTable._build) as build:
+            out = other(mass, redshift)
+            self.assertEqual(build.call_count, 1)
+            self.assertFalse(np.allclose(out, truth, rtol=1e-3))
+            with open(table.cachefile, 'w') as F:
+                F.write('not an npz file')
+            np.testing.assert_allclose(self._table()(mass, redshift), truth, rtol=1e-12)
+            self.assertEqual(build.call_count, 2)
+            # without a cache directory the table is neither read nor written
+            nocache = self._table(cachedir=False)
+            self.assertIsNone(nocache.cachefile)
+            np.testing.assert_allclose(nocache(mass, redshift), truth, rtol=1e-12)
+            self.assertEqual(build.call_count, 3)
+        self.assertEqual(sorted(os.listdir(self.cachedir)),
+                         sorted([os.path.basename(table.cachefile), os.path.basename(other.cachefile)]))
+
+        # the table is loaded once per process
+        args = {'logmass': (12.0, 15.0, 0.1), 'redshift': (0.0, 1.0, 0.1), 'cachedir': self.cachedir}
+        with mock.patch.dict(_TABLES, clear=True):
+            table = get_table('myCosmo', COSMO_PARAMS, '200m', '200c', c=3.5, **args)
+            self.assertIs(get_table('myCosmo', COSMO_PARAMS, '200m', '200c', c=3.5, **args), table)
+            self.assertIsNot(get_table('myCosmo', COSMO_PARAMS, '200m', '200c', c=5.0, **args), table)
+
+    def test_out_of_grid(self):
+        """Masses and redshifts outside of the grid are converted with colossus."""
+        from legacyhalos import halomass
+
+        table = self._table().load()
+        mass = np.array([1e11, 3e12, 1e12, 1e15, 5e15, 2e13, 2e13, 2e13])
+        redshift = np.array([0.3, 0.3, 0.0, 1.0, 0.5, 1.5, 0.5, 3.0])
+        outside = np.array([True, False, False, False, True, True, False, True])
+
+        with mock.patch('legacyhalos.halomass.change_mass_definition',
+                        wraps=halomass.change_mass_definition) as convert:
+            out = table(mass, redshift)
+        self.assertEqual(convert.call_count, 1)
+        np.testing.assert_array_equal(convert.call_args[0][0], mass[outside])
+        np.testing.assert_array_equal(convert.call_args[0][1], redshift[outside])
+
+        truth = self._colossus(table, mass, redshift)
+        np.testing.assert_array_equal(out[outside], truth[outside])
+        self.assertLess(np.max(np.abs(np.log10(out / truth))), table.tol)
+
+        # no colossus calls when all the masses are within the grid
+        with mock.patch('legacyhalos.halomass.change_mass_definition',
+                        wraps=halomass.change_mass_definition) as convert:
+            table(mass[~outside], redshift[~outside])
+        self.assertEqual(convert.call_count, 0)
+
+@unittest.skipUnless(_importable('colossus') and _importable('astrometry'),
+                     'requires colossus and astrometry.net')
+class TestLambda2Mhalo(unittest.TestCase):
+
+    def test_engine(self):
+        """The table and colossus engines give the same halo masses."""
+        from legacyhalos.legacyhalos import lambda2mhalo
+        from legacyhalos.halomass import _TABLES
+
+        cachedir = tempfile.mkdtemp()
+        try:
+            rand = np.random.RandomState(2)
+            richness = rand.uniform(20, 150, 50)
+            redshift = rand.uniform(0.1, 0.6, 50)
+            with mock.patch.dict(os.environ, {'LEGACYHALOS_CACHE_DIR': cachedir}), \
+                 mock.patch.dict(_TABLES, clear=True):
+                table = lambda2mhalo(richness, redshift)
+                self.assertEqual(len(os.listdir(cachedir)), 1)
+            colossus = lambda2mhalo(richness, redshift, engine='colossus')
+            np.testing.assert_allclose(table, colossus, rtol=0, atol=1e-4)
+            with self.assertRaises(ValueError):
+                lambda2mhalo(richness, redshift, engine='spline')
+        finally:
+            shutil.rmtree(cachedir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+import numpy as np
+import numpy.ma as ma
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+def mock_galaxy(shape=(151, 141), x0=72.3, y0=74.8, theta=0.6, ba=0.6, seed=1):
+    """Masked image of an exponential disk plus noise, with a masked star."""
+    rand = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    dx, dy = xx - x0, yy - y0
+    xp = dx * np.cos(theta) + dy * np.sin(theta)
+    yp = -dx * np.sin(theta) + dy * np.cos(theta)
+    img = 10 * np.exp(-np.hypot(xp, yp / ba) / 8) + rand.normal(0, 0.05, shape)
+    mask = np.hypot(xx - 110, yy - 40) < 6
+    return ma.masked_array(img.astype('f4'), mask)
+
+@unittest.skipUnless(_importable('astrometry') and _importable('photutils'),
+                     'requires astrometry.net and photutils')
+class TestIsophoteEngine(unittest.TestCase):
+
+    def setUp(self):
+        from legacyhalos.pool import get_pool
+        self.pool = get_pool(2)
+        self.img = mock_galaxy()
+        # photutils' x0, y0 are the column and row; see ellipsefit_multiband
+        self.args = (0.6, 0.4, 72.3, 74.8, 1.0, 'median', 3, 3)
+        self.sma = np.arange(0, 60, 3.0).astype('f4')
+
+    def tearDown(self):
+        from legacyhalos.pool import close_pool
+        close_pool()
+
+    def _assert_same(self, isolist1, isolist2):
+        self.assertEqual(len(isolist1), len(isolist2))
+        for iso1, iso2 in zip(isolist1, isolist2):
+            for attr in ('sma', 'intens', 'int_err', 'pix_stddev', 'rms'):
+                np.testing.assert_array_equal(getattr(iso1, attr), getattr(iso2, attr))
+
+    def test_shared_vs_pickle(self):
+        """The shared-memory engine gives the same isophotes as mapping
+        integrate_isophot_one over sma with the full (pickled) image.
+
+        """
+        from legacyhalos.ellipse import _integrate_isophot_one
+        from legacyhalos.isophote import integrate_isophotes
+
+        pickle = self.pool.map(_integrate_isophot_one, [(self.img, _sma, *self.args)
+                                                        for _sma in self.sma])
+        for nchunk in (None, 1, len(self.sma)):
+            shared = integrate_isophotes(self.pool, self.img, self.sma, *self.args,
+                                         nproc=2, nchunk=nchunk)
+            self._assert_same(shared, pickle)
+
+    def test_multiband(self):
+        """Scheduling several images together gives the same isophotes as
+        integrating each image in turn.
+
+        """
+        from legacyhalos.isophote import integrate_isophotes, integrate_isophotes_multiband
+        imgs = {'g': self.img, 'r': mock_galaxy(seed=2)}
+        multi = integrate_isophotes_multiband(self.pool, imgs, self.sma, *self.args, nproc=2)
+        for key, img in imgs.items():
+            self._assert_same(multi[key], integrate_isophotes(self.pool, img, self.sma,
+                                                              *self.args, nproc=2))
+
+class TestIsophote(unittest.TestCase):
+
+    def test_adaptive_step_linear(self):
+        """On a linear grid the step adapts to the curvature of ln(I) in sma: an
+        exponential profile gets the coarsest step and a bent one a finer step.
+
+        """
+        from legacyhalos.isophote import adaptive_sma_logstep
+        sma = np.array([10.0, 14.0, 18.0])
+        err = np.full(3, 1e-6)
+
+        step = adaptive_sma_logstep(sma, np.exp(-sma / 5), err, 4.0, logsma=False)
+        self.assertAlmostEqual(step, 8.0)
+
+        step = adaptive_sma_logstep(sma, np.exp(-(sma / 5)**2), err, 4.0, logsma=False)
+        self.assertLess(step, 4.0)
+        self.assertAlmostEqual(step, 2.0) # clipped at logstep/maxfactor
+
+        # Faded into the noise.
+        step = adaptive_sma_logstep(sma, np.exp(-sma / 5), np.ones(3), 4.0, logsma=False)
+        self.assertAlmostEqual(step, 8.0)
+
+if __name__ == '__main__':
+    unittest.main()
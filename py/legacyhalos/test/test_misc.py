@@ -0,0 +1,167 @@
+import unittest
+import numpy as np
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+def mock_tractor(nsrc=12, width=80, seed=1):
+    """Tractor catalog with a mix of source types, one of them off the image,
+    and the WCS of a width x width image centered on it.
+
+    """
+    from astrometry.util.fits import fits_table
+    from astrometry.util.util import Tan
+    from tractor.wcs import ConstantFitsWcs
+
+    pixscale = 0.262 / 3600 # [degrees]
+    ra0, dec0 = 150.0, 2.0
+    wcs = ConstantFitsWcs(Tan(ra0, dec0, (width+1)/2, (width+1)/2, -pixscale, 0.0,
+                              0.0, pixscale, float(width), float(width)))
+
+    rand = np.random.RandomState(seed)
+    cat = fits_table()
+    cat.type = np.array(['PSF', 'REX', 'EXP', 'DEV', 'SER', 'EXP'] * (nsrc // 6))
+    cat.ra = ra0 + rand.uniform(-35, 35, nsrc) * pixscale
+    cat.dec = dec0 + rand.uniform(-35, 35, nsrc) * pixscale
+    cat.ra[-1] = ra0 + 200 * pixscale # off the image
+    cat.flux_r = rand.uniform(1, 100, nsrc).astype('f4')
+    cat.shape_r = np.where(cat.type == 'PSF', 0.0, rand.uniform(0.5, 3, nsrc)).astype('f4')
+    cat.shape_e1 = np.where(np.isin(cat.type, ['EXP', 'DEV', 'SER']), rand.uniform(-0.3, 0.3, nsrc), 0.0).astype('f4')
+    cat.shape_e2 = np.where(np.isin(cat.type, ['EXP', 'DEV', 'SER']), rand.uniform(-0.3, 0.3, nsrc), 0.0).astype('f4')
+    cat.sersic = np.select([cat.type == 'DEV', cat.type == 'SER'], [4.0, 2.5], 1.0).astype('f4')
+    return cat, wcs
+
+@unittest.skipUnless(_importable('tractor') and _importable('legacypipe') and _importable('astrometry'),
+                     'requires the Tractor, legacypipe, and astrometry.net')
+class TestSourceModelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cat, self.wcs = mock_tractor()
+
+    def test_subsets(self):
+        """The cached model of any subset of the sources equals srcs2image of
+        the same subset, whether it is built from its own patches or by
+        subtracting the complement from the model of all the sources.
+
+        """
+        from legacyhalos.misc import SourceModelCache, srcs2image
+
+        cache = SourceModelCache(self.cat)
+        nsrc = len(self.cat)
+        subsets = [None, np.arange(nsrc), np.array([0]), np.array([3, 5, 7]),
+                   np.delete(np.arange(nsrc), 2), np.delete(np.arange(nsrc), nsrc-1)]
+        for indx in subsets:
+            model = cache.model(self.wcs, band='r', indx=indx)
+            cat = self.cat if indx is None else self.cat[indx]
+            truth = srcs2image(cat, self.wcs, band='r')
+            self.assertEqual(model.dtype, np.float32)
+            np.testing.assert_allclose(model, truth, rtol=1e-5, atol=1e-6 * np.max(truth))
+
+        empty = cache.model(self.wcs, band='r', indx=np.array([], int))
+        self.assertTrue(np.all(empty == 0))
+
+    def test_render_once(self):
+        """The sources are rendered once per band and WCS."""
+        from legacyhalos.misc import SourceModelCache
+
+        cache = SourceModelCache(self.cat)
+        total, patches = cache.patches(self.wcs, band='r')
+        self.assertIs(cache.patches(self.wcs, band='r')[1], patches)
+        self.assertEqual(len(patches), len(self.cat))
+        self.assertIsNone(patches[-1]) # off the image
+        cache.model(self.wcs, band='r', indx=[1, 2])
+        self.assertEqual(len(cache._cache), 1)
+
+class TestEllipseMask(unittest.TestCase):
+
+    def setUp(self):
+        self.shape = (60, 75)
+        rand = np.random.RandomState(3)
+        nell = 40
+        # centers inside, near the edges of, and well outside the frame
+        xcen = np.hstack((rand.uniform(0, 60, nell), [-3.0, 62.5, -40.0, 200.0, 30.0]))
+        ycen = np.hstack((rand.uniform(0, 75, nell), [30.0, 10.0, -40.0, 30.0, 150.0]))
+        semia = np.hstack((rand.uniform(0.3, 40, nell), [10.0, 8.0, 20.0, 50.0, 10.0]))
+        ba = np.hstack((rand.uniform(0.1, 1, nell), [0.5, 1.0, 0.7, 0.3, 0.9]))
+        phi = np.hstack((rand.uniform(0, 2*np.pi, nell), [0.3, 1.0, 0.0, 2.0, 0.7]))
+        self.ellipses = list(zip(xcen, ycen, semia, semia * ba, phi))
+
+    def test_mask_bbox(self):
+        """ellipse_mask_bbox equals ellipse_mask over the full frame, including
+        for ellipses which straddle the edges or fall outside of it.
+
+        """
+        from legacyhalos.misc import ellipse_mask, ellipse_mask_bbox, ellipse_bbox
+
+        xobj, yobj = np.ogrid[0:self.shape[0], 0:self.shape[1]]
+        noverlap = 0
+        for ellipse in self.ellipses:
+            full = ellipse_mask(*ellipse, xobj, yobj)
+            np.testing.assert_array_equal(ellipse_mask_bbox(*ellipse, self.shape), full)
+            bbox = ellipse_bbox(*ellipse, self.shape)
+            if bbox is None:
+                self.assertFalse(np.any(full))
+            else:
+                noverlap += 1
+                outside = np.ones(self.shape, bool)
+                outside[bbox] = False
+                self.assertFalse(np.any(full[outside]))
+        self.assertLess(noverlap, len(self.ellipses))
+        self.assertIsNone(ellipse_bbox(np.nan, 10.0, 5.0, 5.0, 0.0, self.shape))
+
+    def test_paint(self):
+        """paint_ellipse ORs the ellipses into Boolean and integer masks."""
+        from legacyhalos.misc import ellipse_mask, paint_ellipse
+
+        xobj, yobj = np.ogrid[0:self.shape[0], 0:self.shape[1]]
+        mask = np.zeros(self.shape, bool)
+        bitmask = np.zeros(self.shape, np.int16)
+        truth, bittruth = np.zeros(self.shape, bool), np.zeros(self.shape, np.int16)
+        for ii, ellipse in enumerate(self.ellipses[:8]):
+            bit = np.int16(2**(ii % 3))
+            self.assertIs(paint_ellipse(mask, *ellipse), mask)
+            paint_ellipse(bitmask, *ellipse, value=bit)
+            inside = ellipse_mask(*ellipse, xobj, yobj)
+            truth |= inside
+            bittruth |= np.where(inside, bit, 0).astype(np.int16)
+        np.testing.assert_array_equal(mask, truth)
+        np.testing.assert_array_equal(bitmask, bittruth)
+
+    def test_shrink_factor(self):
+        """ellipse_shrink_factor chooses the same factor (and rejects the same
+        ones) as building the full-frame mask for each factor in turn.
+
+        """
+        from legacyhalos.misc import ellipse_mask, ellipse_shrink_factor
+
+        xobj, yobj = np.ogrid[0:self.shape[0], 0:self.shape[1]]
+        shrinks = np.arange(0.1, 1.05, 0.05)
+        box = np.arange(5) - 2
+        rand = np.random.RandomState(4)
+        for ellipse in self.ellipses:
+            # central pixels near the center of the ellipse, so some factors
+            # are rejected
+            bx = int(np.clip(ellipse[1] + rand.normal(0, 5), 2, self.shape[1]-3))
+            by = int(np.clip(ellipse[0] + rand.normal(0, 5), 2, self.shape[0]-3))
+            xbox = np.array([int(yb+by) for xb in box for yb in box])
+            ybox = np.array([int(xb+bx) for xb in box for yb in box])
+
+            rejected = []
+            for shrink in shrinks[::-1]:
+                maxis, minaxis = shrink * ellipse[2], shrink * ellipse[3]
+                _mask = ellipse_mask(ellipse[0], ellipse[1], maxis, minaxis, ellipse[4], xobj, yobj)
+                if np.any(_mask[xbox, ybox]):
+                    rejected.append(shrink)
+                else:
+                    break
+
+            factor, _rejected = ellipse_shrink_factor(*ellipse, xbox, ybox, shrinks)
+            self.assertEqual(factor, shrink)
+            np.testing.assert_array_equal(_rejected, rejected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import unittest
+from types import SimpleNamespace
+import numpy as np
+import numpy.ma as ma
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+def block_average_loop(img, var, factor, minfrac=0.5):
+    """Average each factor x factor block of a masked image one at a time."""
+    ny, nx = np.array(img.shape) // factor
+    mean, meanvar = np.zeros((ny, nx)), np.zeros((ny, nx))
+    mask = np.zeros((ny, nx), bool)
+    for jj in range(ny):
+        for ii in range(nx):
+            block = img[jj*factor:(jj+1)*factor, ii*factor:(ii+1)*factor]
+            vblock = var[jj*factor:(jj+1)*factor, ii*factor:(ii+1)*factor]
+            good = ~ma.getmaskarray(block)
+            if np.sum(good) < max(minfrac * factor**2, 1):
+                mask[jj, ii] = True
+                continue
+            mean[jj, ii] = np.mean(ma.getdata(block)[good])
+            meanvar[jj, ii] = np.sum(vblock[good]) / np.sum(good)**2
+    return ma.masked_array(mean, mask), meanvar
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):
+        rand = np.random.RandomState(1)
+        self.shape = (67, 90) # not a multiple of the block size
+        data = rand.normal(10.0, 1.0, self.shape)
+        mask = rand.uniform(size=self.shape) < 0.3
+        mask[20:30, 40:52] = True # fully masked blocks
+        self.img = ma.masked_array(data, mask)
+        self.var = rand.uniform(0.5, 2.0, self.shape)
+
+    def test_block_average(self):
+        from legacyhalos.multires import block_average
+        for factor in (2, 3, 4):
+            for minfrac in (0.5, 0.9):
+                out, outvar = block_average(self.img, var=self.var, factor=factor, minfrac=minfrac)
+                mean, meanvar = block_average_loop(self.img, self.var, factor, minfrac=minfrac)
+                self.assertEqual(out.shape, (self.shape[0] // factor, self.shape[1] // factor))
+                np.testing.assert_array_equal(ma.getmaskarray(out), ma.getmaskarray(mean))
+                good = ~ma.getmaskarray(mean)
+                self.assertTrue(np.any(~good))
+                np.testing.assert_allclose(ma.getdata(out)[good], ma.getdata(mean)[good], rtol=1e-12)
+                np.testing.assert_allclose(outvar[good], meanvar[good], rtol=1e-12)
+
+        out, outvar = block_average(self.img, factor=2)
+        self.assertIsNone(outvar)
+
+    def test_variance(self):
+        """The propagated variance of each level matches the scatter of the block
+        means of pure noise, and (without masking) the variance of averaging
+        the original image in 2**level blocks.
+
+        """
+        from legacyhalos.multires import image_pyramid, block_average
+
+        rand = np.random.RandomState(2)
+        sigma = 0.7
+        img = ma.masked_array(rand.normal(0.0, sigma, (512, 512)))
+        var = np.full(img.shape, sigma**2)
+        pyramid = image_pyramid(img, var=var, nlevel=4)
+        self.assertEqual(len(pyramid), 4)
+        for level, (limg, lvar) in enumerate(pyramid):
+            factor = 2**level
+            self.assertEqual(limg.shape, (512 // factor, 512 // factor))
+            np.testing.assert_allclose(lvar, sigma**2 / factor**2, rtol=1e-12)
+            self.assertAlmostEqual(np.std(ma.getdata(limg)) / (sigma / factor), 1.0, delta=0.1)
+            if level > 0:
+                direct, directvar = block_average(img, var=var, factor=factor)
+                np.testing.assert_allclose(ma.getdata(limg), ma.getdata(direct), atol=1e-12)
+                np.testing.assert_allclose(lvar, directvar, rtol=1e-12)
+
+    def test_level(self):
+        from legacyhalos.multires import pyramid_level, pyramid_nlevel
+        sma = np.array([0.0, 10.0, 24.9, 25.0, 49.9, 50.0, 100.0, 199.0, 200.0, 1e4])
+        np.testing.assert_array_equal(pyramid_level(sma, 4, minsma=25.0),
+                                      [0, 0, 0, 0, 0, 1, 2, 2, 3, 3])
+        np.testing.assert_array_equal(pyramid_level(sma, 2, minsma=25.0),
+                                      [0, 0, 0, 0, 0, 1, 1, 1, 1, 1])
+        # pyramid_nlevel has just enough levels for the largest semi-major axis
+        for maxsma in (10.0, 25.0, 50.0, 199.0, 200.0, 1e4):
+            nlevel = pyramid_nlevel(maxsma, minsma=25.0, maxlevel=6)
+            self.assertEqual(pyramid_level(maxsma, 99, minsma=25.0).clip(0, 6), nlevel - 1)
+
+    def test_to_native(self):
+        """The geometry of an isophote measured on a block-averaged level maps
+        back to the same ellipse in native pixels.
+
+        """
+        from legacyhalos.multires import _to_native
+        for integrmode, errfactor in (('median', 1.0), ('mean', 1.0),
+                                      ('bilinear', 2.0), ('nearest_neighbor', 2.0)):
+            factor = 4
+            x0, y0, sma = 101.3, 57.8, 80.0 # [native pixels]
+            geometry = SimpleNamespace(sma=sma / factor, x0=(x0 + 0.5) / factor - 0.5,
+                                       y0=(y0 + 0.5) / factor - 0.5)
+            iso = SimpleNamespace(sample=SimpleNamespace(geometry=geometry), sma=geometry.sma,
+                                  x0=geometry.x0, y0=geometry.y0, x0_err=0.1, y0_err=0.2,
+                                  grad=-0.5, pix_stddev=0.3, int_err=0.01)
+            iso = _to_native(iso, factor, integrmode=integrmode)
+            for value in (iso.sma, iso.sample.geometry.sma):
+                self.assertAlmostEqual(value, sma)
+            for value in (iso.x0, iso.sample.geometry.x0):
+                self.assertAlmostEqual(value, x0)
+            for value in (iso.y0, iso.sample.geometry.y0):
+                self.assertAlmostEqual(value, y0)
+            self.assertAlmostEqual(iso.x0_err, 0.4)
+            self.assertAlmostEqual(iso.y0_err, 0.8)
+            self.assertAlmostEqual(iso.grad, -0.125)
+            self.assertAlmostEqual(iso.pix_stddev, 1.2)
+            self.assertAlmostEqual(iso.int_err, 0.01 * errfactor)
+
+@unittest.skipUnless(_importable('astrometry') and _importable('photutils.isophote'),
+                     'legacyhalos.ellipse needs astrometry.net and photutils')
+class TestMultiresIsophote(unittest.TestCase):
+
+    def test_int_err(self):
+        """The errors of the multi-resolution isophotes match the errors of the
+        full-resolution isophotes of pure noise, in all integration modes.
+
+        """
+        from legacyhalos.ellipse import integrate_isophot_one
+        from legacyhalos.multires import image_pyramid, integrate_isophot_multires, pyramid_level
+
+        rand = np.random.RandomState(3)
+        img = ma.masked_array(rand.normal(0.0, 1.0, (600, 600)))
+        x0 = y0 = 299.5
+        sma = np.array([60.0, 120.0, 220.0])
+        pyramid = image_pyramid(img, nlevel=4)
+        np.testing.assert_array_equal(pyramid_level(sma, 4), [1, 2, 3])
+        for integrmode in ('bilinear', 'nearest_neighbor', 'median', 'mean'):
+            for _sma in sma:
+                native = integrate_isophot_one(img, _sma, 0.3, 0.3, x0, y0, 1.0, integrmode, 3, 0)
+                multi = integrate_isophot_multires(pyramid, _sma, 0.3, 0.3, x0, y0, integrmode, 3, 0)
+                self.assertAlmostEqual(multi.sma, _sma)
+                self.assertAlmostEqual(multi.int_err / native.int_err, 1.0, delta=0.3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import os, shutil, tempfile, unittest
+import numpy as np
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.galaxies = ['galaxy{}'.format(ii) for ii in range(7)]
+        for galaxy in self.galaxies:
+            galaxydir = os.path.join(self.tmpdir, 'data', galaxy)
+            os.makedirs(galaxydir)
+            with open(os.path.join(galaxydir, '{}-custom-tractor.fits'.format(galaxy)), 'w') as F:
+                F.write(galaxy)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _galaxydir(self, ii):
+        return self.galaxies[ii], os.path.join(self.tmpdir, 'data', self.galaxies[ii])
+
+    def test_dynamic_loop(self):
+        """Run the prefetching loop of the drivers on two interleaved "ranks"
+        sharing one LocalCounter queue; each rank must read every galaxy after
+        the first from the staged copy of its own inputs.
+
+        """
+        from legacyhalos.scheduler import DynamicQueue, LocalCounter, dynamic_groups, upcoming
+        from legacyhalos.prefetch import InputPrefetcher
+
+        diam = np.arange(len(self.galaxies))[::-1]
+        queue = dynamic_groups([np.arange(len(self.galaxies))], diam, counter=LocalCounter())[0]
+        queues = [queue, DynamicQueue(queue.indices, queue.counter)]
+
+        done, staged = [], []
+        ranks = []
+        for rank, group in enumerate(queues):
+            prefetcher = InputPrefetcher(scratchdir=os.path.join(self.tmpdir, 'scratch'))
+            ranks.append((rank, group, prefetcher, enumerate(group)))
+        while len(ranks) > 0:
+            for state in list(ranks):
+                rank, group, prefetcher, loop = state
+                try:
+                    count, ii = next(loop)
+                except StopIteration:
+                    prefetcher.close()
+                    ranks.remove(state)
+                    continue
+                galaxy, galaxydir = self._galaxydir(ii)
+                inputdir = prefetcher.inputdir(galaxy, galaxydir)
+                nextii = upcoming(group, count)
+                if nextii is not None:
+                    nextgalaxy, nextgalaxydir = self._galaxydir(nextii)
+                    self.assertTrue(prefetcher.prefetch(nextgalaxy, nextgalaxydir, 'custom'))
+                with open(os.path.join(inputdir, '{}-custom-tractor.fits'.format(galaxy))) as F:
+                    self.assertEqual(F.read(), galaxy)
+                if count > 0:
+                    self.assertNotEqual(inputdir, galaxydir)
+                    staged.append(ii)
+                prefetcher.release(galaxy)
+                done.append(ii)
+
+        self.assertEqual(sorted(done), list(range(len(self.galaxies))))
+        self.assertEqual(len(staged), len(self.galaxies) - 2)
+        self.assertEqual(sum(group.count for group in queues), len(self.galaxies))
+
+    def test_static_loop(self):
+        from legacyhalos.scheduler import upcoming
+        from legacyhalos.prefetch import InputPrefetcher
+
+        group = np.array([3, 0, 5])
+        with InputPrefetcher(scratchdir=os.path.join(self.tmpdir, 'scratch')) as prefetcher:
+            for count, ii in enumerate(group):
+                galaxy, galaxydir = self._galaxydir(ii)
+                inputdir = prefetcher.inputdir(galaxy, galaxydir)
+                self.assertEqual(inputdir == galaxydir, count == 0)
+                nextii = upcoming(group, count)
+                if nextii is not None:
+                    prefetcher.prefetch(*self._galaxydir(nextii), 'custom')
+                prefetcher.release(galaxy)
+
+    @unittest.skipUnless(_importable('fitsio'), 'requires fitsio')
+    def test_compressed(self):
+        """A tile-compressed image is budgeted at (at least) its decompressed size
+        and staged with the same pixels and header.
+
+        """
+        import fitsio
+        from legacyhalos.prefetch import InputPrefetcher, staged_size
+
+        galaxy, galaxydir = self._galaxydir(0)
+        imfile = os.path.join(galaxydir, '{}-custom-image-r.fits.fz'.format(galaxy))
+        rand = np.random.RandomState(1)
+        img = rand.normal(0, 2, (300, 400)).astype('f4')
+        with fitsio.FITS(imfile, 'rw', clobber=True) as F:
+            F.write(None, header={'SURVEY': 'DECaLS'})
+            F.write(img, compress='RICE', header={'BANDPASS': 'r', 'MAGZERO': 22.5})
+
+        nbytes = img.size * 4
+        self.assertLess(os.path.getsize(imfile), nbytes / 2)
+        self.assertGreaterEqual(staged_size(imfile), nbytes)
+        self.assertEqual(staged_size(imfile, decompress=False), os.path.getsize(imfile))
+
+        # The decompressed image does not fit, even though the compressed one would.
+        tractorfile = os.path.join(galaxydir, '{}-custom-tractor.fits'.format(galaxy))
+        maxbytes = os.path.getsize(imfile) + os.path.getsize(tractorfile) + nbytes // 2
+        with InputPrefetcher(scratchdir=os.path.join(self.tmpdir, 'scratch'), maxbytes=maxbytes) as prefetcher:
+            self.assertFalse(prefetcher.prefetch(galaxy, galaxydir, 'custom', bands=['r']))
+
+        with InputPrefetcher(scratchdir=os.path.join(self.tmpdir, 'scratch')) as prefetcher:
+            self.assertTrue(prefetcher.prefetch(galaxy, galaxydir, 'custom', bands=['r']))
+            inputdir = prefetcher.inputdir(galaxy, galaxydir)
+            self.assertNotEqual(inputdir, galaxydir)
+            stagedfile = os.path.join(inputdir, os.path.basename(imfile))
+            self.assertLessEqual(os.path.getsize(stagedfile), staged_size(imfile))
+            self.assertLessEqual(sum(prefetcher._reserved.values()), prefetcher.maxbytes)
+
+            with fitsio.FITS(stagedfile) as F:
+                self.assertFalse(F[1].is_compressed())
+                self.assertEqual(F[0].read_header()['SURVEY'], 'DECaLS')
+                hdr = F[1].read_header()
+                staged = F[1].read()
+            self.assertEqual(hdr['BANDPASS'], 'r')
+            self.assertEqual(hdr['MAGZERO'], 22.5)
+            # identical to decompressing the original (quantized) image
+            np.testing.assert_array_equal(staged, fitsio.read(imfile, ext=1))
+            self.assertEqual(staged.dtype, img.dtype)
+            np.testing.assert_allclose(staged, img, atol=0.5)
+            prefetcher.release(galaxy)
+
+if __name__ == '__main__':
+    unittest.main()
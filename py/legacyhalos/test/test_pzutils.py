@@ -0,0 +1,91 @@
+import unittest
+import numpy as np
+
+def mock_pz(ngal=200, npz=21, seed=1):
+    """Gaussian redshift PDFs tabulated on uniform grids with different centers
+    and widths for every galaxy.
+
+    """
+    rand = np.random.RandomState(seed)
+    zz = rand.uniform(0.1, 0.6, ngal)
+    width = rand.uniform(0.01, 0.05, ngal)
+    pzbins = zz[:, np.newaxis] + width[:, np.newaxis] * np.linspace(-5, 5, npz)
+    pz = np.exp(-0.5 * ((pzbins - zz[:, np.newaxis]) / width[:, np.newaxis])**2)
+    pz /= np.sum(pz, axis=1)[:, np.newaxis] * (pzbins[:, 1] - pzbins[:, 0])[:, np.newaxis]
+    return pz, pzbins
+
+class TestPzBins(unittest.TestCase):
+
+    def setUp(self):
+        self.pz, self.pzbins = mock_pz()
+        # narrow and wide bins, so every galaxy falls in each of the four cases
+        # of _p_in_bin_loop (or outside of the bin) for some of them
+        self.zmin = np.array([0.0, 0.1, 0.2, 0.33, 0.3, 0.45])
+        self.zmax = np.array([0.1, 0.2, 0.3, 0.34, 0.7, 1.0])
+
+    def test_loop(self):
+        from legacyhalos.redmapper.pzutils import p_in_zbins, _p_in_bin_loop
+        p = p_in_zbins(self.pz, self.pzbins, self.zmin, self.zmax)
+        self.assertEqual(p.shape, (len(self.zmin), len(self.pz)))
+        for ii, (zmin, zmax) in enumerate(zip(self.zmin, self.zmax)):
+            ploop = _p_in_bin_loop(self.pz, self.pzbins, zmin, zmax)
+            np.testing.assert_allclose(p[ii], ploop, rtol=1e-12, atol=1e-12)
+
+    def test_engine(self):
+        from legacyhalos.redmapper.pzutils import p_in_zbin
+        p = p_in_zbin(self.pz, self.pzbins, 0.2, 0.3)
+        ploop = p_in_zbin(self.pz, self.pzbins, 0.2, 0.3, engine='loop')
+        np.testing.assert_allclose(p, ploop, rtol=1e-12, atol=1e-12)
+        with self.assertRaises(ValueError):
+            p_in_zbin(self.pz, self.pzbins, 0.2, 0.3, engine='fast')
+
+class TestResample(unittest.TestCase):
+
+    def setUp(self):
+        rand = np.random.RandomState(2)
+        self.ngal, self.nboot = 150, 7
+        self.pz = rand.uniform(0, 1, (3, self.ngal))
+        self.plambda = rand.uniform(0, 1, (4, self.ngal))
+
+    def test_bootstrap_weights(self):
+        """The weights count the draws of bootstrap_resample_simple, also when
+        the samples are drawn a few at a time.
+
+        """
+        from legacyhalos.redmapper.pzutils import bootstrap_weights, bootstrap_resample_simple
+        indx = bootstrap_resample_simple(self.ngal, nboot=self.nboot, seed=1)
+        for chunksize in (2**22, 2 * self.ngal):
+            weights = bootstrap_weights(self.ngal, nboot=self.nboot, seed=1, chunksize=chunksize)
+            self.assertEqual(weights.shape, (self.nboot, self.ngal))
+            for kk in range(self.nboot):
+                np.testing.assert_array_equal(weights[kk].toarray()[0],
+                                              np.bincount(indx[kk], minlength=self.ngal))
+
+    def test_resample_sums(self):
+        """The sums match looping over the bootstrap samples and bins."""
+        from legacyhalos.redmapper.pzutils import (bootstrap_weights, bootstrap_resample_simple,
+                                                   resample_sums)
+        indx = bootstrap_resample_simple(self.ngal, nboot=self.nboot, seed=1)
+        loop = np.zeros((self.nboot, len(self.pz), len(self.plambda)))
+        for kk in range(self.nboot):
+            for ii in range(len(self.pz)):
+                for jj in range(len(self.plambda)):
+                    loop[kk, ii, jj] = np.sum(self.pz[ii, indx[kk]] * self.plambda[jj, indx[kk]])
+
+        weights = bootstrap_weights(self.ngal, nboot=self.nboot, seed=1)
+        for chunksize in (2**22, 50):
+            sums = resample_sums(weights, self.pz, self.plambda, chunksize=chunksize)
+            np.testing.assert_allclose(sums, loop, rtol=1e-12)
+
+    def test_jackknife_sums(self):
+        """Sparse (jackknife) weights sum the galaxies in each region."""
+        from legacyhalos.redmapper.pzutils import jackknife_weights, resample_sums
+        pix = np.arange(self.ngal) % 5 + 10
+        jackpix = np.array([10, 12, 14, 99])
+        sums = resample_sums(jackknife_weights(pix, jackpix), self.pz)
+        for kk, jpix in enumerate(jackpix):
+            np.testing.assert_allclose(sums[kk], np.sum(self.pz[:, pix == jpix], axis=1),
+                                       rtol=1e-12)
+
+if __name__ == '__main__':
+    unittest.main()
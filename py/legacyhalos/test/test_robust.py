@@ -0,0 +1,103 @@
+import unittest
+import numpy as np
+import numpy.ma as ma
+
+def mock_sky(shape=(700, 800), sigma=1.0, seed=1):
+    """Blank sky with a few bright, extended sources, some masked pixels, and some
+    non-finite pixels.
+
+    """
+    rand = np.random.RandomState(seed)
+    img = rand.normal(0.3, sigma, shape)
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    for x0, y0, amp, rr in zip(rand.uniform(0, shape[1], 30), rand.uniform(0, shape[0], 30),
+                               rand.uniform(5, 500, 30), rand.uniform(2, 15, 30)):
+        img += amp * sigma * np.exp(-0.5 * ((xx - x0)**2 + (yy - y0)**2) / rr**2)
+    mask = np.hypot(xx - 100, yy - 200) < 40
+    img[rand.randint(0, shape[0], 50), rand.randint(0, shape[1], 50)] = np.nan
+    return img, mask
+
+class TestClippedStats(unittest.TestCase):
+
+    def setUp(self):
+        self.img, self.mask = mock_sky()
+
+    def _reference(self, data, mask=None):
+        from astropy.stats import sigma_clipped_stats
+        return np.array(sigma_clipped_stats(data, mask=mask, sigma=3.0, maxiters=5))
+
+    def test_astropy(self):
+        from legacyhalos.robust import clipped_stats
+        truth = self._reference(self.img, mask=self.mask)
+        np.testing.assert_array_equal(clipped_stats(self.img, mask=self.mask), truth)
+        # the mask of a masked array is used by default
+        np.testing.assert_array_equal(clipped_stats(ma.masked_array(self.img, self.mask)), truth)
+
+    def test_continuous(self):
+        """The histogram engine agrees with astropy to a small fraction of the bin
+        width, and the subsample engine to within its statistical error.
+
+        """
+        from legacyhalos.robust import clipped_stats
+        for sigma in (1.0, 1e-3, 1e4):
+            img, mask = mock_sky(sigma=sigma, seed=2)
+            img = img.astype('f4')
+            truth = self._reference(img, mask=mask)
+            std = truth[2]
+            self.assertAlmostEqual(std / sigma, 1.0, delta=0.05)
+
+            stats = np.array(clipped_stats(img, mask=mask, engine='histogram'))
+            np.testing.assert_allclose(stats, truth, rtol=0, atol=std / 800)
+            stats = np.array(clipped_stats(ma.masked_array(img, mask), engine='histogram'))
+            np.testing.assert_allclose(stats, truth, rtol=0, atol=std / 800)
+
+            nsample = 2**16
+            stats = np.array(clipped_stats(img, mask=mask, engine='subsample', nsample=nsample))
+            np.testing.assert_allclose(stats, truth, rtol=0, atol=5 * 1.25 * std / np.sqrt(nsample))
+
+    def test_discrete(self):
+        """For integer-valued images the histogram engine gives the same
+        statistics as astropy, including a median which is one of the values
+        (or the mean of two of them).
+
+        """
+        from legacyhalos.robust import clipped_stats
+
+        rand = np.random.RandomState(3)
+        for lam, dtype in ((0.7, 'i2'), (4.0, 'i4'), (30.0, 'f4'), (400.0, 'f8'), (2.5, 'u2')):
+            img = rand.poisson(lam, (600, 500))
+            img[rand.uniform(size=img.shape) < 0.03] += rand.poisson(50 * lam + 20, 1)
+            img = img.astype(dtype)
+            mask = np.zeros(img.shape, bool)
+            mask[:40, :50] = True
+            for _mask in (None, mask):
+                for npix in (img.size, img.size - 1): # even and odd number of pixels
+                    data = img.ravel()[:npix]
+                    _mask1 = None if _mask is None else _mask.ravel()[:npix]
+                    truth = self._reference(data, mask=_mask1)
+                    stats = np.array(clipped_stats(data, mask=_mask1, engine='histogram'))
+                    self.assertEqual(stats[1], truth[1])
+                    np.testing.assert_allclose(stats, truth, rtol=1e-6, atol=1e-6)
+
+        # the median of an even number of values is the mean of the middle two
+        data = np.array([1] * 50 + [2] * 50 + [3] * 7, 'i4')[:100]
+        np.testing.assert_allclose(clipped_stats(data, engine='histogram'),
+                                   self._reference(data), rtol=1e-6)
+        self.assertEqual(clipped_stats(data, engine='histogram')[1], 1.5)
+
+    def test_corner_cases(self):
+        from legacyhalos.robust import clipped_stats
+        with self.assertRaises(ValueError):
+            clipped_stats(self.img, engine='fast')
+
+        # no good pixels
+        for engine in ('histogram', 'subsample'):
+            stats = clipped_stats(self.img, mask=np.ones(self.img.shape, bool), engine=engine)
+            self.assertTrue(np.all(np.isnan(stats)))
+
+        # constant image
+        const = np.full((50, 60), 7.5, 'f4')
+        np.testing.assert_array_equal(clipped_stats(const, engine='histogram'), self._reference(const))
+
+if __name__ == '__main__':
+    unittest.main()
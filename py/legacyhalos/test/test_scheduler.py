@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        from legacyhalos.scheduler import dynamic_groups, LocalCounter
+        self.diam = np.array([1.0, 5.0, 3.0, 4.0, 2.0, 6.0])
+        groups = [np.array([0, 1, 2]), np.array([3, 4, 5])]
+        self.queue = dynamic_groups(groups, self.diam, counter=LocalCounter())[0]
+
+    def test_largest_first(self):
+        self.assertEqual(list(self.queue), [5, 1, 3, 2, 4, 0])
+        self.assertEqual(self.queue.count, 6)
+        self.assertEqual(self.queue.nleft(), 0)
+
+    def test_peek(self):
+        """A claimed galaxy is the next one returned and is not handed to
+        another rank sharing the counter.
+
+        """
+        from legacyhalos.scheduler import DynamicQueue, upcoming
+        other = DynamicQueue(self.queue.indices, self.queue.counter)
+
+        mine, theirs = iter(self.queue), iter(other)
+        self.assertEqual(next(mine), 5)
+        nextii = upcoming(self.queue, 0)
+        self.assertEqual(nextii, 1)
+        self.assertEqual(upcoming(self.queue, 0), nextii)
+        self.assertEqual(next(theirs), 3)
+        self.assertEqual(next(mine), nextii)
+        self.assertEqual(self.queue.count, 2)
+        self.assertEqual(other.count, 1)
+        self.assertEqual(self.queue.nleft(), 3)
+
+    def test_static(self):
+        from legacyhalos.scheduler import upcoming, progress, describe
+        group = np.array([4, 2, 7])
+        self.assertEqual(upcoming(group, 0), 2)
+        self.assertIsNone(upcoming(group, 2))
+        self.assertEqual(progress(group, 1), '2 / 3')
+        self.assertEqual(describe(group), '3')
+
+    def test_empty(self):
+        from legacyhalos.scheduler import dynamic_groups, free
+        groups = dynamic_groups([np.array([], int), np.array([], int)], counter=None)
+        self.assertEqual(len(groups[0]), 0)
+        free(groups)
+
+    def test_run_local(self):
+        from legacyhalos.scheduler import run_local
+        out = run_local(np.arange(6), np.square, weights=self.diam, size=2)
+        self.assertEqual([ii for ii, _, _ in out], [5, 1, 3, 2, 4, 0])
+        self.assertEqual([result for _, _, result in out], [25, 1, 9, 4, 16, 0])
+
+if __name__ == '__main__':
+    unittest.main()
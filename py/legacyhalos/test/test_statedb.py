@@ -0,0 +1,81 @@
+import os, shutil, tempfile, time, unittest
+import numpy as np
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+class TestStateDB(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.galaxy = np.array(['gal0', 'gal1', 'gal2'])
+        self.galaxydir = np.array([os.path.join(self.tmpdir, gal) for gal in self.galaxy])
+        for gdir in self.galaxydir:
+            os.makedirs(gdir)
+        self.environ = os.environ.get('LEGACYHALOS_STATEDB')
+        os.environ['LEGACYHALOS_STATEDB'] = os.path.join(self.tmpdir, 'state.db')
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['LEGACYHALOS_STATEDB']
+        else:
+            os.environ['LEGACYHALOS_STATEDB'] = self.environ
+        shutil.rmtree(self.tmpdir)
+
+    def _missing_files_on_disk(self, filesuffix, clobber=False):
+        """Transcription of io.missing_files_one (which needs the pipeline
+        dependencies) for the sentinel files.
+
+        """
+        todo = []
+        for gal, gdir in zip(self.galaxy, self.galaxydir):
+            checkfile = os.path.join(gdir, '{}{}'.format(gal, filesuffix))
+            failfile = checkfile[:-6]+'isfail'
+            if os.path.exists(checkfile) and not clobber:
+                todo.append('done')
+            elif os.path.exists(failfile) and not clobber:
+                todo.append('fail')
+            else:
+                todo.append('todo')
+        return np.array(todo)
+
+    def _check(self, done):
+        from legacyhalos.statedb import missing_files
+        done('gal0', self.galaxydir[0], 1)
+        done('gal2', self.galaxydir[2], 0)
+
+        filesuffix = '-custom-ellipse.isdone'
+        expected = ['done', 'todo', 'fail']
+        self.assertEqual(list(missing_files(self.galaxy, filesuffix)), expected)
+        self.assertEqual(list(self._missing_files_on_disk(filesuffix)), expected)
+
+        # Reprocessing the failures removes their sentinel files, too.
+        self.assertEqual(list(missing_files(self.galaxy, filesuffix, clobber=True)), ['todo'] * 3)
+        self.assertEqual(list(missing_files(self.galaxy, filesuffix)), ['done', 'todo', 'todo'])
+        self.assertEqual(list(self._missing_files_on_disk(filesuffix)), ['done', 'todo', 'todo'])
+
+    def test_record_state(self):
+        from legacyhalos.statedb import record_state
+        def done(galaxy, galaxydir, err):
+            status = 'fail' if err == 0 else 'done'
+            record_state(galaxy, galaxydir, '-custom-ellipse.is{}'.format(status), tstart=time.time())
+        self._check(done)
+
+    @unittest.skipUnless(_importable('astrometry'), 'legacyhalos.mpi needs astrometry.net')
+    def test_done(self):
+        from legacyhalos.mpi import _done
+        from legacyhalos.io import missing_files_one
+        def done(galaxy, galaxydir, err):
+            _done(galaxy, galaxydir, err, time.time(), 'ellipse', filesuffix='custom')
+        self._check(done)
+
+        for gal, gdir, status in zip(self.galaxy, self.galaxydir, ['done', 'todo', 'todo']):
+            checkfile = os.path.join(gdir, '{}-custom-ellipse.isdone'.format(gal))
+            self.assertEqual(missing_files_one(checkfile, None, False), status)
+
+if __name__ == '__main__':
+    unittest.main()
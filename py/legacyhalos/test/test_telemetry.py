@@ -0,0 +1,38 @@
+import os, shutil, tempfile, unittest
+from unittest import mock
+
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.teldir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.teldir)
+
+    def test_disabled(self):
+        """Without a telemetry directory nothing is measured or recorded."""
+        import legacyhalos.telemetry as T
+        with mock.patch.dict(os.environ, {'LEGACYHALOS_TELEMETRY': ''}), \
+             mock.patch.object(T, '_read_proc') as read_proc:
+            with T.StageTelemetry('NGC0001', 'ellipse') as tel:
+                T.record_metric(nisophote=10)
+                self.assertEqual(len(T._ACTIVE), 0)
+            self.assertIsNone(tel.finish())
+        read_proc.assert_not_called()
+
+    def test_exception(self):
+        """A failed stage is recorded once and does not stay active."""
+        import legacyhalos.telemetry as T
+        with self.assertRaises(RuntimeError):
+            with T.StageTelemetry('NGC0001', 'ellipse', diameter=1.0, teldir=self.teldir) as tel:
+                T.record_metric(nisophote=10)
+                raise RuntimeError
+        self.assertEqual(len(T._ACTIVE), 0)
+        self.assertIsNotNone(tel.finish('done'))
+        tab = T.read_telemetry(self.teldir)
+        self.assertEqual(len(tab), 1)
+        self.assertEqual(tab['status'][0], 'fail')
+        self.assertEqual(tab['nisophote'][0], 10)
+
+if __name__ == '__main__':
+    unittest.main()